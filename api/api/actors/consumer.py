@@ -1,56 +1,242 @@
 from django.conf import settings
-from threading import Thread
+from threading import Thread, Lock
 import logging
 import pika
+import time
 
 logging.getLogger("pika").propagate = False
 logger = logging.getLogger(__name__)
 
+_engine = None
+_engine_lock = Lock()
 
-class Consumer(object):
-    _tell = ['start_consuming', 'stop_consuming']
 
-    def __init__(self, queue, routing_key, parent):
+def get_consumer_engine():
+    """
+    Returns the consumer engine shared by all the consumer actors of this
+    process, creating it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            credentials = pika.PlainCredentials(settings.RABBITMQ_USERNAME,
+                                                settings.RABBITMQ_PASSWORD)
+            parameters = pika.ConnectionParameters(host=settings.RABBITMQ_HOST,
+                                                   port=settings.RABBITMQ_PORT,
+                                                   credentials=credentials)
+            _engine = ConsumerEngine(parameters, settings.RABBITMQ_EXCHANGE,
+                                     prefetch_count=settings.RABBITMQ_PREFETCH_COUNT,
+                                     batch_size=settings.RABBITMQ_BATCH_SIZE,
+                                     batch_interval=settings.RABBITMQ_BATCH_INTERVAL,
+                                     max_reconnect_delay=settings.RABBITMQ_MAX_RECONNECT_DELAY)
+        return _engine
 
-        rmq_user = settings.RABBITMQ_USERNAME
-        rmq_pass = settings.RABBITMQ_PASSWORD
-        rmq_host = settings.RABBITMQ_HOST
-        rmq_port = settings.RABBITMQ_PORT
-        exchange = settings.RABBITMQ_EXCHANGE
 
-        credentials = pika.PlainCredentials(rmq_user, rmq_pass)
-        parameters = pika.ConnectionParameters(host=rmq_host,
-                                               port=rmq_port,
-                                               credentials=credentials)
-        self._channel = pika.BlockingConnection(parameters).channel()
+class Subscription(object):
+    """
+    A queue consumed by the engine. Messages are buffered and delivered to
+    the callback in batches; they are acknowledged once delivered.
+    """
 
-        self.parent = parent
+    def __init__(self, queue, routing_key, callback):
         self.queue = queue
         self.routing_key = routing_key
+        self.callback = callback
+        self.channel = None
+        self.active = False
+        self.pending = list()
+        self.last_tag = None
 
-        self._channel.queue_declare(queue=queue)
+    def add(self, delivery_tag, body):
+        self.pending.append(body)
+        self.last_tag = delivery_tag
 
-        if routing_key:
-            self._channel.queue_bind(exchange=exchange,
-                                     queue=queue,
-                                     routing_key=routing_key)
-            self.consumer = self._channel.basic_consume(self.callback,
-                                                        queue=queue,
-                                                        no_ack=True)
-        else:
+    def flush(self):
+        """
+        Delivers the pending messages and acknowledges them all at once.
+        """
+        if not self.pending:
+            return
+        bodies = self.pending
+        self.pending = list()
+        try:
+            self.callback(bodies)
+        except Exception as e:
+            logger.error('Consumer, Error delivering messages from ' + self.queue + ': ' + str(e))
+        if self.channel and self.channel.is_open:
+            self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+
+    def reset(self):
+        # Unacknowledged messages are redelivered by RabbitMQ after a reconnection
+        self.channel = None
+        self.active = False
+        self.pending = list()
+        self.last_tag = None
+
+
+class ConsumerEngine(object):
+    """
+    Consumes all the queues of this process over a single RabbitMQ
+    connection, driven by an event loop (pika SelectConnection) in one
+    thread. Each queue gets its own channel with a prefetch limit, and the
+    consumed messages are delivered in micro-batches: when ``batch_size``
+    messages are pending or every ``batch_interval`` seconds. If the
+    connection is lost, the engine reconnects with exponential backoff and
+    consumes again from all the subscribed queues.
+    """
+
+    def __init__(self, parameters, exchange, prefetch_count=1000, batch_size=500,
+                 batch_interval=0.1, max_reconnect_delay=30):
+        self.parameters = parameters
+        self.exchange = exchange
+        self.prefetch_count = prefetch_count
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.subscriptions = dict()
+        self.reconnect_delay = 1
+        self._connection = None
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def subscribe(self, queue, routing_key, callback):
+        """
+        Starts consuming from a queue bound to ``routing_key``.
+
+        :param callback: Function called with each batch of message bodies.
+        """
+        subscription = Subscription(queue, routing_key, callback)
+        self.subscriptions[queue] = subscription
+        self._call_threadsafe(lambda: self._open_channel(subscription))
+        self.start()
+
+    def unsubscribe(self, queue):
+        """
+        Stops consuming from a queue. Pending messages are delivered first.
+        """
+        subscription = self.subscriptions.pop(queue, None)
+        if subscription:
+            self._call_threadsafe(lambda: self._close_channel(subscription))
+
+    def _call_threadsafe(self, callback):
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.ioloop.add_callback_threadsafe(callback)
+        # Otherwise, the subscriptions are set up when the connection opens
+
+    def _run(self):
+        while True:
+            self._connection = pika.SelectConnection(self.parameters,
+                                                     on_open_callback=self._on_connection_open,
+                                                     on_open_error_callback=self._on_connection_error,
+                                                     on_close_callback=self._on_connection_closed,
+                                                     stop_ioloop_on_close=False)
+            self._connection.ioloop.start()
+
+            for subscription in self.subscriptions.values():
+                subscription.reset()
+            logger.info('Consumer, Reconnecting to RabbitMQ in ' + str(self.reconnect_delay) + 's')
+            self._connection.ioloop.close()
+            time.sleep(self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
+
+    def _on_connection_open(self, connection):
+        logger.info('Consumer, Connected to RabbitMQ')
+        self.reconnect_delay = 1
+        for subscription in self.subscriptions.values():
+            self._open_channel(subscription)
+        connection.add_timeout(self.batch_interval, self._on_batch_timer)
+
+    def _on_connection_error(self, connection, error):
+        logger.error('Consumer, Error connecting to RabbitMQ: ' + str(error))
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        logger.error('Consumer, Connection to RabbitMQ closed: ' + str(reply_text))
+        connection.ioloop.stop()
+
+    def _on_batch_timer(self):
+        self.flush()
+        if self._connection is not None and self._connection.is_open:
+            self._connection.add_timeout(self.batch_interval, self._on_batch_timer)
+
+    def flush(self):
+        for subscription in self.subscriptions.values():
+            subscription.flush()
+
+    def _open_channel(self, subscription):
+        if subscription.active or subscription.queue not in self.subscriptions:
+            return
+        subscription.active = True
+
+        def on_channel_open(channel):
+            subscription.channel = channel
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+            channel.queue_declare(on_queue_declared, queue=subscription.queue)
+
+        def on_queue_declared(frame):
+            subscription.channel.queue_bind(on_queue_bound, subscription.queue,
+                                            self.exchange, subscription.routing_key)
+
+        def on_queue_bound(frame):
+            subscription.channel.basic_consume(on_message, queue=subscription.queue)
+
+        def on_message(channel, method, properties, body):
+            subscription.add(method.delivery_tag, body)
+            if len(subscription.pending) >= self.batch_size:
+                subscription.flush()
+
+        self._connection.channel(on_open_callback=on_channel_open)
+
+    def _close_channel(self, subscription):
+        subscription.flush()
+        if subscription.channel and subscription.channel.is_open:
+            subscription.channel.close()
+        subscription.reset()
+
+
+class Consumer(object):
+    """
+    Consumer: Consumes the messages published in RabbitMQ with a routing key
+    and delivers them to its parent actor. All the consumers of a process
+    share the connection of the consumer engine. The messages are delivered
+    in batches with ``notify_many`` if the parent provides it, or one by one
+    with ``notify``.
+    """
+    _tell = ['start_consuming', 'stop_consuming']
+
+    def __init__(self, queue, routing_key, parent):
+        self.engine = get_consumer_engine()
+        self.parent = parent
+        self.queue = queue
+        self.routing_key = routing_key
+
+        if not routing_key:
             logger.error("Consumer: You must entry a routing key")
             print "You must entry a routing key"
 
-    def callback(self, ch, method, properties, body):
-        self.parent.notify(body)
+    def deliver(self, bodies):
+        notify_many = getattr(self.parent, 'notify_many', None)
+        if notify_many:
+            notify_many(bodies)
+        else:
+            for body in bodies:
+                self.parent.notify(body)
 
     def start_consuming(self):
-        logger.info('Start to consume from RabbitMQ: '+self.routing_key)
-        self.thread = Thread(target=self._channel.start_consuming)
-        self.thread.start()
+        if self.routing_key:
+            logger.info('Start to consume from RabbitMQ: '+self.routing_key)
+            self.engine.subscribe(self.queue, self.routing_key, self.deliver)
 
     def stop_consuming(self):
-        logger.info('Stopping to consume from RabbitMQ: '+self.routing_key)
+        logger.info('Stopping to consume from RabbitMQ: '+str(self.routing_key))
+        self.engine.unsubscribe(self.queue)
         self.host.stop_actor(self.id)
-        self._channel.stop_consuming()
-        self._channel.close()
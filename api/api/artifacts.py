@@ -0,0 +1,130 @@
+"""
+Content-addressed store of the uploaded files.
+
+Filters, metric modules, controllers and dependencies are uploaded into
+their directories in /opt/crystal, which are synchronized with the nodes.
+Every uploaded file is now stored once, by its SHA-256, in ARTIFACTS_DIR
+(``<ARTIFACTS_DIR>/<first 2 hex digits>/<sha256>``), and the file in the
+directory of its type is a hard link to the blob (a copy if they are in
+different file systems). Uploading the same content again does not store
+it again, and the views compare the digest with the one of the object
+(its ``sha256`` field) to skip the work when the file did not change.
+Since the nodes receive only the files whose digest changed (see
+api.node_sync), an unchanged upload is not sent to them either.
+
+The storlets deployed to the .storlet container of each project are
+recorded in ``storlets:<project id>`` (filter name -> digest of the content
+and the storlet metadata, see deployment_digest()), so deploying a storlet
+that is already in a project with the same content and metadata is only a
+reference update.
+"""
+from django.conf import settings
+import hashlib
+import os
+import shutil
+import tempfile
+
+from api.common import make_sure_path_exists
+
+DEPLOYED_STORLETS_PREFIX = 'storlets:'
+
+
+def blob_path(digest):
+    return os.path.join(settings.ARTIFACTS_DIR, digest[:2], digest)
+
+
+def store(file_):
+    """
+    Stores an uploaded file, unless there already is a blob with its
+    content.
+
+    :param file_: The uploaded file (Django UploadedFile).
+    :return: The SHA-256 of the file.
+    """
+    make_sure_path_exists(settings.ARTIFACTS_DIR)
+    sha256 = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=settings.ARTIFACTS_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            for chunk in file_.chunks():
+                sha256.update(chunk)
+                tmp_file.write(chunk)
+        digest = sha256.hexdigest()
+        path = blob_path(digest)
+        if not os.path.isfile(path):
+            make_sure_path_exists(os.path.dirname(path))
+            os.rename(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    return digest
+
+
+def link(digest, path, filename):
+    """
+    Makes ``path/filename`` the blob of a digest.
+
+    :return: The path of the file.
+    """
+    file_path = os.path.join(path, filename)
+    blob = blob_path(digest)
+    if os.path.isfile(file_path):
+        if os.path.samefile(file_path, blob):
+            return file_path
+        os.remove(file_path)
+    try:
+        os.link(blob, file_path)
+    except OSError:
+        shutil.copyfile(blob, file_path)
+    return file_path
+
+
+def save_file(file_, path):
+    """
+    Stores an uploaded file and links it into a directory, like
+    api.common.save_file.
+
+    :return: The path of the file and its SHA-256.
+    :rtype: tuple
+    """
+    make_sure_path_exists(path)
+    digest = store(file_)
+    return str(link(digest, path, file_.name)), digest
+
+
+def deployment_digest(digest, metadata):
+    """
+    :param digest: The SHA-256 of the storlet, or None if it is unknown.
+    :param metadata: The storlet headers of the object (main class,
+                     language, interface version...).
+    :return: The digest of a storlet deployment, or None.
+    """
+    if digest is None:
+        return None
+    sha256 = hashlib.sha256(digest)
+    for header, value in sorted(metadata.items()):
+        sha256.update('\n' + header + ': ' + value)
+    return sha256.hexdigest()
+
+
+def is_deployed(r, project_id, storlet_name, digest):
+    """
+    :return: True if the project has the storlet with this content.
+    """
+    return digest is not None and r.hget(DEPLOYED_STORLETS_PREFIX + project_id, storlet_name) == digest
+
+
+def set_deployed(r, project_id, storlet_name, digest):
+    if digest is not None:
+        r.hset(DEPLOYED_STORLETS_PREFIX + project_id, storlet_name, digest)
+
+
+def unset_deployed(r, project_id, storlet_name):
+    r.hdel(DEPLOYED_STORLETS_PREFIX + project_id, storlet_name)
+
+
+def unset_project(r, project_id):
+    """
+    Forgets all the storlets deployed to a project.
+    """
+    r.delete(DEPLOYED_STORLETS_PREFIX + project_id)
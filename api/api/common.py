@@ -6,9 +6,12 @@ from django.core.management.color import color_style
 from django.http import HttpResponse
 from rest_framework.renderers import JSONRenderer
 from api.exceptions import FileSynchronizationException
+from api.keystone_cache import get_keystone_cache
+from api import registry
+from api import node_sync
+from api.node_sync import get_node_synchronizer
 from pyactor.context import set_context, create_host
 from swiftclient import client as swift_client
-import threading
 import errno
 import hashlib
 import logging
@@ -23,6 +26,7 @@ NODE_STATUS_THRESHOLD = 15  # seconds
 controller_actors = dict()
 metric_actors = dict()
 rule_actors = dict()
+rule_engine_actors = dict()
 
 
 class LoggingColorsDjango(logging.Formatter):
@@ -86,11 +90,46 @@ def get_redis_connection():
     return redis.Redis(connection_pool=settings.REDIS_CON_POOL)
 
 
+def get_hashes(r, keys, fields=None):
+    """
+    Reads many hashes in a single round trip to redis.
+
+    :param keys: The keys of the hashes.
+    :param fields: If given, only these fields are read (with HMGET); the
+                   fields a hash does not have are left out of it.
+    :return: The hashes, in the order of the keys. A key that does not
+             exist returns an empty dict.
+    :rtype: list of dict
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        if fields:
+            pipe.hmget(key, fields)
+        else:
+            pipe.hgetall(key)
+    results = pipe.execute()
+    if fields:
+        results = [dict((field, value) for field, value in zip(fields, values) if value is not None)
+                   for values in results]
+    return results
+
+
 def get_token_connection(request):
     return request.META['HTTP_X_AUTH_TOKEN'] if 'HTTP_X_AUTH_TOKEN' in request.META else False
 
 
 def get_keystone_admin_auth():
+    """
+    Returns the Keystone admin client, cached for KEYSTONE_CLIENT_TTL
+    seconds.
+    """
+    return get_keystone_cache().client(connect_keystone_admin)
+
+
+def connect_keystone_admin():
     admin_project = settings.MANAGEMENT_ACCOUNT
     admin_user = settings.MANAGEMENT_ADMIN_USERNAME
     admin_passwd = settings.MANAGEMENT_ADMIN_PASSWORD
@@ -139,6 +178,29 @@ def get_admin_role_user_ids(keystone_client):
 
 
 def get_project_list():
+    """
+    Returns the projects as a dict {project_id: project_name}, cached for
+    KEYSTONE_PROJECTS_TTL seconds.
+    """
+    return get_keystone_cache().project_names(list_keystone_projects)
+
+
+def get_project_name(project_id):
+    return get_keystone_cache().project_name(project_id, list_keystone_projects)
+
+
+def get_project_id_by_name(project_name):
+    return get_keystone_cache().project_id(project_name, list_keystone_projects)
+
+
+def invalidate_project_list():
+    """
+    Must be called when a project is created, enabled, disabled or deleted.
+    """
+    get_keystone_cache().invalidate_projects()
+
+
+def list_keystone_projects():
     keystone_client = get_keystone_admin_auth()
     projects = keystone_client.projects.list()
 
@@ -149,28 +211,27 @@ def get_project_list():
     return project_list
 
 
-def rsync_dir_with_nodes(src, dest):
-    # retrieve nodes
+def rsync_dir_with_nodes(src, dest, timeout=None):
+    """
+    Copies the files of the directory ``src`` that changed to the directory
+    ``dest`` of all the registered nodes, and waits for them.
+
+    :param timeout: Seconds to wait for the nodes (NODE_SYNC_TIMEOUT by default).
+    :return: The status of each node (see NodeSynchronizer.sync).
+    :raises FileSynchronizationException: If a node has no SSH credentials,
+                                          or could not be synchronized.
+    """
     nodes = get_all_registered_nodes()
-    already_sync = list()
     for node in nodes:
-        if node['ip'] not in already_sync:
-            already_sync.append(node['ip'])
-            to_json_bools(node, 'ssh_access')
-            if not node['ssh_access']:
-                raise FileSynchronizationException("SSH credentials missing. Please, set the credentials for this "+node['type']+" node: "+node['name'])
-
-            # The basename of the path is not needed because it will be the same as source dir
-            logger.info("Rsync - pushing to "+node['type']+":"+node['name'])
-            data = {'directory': src+'/', 'dest_directory': dest+'/', 'node_ip': node['ip'],
-                    'ssh_username': node['ssh_username'], 'ssh_password': node['ssh_password']}
+        to_json_bools(node, 'ssh_access')
+        if not node['ssh_access']:
+            raise FileSynchronizationException("SSH credentials missing. Please, set the credentials for this "+node['type']+" node: "+node['name'])
 
-            threading.Thread(target=rsync, args=(data,)).start()
-
-
-def rsync(data):
-    rsync_command = 'sshpass -p {ssh_password} rsync --progress -avrz -e ssh {directory} {ssh_username}@{node_ip}:{dest_directory}'.format(**data)
-    os.system(rsync_command)
+    results = get_node_synchronizer().sync(get_redis_connection(), nodes, src, dest, timeout)
+    failed = sorted(name for name, result in results.items() if result['status'] in (node_sync.FAILED, node_sync.TIMEOUT))
+    if failed:
+        raise FileSynchronizationException("Error synchronizing " + src + " with the nodes: " + ", ".join(failed))
+    return results
 
 
 def get_all_registered_nodes():
@@ -179,12 +240,8 @@ def get_all_registered_nodes():
     :return:
     """
     r = get_redis_connection()
-    keys = r.keys("*_node:*")
-    nodes = []
-    for key in keys:
-        node = r.hgetall(key)
-        nodes.append(node)
-    return nodes
+    keys = registry.scan(r, "*_node:*")
+    return [node for node in get_hashes(r, keys) if node]
 
 
 def to_json_bools(dictionary, *args):
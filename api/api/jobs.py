@@ -0,0 +1,405 @@
+"""
+Background jobs of the long-running operations.
+
+Deploying a storage policy (ring rebalance and synchronization with the
+nodes), loading the policies of the cluster, migrating a container,
+creating the Docker image of a project and restarting a node used to run
+inside the HTTP request, or in untracked threads whose result was lost.
+They now run as jobs:
+
+- submit() stores the job in ``job:<id>`` (type, parameters, status,
+  progress), indexes it by its creation time in ``jobs:index`` and pushes
+  its id to the ``jobs:queue`` list; the view returns 202 with the job.
+- A pool of JOBS_WORKERS threads per controller process, started by the
+  first request (see api.middleware) or job it receives, moves the ids from
+  the queue to the ``jobs:processing`` list (BRPOPLPUSH) and runs the
+  handler registered for their type (see job_handler). Handlers report
+  their progress with Job.progress().
+- A job is queued, running, succeeded, failed or cancelled. The changes
+  from queued to running or cancelled are made by Lua scripts, so a job
+  cancelled while a worker takes it is either run or cancelled, never
+  both. A queued job is cancelled at once; a running one when its handler
+  next reports its progress. A finished job, with its result or error, is
+  kept for JOBS_RESULT_TTL seconds.
+- A running job is in the ``jobs:running`` set. The workers of each
+  process refresh the heartbeat of their running jobs every
+  JOBS_HEARTBEAT_INTERVAL seconds. A running job without a heartbeat for
+  three intervals (its process died) is failed, and a job left in
+  ``jobs:processing`` by a process that died before running it is queued
+  again after three intervals.
+
+The jobs are listed and followed in /jobs/ (see api.views).
+"""
+from django.conf import settings
+from django.core.urlresolvers import get_resolver
+from threading import Event, Lock, Thread
+import json
+import logging
+import time
+import uuid
+
+from api.common import get_redis_connection
+from api.listing import InvalidListQuery
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = 'jobs:queue'
+PROCESSING_KEY = 'jobs:processing'
+RUNNING_KEY = 'jobs:running'
+JOB_PREFIX = 'job:'
+INDEX_KEY = 'jobs:index'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# KEYS: job, processing list, running set. ARGV: job id, time
+START_SCRIPT = """
+redis.call('lrem', KEYS[2], 0, ARGV[1])
+if redis.call('hget', KEYS[1], 'status') ~= 'queued' then
+    return 0
+end
+redis.call('hmset', KEYS[1], 'status', 'running', 'started', ARGV[2], 'heartbeat', ARGV[2])
+redis.call('hdel', KEYS[1], 'popped')
+redis.call('sadd', KEYS[3], ARGV[1])
+return 1
+"""
+
+# KEYS: job. ARGV: time, result TTL
+CANCEL_SCRIPT = """
+local status = redis.call('hget', KEYS[1], 'status')
+if status == 'queued' then
+    redis.call('hmset', KEYS[1], 'status', 'cancelled', 'finished', ARGV[1])
+    redis.call('expire', KEYS[1], ARGV[2])
+elseif status == 'running' then
+    redis.call('hset', KEYS[1], 'cancel', 1)
+end
+return status
+"""
+
+# KEYS: job, processing list, queue. ARGV: job id, time, stale time
+REQUEUE_SCRIPT = """
+if redis.call('hget', KEYS[1], 'status') ~= 'queued' then
+    redis.call('lrem', KEYS[2], 0, ARGV[1])
+    return 0
+end
+local popped = redis.call('hget', KEYS[1], 'popped')
+if not popped then
+    redis.call('hset', KEYS[1], 'popped', ARGV[2])
+elseif tonumber(popped) < tonumber(ARGV[3]) then
+    redis.call('lrem', KEYS[2], 0, ARGV[1])
+    redis.call('hdel', KEYS[1], 'popped')
+    redis.call('rpush', KEYS[3], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+_handlers = dict()
+
+# Jobs run by the workers of this process
+_running = set()
+_running_lock = Lock()
+
+_pool = None
+_pool_lock = Lock()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_handler(job_type):
+    """
+    Registers the function that runs the jobs of a type. It is called with
+    the Job and the parameters of the job as keyword arguments, and returns
+    the result of the job (JSON serializable). An exception fails the job.
+    """
+    def register(function):
+        _handlers[job_type] = function
+        return function
+    return register
+
+
+def job_key(job_id):
+    return JOB_PREFIX + job_id
+
+
+def submit(r, job_type, **params):
+    """
+    Queues a job and makes sure the workers of this process are running.
+
+    :return: The state of the job.
+    """
+    if job_type not in _handlers:
+        raise ValueError('Unknown job type: ' + job_type)
+    job_id = uuid.uuid4().hex
+    created = time.time()
+    pipe = r.pipeline()
+    pipe.hmset(job_key(job_id), {'id': job_id, 'type': job_type, 'status': QUEUED, 'progress': 0, 'message': '',
+                                 'params': json.dumps(params), 'created': created})
+    pipe.zadd(INDEX_KEY, job_id, created)
+    pipe.lpush(QUEUE_KEY, job_id)
+    pipe.execute()
+    get_job_pool().start()
+    return get_job(r, job_id)
+
+
+def get_job(r, job_id):
+    """
+    :return: The state of a job, or None.
+    """
+    job = r.hgetall(job_key(job_id))
+    if not job:
+        return None
+    job['progress'] = int(job['progress'])
+    job['params'] = json.loads(job['params'])
+    if 'result' in job:
+        job['result'] = json.loads(job['result'])
+    job['cancel_requested'] = job.pop('cancel', None) is not None
+    return job
+
+
+def get_jobs(r, job_ids):
+    """
+    :return: The state of the jobs, None for the ones that expired.
+    """
+    jobs = [get_job(r, job_id) for job_id in job_ids]
+    expired = [job_id for job_id, job in zip(job_ids, jobs) if job is None]
+    if expired:
+        r.zrem(INDEX_KEY, *expired)
+    return jobs
+
+
+def job_ids(r):
+    """
+    :return: The ids of the jobs, oldest first.
+    """
+    return r.zrange(INDEX_KEY, 0, -1)
+
+
+def job_fetcher(r):
+    """
+    Returns a fetch function for api.listing.get_page() that reads the jobs
+    from the index, oldest first. The position of a job is its creation
+    time.
+    """
+    def fetch(after, count):
+        if after is None:
+            min_created = '-inf'
+        else:
+            try:
+                min_created = '(' + repr(float(after))
+            except ValueError:
+                raise InvalidListQuery('Invalid cursor')
+        if count is None:
+            entries = r.zrangebyscore(INDEX_KEY, min_created, '+inf', withscores=True)
+        else:
+            entries = r.zrangebyscore(INDEX_KEY, min_created, '+inf', start=0, num=count, withscores=True)
+        return zip([repr(created) for _, created in entries], get_jobs(r, [job_id for job_id, _ in entries]))
+    return fetch
+
+
+def cancel(r, job_id):
+    """
+    Cancels a queued job, or asks its handler to stop if it is running.
+
+    :return: The state of the job, or None if it does not exist.
+    """
+    # A worker that pops a cancelled job skips it
+    if r.eval(CANCEL_SCRIPT, 1, job_key(job_id), time.time(), settings.JOBS_RESULT_TTL) is None:
+        return None
+    return get_job(r, job_id)
+
+
+def _finish(r, job_id, job_status, **fields):
+    key = job_key(job_id)
+    fields.update(status=job_status, finished=time.time())
+    pipe = r.pipeline()
+    pipe.hmset(key, fields)
+    pipe.expire(key, settings.JOBS_RESULT_TTL)
+    pipe.srem(RUNNING_KEY, job_id)
+    pipe.execute()
+
+
+class Job(object):
+    """
+    A running job, as seen by its handler.
+    """
+
+    def __init__(self, r, job_id):
+        self.r = r
+        self.id = job_id
+        self.key = job_key(job_id)
+
+    def cancelled(self):
+        return self.r.hexists(self.key, 'cancel')
+
+    def progress(self, progress, message=None):
+        """
+        Updates the progress of the job (0-100).
+
+        :raises JobCancelled: If the job was cancelled; the handler must
+                              stop.
+        """
+        fields = {'progress': int(progress), 'updated': time.time()}
+        if message is not None:
+            fields['message'] = message
+        self.r.hmset(self.key, fields)
+        if self.cancelled():
+            raise JobCancelled('The job was cancelled')
+
+
+def run_job(r, job_id):
+    """
+    Runs a queued job in this thread, and removes it from the processing
+    list.
+
+    :return: The final status of the job, or None if it was not queued.
+    """
+    key = job_key(job_id)
+    if not r.eval(START_SCRIPT, 3, key, PROCESSING_KEY, RUNNING_KEY, job_id, time.time()):
+        return None
+    job = r.hgetall(key)
+
+    with _running_lock:
+        _running.add(job_id)
+    try:
+        result = _handlers[job['type']](Job(r, job_id), **json.loads(job['params']))
+        # A result that cannot be stored fails the job
+        result = json.dumps(result)
+    except JobCancelled:
+        logger.info("Jobs, " + job['type'] + " " + job_id + " cancelled")
+        _finish(r, job_id, CANCELLED)
+        return CANCELLED
+    except Exception as e:
+        logger.exception("Jobs, error running " + job['type'] + " " + job_id)
+        _finish(r, job_id, FAILED, error=str(e) or e.__class__.__name__)
+        return FAILED
+    finally:
+        with _running_lock:
+            _running.discard(job_id)
+    _finish(r, job_id, SUCCEEDED, progress=100, result=result)
+    return SUCCEEDED
+
+
+def run_next(r, timeout=None):
+    """
+    Moves the next job of the queue to the processing list and runs it.
+
+    :param timeout: Seconds to wait for a job; None does not wait.
+    :return: The id of the job, or None if the queue was empty.
+    """
+    if timeout is None:
+        job_id = r.rpoplpush(QUEUE_KEY, PROCESSING_KEY)
+    else:
+        job_id = r.brpoplpush(QUEUE_KEY, PROCESSING_KEY, timeout)
+    if job_id is not None:
+        run_job(r, job_id)
+    return job_id
+
+
+def beat(r):
+    """
+    Refreshes the heartbeat of the jobs run by this process.
+    """
+    with _running_lock:
+        running = list(_running)
+    pipe = r.pipeline()
+    for job_id in running:
+        pipe.hset(job_key(job_id), 'heartbeat', time.time())
+    pipe.execute()
+
+
+def fail_interrupted(r):
+    """
+    Fails the running jobs whose process stopped refreshing their heartbeat,
+    and queues again the jobs taken by a process that died before running
+    them.
+    """
+    now = time.time()
+    stale = now - 3 * settings.JOBS_HEARTBEAT_INTERVAL
+    running = list(r.smembers(RUNNING_KEY))
+    pipe = r.pipeline()
+    for job_id in running:
+        pipe.hmget(job_key(job_id), 'status', 'heartbeat')
+    for job_id, (job_status, heartbeat) in zip(running, pipe.execute()):
+        if job_status != RUNNING:
+            r.srem(RUNNING_KEY, job_id)
+        elif float(heartbeat or 0) < stale:
+            _finish(r, job_id, FAILED, error='Interrupted: the controller process running the job stopped')
+
+    for job_id in r.lrange(PROCESSING_KEY, 0, -1):
+        r.eval(REQUEUE_SCRIPT, 3, job_key(job_id), PROCESSING_KEY, QUEUE_KEY, job_id, now, stale)
+
+
+def get_job_pool():
+    """
+    Returns the job workers of this process, creating them on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = JobWorkerPool()
+        return _pool
+
+
+class JobWorkerPool(object):
+    """
+    Threads that run the queued jobs, JOBS_WORKERS per process.
+    """
+
+    def __init__(self):
+        self._threads = list()
+        self._heartbeat_thread = None
+        self._stopped = Event()
+        self._lock = Lock()
+
+    def _spawn(self, target):
+        thread = Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start(self):
+        with self._lock:
+            self._stopped.clear()
+            if not settings.JOBS_WORKERS:
+                return
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < settings.JOBS_WORKERS:
+                self._threads.append(self._spawn(self._run))
+            if self._heartbeat_thread is None or not self._heartbeat_thread.is_alive():
+                self._heartbeat_thread = self._spawn(self._heartbeat)
+
+    def _run(self):
+        # The job handlers are registered by the views, imported with the URLs
+        get_resolver().url_patterns
+        while not self._stopped.is_set():
+            try:
+                run_next(get_redis_connection(), settings.JOBS_POLL_TIMEOUT)
+            except Exception:
+                logger.exception("Jobs, worker error")
+                self._stopped.wait(settings.JOBS_POLL_TIMEOUT)
+
+    def _heartbeat(self):
+        while not self._stopped.is_set():
+            try:
+                r = get_redis_connection()
+                beat(r)
+                fail_interrupted(r)
+            except Exception:
+                logger.exception("Jobs, heartbeat error")
+            self._stopped.wait(settings.JOBS_HEARTBEAT_INTERVAL)
+
+    def stop(self):
+        """
+        Stops the workers once they finish their current jobs.
+        """
+        with self._lock:
+            self._stopped.set()
+            self._threads = list()
+            self._heartbeat_thread = None
@@ -0,0 +1,120 @@
+"""
+Cache of the Keystone admin client and of the project list.
+
+Creating the admin client authenticates against Keystone, and listing the
+projects is another round trip; both used to happen on every call of
+get_keystone_admin_auth() and get_project_list(), several times per
+request. The cache keeps the client for KEYSTONE_CLIENT_TTL seconds and
+the id <-> name mapping of the projects for KEYSTONE_PROJECTS_TTL seconds.
+The views that change the projects invalidate it.
+"""
+from django.conf import settings
+from threading import Lock
+import time
+
+CLIENT = 'client'
+PROJECTS = 'projects'
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_keystone_cache():
+    """
+    Returns the Keystone cache shared by all the threads of this process,
+    creating it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = KeystoneCache(settings.KEYSTONE_CLIENT_TTL, settings.KEYSTONE_PROJECTS_TTL)
+        return _cache
+
+
+class KeystoneCache(object):
+    """
+    Thread-safe TTL cache. Loads are done holding the lock of the cache, so
+    concurrent misses wait for a single request to Keystone.
+    """
+
+    def __init__(self, client_ttl, projects_ttl, clock=time.time):
+        self.client_ttl = client_ttl
+        self.projects_ttl = projects_ttl
+        self.clock = clock
+        self.hits = {CLIENT: 0, PROJECTS: 0}
+        self.misses = {CLIENT: 0, PROJECTS: 0}
+
+        self._client = None
+        self._client_expiration = 0
+        self._names = dict()
+        self._ids = dict()
+        self._projects_expiration = 0
+        self._lock = Lock()
+
+    def client(self, connect):
+        """
+        Returns the cached admin client, or the one returned by ``connect``
+        if there is none or it expired. A None client is not cached.
+        """
+        with self._lock:
+            if self._client is not None and self.clock() < self._client_expiration:
+                self.hits[CLIENT] += 1
+                return self._client
+
+            self.misses[CLIENT] += 1
+            keystone_client = connect()
+            if keystone_client is not None:
+                self._client = keystone_client
+                self._client_expiration = self.clock() + self.client_ttl
+            return keystone_client
+
+    def _projects(self, load):
+        if self.clock() < self._projects_expiration:
+            self.hits[PROJECTS] += 1
+        else:
+            self.misses[PROJECTS] += 1
+            names = load()
+            self._names = names
+            self._ids = dict((name, project_id) for project_id, name in names.items())
+            self._projects_expiration = self.clock() + self.projects_ttl
+
+    def project_names(self, load):
+        """
+        Returns a copy of the id -> name mapping of the projects.
+
+        :param load: Function that returns the mapping from Keystone.
+        """
+        with self._lock:
+            self._projects(load)
+            return dict(self._names)
+
+    def project_name(self, project_id, load):
+        with self._lock:
+            self._projects(load)
+            return self._names.get(project_id)
+
+    def project_id(self, project_name, load):
+        with self._lock:
+            self._projects(load)
+            return self._ids.get(project_name)
+
+    def invalidate_client(self):
+        with self._lock:
+            self._client = None
+
+    def invalidate_projects(self):
+        with self._lock:
+            self._projects_expiration = 0
+
+    def invalidate(self):
+        self.invalidate_client()
+        self.invalidate_projects()
+
+    def stats(self):
+        """
+        :return: The hits and misses of the client and of the project list,
+                 e.g. {'client': {'hits': 10, 'misses': 1}, 'projects': ...}
+        """
+        with self._lock:
+            return dict((key, {'hits': self.hits[key], 'misses': self.misses[key]})
+                        for key in (CLIENT, PROJECTS))
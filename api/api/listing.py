@@ -0,0 +1,175 @@
+"""
+Pagination, filtering and field selection of the list views.
+
+The list views return the whole collection by default. Their query
+string can narrow the response:
+
+- ``limit``: returns at most ``limit`` items (up to LIST_MAX_LIMIT). If
+  there are more, the ``X-Next-Cursor`` header of the response has the
+  cursor of the next page.
+- ``cursor``: returns the page that follows the one with this cursor.
+- ``fields``: comma-separated fields of the items to return, e.g.
+  ``fields=id,dsl_name``.
+- Any other parameter filters the items by the value of a field, e.g.
+  ``filter_type=storlet`` or ``status=alive``. Values are compared as
+  strings, case-insensitively.
+
+The pages are read from the sorted indexes of the registry (see
+api.registry), in the order of their keys, so a page only reads the
+objects it returns, and objects created or deleted between two requests
+do not shift the following pages. The static policies are the exception:
+they are paged by their position in the execution order (see
+policies.static_policies), so a policy created or deleted before the
+cursor shifts the following pages. Without ``limit`` the views keep the
+order they always had.
+"""
+from django.conf import settings
+import base64
+import binascii
+
+from api import registry
+from api.common import JSONResponse
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+RESERVED_PARAMS = ('limit', 'cursor', 'fields')
+
+
+class InvalidListQuery(ValueError):
+    pass
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(str(position))
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(str(cursor))
+    except (TypeError, binascii.Error, UnicodeEncodeError):
+        raise InvalidListQuery('Invalid cursor')
+
+
+class ListQuery(object):
+    """
+    The pagination, filters and fields of a list request.
+
+    :param params: The query string of the request (request.GET).
+    :raises InvalidListQuery: If limit or cursor are not valid.
+    """
+
+    def __init__(self, params):
+        self.limit = None
+        self.cursor = None
+        self.fields = None
+        self.filters = dict()
+
+        if params.get('limit'):
+            try:
+                self.limit = int(params['limit'])
+            except ValueError:
+                raise InvalidListQuery('Invalid limit')
+            if self.limit < 1:
+                raise InvalidListQuery('Invalid limit')
+            self.limit = min(self.limit, settings.LIST_MAX_LIMIT)
+        if params.get('cursor'):
+            if self.limit is None:
+                self.limit = settings.LIST_MAX_LIMIT
+            self.cursor = decode_cursor(params['cursor'])
+        if params.get('fields'):
+            self.fields = [field.strip() for field in params['fields'].split(',') if field.strip()]
+        for param in params:
+            if param not in RESERVED_PARAMS:
+                self.filters[param] = params[param].lower()
+
+    @property
+    def paginated(self):
+        return self.limit is not None
+
+    def matches(self, item):
+        """
+        :return: True if the item has the values of all the filters.
+        """
+        for field, value in self.filters.items():
+            if field not in item or unicode(item[field]).lower() != value:
+                return False
+        return True
+
+    def project(self, item):
+        """
+        :return: The item with only the selected fields.
+        """
+        if self.fields is None:
+            return item
+        return dict((field, item[field]) for field in self.fields if field in item)
+
+
+def index_fetcher(r, ktype, load):
+    """
+    Returns a fetch function for get_page() that reads the objects of a type
+    from its index.
+
+    :param load: Function that returns the items of a list of keys, in the
+                 same order; an object that no longer exists may be
+                 returned as None or an empty dict.
+    """
+    def fetch(after, count):
+        if count is None:
+            keys = registry.keys(r, ktype)
+        else:
+            keys = registry.page(r, ktype, after, count)
+        return zip(keys, load(keys))
+    return fetch
+
+
+def sorted_fetcher(keys, load):
+    """
+    Like index_fetcher(), for objects without index, from a list of keys.
+    """
+    keys = sorted(keys)
+
+    def fetch(after, count):
+        page_keys = [key for key in keys if after is None or key > after]
+        if count is not None:
+            page_keys = page_keys[:count]
+        return zip(page_keys, load(page_keys))
+    return fetch
+
+
+def get_page(query, fetch, sort_key=None):
+    """
+    Returns the items of a list request.
+
+    :param fetch: Function (after, count) that returns up to ``count``
+                  (position, item) pairs that come after the position
+                  ``after``, in order; with ``count`` None it returns all
+                  of them.
+    :param sort_key: Key to sort the items of an unpaginated request.
+    :return: The items, and the position of the last one if there may be
+             more, or None.
+    """
+    if not query.paginated:
+        items = [item for _, item in fetch(None, None) if item and query.matches(item)]
+        if sort_key is not None:
+            items.sort(key=sort_key)
+        return [query.project(item) for item in items], None
+
+    items = list()
+    after = query.cursor
+    batch_size = query.limit if not query.filters else max(query.limit, settings.LIST_BATCH_SIZE)
+    while True:
+        batch = fetch(after, batch_size)
+        for position, item in batch:
+            after = position
+            if item and query.matches(item):
+                items.append(query.project(item))
+                if len(items) == query.limit:
+                    return items, position
+        if len(batch) < batch_size:
+            return items, None
+
+
+def list_response(query, items, last_position):
+    response = JSONResponse(items, status=200)
+    if last_position is not None:
+        response[NEXT_CURSOR_HEADER] = encode_cursor(last_position)
+    return response
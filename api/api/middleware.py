@@ -1,13 +1,14 @@
+import calendar
 import logging
 from keystoneauth1 import exceptions
 from rest_framework import status
 from django.utils import timezone
 from api.common import JSONResponse, get_keystone_admin_auth
+from api.jobs import get_job_pool
+from api.token_cache import get_token_cache
 
 logger = logging.getLogger(__name__)
 
-valid_tokens = dict()
-
 
 class CrystalMiddleware(object):
     def __init__(self):
@@ -15,6 +16,8 @@ class CrystalMiddleware(object):
 
     @staticmethod
     def process_request(request):
+        # Run the jobs left in the queue by a previous controller process
+        get_job_pool().start()
 
         # Example of the django logging
         # logger.info('Remote address: ' + str(request.META['REMOTE_ADDR']))
@@ -26,30 +29,44 @@ class CrystalMiddleware(object):
         else:
             return JSONResponse('You must be authenticated as admin.', status=status.HTTP_401_UNAUTHORIZED)
 
-        is_admin = False
-        now = timezone.now()
+        token_cache = get_token_cache()
+        is_valid = token_cache.get(token)
+        if is_valid is None:
+            is_valid = CrystalMiddleware.validate_token(token, token_cache)
 
-        if token not in valid_tokens:
-            keystone_client = get_keystone_admin_auth()
+        if is_valid:
+            return None
+
+        return JSONResponse('You must be authenticated as admin.', status=status.HTTP_401_UNAUTHORIZED)
 
-            try:
-                token_data = keystone_client.tokens.validate(token)
-            except exceptions.base.ClientException:
-                return JSONResponse('You must be authenticated as admin.', status=status.HTTP_401_UNAUTHORIZED)
+    @staticmethod
+    def validate_token(token, token_cache):
+        """
+        Validates the token against Keystone and caches the result. Tokens
+        Keystone does not know (404), or not belonging to an admin, are
+        cached as invalid. Any other error is not cached: a failure to reach
+        Keystone, a Keystone 5xx, or a 401/403 (those refer to the admin
+        credentials of the controller, not to the validated token).
+        """
+        keystone_client = get_keystone_admin_auth()
 
-            for role in token_data['roles']:
-                if role['name'] == 'admin':
-                    is_admin = True
+        try:
+            token_data = keystone_client.tokens.validate(token)
+        except exceptions.http.NotFound:
+            token_cache.set_invalid(token)
+            return False
+        except exceptions.base.ClientException as e:
+            logger.error('Middleware, Error validating a token with Keystone: ' + str(e))
+            return False
 
-            if token_data.expires > now and is_admin:
-                valid_tokens[token] = token_data.expires
-                return None
+        is_admin = False
+        for role in token_data['roles']:
+            if role['name'] == 'admin':
+                is_admin = True
 
-        else:
-            token_expiration = valid_tokens[token]
-            if token_expiration > now:
-                return None
-            else:
-                valid_tokens.pop(token, None)
+        if token_data.expires > timezone.now() and is_admin:
+            token_cache.set_valid(token, calendar.timegm(token_data.expires.utctimetuple()))
+            return True
 
-        return JSONResponse('You must be authenticated as admin.', status=status.HTTP_401_UNAUTHORIZED)
+        token_cache.set_invalid(token)
+        return False
@@ -0,0 +1,267 @@
+"""
+Synchronization of controller directories with the Swift nodes.
+
+rsync_dir_with_nodes() used to start one untracked thread per node running
+``sshpass ... rsync``, and returned before any of them finished. The
+synchronizer pushes the files with SFTP from a pool of NODE_SYNC_WORKERS
+threads, waits up to NODE_SYNC_TIMEOUT seconds for the nodes and returns
+the status of each one.
+
+- The SSH connection of each node is kept open and reused by the next
+  pushes (a dead one is opened again).
+- The SHA-256 and the mode of every pushed file are kept in Redis, in
+  ``node_sync:<node ip>:<remote directory>``, so only the files that
+  changed since the last push to the node are copied, and a directory that
+  did not change is not copied at all. Like rsync without --delete, the
+  files removed from the directory are not removed from the nodes.
+- The pushed files get the mode of the local files (SFTP does not keep it).
+- Each file is written to a temporary name in its remote directory and
+  renamed over the target (posix-rename), so a node never runs a partially
+  copied file.
+- The node views forget what was pushed to a node when it is updated or
+  deleted (see invalidate()), so a reinstalled node gets every file again.
+"""
+from django.conf import settings
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import hashlib
+import logging
+import multiprocessing
+import os
+import paramiko
+import posixpath
+import socket
+import stat
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+REDIS_PREFIX = 'node_sync:'
+
+SYNCED = 'synced'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+_synchronizer = None
+_synchronizer_lock = Lock()
+
+
+def get_node_synchronizer():
+    """
+    Returns the node synchronizer shared by all the threads of this process,
+    creating it on first use.
+    """
+    global _synchronizer
+    with _synchronizer_lock:
+        if _synchronizer is None:
+            _synchronizer = NodeSynchronizer(settings.NODE_SYNC_WORKERS, settings.NODE_SYNC_TIMEOUT,
+                                             settings.NODE_SYNC_CONNECT_TIMEOUT)
+        return _synchronizer
+
+
+def file_hashes(directory):
+    """
+    :return: The SHA-256 and the mode of the files of a directory and its
+             subdirectories, e.g. '<sha256>:755', by their path relative to
+             it.
+    :rtype: dict
+    """
+    hashes = dict()
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            path = os.path.join(root, filename)
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha256.update(chunk)
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+            hashes[os.path.relpath(path, directory)] = '%s:%o' % (sha256.hexdigest(), mode)
+    return hashes
+
+
+class SSHConnectionPool(object):
+    """
+    Open SSH connections to the nodes, one per node. A connection is used by
+    one thread at a time.
+    """
+
+    def __init__(self, connect_timeout):
+        self.connect_timeout = connect_timeout
+        self._clients = dict()
+        self._locks = dict()
+        self._lock = Lock()
+
+    def lock(self, node_ip):
+        with self._lock:
+            return self._locks.setdefault(node_ip, Lock())
+
+    def get(self, node_ip, username, password):
+        """
+        Returns the open connection to a node, or a new one. Must be called
+        holding lock(node_ip).
+        """
+        client, credentials = self._clients.get(node_ip, (None, None))
+        if client is not None:
+            transport = client.get_transport()
+            if credentials == (username, password) and transport is not None and transport.is_active():
+                return client
+            client.close()
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(node_ip, username=username, password=password, timeout=self.connect_timeout)
+        self._clients[node_ip] = (client, (username, password))
+        return client
+
+    def discard(self, node_ip):
+        client, _ = self._clients.pop(node_ip, (None, None))
+        if client is not None:
+            client.close()
+
+    def close(self):
+        with self._lock:
+            for client, _ in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+class NodeSynchronizer(object):
+    """
+    Pushes local directories to the nodes in parallel.
+
+    :param max_workers: Maximum number of nodes synchronized at a time.
+    :param timeout: Default seconds to wait for all the nodes.
+    :param connect_timeout: Seconds to wait for an SSH connection.
+    """
+
+    def __init__(self, max_workers, timeout, connect_timeout):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.connections = SSHConnectionPool(connect_timeout)
+        self._pool = None
+        self._lock = Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_workers)
+            return self._pool
+
+    def sync(self, r, nodes, src, dest, timeout=None):
+        """
+        Copies the files of the directory ``src`` that changed to the
+        directory ``dest`` of the nodes.
+
+        :param r: Redis connection.
+        :param nodes: The nodes, with their ip and SSH credentials. Nodes
+                      with the same ip are synchronized once.
+        :param timeout: Seconds to wait for the nodes; the ones that did not
+                        finish are reported as 'timeout'.
+        :return: The status of each node, by name, e.g.
+                 {'storagenode1': {'ip': '10.0.0.2', 'status': 'synced', 'files': 2}}
+        """
+        timeout = self.timeout if timeout is None else timeout
+        hashes = file_hashes(src)
+        pool = self._get_pool()
+
+        pending = list()
+        ips = set()
+        for node in nodes:
+            if node['ip'] not in ips:
+                ips.add(node['ip'])
+                logger.info("Node sync - pushing to " + node['type'] + ":" + node['name'])
+                pending.append((node, pool.apply_async(self._push, (r, node, src, dest, hashes))))
+
+        results = dict()
+        deadline = time.time() + timeout
+        for node, async_result in pending:
+            try:
+                result = async_result.get(max(deadline - time.time(), 0))
+            except multiprocessing.TimeoutError:
+                result = {'status': TIMEOUT}
+            except Exception as e:
+                logger.error("Node sync - error pushing to " + node['name'] + ": " + str(e))
+                result = {'status': FAILED, 'error': str(e)}
+            result['ip'] = node['ip']
+            results[node['name']] = result
+        return results
+
+    def _push(self, r, node, src, dest, hashes):
+        manifest_key = REDIS_PREFIX + node['ip'] + ':' + dest
+        pushed = r.hgetall(manifest_key)
+        changed = sorted(path for path, digest in hashes.items() if pushed.get(path) != digest)
+        if not changed:
+            return {'status': UNCHANGED, 'files': 0}
+
+        with self.connections.lock(node['ip']):
+            try:
+                client = self.connections.get(node['ip'], node['ssh_username'], node['ssh_password'])
+                sftp = client.open_sftp()
+                try:
+                    created = set()
+                    for path in changed:
+                        remote_path = posixpath.join(dest, *path.split(os.sep))
+                        self._make_dirs(sftp, posixpath.dirname(remote_path), created)
+                        self._put(sftp, os.path.join(src, path), remote_path, int(hashes[path].split(':')[1], 8))
+                finally:
+                    sftp.close()
+            except (paramiko.SSHException, socket.error, EnvironmentError):
+                self.connections.discard(node['ip'])
+                raise
+
+        removed = [path for path in pushed if path not in hashes]
+        pipe = r.pipeline()
+        pipe.hmset(manifest_key, dict((path, hashes[path]) for path in changed))
+        if removed:
+            pipe.hdel(manifest_key, *removed)
+        pipe.execute()
+        return {'status': SYNCED, 'files': len(changed)}
+
+    @staticmethod
+    def _put(sftp, local_path, remote_path, mode):
+        """
+        Copies a file to a temporary name in its remote directory and renames
+        it over the remote path, so the node never sees a partial file.
+        """
+        remote_dir, name = posixpath.split(remote_path)
+        tmp_path = posixpath.join(remote_dir, '.' + name + '.' + uuid.uuid4().hex[:8] + '.tmp')
+        try:
+            sftp.put(local_path, tmp_path)
+            sftp.chmod(tmp_path, mode)
+            sftp.posix_rename(tmp_path, remote_path)
+        except Exception:
+            try:
+                sftp.remove(tmp_path)
+            except (paramiko.SSHException, socket.error, EnvironmentError):
+                pass
+            raise
+
+    @staticmethod
+    def _make_dirs(sftp, remote_dir, created):
+        if not remote_dir or remote_dir == '/' or remote_dir in created:
+            return
+        NodeSynchronizer._make_dirs(sftp, posixpath.dirname(remote_dir), created)
+        try:
+            sftp.stat(remote_dir)
+        except IOError:
+            sftp.mkdir(remote_dir)
+        created.add(remote_dir)
+
+    @staticmethod
+    def invalidate(r, node_ip=None):
+        """
+        Forgets the files pushed to a node, or to all of them, so the next
+        synchronization copies every file again.
+        """
+        keys = list(r.scan_iter(match=REDIS_PREFIX + (node_ip + ':*' if node_ip else '*'), count=1000))
+        if keys:
+            r.delete(*keys)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+        self.connections.close()
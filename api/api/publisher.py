@@ -0,0 +1,195 @@
+"""
+Shared RabbitMQ publisher of the controller actors.
+
+Publishing used to open and close a connection per message. The pool
+keeps a few long-lived connections, each one used by a single thread at a
+time, and publishes whole batches of messages over them. When transactions
+are enabled, each batch is published in an AMQP transaction and the broker
+accepts it with a single round trip (tx.commit), instead of one publisher
+confirm wait per message. Idle connections are serviced every ``idle_interval``
+seconds so that they answer the broker heartbeats, and broken connections
+are replaced transparently.
+"""
+from django.conf import settings
+from threading import Event, Lock, Thread
+import logging
+import pika
+import Queue
+
+logging.getLogger("pika").propagate = False
+logger = logging.getLogger(__name__)
+
+_publisher = None
+_publisher_lock = Lock()
+
+
+def get_publisher():
+    """
+    Returns the publisher pool shared by all the actors of this process,
+    creating it on first use.
+    """
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            credentials = pika.PlainCredentials(settings.RABBITMQ_USERNAME,
+                                                settings.RABBITMQ_PASSWORD)
+            parameters = pika.ConnectionParameters(host=settings.RABBITMQ_HOST,
+                                                   port=settings.RABBITMQ_PORT,
+                                                   credentials=credentials)
+            _publisher = PublisherPool(parameters, settings.RABBITMQ_EXCHANGE,
+                                       size=settings.RABBITMQ_PUBLISHER_POOL_SIZE,
+                                       transactional=settings.RABBITMQ_PUBLISHER_TRANSACTIONS,
+                                       idle_interval=settings.RABBITMQ_PUBLISHER_IDLE_INTERVAL)
+        return _publisher
+
+
+class PublisherPool(object):
+    """
+    Thread-safe pool of RabbitMQ publishing channels.
+    """
+
+    def __init__(self, parameters, exchange, size=4, transactional=True, retries=1, idle_interval=10):
+        self.parameters = parameters
+        self.exchange = exchange
+        self.size = size
+        self.transactional = transactional
+        self.retries = retries
+        self.idle_interval = idle_interval
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+        self._service_thread = None
+        self._stopped = Event()
+
+    def _connect(self):
+        connection = pika.BlockingConnection(self.parameters)
+        try:
+            channel = connection.channel()
+            if self.transactional:
+                channel.tx_select()
+        except Exception:
+            try:
+                connection.close()
+            except Exception:
+                pass
+            raise
+        self._start_service()
+        return connection, channel
+
+    def _start_service(self):
+        with self._lock:
+            if self.idle_interval and (self._service_thread is None or not self._service_thread.is_alive()):
+                self._stopped.clear()
+                self._service_thread = Thread(target=self._service)
+                self._service_thread.daemon = True
+                self._service_thread.start()
+
+    def _service(self):
+        while not self._stopped.wait(self.idle_interval):
+            self.service_idle()
+
+    def service_idle(self):
+        """
+        Processes the pending events (heartbeats, broker notifications) of
+        the idle connections, discarding the broken ones.
+        """
+        idle = list()
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except Queue.Empty:
+                break
+        for publisher in idle:
+            try:
+                publisher[0].process_data_events(0)
+            except pika.exceptions.AMQPError as e:
+                logger.error('Publisher, Idle connection to RabbitMQ lost: ' + str(e))
+                self._discard(publisher)
+            else:
+                self._release(publisher)
+
+    def stop(self):
+        """
+        Stops servicing the idle connections.
+        """
+        self._stopped.set()
+
+    def _acquire(self):
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except Queue.Empty:
+                pass
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                # Wait for a channel, but check again if one was discarded
+                return self._idle.get(timeout=1)
+            except Queue.Empty:
+                pass
+
+    def _release(self, publisher):
+        self._idle.put(publisher)
+
+    def _discard(self, publisher):
+        with self._lock:
+            self._created -= 1
+        try:
+            publisher[0].close()
+        except Exception:
+            pass
+
+    def publish(self, routing_key, body):
+        return self.publish_many([(routing_key, body)])
+
+    def publish_many(self, messages):
+        """
+        Publishes a batch of messages over a single pooled channel. If the
+        connection breaks, the unpublished messages (with transactions, the
+        whole uncommitted batch) are retried over a new one.
+
+        :param messages: The messages to publish.
+        :type messages: list of (routing_key, body) tuples
+        :return: The number of messages published (and committed, if
+                 transactions are enabled).
+        :rtype: int
+        """
+        sent = 0
+        published = 0
+        attempts = 0
+        while sent < len(messages):
+            try:
+                publisher = self._acquire()
+            except Exception as e:
+                logger.error('Publisher, Error connecting to RabbitMQ: ' + str(e))
+                break
+            channel = publisher[1]
+            try:
+                if self.transactional:
+                    for routing_key, body in messages[sent:]:
+                        channel.basic_publish(exchange=self.exchange, routing_key=routing_key, body=body)
+                    channel.tx_commit()
+                    published += len(messages) - sent
+                    sent = len(messages)
+                else:
+                    for routing_key, body in messages[sent:]:
+                        channel.basic_publish(exchange=self.exchange, routing_key=routing_key, body=body)
+                        sent += 1
+                        published += 1
+                self._release(publisher)
+            except pika.exceptions.AMQPError as e:
+                logger.error('Publisher, Error publishing to RabbitMQ: ' + str(e))
+                self._discard(publisher)
+                attempts += 1
+                if attempts > self.retries:
+                    break
+        return published
@@ -0,0 +1,131 @@
+"""
+Indexes of the objects stored in Redis.
+
+The list views used to find their objects with KEYS, which walks the whole
+keyspace and blocks Redis (and the actors that use it) while it does. Every
+type of object now has an index, ``index:<type>``, with the keys of its
+objects (e.g. ``index:filter`` = {'filter:compression', ...}). The views add
+the key to the index when they create an object and remove it when they
+delete it, and list the objects from the index.
+
+The indexes are sorted sets with all the scores set to 0, so their keys are
+sorted lexicographically and can be read page by page (ZRANGEBYLEX) after
+the last key of the previous page.
+
+The indexes of an existing database are built, with SCAN, by migrate(),
+which is called when the controller starts and whenever INDEX_VERSION
+changes. The nodes are registered by the Swift nodes themselves, so they
+have no index and are listed with SCAN.
+"""
+INDEX_PREFIX = 'index:'
+VERSION_KEY = 'index:version'
+INDEX_VERSION = '2'  # 1: sets, 2: sorted sets
+
+INDEXED_TYPES = ('filter', 'dependency', 'pipeline', 'policy', 'acl', 'SLO', 'object_type',
+                 'metric', 'workload_metric', 'controller', 'controller_instance', 'project_group',
+                 'storage-policy', 'region', 'zone')
+
+
+def index_key(key_type):
+    return INDEX_PREFIX + key_type
+
+
+def key_type(key):
+    return key.split(':', 1)[0]
+
+
+def _group_by_type(keys):
+    groups = dict()
+    for key in keys:
+        groups.setdefault(key_type(key), list()).append(key)
+    return groups.items()
+
+
+def _zadd(r, index, keys):
+    args = list()
+    for key in keys:
+        args += [key, 0]
+    r.zadd(index, *args)
+
+
+def add(r, *keys):
+    """
+    Adds the keys to the index of their type.
+
+    :param r: Redis connection or pipeline.
+    """
+    for ktype, type_keys in _group_by_type(keys):
+        _zadd(r, index_key(ktype), type_keys)
+
+
+def remove(r, *keys):
+    """
+    Removes the keys from the index of their type.
+
+    :param r: Redis connection or pipeline.
+    """
+    for ktype, type_keys in _group_by_type(keys):
+        r.zrem(index_key(ktype), *type_keys)
+
+
+def remove_if_empty(r, key):
+    """
+    Removes a hash or a list from its index if it no longer exists, e.g.
+    after deleting the last policy of a pipeline.
+    """
+    if not r.exists(key):
+        remove(r, key)
+
+
+def keys(r, ktype):
+    """
+    :return: The keys of the objects of a type, e.g. keys(r, 'filter'),
+             sorted.
+    :rtype: list
+    """
+    return r.zrange(index_key(ktype), 0, -1)
+
+
+def page(r, ktype, after=None, count=100):
+    """
+    Returns up to ``count`` keys of the objects of a type, sorted, that
+    come after the key ``after``.
+    """
+    start = '(' + after if after else '-'
+    return r.zrangebylex(index_key(ktype), start, '+', 0, count)
+
+
+def scan(r, pattern):
+    """
+    Returns the keys that match a pattern without blocking Redis. Only for
+    the keys that have no index, like the nodes.
+    """
+    return list(r.scan_iter(match=pattern, count=1000))
+
+
+def build_indexes(r):
+    """
+    Builds the index of every type from the keys in the database.
+    """
+    for ktype in INDEXED_TYPES:
+        pipe = r.pipeline()
+        pipe.delete(index_key(ktype))
+        type_keys = scan(r, ktype + ':*')
+        if type_keys:
+            _zadd(pipe, index_key(ktype), type_keys)
+        pipe.execute()
+
+
+def migrate(r):
+    """
+    Builds the indexes of a database that has none yet, or whose indexes
+    are from a previous INDEX_VERSION.
+
+    :return: True if the indexes were built.
+    """
+    if r.get(VERSION_KEY) == INDEX_VERSION:
+        return False
+    build_indexes(r)
+    r.delete('index:migrated')
+    r.set(VERSION_KEY, INDEX_VERSION)
+    return True
@@ -22,6 +22,7 @@ NATIVE_FILTERS_DIR = os.path.join('/opt', 'crystal', 'native_filters')
 STORLET_FILTERS_DIR = os.path.join('/opt', 'crystal', 'storlet_filters')
 DEPENDENCY_DIR = os.path.join('/opt', 'crystal', 'dependencies')
 CONTROLLERS_DIR = os.path.join('/opt', 'crystal', 'controllers')
+ARTIFACTS_DIR = os.path.join('/opt', 'crystal', 'artifacts')
 SWIFT_CFG_TMP_DIR = os.path.join('/opt', 'crystal', 'swift', 'tmp')
 SWIFT_CFG_DEPLOY_DIR = os.path.join('/opt', 'crystal', 'swift', 'deploy')
 
@@ -164,6 +165,37 @@ STORLET_DOCKER_IMAGE = 'ubuntu_16.04_jre8_storlets'
 MANAGEMENT_ACCOUNT = 'management'
 MANAGEMENT_ADMIN_USERNAME = 'manager'
 MANAGEMENT_ADMIN_PASSWORD = 'manager'  # noqa
+KEYSTONE_CLIENT_TTL = 3600  # seconds the Keystone admin client is reused
+KEYSTONE_PROJECTS_TTL = 60  # seconds the Keystone project list is cached
+TOKEN_CACHE_SIZE = 10000  # validated tokens kept in memory by each process
+TOKEN_CACHE_NEGATIVE_TTL = 10  # seconds an invalid token is cached
+TOKEN_CACHE_REDIS = False  # share the validated tokens between processes through Redis
+
+# List views
+LIST_MAX_LIMIT = 1000  # maximum page size of the list views
+LIST_BATCH_SIZE = 100  # keys read at a time to fill a filtered page
+
+# Node synchronization
+NODE_SYNC_WORKERS = 16  # nodes synchronized at a time
+NODE_SYNC_TIMEOUT = 60  # seconds to wait for all the nodes
+NODE_SYNC_CONNECT_TIMEOUT = 10  # seconds to wait for the SSH connection to a node
+
+# Storlet deployment
+STORLET_DEPLOY_WORKERS = 16  # projects a storlet is uploaded to at a time
+STORLET_DEPLOY_RETRIES = 3  # retries of a failed upload
+STORLET_DEPLOY_BACKOFF = 0.5  # seconds before the first retry, doubled on each retry
+
+# Container storage policy migration
+MIGRATION_WORKERS = 8  # objects copied at a time
+MIGRATION_PAGE_SIZE = 1000  # objects listed at a time, and between checkpoints
+MIGRATION_CHUNK_SIZE = 65536  # bytes of the objects read at a time
+MIGRATION_LOCK_TTL = 300  # seconds a migration that stopped updating keeps the container locked
+
+# Background jobs
+JOBS_WORKERS = 4  # jobs run at a time by each controller process
+JOBS_POLL_TIMEOUT = 1  # whole seconds a worker waits for a job before checking if it was stopped
+JOBS_RESULT_TTL = 86400  # seconds a finished job and its result are kept
+JOBS_HEARTBEAT_INTERVAL = 10  # seconds between heartbeats of the running jobs
 
 # pyactor
 PYACTOR_TRANSPORT = 'http'
@@ -178,12 +210,23 @@ CONSUMER_MODULE = 'api.actors.consumer/Consumer'
 # Swift Metric Actor
 METRIC_MODULE = 'metrics.actors.swift_metric/SwiftMetric'
 
+# Policy DSL parser: 'descent' (hand-written recursive-descent parser) or
+# 'pyparsing' (grammar built with pyparsing)
+DSL_PARSER_BACKEND = 'descent'
+
 # Rule Actor
 RULE_MODULE = 'policies.actors.rule/Rule'
 
 # Transient Rule Actor
 RULE_TRANSIENT_MODULE = 'policies.actors.rule_transient/TransientRule'
 
+# Rule Engine Actor
+RULE_ENGINE_MODULE = 'policies.actors.rule_engine/RuleEngine'
+# 'actors': one Rule actor per dynamic policy. 'engine': dynamic policies are
+# hosted as table rows in RULE_ENGINE_SHARDS rule engine actors.
+DYNAMIC_POLICY_ENGINE = 'actors'
+RULE_ENGINE_SHARDS = 4
+
 # Global controllers
 GLOBAL_CONTROLLERS_BASE_MODULE = 'controller.dynamic_policies.rules'
 METRICS_BASE_MODULE = 'controller.dynamic_policies.metrics'
@@ -194,7 +237,16 @@ RABBITMQ_PORT = 5672
 RABBITMQ_USERNAME = 'guest'
 RABBITMQ_PASSWORD = 'guest'  # noqa
 RABBITMQ_EXCHANGE = 'amq.topic'
+RABBITMQ_PREFETCH_COUNT = 1000  # unacknowledged messages per consumed queue
+RABBITMQ_BATCH_SIZE = 500  # messages delivered to the consumer parent at once
+RABBITMQ_BATCH_INTERVAL = 0.1  # seconds between deliveries of incomplete batches
+RABBITMQ_MAX_RECONNECT_DELAY = 30  # seconds
+RABBITMQ_PUBLISHER_POOL_SIZE = 4  # connections shared by the controllers to publish
+RABBITMQ_PUBLISHER_TRANSACTIONS = True  # each batch is committed in a transaction
+RABBITMQ_PUBLISHER_IDLE_INTERVAL = 10  # seconds between heartbeat services of the idle connections
 
 # Logstash
 LOGSTASH_HOST = 'localhost'
 LOGSTASH_PORT = 5400
+LOGSTASH_MAX_DATAGRAM = 1472  # bytes of newline-delimited metrics packed in each UDP datagram
+LOGSTASH_QUEUE_SIZE = 65536  # metrics waiting to be sent before new ones are dropped
@@ -1,6 +1,7 @@
 import redis
 import sys
 import settings
+import registry
 
 
 def run():
@@ -14,18 +15,22 @@ def run():
 
     r = redis.Redis(connection_pool=settings.REDIS_CON_POOL)
 
+    # Index sets of a database created by a version without them
+    registry.migrate(r)
+
     # Workload metric definitions
-    for key in r.keys('workload_metric:*'):
+    for key in registry.keys(r, 'workload_metric'):
         r.hset(key, 'status', 'Stopped')
 
     # Workload metric Actors
-    for key in r.keys('metric:*'):
+    for key in registry.keys(r, 'metric'):
         r.delete(key)
+        registry.remove(r, key)
 
     # Dynamic policies
-    for key in r.keys('policy:*'):
+    for key in registry.keys(r, 'policy'):
         r.hset(key, 'status', 'Stopped')
 
     # Controller Instances
-    for key in r.keys('controller_instance:*'):
+    for key in registry.keys(r, 'controller_instance'):
         r.hset(key, 'status', 'Stopped')
@@ -1,30 +1,74 @@
 import calendar
+import hashlib
+import json
 import time
 import mock
 import os
+import pika
 import redis
+import shutil
+import socket
+import tempfile
 from datetime import timedelta
 from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import resolve
 from django.test import TestCase, override_settings
 from django.utils import timezone
+from keystoneauth1 import exceptions
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
-from .common import get_all_registered_nodes, remove_extra_whitespaces, to_json_bools, rsync_dir_with_nodes, get_project_list, get_keystone_admin_auth
+from .common import get_all_registered_nodes, get_hashes, remove_extra_whitespaces, to_json_bools, rsync_dir_with_nodes, get_project_list, get_keystone_admin_auth, \
+    get_project_id_by_name, invalidate_project_list
 from .exceptions import FileSynchronizationException
 from .startup import run as startup_run
 from .middleware import CrystalMiddleware
+from .actors.consumer import Consumer, ConsumerEngine, Subscription
+from .publisher import PublisherPool
+from .keystone_cache import KeystoneCache, get_keystone_cache
+from .token_cache import TokenCache, get_token_cache
+from .node_sync import NodeSynchronizer, get_node_synchronizer
+from . import artifacts, jobs, registry
+from .views import job_list, job_detail
+from .listing import ListQuery, InvalidListQuery, encode_cursor, get_page, index_fetcher
+
+
+@jobs.job_handler('test_echo')
+def echo_job(job, value):
+    job.progress(50, 'Half way')
+    return value
+
+
+@jobs.job_handler('test_fail')
+def fail_job(job):
+    raise ValueError('broken')
+
+
+@jobs.job_handler('test_unserializable')
+def unserializable_job(job):
+    return object()
+
+
+@jobs.job_handler('test_cancel')
+def cancel_job(job):
+    jobs.cancel(job.r, job.id)
+    job.progress(10)
+    return 'not cancelled'
 
 
 # Tests use database=10 instead of 0.
 @override_settings(REDIS_CON_POOL=redis.ConnectionPool(host='localhost', port=6379, db=10),
-                   WORKLOAD_METRICS_DIR=os.path.join("/tmp", "crystal", "workload_metrics"),)
+                   WORKLOAD_METRICS_DIR=os.path.join("/tmp", "crystal", "workload_metrics"),
+                   JOBS_WORKERS=0)
 class MainTestCase(TestCase):
     def setUp(self):
         self.r = redis.Redis(connection_pool=settings.REDIS_CON_POOL)
         self.create_nodes()
         self.factory = APIRequestFactory()
+        get_keystone_cache().invalidate()
+        get_token_cache().clear()
+        get_node_synchronizer().close()
 
     def tearDown(self):
         self.r.flushdb()
@@ -56,11 +100,100 @@ class MainTestCase(TestCase):
         self.assertEqual(bdict['d'], 'False')
         self.assertNotEqual(bdict['d'], False)
 
-    @mock.patch('api.common.threading.Thread')
-    def test_rsync_dir_with_nodes_ok(self, mock_thread):
+    @mock.patch('api.node_sync.paramiko.SSHClient')
+    def test_rsync_dir_with_nodes_ok(self, mock_ssh_client):
+        self.configure_usernames_and_passwords_for_nodes()
+        src = self.create_sync_dir()
+        # The mock does not count the calls of concurrent threads reliably
+        puts = list()
+        mock_ssh_client.return_value.open_sftp.return_value.put.side_effect = lambda *args: puts.append(args)
+        chmods = dict()
+        mock_ssh_client.return_value.open_sftp.return_value.chmod.side_effect = lambda path, mode: chmods.update({path: mode})
+        renames = dict()
+        mock_ssh_client.return_value.open_sftp.return_value.posix_rename.side_effect = lambda old, new: renames.update({old: new})
+        os.chmod(os.path.join(src, 'sub', 'b.py'), 0o755)
+
+        results = rsync_dir_with_nodes(src, '/opt/crystal/workload_metrics')
+        self.assertEqual(sorted(results.keys()), ['controller', 'storagenode1', 'storagenode2'])
+        self.assertEqual(results['storagenode1'], {'ip': '192.168.2.2', 'status': 'synced', 'files': 2})
+        self.assertEqual(len(puts), 6)
+        # The files are copied to a temporary name and renamed over the target
+        tmp_paths = [remote for local, remote in puts if local == os.path.join(src, 'sub', 'b.py')]
+        self.assertEqual(len(tmp_paths), 3)
+        for tmp_path in tmp_paths:
+            self.assertTrue(tmp_path.startswith('/opt/crystal/workload_metrics/sub/.b.py.'))
+            self.assertEqual(renames[tmp_path], '/opt/crystal/workload_metrics/sub/b.py')
+            # The remote files get the mode of the local ones
+            self.assertEqual(chmods[tmp_path], 0o755)
+
+        # Unchanged files are not copied again
+        del puts[:]
+        results = rsync_dir_with_nodes(src, '/opt/crystal/workload_metrics')
+        self.assertEqual(results['controller']['status'], 'unchanged')
+        self.assertEqual(puts, [])
+
+        # Only the changed files are copied, reusing the connections
+        with open(os.path.join(src, 'a.py'), 'w') as f:
+            f.write('a = 2\n')
+        results = rsync_dir_with_nodes(src, '/opt/crystal/workload_metrics')
+        self.assertEqual(results['controller']['files'], 1)
+        self.assertEqual(len(puts), 3)
+        self.assertEqual(len(get_node_synchronizer().connections._clients), 3)
+
+        # A file whose mode changed is copied again
+        del puts[:]
+        os.chmod(os.path.join(src, 'a.py'), 0o700)
+        results = rsync_dir_with_nodes(src, '/opt/crystal/workload_metrics')
+        self.assertEqual(results['controller']['files'], 1)
+        self.assertEqual(len(puts), 3)
+
+    @mock.patch('api.node_sync.paramiko.SSHClient')
+    def test_rsync_dir_with_nodes_when_a_node_fails(self, mock_ssh_client):
         self.configure_usernames_and_passwords_for_nodes()
-        rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR, settings.WORKLOAD_METRICS_DIR)
-        self.assertEqual(mock_thread.call_count, 3)
+        src = self.create_sync_dir()
+        mock_ssh_client.return_value.connect.side_effect = socket.error('Connection refused')
+        with self.assertRaises(FileSynchronizationException):
+            rsync_dir_with_nodes(src, '/opt/crystal/workload_metrics')
+
+        # The failed nodes are synchronized again
+        mock_ssh_client.return_value.connect.side_effect = None
+        results = rsync_dir_with_nodes(src, '/opt/crystal/workload_metrics')
+        self.assertEqual(results['storagenode2']['status'], 'synced')
+
+    @mock.patch('api.node_sync.paramiko.SSHClient')
+    def test_rsync_dir_with_nodes_when_a_copy_fails(self, mock_ssh_client):
+        self.configure_usernames_and_passwords_for_nodes()
+        src = self.create_sync_dir()
+        mock_sftp = mock_ssh_client.return_value.open_sftp.return_value
+        puts = list()
+
+        def put(local_path, remote_path):
+            puts.append(remote_path)
+            raise IOError('No space left on device')
+        mock_sftp.put.side_effect = put
+        removes = list()
+        mock_sftp.remove.side_effect = removes.append
+        with self.assertRaises(FileSynchronizationException):
+            rsync_dir_with_nodes(src, '/opt/crystal/workload_metrics')
+        # The partial copy is removed and the remote file is not replaced
+        self.assertFalse(mock_sftp.posix_rename.called)
+        self.assertEqual(len(puts), 3)
+        self.assertEqual(sorted(removes), sorted(puts))
+
+    @mock.patch('api.node_sync.paramiko.SSHClient')
+    def test_node_synchronizer_timeout(self, mock_ssh_client):
+        self.configure_usernames_and_passwords_for_nodes()
+        src = self.create_sync_dir()
+
+        def connect(*args, **kwargs):
+            time.sleep(0.5)
+            # The pushes still running after the test must not store anything
+            raise socket.error('Connection timed out')
+        mock_ssh_client.return_value.connect.side_effect = connect
+        synchronizer = NodeSynchronizer(2, 60, 10)
+        results = synchronizer.sync(self.r, get_all_registered_nodes(), src, '/opt/crystal/workload_metrics', timeout=0.1)
+        self.assertEqual(set(result['status'] for result in results.values()), set(['timeout']))
+        synchronizer.close()
 
     def test_rsync_dir_with_nodes_when_username_and_password_not_present(self):
         with self.assertRaises(FileSynchronizationException):
@@ -133,6 +266,190 @@ class MainTestCase(TestCase):
         mock_session.assert_called()
         mock_keystone_client.assert_called()
 
+    @mock.patch('api.common.get_keystone_admin_auth')
+    def test_get_project_list_is_cached(self, mock_keystone_admin_auth):
+        fake_tenants_list = [FakeTenantData('1234567890abcdef', 'tenantA')]
+        mock_keystone_admin_auth.return_value.projects.list.return_value = fake_tenants_list
+        project_list = get_project_list()
+        project_list['global'] = 'Global'
+        self.assertEquals(get_project_list(), {'1234567890abcdef': 'tenantA'})
+        self.assertEquals(get_project_id_by_name('tenantA'), '1234567890abcdef')
+        self.assertEquals(mock_keystone_admin_auth.return_value.projects.list.call_count, 1)
+
+        invalidate_project_list()
+        get_project_list()
+        self.assertEquals(mock_keystone_admin_auth.return_value.projects.list.call_count, 2)
+
+    @mock.patch('api.common.client.Client')
+    @mock.patch('api.common.session.Session')
+    @mock.patch('api.common.v3.Password')
+    def test_get_keystone_admin_auth_is_cached(self, mock_password, mock_session, mock_keystone_client):
+        self.assertEqual(get_keystone_admin_auth(), get_keystone_admin_auth())
+        self.assertEqual(mock_keystone_client.call_count, 1)
+
+    def test_keystone_cache_ttl_and_counters(self):
+        now = [1000.0]
+        cache = KeystoneCache(client_ttl=60, projects_ttl=10, clock=lambda: now[0])
+        load = mock.Mock(return_value={'1234567890abcdef': 'tenantA'})
+
+        self.assertEqual(cache.project_name('1234567890abcdef', load), 'tenantA')
+        self.assertEqual(cache.project_id('tenantA', load), '1234567890abcdef')
+        now[0] += 10
+        self.assertIsNone(cache.project_id('tenantB', load))
+        self.assertEqual(load.call_count, 2)
+
+        # Failed connections are not cached
+        connect = mock.Mock(side_effect=[None, 'client'])
+        self.assertIsNone(cache.client(connect))
+        self.assertEqual(cache.client(connect), 'client')
+        self.assertEqual(cache.client(connect), 'client')
+
+        self.assertEqual(cache.stats(), {'client': {'hits': 1, 'misses': 2},
+                                         'projects': {'hits': 1, 'misses': 2}})
+
+    def test_get_hashes(self):
+        keys = ['proxy_node:controller', 'object_node:unknown', 'object_node:storagenode1']
+        nodes = get_hashes(self.r, keys)
+        self.assertEqual(nodes[0]['name'], 'controller')
+        self.assertEqual(nodes[1], {})
+        self.assertEqual(nodes[2]['name'], 'storagenode1')
+
+        nodes = get_hashes(self.r, keys, ['name', 'unknown_field'])
+        self.assertEqual(nodes, [{'name': 'controller'}, {}, {'name': 'storagenode1'}])
+        self.assertEqual(get_hashes(self.r, []), [])
+
+    def test_get_hashes_single_round_trip(self):
+        r = mock.MagicMock()
+        r.pipeline.return_value.execute.return_value = [{'a': '1'}, {'a': '2'}]
+        self.assertEqual(get_hashes(r, ['key:1', 'key:2']), [{'a': '1'}, {'a': '2'}])
+        r.pipeline.return_value.execute.assert_called_once_with()
+        r.hgetall.assert_not_called()
+
+    @override_settings(ARTIFACTS_DIR=os.path.join("/tmp", "crystal", "artifacts"))
+    def test_artifacts_save_file(self):
+        dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        for path in dirs:
+            self.addCleanup(shutil.rmtree, path)
+
+        path1, digest1 = artifacts.save_file(SimpleUploadedFile('m.py', 'a = 1\n'), dirs[0])
+        path2, digest2 = artifacts.save_file(SimpleUploadedFile('m.py', 'a = 1\n'), dirs[1])
+        self.assertEqual(digest1, hashlib.sha256('a = 1\n').hexdigest())
+        self.assertEqual(digest1, digest2)
+        self.assertEqual(path1, os.path.join(dirs[0], 'm.py'))
+        self.assertTrue(os.path.samefile(path1, artifacts.blob_path(digest1)))
+        self.assertTrue(os.path.samefile(path2, artifacts.blob_path(digest1)))
+
+        path1, digest3 = artifacts.save_file(SimpleUploadedFile('m.py', 'a = 2\n'), dirs[0])
+        self.assertNotEqual(digest1, digest3)
+        with open(path1) as f:
+            self.assertEqual(f.read(), 'a = 2\n')
+        with open(path2) as f:
+            self.assertEqual(f.read(), 'a = 1\n')
+
+    def test_artifacts_deployed_storlets(self):
+        self.assertFalse(artifacts.is_deployed(self.r, 'project1', 'test-1.0.jar', 'abc'))
+        artifacts.set_deployed(self.r, 'project1', 'test-1.0.jar', 'abc')
+        self.assertTrue(artifacts.is_deployed(self.r, 'project1', 'test-1.0.jar', 'abc'))
+        self.assertFalse(artifacts.is_deployed(self.r, 'project1', 'test-1.0.jar', 'def'))
+        self.assertFalse(artifacts.is_deployed(self.r, 'project1', 'test-1.0.jar', None))
+        artifacts.unset_deployed(self.r, 'project1', 'test-1.0.jar')
+        self.assertFalse(artifacts.is_deployed(self.r, 'project1', 'test-1.0.jar', 'abc'))
+
+        metadata = {'X-Object-Meta-Storlet-Main': 'com.example.Storlet', 'X-Object-Meta-Storlet-Language': 'java'}
+        digest = artifacts.deployment_digest('abc', metadata)
+        self.assertEqual(digest, artifacts.deployment_digest('abc', dict(metadata)))
+        self.assertNotEqual(digest, artifacts.deployment_digest('abd', metadata))
+        metadata['X-Object-Meta-Storlet-Main'] = 'com.example.Other'
+        self.assertNotEqual(digest, artifacts.deployment_digest('abc', metadata))
+        self.assertIsNone(artifacts.deployment_digest(None, metadata))
+
+    def test_registry_add_and_remove(self):
+        registry.add(self.r, 'filter:compression', 'filter:encryption', 'policy:1')
+        self.assertEqual(sorted(registry.keys(self.r, 'filter')), ['filter:compression', 'filter:encryption'])
+        self.assertEqual(registry.keys(self.r, 'policy'), ['policy:1'])
+
+        registry.remove(self.r, 'filter:compression', 'policy:1')
+        self.assertEqual(registry.keys(self.r, 'filter'), ['filter:encryption'])
+        self.assertEqual(registry.keys(self.r, 'policy'), [])
+
+        self.r.hset('pipeline:0123456789abcdef', '1', '{}')
+        registry.add(self.r, 'pipeline:0123456789abcdef')
+        registry.remove_if_empty(self.r, 'pipeline:0123456789abcdef')
+        self.assertEqual(registry.keys(self.r, 'pipeline'), ['pipeline:0123456789abcdef'])
+        self.r.hdel('pipeline:0123456789abcdef', '1')
+        registry.remove_if_empty(self.r, 'pipeline:0123456789abcdef')
+        self.assertEqual(registry.keys(self.r, 'pipeline'), [])
+
+    def test_registry_migrate_runs_once(self):
+        self.create_startup_fixtures()
+        self.r.incr('policies:id')
+        self.assertTrue(registry.migrate(self.r))
+        self.assertEqual(sorted(registry.keys(self.r, 'policy')), ['policy:1', 'policy:2'])
+        self.assertEqual(sorted(registry.keys(self.r, 'metric')), ['metric:metric1', 'metric:metric2'])
+        self.assertEqual(sorted(registry.keys(self.r, 'workload_metric')), ['workload_metric:1', 'workload_metric:2'])
+        self.assertEqual(registry.keys(self.r, 'controller'), [])
+
+        self.r.hmset('policy:3', {'status': 'Alive'})
+        self.assertFalse(registry.migrate(self.r))
+        self.assertEqual(len(registry.keys(self.r, 'policy')), 2)
+
+    def test_registry_page(self):
+        registry.add(self.r, *['filter:f%d' % i for i in range(5)])
+        self.assertEqual(registry.page(self.r, 'filter', count=2), ['filter:f0', 'filter:f1'])
+        self.assertEqual(registry.page(self.r, 'filter', 'filter:f1', 2), ['filter:f2', 'filter:f3'])
+        self.assertEqual(registry.page(self.r, 'filter', 'filter:f3', 2), ['filter:f4'])
+        self.assertEqual(registry.page(self.r, 'filter', 'filter:f4', 2), [])
+
+    def test_registry_migrate_rebuilds_set_indexes(self):
+        # Indexes of the previous version
+        self.r.hmset('filter:compression', {'id': '1'})
+        self.r.sadd('index:filter', 'filter:compression')
+        self.r.set('index:migrated', 1)
+        self.assertTrue(registry.migrate(self.r))
+        self.assertEqual(registry.keys(self.r, 'filter'), ['filter:compression'])
+        self.assertFalse(self.r.exists('index:migrated'))
+
+    def test_list_query(self):
+        query = ListQuery({'limit': '5000', 'fields': 'id, name', 'filter_type': 'Storlet'})
+        self.assertEqual(query.limit, settings.LIST_MAX_LIMIT)
+        self.assertEqual(query.fields, ['id', 'name'])
+        self.assertTrue(query.matches({'filter_type': 'storlet'}))
+        self.assertFalse(query.matches({'filter_type': 'native'}))
+        self.assertFalse(query.matches({'name': 'compression'}))
+        self.assertEqual(query.project({'id': 1, 'name': 'a', 'main': 'b'}), {'id': 1, 'name': 'a'})
+        self.assertFalse(ListQuery({}).paginated)
+
+        self.assertRaises(InvalidListQuery, ListQuery, {'limit': 'ten'})
+        self.assertRaises(InvalidListQuery, ListQuery, {'limit': '0'})
+        self.assertRaises(InvalidListQuery, ListQuery, {'limit': '1', 'cursor': 'a'})
+
+    def test_get_page(self):
+        keys = ['filter:f%d' % i for i in range(7)]
+        registry.add(self.r, *keys)
+        for i, key in enumerate(keys):
+            self.r.hmset(key, {'id': i, 'type': 'even' if i % 2 == 0 else 'odd'})
+        fetch = index_fetcher(self.r, 'filter', lambda page_keys: get_hashes(self.r, page_keys))
+
+        items, last_key = get_page(ListQuery({'limit': '3'}), fetch)
+        self.assertEqual([item['id'] for item in items], ['0', '1', '2'])
+        items, last_key = get_page(ListQuery({'limit': '3', 'cursor': encode_cursor(last_key)}), fetch)
+        self.assertEqual([item['id'] for item in items], ['3', '4', '5'])
+        items, last_key = get_page(ListQuery({'limit': '3', 'cursor': encode_cursor(last_key)}), fetch)
+        self.assertEqual([item['id'] for item in items], ['6'])
+        self.assertIsNone(last_key)
+
+        items, last_key = get_page(ListQuery({'limit': '2', 'type': 'odd', 'fields': 'id'}), fetch)
+        self.assertEqual(items, [{'id': '1'}, {'id': '3'}])
+        self.assertEqual(last_key, 'filter:f3')
+
+        items, last_key = get_page(ListQuery({'type': 'even'}), fetch, sort_key=lambda item: -int(item['id']))
+        self.assertEqual([item['id'] for item in items], ['6', '4', '2', '0'])
+        self.assertIsNone(last_key)
+
+    def test_registry_scan_nodes(self):
+        self.assertEqual(sorted(registry.scan(self.r, '*_node:*')),
+                         ['object_node:storagenode1', 'object_node:storagenode2', 'proxy_node:controller'])
+
     @mock.patch('api.startup.redis.Redis')
     def test_startup_run_ok(self, mock_startup_redis):
         self.create_startup_fixtures()
@@ -145,6 +462,7 @@ class MainTestCase(TestCase):
         self.assertFalse(self.r.exists('metric:metric2'))
         self.assertEquals(self.r.hget('policy:1', 'status'), 'Stopped')
         self.assertEquals(self.r.hget('policy:2', 'status'), 'Stopped')
+        self.assertEqual(registry.keys(self.r, 'metric'), [])
 
     #
     # URL tests
@@ -169,6 +487,13 @@ class MainTestCase(TestCase):
         self.assertEqual(resolver.view_name, 'swift_api.views.node_detail')
         self.assertEqual(resolver.kwargs, {'server_type': 'object', 'node_id': 'node1'})
 
+        resolver = resolve('/jobs/')
+        self.assertEqual(resolver.view_name, 'api.views.job_list')
+
+        resolver = resolve('/jobs/0123abcd')
+        self.assertEqual(resolver.view_name, 'api.views.job_detail')
+        self.assertEqual(resolver.kwargs, {'job_id': '0123abcd'})
+
     #
     # Crystal Middleware tests
     #
@@ -195,7 +520,7 @@ class MainTestCase(TestCase):
         mock_get_keystone_admin_auth.assert_called()
         self.assertEqual(response, None)
 
-        # Now token is saved in valid_tokens
+        # Now token is saved in the token cache
         mock_get_keystone_admin_auth.reset_mock()
         request = self.factory.get('/filters')
         request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
@@ -203,6 +528,340 @@ class MainTestCase(TestCase):
         mock_get_keystone_admin_auth.assert_not_called()
         self.assertEqual(response, None)
 
+    @mock.patch('api.middleware.get_keystone_admin_auth')
+    def test_middleware_caches_rejected_token(self, mock_get_keystone_admin_auth):
+        mock_get_keystone_admin_auth.return_value.tokens.validate.side_effect = exceptions.http.NotFound()
+        cm = CrystalMiddleware()
+
+        for _ in range(2):
+            request = self.factory.get('/filters')
+            request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+            response = cm.process_request(request)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(mock_get_keystone_admin_auth.return_value.tokens.validate.call_count, 1)
+
+    @mock.patch('api.middleware.get_keystone_admin_auth')
+    def test_middleware_does_not_cache_keystone_failure(self, mock_get_keystone_admin_auth):
+        validate = mock_get_keystone_admin_auth.return_value.tokens.validate
+        cm = CrystalMiddleware()
+
+        for error in (exceptions.ConnectFailure(), exceptions.http.InternalServerError(),
+                      exceptions.http.Unauthorized()):
+            validate.reset_mock()
+            validate.side_effect = error
+            for _ in range(2):
+                request = self.factory.get('/filters')
+                request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+                response = cm.process_request(request)
+                self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            self.assertEqual(validate.call_count, 2)
+
+    @mock.patch('api.middleware.get_keystone_admin_auth')
+    def test_middleware_non_admin_token(self, mock_get_keystone_admin_auth):
+        member_token = FakeTokenData(timezone.now() + timedelta(minutes=5), [{'name': '_member_'}])
+        mock_get_keystone_admin_auth.return_value.tokens.validate.return_value = member_token
+        cm = CrystalMiddleware()
+
+        request = self.factory.get('/filters')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        response = cm.process_request(request)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(get_token_cache().get('fake_token'))
+
+    def test_token_cache_lru_eviction(self):
+        cache = TokenCache(2, 10, clock=lambda: 1000)
+        cache.set_valid('token1', 2000)
+        cache.set_valid('token2', 2000)
+        self.assertTrue(cache.get('token1'))
+        cache.set_valid('token3', 2000)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get('token1'))
+        self.assertIsNone(cache.get('token2'))
+        self.assertTrue(cache.get('token3'))
+
+    def test_token_cache_expiration(self):
+        now = [1000]
+        cache = TokenCache(10, 10, clock=lambda: now[0])
+        cache.set_valid('token1', 1100)
+        cache.set_invalid('token2')
+        self.assertTrue(cache.get('token1'))
+        self.assertFalse(cache.get('token2'))
+
+        now[0] = 1050
+        self.assertTrue(cache.get('token1'))
+        self.assertIsNone(cache.get('token2'))
+
+        # Storing the token again replaces its expiration
+        cache.set_valid('token1', 1200)
+        now[0] = 1150
+        self.assertTrue(cache.get('token1'))
+        now[0] = 1200
+        self.assertIsNone(cache.get('token1'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats(), {'size': 0, 'hits': 4, 'misses': 2})
+
+    def test_token_cache_shared_through_redis(self):
+        worker1 = TokenCache(10, 10, redis_connection=lambda: self.r)
+        worker2 = TokenCache(10, 10, redis_connection=lambda: self.r)
+        worker1.set_valid('token1', time.time() + 60)
+        worker1.set_invalid('token2')
+
+        self.assertTrue(worker2.get('token1'))
+        self.assertFalse(worker2.get('token2'))
+        self.assertIsNone(worker2.get('token3'))
+        self.assertEqual(len(worker2), 2)
+        # Raw tokens are not stored in Redis
+        self.assertEqual(self.r.keys('*token1*'), [])
+        self.assertTrue(0 < self.r.ttl(TokenCache._key('token2')) <= 10)
+
+    #
+    # Consumer
+    #
+
+    def test_consumer_engine_delivers_batches_and_acks(self):
+        engine = ConsumerEngine(mock.MagicMock(), 'amq.topic', prefetch_count=10, batch_size=3)
+        engine._connection = mock.MagicMock()
+        callback = mock.MagicMock()
+        subscription = Subscription('metric1', 'metric.1', callback)
+        engine.subscriptions['metric1'] = subscription
+
+        engine._open_channel(subscription)
+        on_channel_open = engine._connection.channel.call_args[1]['on_open_callback']
+        channel = mock.MagicMock()
+        on_channel_open(channel)
+        channel.basic_qos.assert_called_with(prefetch_count=10)
+        on_queue_declared = channel.queue_declare.call_args[0][0]
+        on_queue_declared(None)
+        on_queue_bound = channel.queue_bind.call_args[0][0]
+        self.assertEqual(channel.queue_bind.call_args[0][1:], ('metric1', 'amq.topic', 'metric.1'))
+        on_queue_bound(None)
+        on_message = channel.basic_consume.call_args[0][0]
+
+        for tag in range(1, 5):
+            on_message(channel, mock.Mock(delivery_tag=tag), None, 'body' + str(tag))
+        callback.assert_called_once_with(['body1', 'body2', 'body3'])
+        channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+        engine.flush()
+        callback.assert_called_with(['body4'])
+        channel.basic_ack.assert_called_with(delivery_tag=4, multiple=True)
+
+        # A channel is opened only once per subscription
+        engine._open_channel(subscription)
+        self.assertEqual(engine._connection.channel.call_count, 1)
+
+    @mock.patch('api.actors.consumer.get_consumer_engine')
+    def test_consumer_delivers_to_parent(self, mock_get_consumer_engine):
+        parent = mock.MagicMock()
+        consumer = Consumer('metric1', 'metric.1', parent)
+        consumer.start_consuming()
+        mock_get_consumer_engine.return_value.subscribe.assert_called_with('metric1', 'metric.1', consumer.deliver)
+        consumer.deliver(['body1', 'body2'])
+        parent.notify_many.assert_called_once_with(['body1', 'body2'])
+
+        parent = mock.MagicMock(spec=['notify'])
+        consumer = Consumer('metric1', 'metric.1', parent)
+        consumer.deliver(['body1', 'body2'])
+        self.assertEqual(parent.notify.call_count, 2)
+
+    #
+    # Publisher
+    #
+
+    @mock.patch('api.publisher.pika.BlockingConnection')
+    def test_publisher_pool_reuses_connections(self, mock_connection):
+        pool = PublisherPool(mock.MagicMock(), 'amq.topic', size=2, idle_interval=0)
+        channel = mock_connection.return_value.channel.return_value
+        self.assertEqual(pool.publish_many([('node1', 'a'), ('node2', 'b')]), 2)
+        self.assertEqual(pool.publish('node1', 'c'), 1)
+        self.assertEqual(mock_connection.call_count, 1)
+        channel.tx_select.assert_called_once()
+        # One commit (one round trip) per batch
+        self.assertEqual(channel.tx_commit.call_count, 2)
+        channel.basic_publish.assert_called_with(exchange='amq.topic', routing_key='node1', body='c')
+
+    @mock.patch('api.publisher.pika.BlockingConnection')
+    def test_publisher_pool_reconnects(self, mock_connection):
+        pool = PublisherPool(mock.MagicMock(), 'amq.topic', size=1, idle_interval=0)
+        broken_channel = mock.MagicMock()
+        broken_channel.basic_publish.side_effect = [None, pika.exceptions.ConnectionClosed()]
+        channel = mock.MagicMock()
+        mock_connection.return_value.channel.side_effect = [broken_channel, channel]
+        # The uncommitted batch is published again over the new connection
+        self.assertEqual(pool.publish_many([('node1', 'a'), ('node2', 'b'), ('node3', 'c')]), 3)
+        self.assertEqual(mock_connection.call_count, 2)
+        self.assertFalse(broken_channel.tx_commit.called)
+        self.assertEqual(channel.basic_publish.call_count, 3)
+        self.assertEqual(channel.tx_commit.call_count, 1)
+        self.assertEqual(pool._created, 1)
+
+    @mock.patch('api.publisher.pika.BlockingConnection')
+    def test_publisher_pool_without_transactions(self, mock_connection):
+        pool = PublisherPool(mock.MagicMock(), 'amq.topic', size=1, transactional=False, idle_interval=0)
+        channel = mock_connection.return_value.channel.return_value
+        self.assertEqual(pool.publish_many([('node1', 'a'), ('node2', 'b')]), 2)
+        self.assertFalse(channel.tx_select.called)
+        self.assertFalse(channel.tx_commit.called)
+
+    @mock.patch('api.publisher.pika.BlockingConnection')
+    def test_publisher_pool_closes_connections_it_cannot_use(self, mock_connection):
+        pool = PublisherPool(mock.MagicMock(), 'amq.topic', size=1, idle_interval=0)
+        mock_connection.return_value.channel.return_value.tx_select.side_effect = pika.exceptions.ChannelClosed()
+        self.assertEqual(pool.publish('node1', 'a'), 0)
+        mock_connection.return_value.close.assert_called_once()
+        self.assertEqual(pool._created, 0)
+
+    @mock.patch('api.publisher.pika.BlockingConnection')
+    def test_publisher_pool_services_idle_connections(self, mock_connection):
+        pool = PublisherPool(mock.MagicMock(), 'amq.topic', size=2, idle_interval=0)
+        broken, healthy = mock.MagicMock(), mock.MagicMock()
+        broken.process_data_events.side_effect = pika.exceptions.ConnectionClosed()
+        mock_connection.side_effect = [broken, healthy]
+        pool._release(pool._acquire())
+        pool._release(pool._connect())
+        pool._created = 2
+
+        pool.service_idle()
+        healthy.process_data_events.assert_called_once_with(0)
+        self.assertTrue(broken.close.called)
+        self.assertEqual(pool._created, 1)
+        self.assertEqual(pool._idle.qsize(), 1)
+
+    #
+    # Jobs
+    #
+
+    def test_job_run(self):
+        job = jobs.submit(self.r, 'test_echo', value=[1, 2])
+        self.assertEqual(job['status'], 'queued')
+        self.assertEqual(job['params'], {'value': [1, 2]})
+        self.assertEqual(jobs.job_ids(self.r), [job['id']])
+
+        self.assertEqual(jobs.run_next(self.r), job['id'])
+        job = jobs.get_job(self.r, job['id'])
+        self.assertEqual((job['status'], job['progress'], job['message'], job['result']), ('succeeded', 100, 'Half way', [1, 2]))
+        self.assertTrue(0 < self.r.ttl(jobs.job_key(job['id'])) <= settings.JOBS_RESULT_TTL)
+        self.assertIsNone(jobs.run_next(self.r))
+        self.assertRaises(ValueError, jobs.submit, self.r, 'unknown')
+
+    def test_job_failure(self):
+        job = jobs.submit(self.r, 'test_fail')
+        jobs.run_next(self.r)
+        job = jobs.get_job(self.r, job['id'])
+        self.assertEqual((job['status'], job['error']), ('failed', 'broken'))
+
+        # A result that is not JSON serializable fails the job at once
+        job = jobs.submit(self.r, 'test_unserializable')
+        self.assertEqual(jobs.run_job(self.r, self.r.rpoplpush(jobs.QUEUE_KEY, jobs.PROCESSING_KEY)), 'failed')
+        self.assertEqual(jobs.get_job(self.r, job['id'])['status'], 'failed')
+        self.assertEqual(self.r.scard(jobs.RUNNING_KEY), 0)
+
+    def test_job_cancel(self):
+        # A queued job is not run
+        job = jobs.submit(self.r, 'test_echo', value=1)
+        self.assertEqual(jobs.cancel(self.r, job['id'])['status'], 'cancelled')
+        jobs.run_next(self.r)
+        job = jobs.get_job(self.r, job['id'])
+        self.assertEqual(job['status'], 'cancelled')
+        self.assertNotIn('result', job)
+
+        # A running job stops when it reports its progress
+        job = jobs.submit(self.r, 'test_cancel')
+        jobs.run_next(self.r)
+        job = jobs.get_job(self.r, job['id'])
+        self.assertEqual(job['status'], 'cancelled')
+        self.assertTrue(job['cancel_requested'])
+        self.assertIsNone(jobs.cancel(self.r, 'unknown'))
+
+    def test_job_fail_interrupted(self):
+        stale = jobs.submit(self.r, 'test_echo', value=1)
+        alive = jobs.submit(self.r, 'test_echo', value=2)
+        self.r.hmset(jobs.job_key(stale['id']), {'status': 'running', 'heartbeat': time.time() - 3600})
+        self.r.hmset(jobs.job_key(alive['id']), {'status': 'running', 'heartbeat': time.time()})
+        self.r.sadd(jobs.RUNNING_KEY, stale['id'], alive['id'], 'expired')
+        jobs.fail_interrupted(self.r)
+        self.assertEqual(jobs.get_job(self.r, stale['id'])['status'], 'failed')
+        self.assertEqual(jobs.get_job(self.r, alive['id'])['status'], 'running')
+        self.assertEqual(self.r.smembers(jobs.RUNNING_KEY), {alive['id']})
+
+    def test_job_requeue_lost(self):
+        # The process that took the job died before running it
+        job = jobs.submit(self.r, 'test_echo', value=1)
+        self.assertEqual(self.r.rpoplpush(jobs.QUEUE_KEY, jobs.PROCESSING_KEY), job['id'])
+        jobs.fail_interrupted(self.r)
+        self.assertEqual(self.r.lrange(jobs.PROCESSING_KEY, 0, -1), [job['id']])
+        self.r.hset(jobs.job_key(job['id']), 'popped', time.time() - 3600)
+        jobs.fail_interrupted(self.r)
+        self.assertEqual(self.r.lrange(jobs.PROCESSING_KEY, 0, -1), [])
+
+        self.assertEqual(jobs.run_next(self.r), job['id'])
+        self.assertEqual(jobs.get_job(self.r, job['id'])['status'], 'succeeded')
+        self.assertEqual(self.r.llen(jobs.PROCESSING_KEY), 0)
+        self.assertEqual(self.r.scard(jobs.RUNNING_KEY), 0)
+
+    def test_job_cancelled_while_taken(self):
+        job = jobs.submit(self.r, 'test_echo', value=1)
+        self.r.rpoplpush(jobs.QUEUE_KEY, jobs.PROCESSING_KEY)
+        jobs.cancel(self.r, job['id'])
+        self.assertIsNone(jobs.run_job(self.r, job['id']))
+        self.assertEqual(jobs.get_job(self.r, job['id'])['status'], 'cancelled')
+        self.assertEqual(self.r.llen(jobs.PROCESSING_KEY), 0)
+
+    @override_settings(JOBS_WORKERS=2)
+    def test_job_worker_pool(self):
+        pool = jobs.JobWorkerPool()
+        pool.start()
+        threads = list(pool._threads) + [pool._heartbeat_thread]
+        self.assertEqual(len(threads), 3)
+        try:
+            with mock.patch('api.jobs.get_job_pool', return_value=pool):
+                job = jobs.submit(self.r, 'test_echo', value='ok')
+            deadline = time.time() + 5
+            while jobs.get_job(self.r, job['id'])['status'] != 'succeeded' and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(jobs.get_job(self.r, job['id'])['result'], 'ok')
+        finally:
+            pool.stop()
+            for thread in threads:
+                thread.join(5)
+
+    def test_job_views(self):
+        job = jobs.submit(self.r, 'test_echo', value=1)
+        done = jobs.submit(self.r, 'test_fail')
+        self.r.lrem(jobs.QUEUE_KEY, job['id'])
+        jobs.run_next(self.r)
+
+        response = job_list(self.factory.get('/jobs/'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(item['id'] for item in json.loads(response.content)), sorted([job['id'], done['id']]))
+        response = job_list(self.factory.get('/jobs/', {'status': 'failed', 'fields': 'id'}))
+        self.assertEqual(json.loads(response.content), [{'id': done['id']}])
+
+        # Oldest first, page by page
+        response = job_list(self.factory.get('/jobs/', {'limit': 1}))
+        self.assertEqual([item['id'] for item in json.loads(response.content)], [job['id']])
+        response = job_list(self.factory.get('/jobs/', {'cursor': response['X-Next-Cursor']}))
+        self.assertEqual([item['id'] for item in json.loads(response.content)], [done['id']])
+        response = job_list(self.factory.get('/jobs/', {'cursor': 'invalid'}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = job_detail(self.factory.get('/jobs/' + job['id']), job['id'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['status'], 'queued')
+        response = job_detail(self.factory.get('/jobs/unknown'), 'unknown')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = job_detail(self.factory.delete('/jobs/' + job['id']), job['id'])
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(json.loads(response.content)['status'], 'cancelled')
+        response = job_detail(self.factory.delete('/jobs/' + done['id']), done['id'])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        # Expired jobs are dropped from the list
+        self.r.delete(jobs.job_key(done['id']))
+        response = job_list(self.factory.get('/jobs/'))
+        self.assertEqual([item['id'] for item in json.loads(response.content)], [job['id']])
+        self.assertEqual(jobs.job_ids(self.r), [job['id']])
 
     #
     # Aux methods
@@ -219,6 +878,16 @@ class MainTestCase(TestCase):
                      {'ip': '192.168.2.3', 'last_ping': str(calendar.timegm(time.gmtime())), 'type': 'object', 'name': 'storagenode2',
                       'devices': '{"sdb1": {"free": 16832876544, "size": 16832880640}}', 'ssh_access': 'False'})
 
+    def create_sync_dir(self):
+        src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src)
+        os.mkdir(os.path.join(src, 'sub'))
+        with open(os.path.join(src, 'a.py'), 'w') as f:
+            f.write('a = 1\n')
+        with open(os.path.join(src, 'sub', 'b.py'), 'w') as f:
+            f.write('b = 1\n')
+        return src
+
     def configure_usernames_and_passwords_for_nodes(self):
         self.r.hmset('proxy_node:controller', {'ssh_username': 'user1', 'ssh_password': 's3cr3t', 'ssh_access': 'True'})
         self.r.hmset('object_node:storagenode1', {'ssh_username': 'user1', 'ssh_password': 's3cr3t', 'ssh_access': 'True'})
@@ -0,0 +1,172 @@
+"""
+Cache of the validated X-Auth-Token headers.
+
+The middleware used to keep every admin token it had validated in an
+unbounded dict of its process, and validated the invalid ones against
+Keystone on every request. The cache is bounded to TOKEN_CACHE_SIZE tokens
+(least recently used first out), drops the expired tokens through a heap of
+expirations and keeps the invalid tokens for TOKEN_CACHE_NEGATIVE_TTL
+seconds. With TOKEN_CACHE_REDIS the results are also shared through Redis,
+so a token validated by one Apache/mod_wsgi worker is valid for all of them.
+Tokens are stored in Redis by their SHA-256 digest.
+"""
+from collections import OrderedDict
+from django.conf import settings
+from threading import Lock
+import hashlib
+import heapq
+import logging
+import redis
+import time
+
+from api.common import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+REDIS_PREFIX = 'token:'
+VALID = '1'
+INVALID = '0'
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_token_cache():
+    """
+    Returns the token cache shared by all the threads of this process,
+    creating it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            redis_connection = get_redis_connection if settings.TOKEN_CACHE_REDIS else None
+            _cache = TokenCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_NEGATIVE_TTL,
+                                redis_connection)
+        return _cache
+
+
+class TokenCache(object):
+    """
+    Thread-safe LRU cache of token -> (valid, expiration).
+
+    :param max_size: Maximum number of tokens kept in memory.
+    :param negative_ttl: Seconds an invalid token is cached.
+    :param redis_connection: Function that returns a Redis connection, or
+                             None to keep the tokens only in memory.
+    """
+
+    def __init__(self, max_size, negative_ttl, redis_connection=None, clock=time.time):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.redis_connection = redis_connection
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._expirations = list()
+        self._lock = Lock()
+
+    def _expire(self, now):
+        # The heap may hold stale expirations of tokens that were evicted or
+        # stored again; only the ones that match the entry remove it.
+        while self._expirations and self._expirations[0][0] <= now:
+            expiration, token = heapq.heappop(self._expirations)
+            entry = self._entries.get(token)
+            if entry is not None and entry[1] == expiration:
+                del self._entries[token]
+
+    def _store(self, token, valid, expiration):
+        self._entries.pop(token, None)
+        self._entries[token] = (valid, expiration)
+        heapq.heappush(self._expirations, (expiration, token))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if len(self._expirations) > 2 * self.max_size:
+            live = set((expiration, token) for token, (_, expiration) in self._entries.items())
+            self._expirations = [item for item in self._expirations if item in live]
+            heapq.heapify(self._expirations)
+
+    def get(self, token):
+        """
+        :return: True if the token is a valid admin token, False if it is
+                 known to be invalid, or None if it is not cached.
+        """
+        now = self.clock()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(token)
+            if entry is not None:
+                self.hits += 1
+                self._entries.pop(token)
+                self._entries[token] = entry
+                return entry[0]
+
+        entry = self._get_shared(token)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            valid, ttl = entry
+            self._store(token, valid, now + ttl)
+            return valid
+
+    def set_valid(self, token, expiration):
+        """
+        :param expiration: Expiration of the token, in seconds since the epoch.
+        """
+        self._set(token, True, expiration)
+
+    def set_invalid(self, token):
+        self._set(token, False, self.clock() + self.negative_ttl)
+
+    def _set(self, token, valid, expiration):
+        with self._lock:
+            self._store(token, valid, expiration)
+        self._set_shared(token, valid, expiration - self.clock())
+
+    def _get_shared(self, token):
+        if self.redis_connection is None:
+            return None
+        try:
+            pipe = self.redis_connection().pipeline(transaction=False)
+            key = self._key(token)
+            pipe.get(key)
+            pipe.pttl(key)
+            value, pttl = pipe.execute()
+        except redis.exceptions.RedisError:
+            logger.exception('Token cache: Redis is not available')
+            return None
+        if value is None or pttl is None or pttl <= 0:
+            return None
+        return value == VALID, pttl / 1000.0
+
+    def _set_shared(self, token, valid, ttl):
+        if self.redis_connection is None or ttl <= 0:
+            return
+        try:
+            self.redis_connection().psetex(self._key(token), int(ttl * 1000) or 1,
+                                           VALID if valid else INVALID)
+        except redis.exceptions.RedisError:
+            logger.exception('Token cache: Redis is not available')
+
+    @staticmethod
+    def _key(token):
+        return REDIS_PREFIX + hashlib.sha256(token).hexdigest()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expirations = list()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """
+        :return: e.g. {'size': 10, 'hits': 100, 'misses': 10}
+        """
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
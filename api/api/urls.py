@@ -1,4 +1,5 @@
 from django.conf.urls import include, url
+from api import views
 
 
 urlpatterns = [
@@ -8,4 +9,6 @@ urlpatterns = [
     url(r'^metrics/', include('metrics.urls')),
     url(r'^policies/', include('policies.urls')),
     url(r'^controllers/', include('controllers.urls')),
+    url(r'^jobs/?$', views.job_list),
+    url(r'^jobs/(?P<job_id>\w+)/?$', views.job_detail),
 ]
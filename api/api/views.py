@@ -0,0 +1,59 @@
+from django.views.decorators.csrf import csrf_exempt
+from redis.exceptions import RedisError
+from rest_framework import status
+
+from api import jobs
+from api.common import JSONResponse, get_redis_connection
+from api.listing import ListQuery, InvalidListQuery, get_page, list_response
+
+
+#
+# Jobs
+#
+@csrf_exempt
+def job_list(request):
+    """
+    GET: List the queued, running and finished jobs
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        try:
+            query = ListQuery(request.GET)
+            job_items, last_position = get_page(query, jobs.job_fetcher(r))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, job_items, last_position)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def job_detail(request, job_id):
+    """
+    GET: Status, progress and result of a job
+    DELETE: Cancel a job
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        job = jobs.get_job(r, job_id)
+        if job is None:
+            return JSONResponse('Job not found.', status=status.HTTP_404_NOT_FOUND)
+        return JSONResponse(job, status=status.HTTP_200_OK)
+
+    if request.method == 'DELETE':
+        job = jobs.get_job(r, job_id)
+        if job is None:
+            return JSONResponse('Job not found.', status=status.HTTP_404_NOT_FOUND)
+        if job['status'] in jobs.FINISHED:
+            return JSONResponse('The job already finished.', status=status.HTTP_409_CONFLICT)
+        return JSONResponse(jobs.cancel(r, job_id), status=status.HTTP_202_ACCEPTED)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -0,0 +1,94 @@
+"""
+Micro-benchmark of the DSL parser.
+
+Parses N policy rules with the pyparsing backend, without the grammar cache
+(the grammar is built for every rule, as the parser used to do) and with
+it (the grammar is built once for the registered metrics and filters), and
+with the hand-written recursive-descent backend. Redis is replaced by an
+in-memory registry of 20 metrics and 20 filters.
+
+Run it from the source folder (``./api``):
+
+    python -m benchmarks.dsl_parser
+"""
+import os
+import random
+import time
+
+import mock
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+
+from django.test.utils import override_settings  # noqa
+from policies import dsl_parser  # noqa
+
+METRICS = ['metric%d' % i for i in range(20)]
+FILTERS = ['filter%d' % i for i in range(20)]
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = dict(('metric:' + name, {'type': 'integer'}) for name in METRICS)
+        self.data.update(('filter:' + name, {'valid_parameters': '{"param1": "integer"}'}) for name in FILTERS)
+
+    def zrange(self, key, start, end):
+        prefix = key.split(':', 1)[1] + ':'
+        return sorted(key for key in self.data if key.startswith(prefix))
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def setnx(self, key, value):
+        return self.data.setdefault(key, value) == value
+
+    def hgetall(self, key):
+        return self.data.get(key, {})
+
+
+def make_rules(num_rules):
+    rules = list()
+    for i in range(num_rules):
+        rule = 'FOR TENANT:project%d' % random.randrange(1000)
+        if random.random() < 0.5:
+            rule += ' WHEN %s > %d AND %s < %d' % (random.choice(METRICS), random.randrange(100),
+                                                   random.choice(METRICS), random.randrange(100))
+        rule += ' DO SET ' + random.choice(FILTERS)
+        if random.random() < 0.5:
+            rule += ' WITH param1=%d' % random.randrange(10)
+        if random.random() < 0.3:
+            rule += ' TO OBJECT_TYPE=DOCS, OBJECT_SIZE>%d' % random.randrange(1000)
+        rules.append(rule)
+    return rules
+
+
+def parse_uncached(rule):
+    dsl_parser._registries.clear()
+    dsl_parser._rule_grammars.clear()
+    return dsl_parser.parse(rule)
+
+
+def timed(parse, rules):
+    start = time.time()
+    for rule in rules:
+        parse(rule)
+    return time.time() - start
+
+
+def run(sizes=(100, 1000, 10000)):
+    print "%10s %14s %14s %14s" % ('rules', 'uncached (s)', 'cached (s)', 'descent (s)')
+    with mock.patch('policies.dsl_parser.get_redis_connection', return_value=FakeRedis()):
+        for size in sizes:
+            rules = make_rules(size)
+            with override_settings(DSL_PARSER_BACKEND='pyparsing'):
+                uncached_time = timed(parse_uncached, rules)
+                cached_time = timed(dsl_parser.parse, rules)
+            with override_settings(DSL_PARSER_BACKEND='descent'):
+                descent_time = timed(dsl_parser.parse, rules)
+            print "%10d %14.2f %14.2f %14.3f" % (size, uncached_time, cached_time, descent_time)
+
+
+if __name__ == '__main__':
+    run()
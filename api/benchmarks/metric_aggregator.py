@@ -0,0 +1,62 @@
+"""
+Micro-benchmark of the per-tick aggregation of SwiftMetric.
+
+Compares the former dictionary-based aggregation with the columnar
+aggregator for increasing numbers of samples per tick. For the columnar
+engine the cost of storing a tick (interning the group fields) is reported
+separately from the cost of the grouped reductions, the per-project and
+per-container sums.
+
+Run it from the source folder (``./api``):
+
+    python -m benchmarks.metric_aggregator
+"""
+import random
+import timeit
+
+from metrics.aggregator import ColumnarAggregator
+from metrics.decoder import MetricRecord
+
+
+def make_records(num_samples, num_projects=50, containers_per_project=20, num_hosts=10):
+    records = []
+    for _ in range(num_samples):
+        project = 'project%d' % random.randrange(num_projects)
+        container = project + '/container%d' % random.randrange(containers_per_project)
+        host = 'host%d' % random.randrange(num_hosts)
+        records.append(MetricRecord(project, container, random.choice(('GET', 'PUT')), host,
+                                    'proxy', random.random() * 100, {}))
+    return records
+
+
+def dict_path(records):
+    aggregate = dict()
+    for record in records:
+        if record.project not in aggregate:
+            aggregate[record.project] = 0
+        if record.container not in aggregate:
+            aggregate[record.container] = 0
+        aggregate[record.project] += record.value
+        aggregate[record.container] += record.value
+    return aggregate
+
+
+def columnar_sums(aggregator):
+    aggregate = aggregator.sums('project')
+    aggregate.update(aggregator.sums('container'))
+    return aggregate
+
+
+def run(sizes=(100, 1000, 10000, 100000), repeat=5):
+    print "%10s %12s %12s %12s" % ('samples', 'dict (ms)', 'store (ms)', 'sums (ms)')
+    for size in sizes:
+        records = make_records(size)
+        aggregator = ColumnarAggregator()
+        dict_time = min(timeit.repeat(lambda: dict_path(records), number=1, repeat=repeat))
+        store_time = min(timeit.repeat(lambda: aggregator.store(records), number=1, repeat=repeat))
+        sums_time = min(timeit.repeat(lambda: columnar_sums(aggregator), number=1, repeat=repeat))
+        print "%10d %12.2f %12.2f %12.2f" % (size, dict_time * 1000, store_time * 1000, sums_time * 1000)
+
+
+if __name__ == '__main__':
+    run()
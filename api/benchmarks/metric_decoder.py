@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of the metric message decoding path.
+
+Compares the former per-message ``eval()`` of SwiftMetric.notify with the
+batched MetricDecoder, for the Python dict literals published by the metric
+middleware (``str(dict)``), for literals that need ``ast.literal_eval``
+(e.g. with a boolean), for JSON bodies and (if installed) for MessagePack
+bodies.
+
+Run it from the source folder (``./api``):
+
+    python -m benchmarks.metric_decoder [num_messages]
+"""
+import json
+import sys
+import timeit
+
+from metrics.decoder import MetricDecoder, msgpack
+
+SAMPLE = {'container': 'crystal/data', 'metric_name': 'bandwidth', '@timestamp': '2017-09-09T18:00:18.331492+02:00',
+          'value': 16.4375, 'project': 'crystal', 'host': 'controller', 'method': 'GET', 'server_type': 'proxy'}
+
+
+def eval_path(bodies):
+    records = []
+    for body in bodies:
+        metric = eval(body)
+        if metric['server_type'] == 'proxy':
+            records.append(metric)
+    return records
+
+
+def run(num_messages=10000, repeat=5):
+    literal_bodies = [str(SAMPLE)] * num_messages
+    slow_literal_bodies = [str(dict(SAMPLE, cached=True))] * num_messages
+    json_bodies = [json.dumps(SAMPLE)] * num_messages
+    decoder = MetricDecoder()
+
+    cases = [('eval (former)', lambda: eval_path(literal_bodies)),
+             ('decoder literal', lambda: decoder.decode_batch(literal_bodies)),
+             ('decoder literal_eval', lambda: decoder.decode_batch(slow_literal_bodies)),
+             ('decoder json', lambda: decoder.decode_batch(json_bodies))]
+    if msgpack is not None:
+        msgpack_bodies = [msgpack.packb(SAMPLE)] * num_messages
+        cases.append(('decoder msgpack', lambda: decoder.decode_batch(msgpack_bodies)))
+
+    print "Decoding %d messages (best of %d)" % (num_messages, repeat)
+    baseline = None
+    for name, func in cases:
+        elapsed = min(timeit.repeat(func, number=1, repeat=repeat))
+        if baseline is None:
+            baseline = elapsed
+        print "%-22s %8.1f ms  %10.0f msg/s  x%.1f" % (name, elapsed * 1000, num_messages / elapsed, baseline / elapsed)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the evaluation of dynamic policies.
+
+Compares one tick of N independent rules (one compiled condition each, as
+the Rule actors do, without the actor messaging) with a single rule engine
+that holds the N policies in its clause table. The tick updates the value
+of every target of one metric.
+
+Run it from the source folder (``./api``):
+
+    python -m benchmarks.rule_engine
+"""
+import os
+import random
+import timeit
+
+import mock
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+
+from policies.actors.rule_engine import RuleEngine  # noqa
+from policies.condition_evaluator import CompiledCondition  # noqa
+
+
+def make_conditions(num_policies):
+    return [[['metric1', random.choice(('>', '<', '>=', '<=')), str(random.randrange(100))]]
+            for _ in range(num_policies)]
+
+
+def make_engine(conditions):
+    engine = RuleEngine('localhost')
+    engine.id = 'rule_engine:0'
+    engine.host = mock.MagicMock()
+    engine.proxy = mock.MagicMock()
+    engine._check_policy = lambda policy_id: None
+    with mock.patch('policies.actors.rule_engine.parse_condition', side_effect=conditions):
+        for policy_id in range(len(conditions)):
+            engine.add_policy({'id': policy_id, 'target_name': 'project%d' % policy_id,
+                               'condition': '', 'transient': False})
+    return engine
+
+
+def rules_tick(rules, values):
+    for target, rule in rules:
+        rule.update('metric1', values[target])
+
+
+def run(sizes=(100, 1000, 10000), repeat=5):
+    print "%10s %12s %12s" % ('policies', 'rules (ms)', 'engine (ms)')
+    for size in sizes:
+        conditions = make_conditions(size)
+        rules = [('project%d' % i, CompiledCondition(condition)) for i, condition in enumerate(conditions)]
+        engine = make_engine(conditions)
+
+        ticks = [dict(('project%d' % i, random.random() * 100) for i in range(size)) for _ in range(repeat + 1)]
+        engine.update_many('metric1', ticks[-1])
+        rules_time = min(timeit.repeat(lambda: rules_tick(rules, ticks.pop()), number=1, repeat=repeat))
+        ticks = [dict(('project%d' % i, random.random() * 100) for i in range(size)) for _ in range(repeat)]
+        engine_time = min(timeit.repeat(lambda: engine.update_many('metric1', ticks.pop()), number=1, repeat=repeat))
+        print "%10d %12.2f %12.2f" % (size, rules_time * 1000, engine_time * 1000)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,28 +1,20 @@
 from redis.exceptions import RedisError
 from pyactor.exceptions import NotFoundError
 from django.conf import settings
+from api.publisher import get_publisher
 import logging
-import pika
 import redis
 
-logging.getLogger("pika").propagate = False
 logger = logging.getLogger(__name__)
 
 
 class AbstractController(object):
 
     _ask = ['get_target', 'run']
-    _tell = ['update', 'stop_actor', 'notify']
+    _tell = ['update', 'update_many', 'stop_actor', 'notify', 'notify_many']
 
     def __init__(self):
-        self.rmq_user = settings.RABBITMQ_USERNAME
-        self.rmq_pass = settings.RABBITMQ_PASSWORD
-        self.rmq_host = settings.RABBITMQ_HOST
-        self.rmq_port = settings.RABBITMQ_PORT
-        self.rmq_exchange = settings.RABBITMQ_EXCHANGE
-
-        self.rmq_credentials = pika.PlainCredentials(self.rmq_user,
-                                                     self.rmq_pass)
+        self.publisher = get_publisher()
         self.consumer = None
 
         try:
@@ -31,42 +23,40 @@ class AbstractController(object):
             logger.error('"Error connecting with Redis DB"')
 
         self.metrics = dict()
+        # Aggregation tier of the metrics (e.g. '10s:tumbling'). None means 1 second sums.
+        self.metric_tier = None
+        # Pre-aggregated table received instead of the raw metrics, e.g.
+        # {'group_by': ['project_id', 'storage_policy', 'host'], 'reducer': 'sum'}.
+        # None means the raw metrics.
+        self.metric_feed = None
 
     def _subscribe_metrics(self):
         try:
             for metric in self.metrics:
                 metric_actor = self.host.lookup(metric)
-                metric_actor.attach(self.proxy)
+                metric_actor.attach(self.proxy, self.metric_tier, self.metric_feed)
         except NotFoundError as e:
             logger.error(str(e))
             raise e
 
-    def _connect_rmq(self):
-        parameters = pika.ConnectionParameters(host=self.rmq_host,
-                                               credentials=self.rmq_credentials)
-        self._connection = pika.BlockingConnection(parameters)
-        self._channel = self._connection.channel()
+    def _send_message_rmq(self, routing_key, message):
+        self._send_messages_rmq([(routing_key, message)])
 
-    def _disconnect_rmq(self):
-        try:
-            self._channel.close()
-            self._connection.close()
-        except:
-            pass
+    def _send_messages_rmq(self, messages):
+        """
+        Publishes in a single batch all the messages of this tick.
 
-    def _send_message_rmq(self, routing_key, message):
-        self._connect_rmq()
-        params = dict(exchange=self.rmq_exchange, routing_key=routing_key, body=str(message))
-        try:
-            self._channel.basic_publish(**params)
-        except Exception as e:
-            logger.error(e.message)
-        self._disconnect_rmq()
+        :param messages: list of (routing_key, message) tuples
+        """
+        messages = [(routing_key, str(message)) for routing_key, message in messages]
+        published = self.publisher.publish_many(messages)
+        if published < len(messages):
+            logger.error('Controller, ' + str(len(messages) - published) + ' messages not published')
 
     def _init_consum(self, queue, routing_key):
         try:
             self.consumer = self.host.spawn(self.id + "_consumer", settings.CONSUMER_MODULE,
-                                            [queue, routing_key, self.proxy])
+                                            queue, routing_key, self.proxy)
             self.consumer.start_consuming()
         except Exception as e:
             logger.error(str(e))
@@ -80,6 +70,14 @@ class AbstractController(object):
         """
         self.compute_rmq_message(body)
 
+    def notify_many(self, bodies):
+        """
+        Method called from the consumer with all the messages consumed since
+        the last delivery.
+        """
+        for body in bodies:
+            self.compute_rmq_message(body)
+
     def get_target(self):
         """
         This controller will be subscribed to all Projects
@@ -92,12 +90,19 @@ class AbstractController(object):
         """
         self.compute_data(metric_data)
 
+    def update_many(self, metric_name, metric_batch):
+        """
+        Method called from the Swift Metric to indicate, in a single call, the
+        new metric data of all the targets observed by this controller
+        """
+        for metric_data in metric_batch.values():
+            self.update(metric_name, metric_data)
+
     def run(self):
         """
         Entry Method
         """
         self._subscribe_metrics()
-        # self._connect_rmq()
 
     def stop_actor(self):
         """
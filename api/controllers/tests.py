@@ -8,6 +8,7 @@ from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
+from api import registry
 from api.common import controller_actors
 from controllers.views import controller_list, controller_detail, ControllerData, create_instance, instance_detail, \
     instances_list, start_controller_instance, stop_controller_instance
@@ -17,7 +18,8 @@ from controllers.views import controller_list, controller_detail, ControllerData
 @override_settings(REDIS_CON_POOL=redis.ConnectionPool(host='localhost', port=6379, db=10),
                    STORLET_FILTERS_DIR=os.path.join("/tmp", "crystal", "storlet_filters"),
                    WORKLOAD_METRICS_DIR=os.path.join("/tmp", "crystal", "workload_metrics"),
-                   GLOBAL_CONTROLLERS_DIR=os.path.join("/tmp", "crystal", "global_controllers"))
+                   GLOBAL_CONTROLLERS_DIR=os.path.join("/tmp", "crystal", "global_controllers"),
+                   ARTIFACTS_DIR=os.path.join("/tmp", "crystal", "artifacts"))
 class ControllersTestCase(TestCase):
     def setUp(self):
         # Every test needs access to the request factory.
@@ -27,6 +29,8 @@ class ControllersTestCase(TestCase):
         self.factory = APIRequestFactory()
 
         self.create_global_controllers()
+        # The fixtures are written directly to redis
+        registry.build_indexes(self.r)
 
     def tearDown(self):
         self.r.flushdb()
@@ -13,8 +13,10 @@ import logging
 import mimetypes
 import os
 
-from api.common import to_json_bools, JSONResponse, get_redis_connection, \
-    create_local_host, controller_actors, make_sure_path_exists, save_file, delete_file
+from api import artifacts, registry
+from api.listing import ListQuery, InvalidListQuery, get_page, index_fetcher, list_response
+from api.common import to_json_bools, JSONResponse, get_redis_connection, get_hashes, \
+    create_local_host, controller_actors, delete_file
 
 logger = logging.getLogger(__name__)
 
@@ -33,13 +35,12 @@ def controller_list(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys('controller:*')
-        controller_list = []
-        for key in keys:
-            controller = r.hgetall(key)
-            # to_json_bools(controller, 'enabled')
-            controller_list.append(controller)
-        return JSONResponse(controller_list, status=status.HTTP_200_OK)
+        try:
+            query = ListQuery(request.GET)
+            controller_list, last_key = get_page(query, index_fetcher(r, 'controller', lambda keys: get_hashes(r, keys)))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, controller_list, last_key)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -67,6 +68,7 @@ def controller_detail(request, controller_id):
 
         try:
             r.hmset('controller:' + str(controller_id), data)
+            registry.add(r, 'controller:' + str(controller_id))
             return JSONResponse("Data updated", status=status.HTTP_200_OK)
         except DataError:
             return JSONResponse("Error updating data", status=status.HTTP_408_REQUEST_TIMEOUT)
@@ -79,12 +81,12 @@ def controller_detail(request, controller_id):
             else:
                 delete_file(controller['controller_name'], settings.CONTROLLERS_DIR)
                 r.delete("controller:" + str(controller_id))
+                registry.remove(r, "controller:" + str(controller_id))
         except:
             return JSONResponse("Error deleting controller", status=status.HTTP_400_BAD_REQUEST)
 
         # If this is the last controller, the counter is reset
-        keys = r.keys('controller:*')
-        if not keys:
+        if not registry.keys(r, 'controller'):
             r.delete('controllers:id')
 
         return JSONResponse('Controller has been deleted', status=status.HTTP_204_NO_CONTENT)
@@ -106,9 +108,9 @@ class ControllerData(APIView):
 
         try:
             file_obj = request.FILES['file']
-            make_sure_path_exists(settings.CONTROLLERS_DIR)
-            path = save_file(file_obj, settings.CONTROLLERS_DIR)
-            r.hmset('controller:' + str(controller_id), {'controller_name': os.path.basename(path)})
+            path, sha256 = artifacts.save_file(file_obj, settings.CONTROLLERS_DIR)
+            r.hmset('controller:' + str(controller_id), {'controller_name': os.path.basename(path), 'sha256': sha256})
+            registry.add(r, 'controller:' + str(controller_id))
             return JSONResponse("Data updated", status=status.HTTP_201_CREATED)
         except DataError:
             return JSONResponse("Error updating data", status=status.HTTP_400_BAD_REQUEST)
@@ -131,11 +133,11 @@ class ControllerData(APIView):
             data['id'] = controller_id
             file_obj = request.FILES['file']
 
-            make_sure_path_exists(settings.CONTROLLERS_DIR)
-            path = save_file(file_obj, settings.CONTROLLERS_DIR)
+            path, data['sha256'] = artifacts.save_file(file_obj, settings.CONTROLLERS_DIR)
             data['controller_name'] = os.path.basename(path)
 
             r.hmset('controller:' + str(controller_id), data)
+            registry.add(r, 'controller:' + str(controller_id))
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
 
@@ -186,14 +188,25 @@ def instances_list(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys('controller_instance:*')
-        controller_list = []
-        for key in keys:
-            controller = r.hgetall(key)
-            controller['id'] = key.split(':')[1]
-            controller['controller'] = r.hgetall('controller:' + controller['controller'])['controller_name']
-            controller_list.append(controller)
-        return JSONResponse(controller_list, status=status.HTTP_200_OK)
+        def load(keys):
+            instances = get_hashes(r, keys)
+            # Names of the controllers of the instances, read at once
+            controller_ids = list(set(instance['controller'] for instance in instances if instance))
+            controllers = get_hashes(r, ['controller:' + controller_id for controller_id in controller_ids], ['controller_name'])
+            controller_names = dict(zip(controller_ids, controllers))
+
+            for key, controller in zip(keys, instances):
+                if controller:
+                    controller['id'] = key.split(':')[1]
+                    controller['controller'] = controller_names[controller['controller']].get('controller_name')
+            return instances
+
+        try:
+            query = ListQuery(request.GET)
+            controller_list, last_key = get_page(query, index_fetcher(r, 'controller_instance', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, controller_list, last_key)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -210,7 +223,9 @@ def create_instance(request):
         data = JSONParser().parse(request)
         try:
             r.hincrby('controller:' + data['controller'], 'instances', 1)
-            r.hmset('controller_instance:' + str(r.incr('controller_instances:id')), data)
+            instance_key = 'controller_instance:' + str(r.incr('controller_instances:id'))
+            r.hmset(instance_key, data)
+            registry.add(r, instance_key)
             return JSONResponse("Instance created", status=status.HTTP_201_CREATED)
         except Exception:
             return JSONResponse("Error creating instance", status=status.HTTP_400_BAD_REQUEST)
@@ -248,6 +263,7 @@ def instance_detail(request, instance_id):
                 stop_controller_instance(instance_id)
 
             r.hmset('controller_instance:' + str(instance_id), data)
+            registry.add(r, 'controller_instance:' + str(instance_id))
             return JSONResponse("Data updated", status=status.HTTP_201_CREATED)
         except DataError:
             return JSONResponse("Error updating data", status=status.HTTP_400_BAD_REQUEST)
@@ -259,12 +275,12 @@ def instance_detail(request, instance_id):
             controller_id = 'controller:' + r.hgetall('controller_instance:' + instance_id)['controller']
             r.hincrby(controller_id, 'instances', -1)
             r.delete("controller_instance:" + str(instance_id))
+            registry.remove(r, "controller_instance:" + str(instance_id))
         except:
             return JSONResponse("Error deleting controller", status=status.HTTP_400_BAD_REQUEST)
 
         # If this is the last controller, the counter is reset
-        keys = r.keys('controller_instance:*')
-        if not keys:
+        if not registry.keys(r, 'controller_instance'):
             r.delete('controller_instances:id')
 
         return JSONResponse('Instance has been deleted', status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,158 @@
+"""
+Upload of a storlet to the .storlet container of many projects.
+
+A global storlet used to be uploaded to the Crystal enabled projects one
+after another, opening the file (and a connection to Swift) for each of
+them. The file is now read once and uploaded from a pool of
+STORLET_DEPLOY_WORKERS threads; each thread keeps its connection to the
+Swift proxy for all its uploads, and the connections are closed once the
+storlet is deployed. A failed upload is retried
+STORLET_DEPLOY_RETRIES times, waiting STORLET_DEPLOY_BACKOFF seconds
+before the first retry and twice as long before each next one. Client
+errors (4xx) are not retried.
+
+The result is a report with the status of every project.
+"""
+from django.conf import settings
+from multiprocessing.pool import ThreadPool
+from rest_framework import status
+from swiftclient import client as swift_client
+from swiftclient.exceptions import ClientException
+from urlparse import urlparse
+import logging
+import threading
+import time
+
+from api import artifacts
+
+logger = logging.getLogger(__name__)
+
+DEPLOYED = 'deployed'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+class StorletUploader(object):
+    """
+    Uploads the content of a storlet to projects.
+
+    :param filter_data: The filter of the storlet.
+    :param metadata: The storlet headers of the object.
+    :param contents: The bytes of the storlet file.
+    """
+
+    def __init__(self, r, filter_data, metadata, contents, token):
+        self.r = r
+        self.filter_data = filter_data
+        self.metadata = metadata
+        self.contents = contents
+        self.digest = artifacts.deployment_digest(filter_data.get('sha256'), metadata)
+        self.token = token
+        self.retries = settings.STORLET_DEPLOY_RETRIES
+        self.backoff = settings.STORLET_DEPLOY_BACKOFF
+        self._local = threading.local()
+        self._conns = list()
+        self._conns_lock = threading.Lock()
+
+    def _http_conn(self, url):
+        # The connection only depends on the host of the proxy, the path
+        # of the request is built from the parsed url of each project.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            _, conn = swift_client.http_connection(url)
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return urlparse(url), conn
+
+    def _discard_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            self._close(conn)
+
+    def _close(self, conn):
+        with self._conns_lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Closes the connections of all the threads, once they are done.
+        """
+        with self._conns_lock:
+            conns = list(self._conns)
+        for conn in conns:
+            self._close(conn)
+
+    def upload(self, project_id):
+        """
+        Uploads the storlet to a project, unless it already has it.
+
+        :return: The status of the project, e.g. {'status': 'deployed', 'attempts': 1}
+        """
+        name = self.filter_data['filter_name']
+        if artifacts.is_deployed(self.r, project_id, name, self.digest):
+            return {'status': UNCHANGED, 'attempts': 0}
+
+        url = settings.SWIFT_URL + "/AUTH_" + project_id
+        delay = self.backoff
+        attempt = 0
+        while True:
+            attempt += 1
+            swift_response = dict()
+            try:
+                swift_client.put_object(url, self.token, ".storlet", name, self.contents, len(self.contents),
+                                        None, None, "application/octet-stream", self.metadata,
+                                        self._http_conn(url), None, None, swift_response)
+                error = None
+            except ClientException as e:
+                error = str(e)
+            except Exception as e:
+                # Connection error: the next attempt opens a new connection
+                self._discard_conn()
+                error = str(e)
+
+            swift_status = swift_response.get('status')
+            if error is None and swift_status == status.HTTP_201_CREATED:
+                artifacts.set_deployed(self.r, project_id, name, self.digest)
+                return {'status': DEPLOYED, 'attempts': attempt}
+
+            retry = swift_status is None or swift_status >= 500
+            if not retry or attempt > self.retries:
+                logger.error("Storlet deploy, error uploading " + name + " to " + project_id + ": " +
+                             str(error or swift_response.get('reason')))
+                return {'status': FAILED, 'attempts': attempt, 'http_status': swift_status,
+                        'error': error or swift_response.get('reason')}
+            time.sleep(delay)
+            delay *= 2
+
+
+def deploy(r, project_ids, filter_data, metadata, token):
+    """
+    Uploads a storlet to the .storlet container of the projects.
+
+    :return: The status of each project, by project id, e.g.
+             {'0123456789abcdef': {'status': 'deployed', 'attempts': 1}}
+    """
+    with open(filter_data["path"], 'rb') as storlet_file:
+        contents = storlet_file.read()
+    uploader = StorletUploader(r, filter_data, metadata, contents, token)
+
+    try:
+        if len(project_ids) == 1:
+            return {project_ids[0]: uploader.upload(project_ids[0])}
+
+        pool = ThreadPool(max(min(settings.STORLET_DEPLOY_WORKERS, len(project_ids)), 1))
+        try:
+            results = pool.map(uploader.upload, project_ids)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(project_ids, results))
+    finally:
+        uploader.close()
@@ -8,13 +8,17 @@ from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
-from .views import dependency_list, dependency_detail, filter_list, filter_detail, filter_deploy, unset_filter, FilterData, DependencyData, filter_undeploy, dependency_deploy
+from api import registry
+from api.exceptions import SwiftClientError
+from .views import dependency_list, dependency_detail, filter_list, filter_detail, filter_deploy, unset_filter, FilterData, DependencyData, filter_undeploy, dependency_deploy, \
+    deploy_storlet
 from policies.views import slo_list, slo_detail
 
 
 # Tests use database=10 instead of 0.
 @override_settings(REDIS_CON_POOL=redis.ConnectionPool(host='localhost', port=6379, db=10),
-                   STORLET_FILTERS_DIR=os.path.join("/tmp", "crystal", "storlet_filters"))
+                   STORLET_FILTERS_DIR=os.path.join("/tmp", "crystal", "storlet_filters"),
+                   ARTIFACTS_DIR=os.path.join("/tmp", "crystal", "artifacts"))
 class FiltersTestCase(TestCase):
     def setUp(self):
         # Every test needs access to the request factory.
@@ -26,6 +30,8 @@ class FiltersTestCase(TestCase):
         self.create_dependency()
         self.create_storage_policies()
         self.create_sample_bw_policies()
+        # The fixtures are written directly to redis
+        registry.build_indexes(self.r)
 
     def tearDown(self):
         self.r.flushdb()
@@ -44,6 +50,29 @@ class FiltersTestCase(TestCase):
         self.assertEqual(storlets[0]['main'], "com.example.FakeMain")
         self.assertEqual(storlets[0]['id'], "1")
 
+    def test_list_storlet_paginated(self):
+        for name in ('fake2', 'fake3'):
+            self.r.hmset('filter:' + name, {'id': name[-1], 'filter_type': 'native', 'dsl_name': name})
+            registry.add(self.r, 'filter:' + name)
+
+        request = self.factory.get('/filters', {'limit': 2, 'fields': 'dsl_name'})
+        response = filter_list(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), [{'dsl_name': 'fake'}, {'dsl_name': 'fake2'}])
+
+        request = self.factory.get('/filters', {'limit': 2, 'fields': 'dsl_name', 'cursor': response['X-Next-Cursor']})
+        response = filter_list(request)
+        self.assertEqual(json.loads(response.content), [{'dsl_name': 'fake3'}])
+        self.assertFalse(response.has_header('X-Next-Cursor'))
+
+        request = self.factory.get('/filters', {'filter_type': 'native'})
+        response = filter_list(request)
+        self.assertEqual([storlet['dsl_name'] for storlet in json.loads(response.content)], ['fake2', 'fake3'])
+
+        request = self.factory.get('/filters', {'limit': 'all'})
+        response = filter_list(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_delete_storlet_ok(self):
         """
         Delete a storlet
@@ -226,6 +255,93 @@ class FiltersTestCase(TestCase):
         json_data = json.loads(dumped_data)
         self.assertEqual(json_data["filter_name"], "test-1.0.jar")
 
+    @mock.patch('filters.views.swift_client.put_object', side_effect=mock_put_object_status_created)
+    def test_filter_deploy_unchanged_storlet_is_not_uploaded_again(self, mock_put_object):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/fake/data', {'file': fp})
+            FilterData.as_view()(request, 'fake')
+        self.assertEqual(len(self.r.hget('filter:fake', 'sha256')), 64)
+
+        data = {"filter_id": "fake", "target_id": "0123456789abcdef",
+                "execution_server": "proxy", "execution_server_reverse": "proxy",
+                "object_type": "", "object_size": "", "object_tag": "", "object_name": "", "params": ""}
+        for _ in range(2):
+            request = self.factory.put('/filters/0123456789abcdef/deploy/fake', data, format='json')
+            request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+            response = filter_deploy(request, "fake", "0123456789abcdef")
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(mock_put_object.call_count, 1)
+
+        # Uploading the same file again does not update the deployed storlets
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/fake/data', {'file': fp})
+            response = FilterData.as_view()(request, 'fake')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(mock_put_object.call_count, 1)
+
+        # A change of the storlet metadata is deployed again
+        self.r.hset('filter:fake', 'main', 'com.example.OtherStorlet')
+        request = self.factory.put('/filters/0123456789abcdef/deploy/fake', data, format='json')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        response = filter_deploy(request, "fake", "0123456789abcdef")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(mock_put_object.call_count, 2)
+
+    @override_settings(STORLET_DEPLOY_BACKOFF=0)
+    @mock.patch('filters.views.swift_client.put_object')
+    def test_deploy_storlet_global(self, mock_put_object):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/fake/data', {'file': fp})
+            FilterData.as_view()(request, 'fake')
+        projects = ['project%d' % i for i in range(6)]
+        self.r.rpush('projects_crystal_enabled', *projects)
+        filter_data = self.r.hgetall('filter:fake')
+
+        with open('test_data/test-1.0.jar', 'rb') as fp:
+            storlet = fp.read()
+
+        # project1 fails with a server error, retried, and project2 with a client error
+        attempts = {'project1': [503, 201], 'project2': [401]}
+        uploads = list()
+
+        def put_object(url, token, container, name, contents, *args):
+            project_id = url.split('AUTH_')[1]
+            uploads.append(project_id)
+            response_dict = args[-1]
+            response_dict['status'] = attempts[project_id].pop(0) if attempts.get(project_id) else 201
+            self.assertEqual(contents, storlet)
+        mock_put_object.side_effect = put_object
+
+        with self.assertRaises(SwiftClientError):
+            deploy_storlet(self.r, 'global', filter_data, 'fake_token')
+        self.assertEqual(sorted(uploads), sorted(projects + ['project1']))
+
+        # The projects that have the storlet are not uploaded again
+        del uploads[:]
+        report = deploy_storlet(self.r, 'global', filter_data, 'fake_token')
+        self.assertEqual(uploads, ['project2'])
+        self.assertEqual(report['project2'], {'status': 'deployed', 'attempts': 1})
+        self.assertEqual(report['project0'], {'status': 'unchanged', 'attempts': 0})
+
+    @mock.patch('filters.storlet_deploy.swift_client.http_connection')
+    @mock.patch('filters.views.swift_client.put_object', side_effect=mock_put_object_status_created)
+    def test_deploy_storlet_global_closes_the_connections(self, mock_put_object, mock_http_connection):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/fake/data', {'file': fp})
+            FilterData.as_view()(request, 'fake')
+        self.r.rpush('projects_crystal_enabled', *['project%d' % i for i in range(6)])
+        conns = list()
+
+        def http_connection(url):
+            conns.append(mock.MagicMock())
+            return url, conns[-1]
+        mock_http_connection.side_effect = http_connection
+
+        deploy_storlet(self.r, 'global', self.r.hgetall('filter:fake'), 'fake_token')
+        self.assertTrue(conns)
+        for conn in conns:
+            conn.close.assert_called_once_with()
+
     @mock.patch('filters.views.swift_client.put_object', side_effect=mock_put_object_status_created)
     def test_filter_deploy_to_project_and_container_ok(self, mock_put_object):
         # Upload a filter for the storlet 1
@@ -251,6 +367,20 @@ class FiltersTestCase(TestCase):
         json_data = json.loads(dumped_data)
         self.assertEqual(json_data["filter_name"], "test-1.0.jar")
         
+    @mock.patch('filters.views.undeploy_storlet')
+    def test_unset_global_storlet_forgets_the_projects(self, mock_undeploy_storlet):
+        self.r.rpush('projects_crystal_enabled', 'project1', 'project2')
+        for project_id in ('global', 'project1', 'project2'):
+            self.r.hset('storlets:' + project_id, 'test-1.0.jar', 'abc')
+        self.r.hset('storlets:project2', 'other-1.0.jar', 'def')
+        filter_data = self.r.hgetall('filter:fake')
+        filter_data['filter_name'] = 'test-1.0.jar'
+
+        unset_filter(self.r, 'global', filter_data, 'fake_token')
+        self.assertFalse(self.r.exists('storlets:global'))
+        self.assertFalse(self.r.exists('storlets:project1'))
+        self.assertEqual(self.r.hgetall('storlets:project2'), {'other-1.0.jar': 'def'})
+
     @mock.patch('filters.views.unset_filter')
     def test_filter_undeploy(self, mock_unset_filter):
         request = self.factory.put('/filters/projectid/containerid/swiftobject/undeploy/1')
@@ -18,9 +18,14 @@ import mimetypes
 import os
 
 from api.common import rsync_dir_with_nodes, JSONResponse, \
-    get_redis_connection, get_token_connection, make_sure_path_exists, save_file, md5,\
+    get_redis_connection, get_hashes, get_token_connection, md5,\
     to_json_bools
+from api import artifacts, registry
+from api.listing import ListQuery, InvalidListQuery, get_page, index_fetcher, list_response
 from api.exceptions import SwiftClientError, StorletNotFoundException, FileSynchronizationException
+from filters import storlet_deploy
+from policies import static_policies
+from policies.dsl_parser import invalidate_grammar_cache
 
 logger = logging.getLogger(__name__)
 
@@ -40,14 +45,19 @@ def filter_list(request):
     except RedisError:
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     if request.method == 'GET':
-        keys = r.keys("filter:*")
-        filters = []
-        for key in keys:
-            filter = r.hgetall(key)
-            to_json_bools(filter, 'get', 'put', 'post', 'head', 'delete')
-            filters.append(filter)
-        sorted_list = sorted(filters, key=lambda x: int(itemgetter('id')(x)))
-        return JSONResponse(sorted_list, status=status.HTTP_200_OK)
+        def load(keys):
+            filters = get_hashes(r, keys)
+            for filter in filters:
+                to_json_bools(filter, 'get', 'put', 'post', 'head', 'delete')
+            return filters
+
+        try:
+            query = ListQuery(request.GET)
+            filters, last_key = get_page(query, index_fetcher(r, 'filter', load),
+                                         sort_key=lambda x: int(itemgetter('id')(x)))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, filters, last_key)
 
     if request.method == 'POST':
         try:
@@ -64,6 +74,8 @@ def filter_list(request):
             filter_id = r.incr("filters:id")
             data['id'] = filter_id
             r.hmset('filter:' + str(data['dsl_name']), data)
+            registry.add(r, 'filter:' + str(data['dsl_name']))
+            invalidate_grammar_cache(r)
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
 
@@ -99,19 +111,21 @@ def filter_detail(request, filter_id):
         try:
             if 'dsl_name' in data and str(filter_id) != data['dsl_name']:
                 # Check for possible activated policies
-                policies = r.keys('policy:*')
-                for policy_key in policies:
-                    policy = r.hgetall(policy_key)
-                    dsl_filter = policy['filter']
-                    if dsl_filter == str(filter_id):
+                policies = registry.keys(r, 'policy')
+                for policy in get_hashes(r, policies, ['filter']):
+                    if policy.get('filter') == str(filter_id):
                         return JSONResponse("It is not possible to change the DSL Name, "+str(filter_id)+
                                             " is associated with some Dynamic Policy", status=status.HTTP_400_BAD_REQUEST)
                 filter_data = r.hgetall("filter:" + str(filter_id))
                 r.hmset('filter:' + str(data['dsl_name']), filter_data)
                 r.delete("filter:" + str(filter_id))
                 r.hmset('filter:' + str(data['dsl_name']), data)
+                registry.remove(r, "filter:" + str(filter_id))
+                registry.add(r, 'filter:' + str(data['dsl_name']))
+                invalidate_grammar_cache(r)
             else:
                 r.hmset('filter:' + str(filter_id), data)
+            static_policies.invalidate(r)
 
             return JSONResponse("Data updated", status=status.HTTP_200_OK)
         except DataError:
@@ -120,6 +134,9 @@ def filter_detail(request, filter_id):
     elif request.method == 'DELETE':
         try:
             r.delete("filter:" + str(filter_id))
+            registry.remove(r, "filter:" + str(filter_id))
+            invalidate_grammar_cache(r)
+            static_policies.invalidate(r)
 
             return JSONResponse('Filter has been deleted', status=status.HTTP_204_NO_CONTENT)
         except DataError:
@@ -151,19 +168,18 @@ class FilterData(APIView):
             elif filter_type == 'native':
                 filter_dir = settings.NATIVE_FILTERS_DIR
 
-            make_sure_path_exists(filter_dir)
-            path = save_file(file_obj, filter_dir)
+            path, sha256 = artifacts.save_file(file_obj, filter_dir)
+            filter_basename = os.path.basename(path)
+            if r.hget(filter_name, 'sha256') == sha256 and r.hget(filter_name, 'path') == path:
+                # Same file: the deployed filters and the nodes already have it
+                return JSONResponse('Filter has been updated', status=status.HTTP_201_CREATED)
             md5_etag = md5(path)
 
             try:
-                filter_basename = os.path.basename(path)
                 content_length = os.stat(path).st_size
                 etag = str(md5_etag)
-                path = str(path)
-                r.hset(filter_name, "filter_name", filter_basename)
-                r.hset(filter_name, "path", path)
-                r.hset(filter_name, "content_length", content_length)
-                r.hset(filter_name, "etag", etag)
+                r.hmset(filter_name, {'filter_name': filter_basename, 'path': path, 'content_length': content_length,
+                                      'etag': etag, 'sha256': sha256})
             except RedisError:
                 return JSONResponse('Problems connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -171,11 +187,10 @@ class FilterData(APIView):
             filter_data = r.hgetall(filter_name)
             main = filter_data['main']
             token = get_token_connection(request)
-            pipelines = r.keys('pipeline:*')
+            pipelines = registry.keys(r, 'pipeline')
 
-            for pipeline in pipelines:
+            for pipeline, filters_data in zip(pipelines, get_hashes(r, pipelines)):
                 target = pipeline.replace('pipeline:', '')
-                filters_data = r.hgetall(pipeline)
                 for policy_id in filters_data:
                     parameters = {}
                     parameters["policy_id"] = policy_id
@@ -184,6 +199,7 @@ class FilterData(APIView):
                         cfilter['filter_name'] = filter_basename
                         cfilter['content_length'] = content_length
                         cfilter['etag'] = etag
+                        cfilter['sha256'] = sha256
                         cfilter['path'] = path
                         cfilter['main'] = main
                         set_filter(r, target, cfilter, parameters, token)
@@ -338,11 +354,12 @@ def dependency_list(request):
         return JSONResponse('Error connecting with DB', status=500)
 
     if request.method == 'GET':
-        keys = r.keys("dependency:*")
-        dependencies = []
-        for key in keys:
-            dependencies.append(r.hgetall(key))
-        return JSONResponse(dependencies, status=200)
+        try:
+            query = ListQuery(request.GET)
+            dependencies, last_key = get_page(query, index_fetcher(r, 'dependency', lambda keys: get_hashes(r, keys)))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=400)
+        return list_response(query, dependencies, last_key)
 
     elif request.method == 'POST':
         data = JSONParser().parse(request)
@@ -350,6 +367,7 @@ def dependency_list(request):
         try:
             data["id"] = dependency_id
             r.hmset('dependency:' + str(dependency_id), data)
+            registry.add(r, 'dependency:' + str(dependency_id))
             return JSONResponse(data, status=201)
         except DataError:
             return JSONResponse("Error to save the filter", status=400)
@@ -375,12 +393,14 @@ def dependency_detail(request, dependency_id):
         data = JSONParser().parse(request)
         try:
             r.hmset('dependency:' + str(dependency_id), data)
+            registry.add(r, 'dependency:' + str(dependency_id))
             return JSONResponse("Data updated", status=201)
         except DataError:
             return JSONResponse("Error updating data", status=400)
 
     elif request.method == 'DELETE':
         r.delete("dependency:" + str(dependency_id))
+        registry.remove(r, "dependency:" + str(dependency_id))
         return JSONResponse('Dependency has been deleted', status=204)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
@@ -395,8 +415,8 @@ class DependencyData(APIView):
             return JSONResponse('Problems to connect with the DB', status=500)
         if r.exists("dependency:" + str(dependency_id)):
             file_obj = request.FILES['file']
-            path = save_file(file_obj, settings.DEPENDENCY_DIR)
-            r.hset("dependency:" + str(dependency_id), "path", str(path))
+            path, sha256 = artifacts.save_file(file_obj, settings.DEPENDENCY_DIR)
+            r.hmset("dependency:" + str(dependency_id), {"path": path, "sha256": sha256})
             return JSONResponse('Dependency has been updated', status=201)
         return JSONResponse('Dependency does not exist', status=404)
 
@@ -505,48 +525,54 @@ def dependency_undeploy(request, dependency_id, project_id):
 
 def set_filter(r, target, filter_data, parameters, token):
     if filter_data['filter_type'] == 'storlet':
+        deploy_storlet(r, target, filter_data, token)
 
-        metadata = {"X-Object-Meta-Storlet-Language": filter_data["language"],
-                    "X-Object-Meta-Storlet-Interface-Version": filter_data["interface_version"],
-                    "X-Object-Meta-Storlet-Dependency": '',
-                    "X-Object-Meta-Storlet-Object-Metadata": '',
-                    "X-Object-Meta-Storlet-Main": filter_data["main"]
-                    }
+    pipeline_key, policy_id, data = get_pipeline_entry(target, filter_data, parameters)
+    r.hset(pipeline_key, policy_id, data)
+    registry.add(r, pipeline_key)
+    static_policies.update(r, pipeline_key.replace('pipeline:', ''), policy_id, data)
 
-        try:
-            project_id = target.split(':')[0]
-
-            if project_id == 'global':
-                projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
-                for project_id in projects_crystal_enabled:
-                    swift_response = dict()
-                    url = settings.SWIFT_URL + "/AUTH_" + project_id
-                    storlet_file = open(filter_data["path"], 'r')
-                    swift_client.put_object(url, token, ".storlet",
-                                            filter_data["filter_name"],
-                                            storlet_file, None,
-                                            None, None, "application/octet-stream",
-                                            metadata, None, None, None, swift_response)
-            else:
-                swift_response = dict()
-                url = settings.SWIFT_URL + "/AUTH_" + project_id
-                storlet_file = open(filter_data["path"], 'r')
-                swift_client.put_object(url, token, ".storlet",
-                                        filter_data["filter_name"],
-                                        storlet_file, None,
-                                        None, None, "application/octet-stream",
-                                        metadata, None, None, None, swift_response)
-            storlet_file.close()
 
-        except Exception as e:
-            logging.error(str(e))
-            raise SwiftClientError("A problem occurred accessing Swift")
+def deploy_storlet(r, target, filter_data, token):
+    """
+    Uploads a storlet to the .storlet container of the target project, or
+    of every Crystal enabled project if the target is 'global'.
+
+    :return: The status of each project (see filters.storlet_deploy).
+    :raises SwiftClientError: If the storlet could not be uploaded to a project.
+    """
+    metadata = {"X-Object-Meta-Storlet-Language": filter_data["language"],
+                "X-Object-Meta-Storlet-Interface-Version": filter_data["interface_version"],
+                "X-Object-Meta-Storlet-Dependency": '',
+                "X-Object-Meta-Storlet-Object-Metadata": '',
+                "X-Object-Meta-Storlet-Main": filter_data["main"]
+                }
+
+    project_id = target.split(':')[0]
+    if project_id == 'global':
+        project_ids = r.lrange('projects_crystal_enabled', 0, -1)
+    else:
+        project_ids = [project_id]
+
+    try:
+        report = storlet_deploy.deploy(r, project_ids, filter_data, metadata, token)
+    except Exception as e:
+        logging.error(str(e))
+        raise SwiftClientError("A problem occurred accessing Swift")
+
+    failed = sorted(project_id for project_id, result in report.items() if result['status'] == storlet_deploy.FAILED)
+    if failed:
+        raise SwiftClientError("A problem occurred uploading Storlet to Swift: " + ", ".join(failed))
+    return report
 
-        swift_status = swift_response.get("status")
 
-        if swift_status != status.HTTP_201_CREATED:
-            raise SwiftClientError("A problem occurred uploading Storlet to Swift")
+def get_pipeline_entry(target, filter_data, parameters):
+    """
+    Returns the entry of a static policy in the pipeline of its target.
 
+    :return: The pipeline key, the policy id and the policy data (JSON).
+    :rtype: tuple
+    """
     if not parameters:
         parameters = {}
 
@@ -565,24 +591,74 @@ def set_filter(r, target, filter_data, parameters, token):
 
     data_dumped = json.dumps(data).replace('"True"', 'true').replace('"False"', 'false')
 
-    r.hset("pipeline:" + str(target), policy_id, data_dumped)
+    return "pipeline:" + str(target), policy_id, data_dumped
 
 
 # FOR TENANT:crystal DO DELETE compression
 def unset_filter(r, target, filter_data, token):
     if filter_data['filter_type'] == 'storlet':
+        swift_response = dict()
         try:
-            project_id = target.split('/', 3)[0]
-            swift_response = dict()
-            url = settings.SWIFT_URL + "/AUTH_" + project_id
-            swift_client.delete_object(url, token, ".storlet", filter_data["filter_name"], None, None, None, None, swift_response)
+            undeploy_storlet(target, filter_data, token, swift_response)
         except ClientException as e:
             print swift_response + str(e)
             return swift_response.get("status")
+        project_id = target.replace('/', ':').split(':')[0]
+        if project_id == 'global':
+            # A global storlet was deployed to every Crystal enabled project
+            project_ids = [project_id] + r.lrange('projects_crystal_enabled', 0, -1)
+        else:
+            project_ids = [project_id]
+        pipe = r.pipeline()
+        for project_id in project_ids:
+            artifacts.unset_deployed(pipe, project_id, filter_data['filter_name'])
+        pipe.execute()
 
+    for pipeline_key, policy_id in get_pipeline_entries(r, target, filter_data):
+        r.hdel(pipeline_key, policy_id)
+        registry.remove_if_empty(r, pipeline_key)
+        static_policies.remove(r, pipeline_key.replace('pipeline:', ''), policy_id)
+
+
+def undeploy_storlet(target, filter_data, token, swift_response):
+    """
+    Deletes a storlet from the .storlet container of the target project.
+
+    :raises ClientException: If the storlet could not be deleted.
+    """
+    project_id = target.split('/', 3)[0]
+    url = settings.SWIFT_URL + "/AUTH_" + project_id
+    swift_client.delete_object(url, token, ".storlet", filter_data["filter_name"], None, None, None, None, swift_response)
+
+
+def revert_deploy_storlet(r, target, filter_data, token):
+    """
+    Deletes a storlet uploaded by deploy_storlet() from the projects of the
+    target, and forgets its deployments.
+
+    :raises ClientException: If the storlet could not be deleted.
+    """
+    project_id = target.replace('/', ':').split(':')[0]
+    if project_id == 'global':
+        project_ids = r.lrange('projects_crystal_enabled', 0, -1)
+    else:
+        project_ids = [project_id]
+    for project_id in project_ids:
+        undeploy_storlet(project_id, filter_data, token, dict())
+        artifacts.unset_deployed(r, project_id, filter_data['filter_name'])
+
+
+def get_pipeline_entries(r, target, filter_data):
+    """
+    Returns the entries of the pipeline of a target that deploy a filter.
+
+    :rtype: list of (pipeline key, policy id) tuples
+    """
     target = target.replace('/', ':')
     keys = r.hgetall("pipeline:" + str(target))
+    entries = list()
     for key, value in keys.items():
         json_value = json.loads(value)
         if json_value["filter_name"] == filter_data["filter_name"]:
-            r.hdel("pipeline:" + str(target), key)
+            entries.append(("pipeline:" + str(target), key))
+    return entries
@@ -1,10 +1,15 @@
 from django.conf import settings
 from redis.exceptions import RedisError
+from api import registry
+from metrics.aggregator import ColumnarAggregator, AggregationTier, Feed, DEFAULT_TIER, parse_tiers
+from metrics.decoder import MetricDecoder
+from metrics.forwarder import LogstashForwarder
+from metrics.subscriptions import SubscriptionIndex, ALL
+from policies.actors.rule_engine import RULE_ENGINE_PREFIX
+from policies.dsl_parser import invalidate_grammar_cache
 from threading import Thread
 import logging
 import redis
-import json
-import socket
 import time
 import Queue
 
@@ -19,13 +24,19 @@ class SwiftMetric(object):
     This class also treats each tenant as a topic, so it is able to distinguish
     for each observer in that tenant is subscribed. In this way, the metric
     actor only sends the necessary information to each observer.
+
+    Observers subscribe to an aggregation tier (see metrics.aggregator), so
+    each one receives the window it needs at the pace of that window, and
+    to a target, which can be a wildcard (see metrics.subscriptions). Only
+    the targets some observer watches are aggregated.
     """
-    _tell = ['attach', 'detach', 'notify', 'start_consuming', 'stop_consuming']
+    _tell = ['attach', 'detach', 'notify', 'notify_many', 'start_consuming', 'stop_consuming', 'set_tiers']
     _ask = ['init_consum', 'stop_actor']
     _ref = ['attach']
 
-    def __init__(self, metric_id, routing_key):
+    def __init__(self, metric_id, routing_key, tiers=DEFAULT_TIER):
         self._observers = {}
+        self._tiers = {}
         self.value = None
         self.name = None
         self.consumer = None
@@ -37,7 +48,12 @@ class SwiftMetric(object):
         self.name = metric_id
         self.routing_key = routing_key
         self.logstash_server = (self.logstash_host, self.logstash_port)
-        self.metrics = Queue.Queue()
+        self.messages = Queue.Queue()
+        self.decoder = MetricDecoder()
+        self.aggregator = ColumnarAggregator()
+        self.forwarder = LogstashForwarder(self.logstash_server, settings.LOGSTASH_MAX_DATAGRAM,
+                                           settings.LOGSTASH_QUEUE_SIZE)
+        self.set_tiers(tiers)
 
         # Subprocess to aggregate collected metrics every time interval
         self.notifier = Thread(target=self._aggregate_and_send_info)
@@ -49,26 +65,64 @@ class SwiftMetric(object):
             logger.info('"Error connecting with Redis DB"')
             print "Error connecting with Redis DB"
 
-    def attach(self, observer):
+    def set_tiers(self, tiers):
+        """
+        Asynchronous method. This method allows to be called remotely. It
+        sets the aggregation tiers configured for this workload metric.
+        Tiers that still have observers attached are kept.
+
+        :param tiers: Comma-separated tier specs, e.g. "1s, 10s:tumbling, ewma".
+        :type tiers: String
+        """
+        specs = parse_tiers(tiers)
+        for spec in specs:
+            if spec not in self._tiers:
+                self._tiers[spec] = AggregationTier(spec, AGGREGATION_INTERVAL)
+        for spec in list(self._tiers):
+            if spec not in specs and not self._observers.get(spec):
+                del self._tiers[spec]
+        self.tier_specs = specs
+
+    def attach(self, observer, tier=None, feed=None, targets=None):
         """
         Asyncronous method. This method allows to be called remotely. It is
         called from observers in order to subscribe in this workload metric.
-        This observer will be saved in a dictionary type structure where the
-        key will be the tenant assigned in the observer, and the value will be
-        the PyActor proxy to connect to the observer.
+        This observer will be saved in the subscription index of its
+        aggregation tier, under the target assigned in the observer.
 
         :param observer: The PyActor proxy of the observer rule that calls this method.
         :type observer: **any** PyActor Proxy type
+        :param tier: The aggregation tier spec. By default, the 1 second sum.
+        :type tier: String
+        :param feed: Only for "ALL" observers, the group-by fields and reducer
+                     of the table they receive instead of the raw metrics,
+                     e.g. {'group_by': ['project_id', 'host'], 'reducer': 'sum'}
+        :type feed: Dict
+        :param targets: The targets to subscribe the observer to. By default,
+                        the target returned by the observer's get_target().
+        :type targets: List
         """
 
         logger.info('Metric, Attaching observer: ' + str(observer))
-        target = observer.get_target(timeout=2)
+        if not targets:
+            targets = [observer.get_target(timeout=2)]
         observer_id = observer.get_id()
+        tier = tier or DEFAULT_TIER
+        if feed:
+            try:
+                feed = Feed.from_spec(feed)
+            except (ValueError, AttributeError) as e:
+                logger.error('Metric, Invalid feed ' + str(feed) + ': ' + str(e))
+                feed = None
 
-        if target not in self._observers.keys():
-            self._observers[target] = dict()
-        if observer_id not in self._observers[target].keys():
-            self._observers[target][observer_id] = observer
+        if tier not in self._tiers:
+            # Tiers not configured for this metric are created on demand
+            self._tiers[tier] = AggregationTier(tier, AGGREGATION_INTERVAL)
+            logger.info('Metric, New aggregation tier: ' + tier)
+
+        index = self._observers.setdefault(tier, SubscriptionIndex())
+        for target in targets:
+            index.add(target, observer_id, observer, feed)
 
     def detach(self, observer, target):
         """
@@ -79,13 +133,18 @@ class SwiftMetric(object):
         :param observer: The PyActor actor id of the observer rule that calls this method.
         :type observer: String
         """
-        try:
-            del self._observers[target][observer]
-            if len(self._observers[target]) == 0:
-                del self._observers[target]
-            logger.info('Metric, observer detached: ' + str(observer))
-        except KeyError:
-            pass
+        for index in self._observers.values():
+            if index.remove(target, observer):
+                logger.info('Metric, observer detached: ' + str(observer))
+
+    def _all_observers(self):
+        """
+        :return: The observers attached to any tier, by observer id.
+        """
+        observers = dict()
+        for index in self._observers.values():
+            observers.update(index.items())
+        return observers
 
     def init_consum(self):
         """
@@ -99,7 +158,10 @@ class SwiftMetric(object):
         """
         try:
             self.redis.hmset("metric:" + self.name, {"network_location": self.proxy.actor.url,
-                                                     "type": "integer"})
+                                                     "type": "integer",
+                                                     "tiers": ', '.join(self.tier_specs)})
+            registry.add(self.redis, "metric:" + self.name)
+            invalidate_grammar_cache(self.redis)
 
             self.consumer = self.host.spawn(self.id + "_consumer", settings.CONSUMER_MODULE,
                                             self.queue, self.routing_key, self.proxy)
@@ -113,14 +175,20 @@ class SwiftMetric(object):
         This method ends the workload execution and kills the actor.
         """
         try:
-            # Stop observers
-            for tenant in self._observers:
-                for observer in self._observers[tenant].values():
+            # Stop observers. A rule engine also hosts policies of other
+            # metrics, so it only drops (and stops) the ones of this metric.
+            for observer_id, observer in self._all_observers().items():
+                if observer_id.startswith(RULE_ENGINE_PREFIX):
+                    observer.remove_metric(self.name)
+                else:
                     observer.stop_actor()
-                    self.redis.hset(observer.get_id(), 'status', 'Stopped')
+                    self.redis.hset(observer_id, 'status', 'Stopped')
 
             self.redis.delete("metric:" + self.name)
+            registry.remove(self.redis, "metric:" + self.name)
+            invalidate_grammar_cache(self.redis)
             self.stop_consuming()
+            self.forwarder.stop()
             self.host.stop_actor(self.id)
 
         except Exception as e:
@@ -148,59 +216,117 @@ class SwiftMetric(object):
     def notify(self, body):
         """
         Method called from the consumer to indicate the value consumed from the
-        rabbitmq queue. After receive the value, this value is communicated to
-        all the observers subscribed to this metric.
+        rabbitmq queue. The raw body is only queued here; it is decoded in
+        batches by the aggregation thread and then communicated to all the
+        observers subscribed to this metric.
 
         {'container': 'crystal/data', 'metric_name': 'bandwidth', '@timestamp': '2017-09-09T18:00:18.331492+02:00',
          'value': 16.4375, 'project': 'crystal', 'host': 'controller', 'method': 'GET', 'server_type': 'proxy'}
         """
-        metric = eval(body)
-        if metric['server_type'] == 'proxy':
-            self.metrics.put(metric)
-        self._send_data_to_logstash(metric)
-
-    def _send_data_to_logstash(self, metric):
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = json.dumps(metric)+'\n'
-            sock.sendto(message, self.logstash_server)
-        except socket.error:
-            logger.info("Swift Metric: Error sending monitoring data to logstash.")
+        self.messages.put(body)
 
-    def _aggregate_and_send_info(self):
-        while True:
-            time.sleep(AGGREGATION_INTERVAL)
-            aggregate = dict()
-            metric_list = list()
+    def notify_many(self, bodies):
+        """
+        Batched version of **notify()**, called from the consumer with all
+        the messages consumed since the last delivery.
+        """
+        for body in bodies:
+            self.messages.put(body)
 
-            while not self.metrics.empty():
-                metric = self.metrics.get()
-                metric_list.append(metric)
-                try:
-                    project = metric['project']
-                    container = metric['container']
-                    value = metric['value']
+    def _drain_messages(self):
+        bodies = list()
+        try:
+            while True:
+                bodies.append(self.messages.get_nowait())
+        except Queue.Empty:
+            pass
+        return bodies
 
-                    if project not in aggregate:
-                        aggregate[project] = 0
-                    if container not in aggregate:
-                        aggregate[container] = 0
+    def _collect_metrics(self):
+        """
+        Decodes all the messages consumed since the last call, forwards them
+        to logstash and returns the records generated by proxy servers.
+        """
+        records = self.decoder.decode_batch(self._drain_messages())
+        self.forwarder.send([record.data for record in records])
+        return [record for record in records if record.server_type == 'proxy']
 
-                    aggregate[project] += value
-                    aggregate[container] += value
+    def _aggregate(self, records):
+        """
+        Stores the records of the last interval and returns the aggregated
+        value, during that interval, of each project and container watched
+        by some observer.
+        """
+        self.aggregator.store(records)
+        indexes = [index for index in self._observers.values() if index]
 
-                except:
-                    logger.info("Swift Metric, Error parsing metric: " + str(metric))
+        def watched(target):
+            return any(index.watches(target) for index in indexes)
 
-            try:
-                for target in aggregate:
-                    if target in self._observers:
-                        for observer in self._observers[target].values():
-                            observer.update(self.name, aggregate[target])
+        aggregate = dict()
+        for key in ('project', 'container'):
+            if any(index.watches_level(key) for index in indexes):
+                aggregate.update(self.aggregator.sums(key, watched))
+        return aggregate
 
-                if "ALL" in self._observers and len(metric_list) > 0:
-                    for observer in self._observers["ALL"].values():
-                        observer.update(self.name, metric_list)
+    def _send_info(self, aggregate, metric_list):
+        """
+        Feeds the last interval to every aggregation tier and sends the
+        values of the tiers that emit this tick to their observers. All the
+        values of a tier addressed to the same observer are coalesced in a
+        single update_many call. An observer subscribed to several tiers gets
+        one call per tier, so the value of a target in one tier does not
+        overwrite its value in another.
+        """
+        batches = dict()
+        for spec, tier in self._tiers.items():
+            index = self._observers.get(spec)
+            result = tier.update(aggregate, metric_list if index and index.all else [])
+            if not index or result is None:
+                continue
+            values, metrics = result
+            for target, value in values.items():
+                for observer_id, observer in index.match(target).items():
+                    batches.setdefault((spec, observer_id), (observer, dict()))[1][target] = value
+
+            if len(metrics) > 0:
+                # Feeds shared by several observers are reduced only once
+                tables = dict()
+                for observer_id, observer in index.all.items():
+                    feed = index.feeds.get(observer_id)
+                    if feed is None:
+                        payload = metrics
+                    else:
+                        if feed.key not in tables:
+                            tables[feed.key] = feed.reduce(metrics)
+                        payload = tables[feed.key]
+                    batches.setdefault((spec, observer_id), (observer, dict()))[1][ALL] = payload
+
+        for observer, batch in batches.values():
+            self._deliver(observer, batch)
+
+    def _deliver(self, observer, batch):
+        """
+        Sends a batch of values {target: value} to an observer. Observers that
+        do not expose update_many receive one update call per target.
+        """
+        try:
+            update_many = getattr(observer, 'update_many', None)
+            if update_many:
+                update_many(self.name, batch)
+            else:
+                for value in batch.values():
+                    observer.update(self.name, value)
+        except Exception as e:
+            logger.info("Swift Metric: Error sending monitoring data to observer: "+str(e))
 
-            except Exception as e:
-                logger.info("Swift Metric: Error sending monitoring data to observer: "+str(e))
+    def _aggregate_and_send_info(self):
+        while True:
+            time.sleep(AGGREGATION_INTERVAL)
+            records = self._collect_metrics()
+            aggregate = self._aggregate(records)
+            if any(index.all for index in self._observers.values()):
+                metric_list = [record.data for record in records]
+            else:
+                metric_list = []
+            self._send_info(aggregate, metric_list)
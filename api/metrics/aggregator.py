@@ -0,0 +1,257 @@
+"""
+Columnar aggregation engine of the workload metric actors.
+
+The decoded records of each aggregation tick are stored column-wise: the
+group-by fields SwiftMetric reduces (project and container) as interned
+integer ids and the values as a NumPy array, so the per-target sums are
+computed with grouped array reductions instead of Python loops over
+dictionaries. Only the last tick is kept: longer windows are kept by the
+aggregation tiers from the per-tick sums, which costs one entry per target
+instead of one per sample.
+"""
+from collections import deque
+from operator import itemgetter
+import numpy as np
+from metrics.decoder import MetricRecord
+
+GROUP_KEYS = ('project', 'container')
+FIELDS = MetricRecord._fields
+
+
+class Interner(object):
+    """
+    Maps names to consecutive integer ids (and back).
+    """
+
+    def __init__(self):
+        self.ids = dict()
+        self.names = list()
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        try:
+            return self.ids[name]
+        except KeyError:
+            new_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            return new_id
+
+    def intern_all(self, names):
+        """
+        Returns the ids of a sequence of names as a NumPy array.
+        """
+        for name in set(names).difference(self.ids):
+            self.intern(name)
+        return np.fromiter(map(self.ids.__getitem__, names), dtype=np.int32, count=len(names))
+
+
+class ColumnarAggregator(object):
+    """
+    Samples of the last aggregation tick stored column-wise.
+
+    Each call to ``store`` replaces the samples of the previous tick, so the
+    columns are as long as the tick and no memory is kept for older ones.
+    """
+
+    def __init__(self):
+        self.interners = dict((key, Interner()) for key in GROUP_KEYS)
+        self.ids = dict((key, np.zeros(0, dtype=np.int32)) for key in GROUP_KEYS)
+        self.values = np.zeros(0, dtype=np.float64)
+
+    def store(self, records):
+        """
+        Stores the records of a new aggregation tick.
+
+        :param records: The records decoded during the last interval.
+        :type records: list of MetricRecord
+        """
+        for key in GROUP_KEYS:
+            column = map(itemgetter(FIELDS.index(key)), records)
+            self.ids[key] = self.interners[key].intern_all(column)
+        self.values = np.fromiter(map(itemgetter(FIELDS.index('value')), records),
+                                  dtype=np.float64, count=len(records))
+
+    def sums(self, key, select=None):
+        """
+        Sum of the values of each ``key`` group during the last tick.
+
+        :param select: Optional predicate on the group names. Only the
+                       groups for which it returns True are reported.
+        :rtype: dict
+        """
+        ids = self.ids[key]
+        if not len(ids):
+            return dict()
+        names = self.interners[key].names
+        counts = np.bincount(ids, minlength=len(names))
+        present = np.flatnonzero(counts)
+        if select is not None:
+            present = [i for i in present if select(names[i])]
+            if not present:
+                return dict()
+        sums = np.bincount(ids, weights=self.values, minlength=len(names))
+        return dict(zip([names[i] for i in present], sums[present].tolist()))
+
+
+DEFAULT_TIER = '1s'
+DEFAULT_EWMA_ALPHA = 0.3
+EWMA_EPSILON = 1e-6
+
+
+class AggregationTier(object):
+    """
+    Downsampled view of a workload metric delivered to the observers that
+    subscribe to it. Tiers are built from the per-tick sums of each target,
+    so their cost depends on the number of targets and not on the number of
+    samples. Supported specs:
+
+    * ``<N>s``: sliding window, the sum of the last N seconds, every tick.
+    * ``<N>s:tumbling``: tumbling window, the sum of N seconds, every N seconds.
+    * ``ewma`` or ``ewma:<alpha>``: exponentially weighted moving average of
+      the per-tick sums, every tick.
+    """
+
+    def __init__(self, spec, interval=1):
+        self.spec = spec
+        self.interval = interval
+        self.ticks = 1
+        self.alpha = None
+        self.elapsed = 0
+        self.totals = dict()
+        self.metrics = list()
+        self.history = deque()
+        self.presence = dict()
+
+        name, _, mode = spec.partition(':')
+        if name == 'ewma':
+            self.kind = 'ewma'
+            self.alpha = float(mode) if mode else DEFAULT_EWMA_ALPHA
+            if not 0 < self.alpha <= 1:
+                raise ValueError('EWMA alpha must be in (0, 1]: ' + spec)
+        elif name.endswith('s') and name[:-1].isdigit() and int(name[:-1]) > 0 and mode in ('', 'sliding', 'tumbling'):
+            self.kind = mode or 'sliding'
+            self.ticks = max(1, int(round(float(name[:-1]) / interval)))
+        else:
+            raise ValueError('Invalid aggregation tier: ' + spec)
+
+    def update(self, tick_sums, metric_list):
+        """
+        Feeds the sums and the raw metrics of the last tick to the tier.
+
+        :return: The aggregated value of each target and the raw metrics of
+                 the period, or None if the tier does not emit this tick.
+        """
+        self.elapsed += 1
+        if self.kind == 'ewma':
+            for target in set(self.totals).union(tick_sums):
+                value = self.alpha * tick_sums.get(target, 0) + (1 - self.alpha) * self.totals.get(target, 0)
+                if target in tick_sums or abs(value) > EWMA_EPSILON:
+                    self.totals[target] = value
+                else:
+                    del self.totals[target]
+            return dict(self.totals), metric_list
+
+        for target, value in tick_sums.items():
+            self.totals[target] = self.totals.get(target, 0) + value
+
+        if self.kind == 'sliding':
+            self.history.append(tick_sums)
+            for target in tick_sums:
+                self.presence[target] = self.presence.get(target, 0) + 1
+            if len(self.history) > self.ticks:
+                for target, value in self.history.popleft().items():
+                    self.presence[target] -= 1
+                    if self.presence[target]:
+                        self.totals[target] -= value
+                    else:
+                        del self.presence[target]
+                        del self.totals[target]
+            return dict(self.totals), metric_list
+
+        # Tumbling window
+        self.metrics.extend(metric_list)
+        if self.elapsed % self.ticks:
+            return None
+        result = self.totals, self.metrics
+        self.totals = dict()
+        self.metrics = list()
+        return result
+
+
+def parse_tiers(specs):
+    """
+    Parses a comma-separated list of tier specs, e.g. "1s, 10s:tumbling, ewma".
+
+    :param specs: The tier specs, as a string or as a list of strings.
+    :return: The normalized list of specs.
+    :raises ValueError: If a spec is not valid.
+    """
+    if isinstance(specs, (list, tuple)):
+        specs = ','.join(specs)
+    tiers = list()
+    for spec in specs.split(','):
+        spec = spec.strip().replace(' ', '')
+        if spec:
+            AggregationTier(spec)
+            if spec not in tiers:
+                tiers.append(spec)
+    if not tiers:
+        raise ValueError('At least one aggregation tier is required')
+    return tiers
+
+
+REDUCERS = {'sum': sum,
+            'count': len,
+            'min': min,
+            'max': max,
+            'mean': lambda values: sum(values) / float(len(values))}
+
+
+class Feed(object):
+    """
+    Pre-aggregated view of the raw metrics for the observers subscribed to
+    "ALL". Instead of every raw metric, the observer receives one row per
+    combination of the ``group_by`` fields, with the reduced value:
+
+    [{'project_id': 'abc', 'storage_policy': '0', 'host': 'node1', 'value': 12.5}, ...]
+
+    Metrics that lack any of the ``group_by`` fields are not part of the feed.
+    """
+
+    def __init__(self, group_by, reducer='sum'):
+        if isinstance(group_by, basestring):
+            group_by = [group_by]
+        if not group_by:
+            raise ValueError('A feed needs at least one group-by field')
+        if reducer not in REDUCERS:
+            raise ValueError('Invalid feed reducer: ' + str(reducer))
+        self.group_by = tuple(group_by)
+        self.reducer = reducer
+        self.key = (self.group_by, self.reducer)
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Builds a feed from its spec, e.g.
+        {'group_by': ['project_id', 'storage_policy', 'host'], 'reducer': 'sum'}
+        """
+        return cls(spec.get('group_by'), spec.get('reducer', 'sum'))
+
+    def reduce(self, metric_list):
+        groups = dict()
+        group_by = self.group_by
+        for metric in metric_list:
+            try:
+                group = tuple(metric[field] for field in group_by)
+                groups.setdefault(group, []).append(float(metric['value']))
+            except (KeyError, TypeError, ValueError):
+                continue
+        reducer = REDUCERS[self.reducer]
+        rows = list()
+        for group, values in groups.items():
+            row = dict(zip(group_by, group))
+            row['value'] = reducer(values)
+            rows.append(row)
+        return rows
@@ -0,0 +1,104 @@
+"""
+Decoding stage of the workload metric actors.
+
+Monitoring messages arrive from RabbitMQ as raw bodies. They are queued by
+the metric actor as they are consumed and decoded here in batches, once per
+aggregation interval, into typed records. Two encodings are accepted:
+
+* Python dict literals (the ``str()`` of a dict), which is what the
+  Crystal metric middleware publishes, and JSON objects.
+* MessagePack maps, when the ``msgpack`` package is installed.
+
+A dict literal of strings and numbers (no double quote or backslash in
+it, so every single quote delimits a string) is read as JSON once its
+single quotes are turned into double quotes. Any other literal is read
+with ``ast.literal_eval``, which is about as slow as the former eval().
+"""
+from collections import namedtuple
+import ast
+import json
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+MetricRecord = namedtuple('MetricRecord', ['project', 'container', 'method', 'host',
+                                           'server_type', 'value', 'data'])
+
+
+def decode_body(body):
+    """
+    Decodes a single raw message body into a dictionary.
+
+    :param body: The raw message body consumed from RabbitMQ.
+    :type body: String type
+    :return: The decoded message.
+    :rtype: dict
+    :raises ValueError: If the body is not a valid JSON or MessagePack map.
+    """
+    if body[:1] == '{':
+        if '"' not in body and '\\' not in body:
+            body_json = body.replace("'", '"')
+        else:
+            body_json = body
+        try:
+            return json.loads(body_json)
+        except ValueError:
+            # e.g. True, None or u'' in the literal
+            return ast.literal_eval(body)
+    if msgpack is None:
+        raise ValueError('Binary metric message received but msgpack is not installed')
+    return msgpack.unpackb(body)
+
+
+def to_record(data):
+    """
+    Builds a typed record from a decoded message.
+
+    :param data: The decoded message.
+    :type data: dict
+    :rtype: MetricRecord
+    :raises KeyError: If a mandatory field is missing.
+    :raises ValueError: If the value is not numeric.
+    """
+    return MetricRecord(data['project'], data['container'], data.get('method'),
+                        data.get('host'), data.get('server_type'),
+                        float(data['value']), data)
+
+
+class MetricDecoder(object):
+    """
+    Decodes batches of raw monitoring messages into MetricRecord tuples.
+    Malformed messages are discarded and counted in ``errors``.
+    """
+
+    def __init__(self):
+        self.decoded = 0
+        self.errors = 0
+
+    def decode(self, body):
+        return to_record(decode_body(body))
+
+    def decode_batch(self, bodies):
+        """
+        Decodes a list of raw message bodies.
+
+        :param bodies: The raw message bodies drained from the consumer.
+        :type bodies: list
+        :return: The successfully decoded records, in arrival order.
+        :rtype: list of MetricRecord
+        """
+        records = []
+        append = records.append
+        for body in bodies:
+            try:
+                append(to_record(decode_body(body)))
+            except (ValueError, KeyError, TypeError, SyntaxError):
+                self.errors += 1
+                logger.info("Metric decoder, Error parsing metric: " + repr(body))
+        self.decoded += len(records)
+        return records
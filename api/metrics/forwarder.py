@@ -0,0 +1,119 @@
+"""
+Logstash forwarding stage of the workload metric actors.
+
+Decoded metrics are handed over to a bounded queue and sent by a dedicated
+thread through a single UDP socket. Several newline-delimited JSON records
+are packed into each datagram, up to ``max_datagram`` bytes, so the number
+of send syscalls grows with the traffic volume and not with the number of
+messages. If Logstash is slow and the queue fills up, new records are
+dropped and counted instead of blocking the metric actor.
+"""
+from threading import Thread
+import json
+import logging
+import socket
+import Queue
+
+logger = logging.getLogger(__name__)
+
+# Payload of a UDP datagram that fits in a 1500 bytes Ethernet MTU
+DEFAULT_MAX_DATAGRAM = 1472
+DEFAULT_QUEUE_SIZE = 65536
+
+
+class LogstashForwarder(object):
+    """
+    Sends metrics to Logstash in batched UDP datagrams.
+
+    Counters: ``sent`` (records sent), ``datagrams`` (datagrams sent),
+    ``dropped`` (records discarded because the queue was full) and ``errors``
+    (records lost because of socket errors).
+    """
+
+    def __init__(self, server, max_datagram=DEFAULT_MAX_DATAGRAM, queue_size=DEFAULT_QUEUE_SIZE):
+        self.server = server
+        self.max_datagram = max_datagram
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sent = 0
+        self.datagrams = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self.sender = Thread(target=self._run)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def send(self, metrics):
+        """
+        Queues a list of metrics to be sent to Logstash. Never blocks.
+
+        :param metrics: The decoded metrics.
+        :type metrics: list of dict
+        """
+        for metric in metrics:
+            try:
+                self.queue.put_nowait(metric)
+            except Queue.Full:
+                self.dropped += 1
+
+    def stop(self):
+        """
+        Stops the sender thread once the queued metrics have been sent.
+        """
+        self.queue.put(None)
+
+    def _drain(self):
+        metrics = [self.queue.get()]
+        try:
+            while metrics[-1] is not None:
+                metrics.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return metrics
+
+    def _run(self):
+        while True:
+            metrics = self._drain()
+            running = metrics[-1] is not None
+            if not running:
+                metrics.pop()
+            if metrics:
+                self.flush(metrics)
+            if not running:
+                self.sock.close()
+                return
+
+    def _packets(self, lines):
+        """
+        Groups newline-terminated records into datagram payloads. A record
+        larger than ``max_datagram`` is sent in a datagram of its own.
+        """
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) > self.max_datagram:
+                yield packet
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line)
+        if packet:
+            yield packet
+
+    def flush(self, metrics):
+        """
+        Encodes and sends a batch of metrics.
+
+        :param metrics: The metrics to send.
+        :type metrics: list of dict
+        """
+        lines = [json.dumps(metric) + '\n' for metric in metrics]
+        for packet in self._packets(lines):
+            try:
+                self.sock.sendto(''.join(packet), self.server)
+                self.sent += len(packet)
+                self.datagrams += 1
+            except socket.error:
+                self.errors += len(packet)
+                logger.info("Swift Metric: Error sending monitoring data to logstash.")
@@ -0,0 +1,126 @@
+"""
+Subscription index of the workload metric actors.
+
+Observers subscribe to a target: a project ("crystal"), a container
+("crystal/data"), a wildcard (any target ending in "*", matched as a
+prefix) or "ALL" for the raw metrics. A wildcard matches the targets of a
+single level, so the traffic of a container is not counted again in the
+aggregate of its project: "crystal*" matches projects and "crystal/*"
+matches containers. "ALL" subscribers may
+declare a feed (see metrics.aggregator.Feed) to receive a pre-aggregated
+table instead. The index answers which observers are interested in an
+aggregated target, and which targets are worth aggregating at all, so
+targets nobody watches are skipped.
+"""
+
+ALL = 'ALL'
+WILDCARD = '*'
+
+
+def wildcard_matches(prefix, target):
+    """
+    Whether the prefix of a wildcard matches a target: a prefix without '/'
+    matches projects, and a prefix with '/' matches containers.
+    """
+    return target.startswith(prefix) and ('/' in prefix) == ('/' in target)
+
+
+class SubscriptionIndex(object):
+    """
+    Maps targets to the observers subscribed to them:
+    {target: {observer_id: observer}}.
+    """
+
+    def __init__(self):
+        self.exact = dict()
+        self.prefixes = dict()
+        self.all = dict()
+        self.feeds = dict()
+        self._matches = dict()
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefixes) + len(self.all)
+
+    def add(self, target, observer_id, observer, feed=None):
+        if target == ALL:
+            self.all[observer_id] = observer
+            if feed:
+                self.feeds[observer_id] = feed
+            else:
+                self.feeds.pop(observer_id, None)
+        elif target.endswith(WILDCARD):
+            self.prefixes.setdefault(target[:-1], dict())[observer_id] = observer
+        else:
+            self.exact.setdefault(target, dict())[observer_id] = observer
+        self._matches.clear()
+
+    def remove(self, target, observer_id):
+        """
+        Removes a subscription.
+
+        :return: True if the observer was subscribed to the target.
+        :rtype: boolean
+        """
+        if target == ALL:
+            observers, key, table = self.all, None, None
+        elif target.endswith(WILDCARD):
+            key, table = target[:-1], self.prefixes
+            observers = table.get(key, {})
+        else:
+            key, table = target, self.exact
+            observers = table.get(key, {})
+        if observer_id not in observers:
+            return False
+        del observers[observer_id]
+        if target == ALL:
+            self.feeds.pop(observer_id, None)
+        if table is not None and not observers:
+            del table[key]
+        self._matches.clear()
+        return True
+
+    def observers(self):
+        for _, observer in self.items():
+            yield observer
+
+    def items(self):
+        """
+        Yields the (observer_id, observer) pair of every subscription.
+        """
+        for table in (self.exact, self.prefixes):
+            for observers in table.values():
+                for item in observers.items():
+                    yield item
+        for item in self.all.items():
+            yield item
+
+    def match(self, target):
+        """
+        Returns the observers subscribed to an aggregated target, either
+        directly or through a wildcard.
+
+        :rtype: dict {observer_id: observer}
+        """
+        try:
+            return self._matches[target]
+        except KeyError:
+            observers = dict(self.exact.get(target, {}))
+            for prefix, prefix_observers in self.prefixes.items():
+                if wildcard_matches(prefix, target):
+                    observers.update(prefix_observers)
+            self._matches[target] = observers
+            return observers
+
+    def watches(self, target):
+        return bool(self.match(target))
+
+    def watches_level(self, key):
+        """
+        Whether any subscription may match the targets of a group-by key:
+        'project' targets have no '/', 'container' targets have one.
+        """
+        if key == 'project':
+            return any('/' not in target for target in self.exact) or \
+                any('/' not in prefix for prefix in self.prefixes)
+        return any('/' in target for target in self.exact) or \
+            any('/' in prefix for prefix in self.prefixes)
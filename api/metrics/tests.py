@@ -8,14 +8,16 @@ from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
-from metrics.views import metric_module_list, metric_module_detail, MetricModuleData, list_activated_metrics
+from api import registry
+from metrics.views import metric_module_list, metric_module_detail, MetricModuleData, list_activated_metrics, start_metric
 
 
 # Tests use database=10 instead of 0.
 @override_settings(REDIS_CON_POOL=redis.ConnectionPool(host='localhost', port=6379, db=10),
                    STORLET_FILTERS_DIR=os.path.join("/tmp", "crystal", "storlet_filters"),
                    WORKLOAD_METRICS_DIR=os.path.join("/tmp", "crystal", "workload_metrics"),
-                   GLOBAL_CONTROLLERS_DIR=os.path.join("/tmp", "crystal", "global_controllers"))
+                   GLOBAL_CONTROLLERS_DIR=os.path.join("/tmp", "crystal", "global_controllers"),
+                   ARTIFACTS_DIR=os.path.join("/tmp", "crystal", "artifacts"))
 class MetricsTestCase(TestCase):
     def setUp(self):
         # Every test needs access to the request factory.
@@ -24,6 +26,8 @@ class MetricsTestCase(TestCase):
 
         self.factory = APIRequestFactory()
         self.create_metric_modules()
+        # The fixtures are written directly to redis
+        registry.build_indexes(self.r)
 
     def tearDown(self):
         self.r.flushdb()
@@ -73,6 +77,33 @@ class MetricsTestCase(TestCase):
         metric_data = json.loads(response.content)
         self.assertEqual(metric_data['status'], 'Stopped')
 
+    @mock.patch('metrics.views.start_metric')
+    def test_update_metric_module_detail_with_tiers(self, mock_start_metric):
+        metric_id = '1'
+        data = {'status': 'Running', 'get': True, 'tiers': '1s,10s:tumbling, ewma'}
+        request = self.factory.post('/metrics/' + metric_id, data, format='json')
+        response = metric_module_detail(request, metric_id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_start_metric.assert_called_with('get_m1', '1s, 10s:tumbling, ewma')
+        self.assertEqual(self.r.hget('workload_metric:1', 'tiers'), '1s, 10s:tumbling, ewma')
+
+    @mock.patch('metrics.views.create_local_host')
+    def test_start_metric_updates_the_tiers_of_a_running_actor(self, mock_create_local_host):
+        actor = mock.MagicMock()
+        self.r.hmset('metric:get_m1', {'network_location': '?', 'type': 'integer', 'tiers': '1s'})
+        with mock.patch.dict('metrics.views.metric_actors', {'get_m1': actor}):
+            start_metric('get_m1', '1s,ewma')
+        actor.set_tiers.assert_called_once_with('1s,ewma')
+        self.assertEqual(self.r.hget('metric:get_m1', 'tiers'), '1s, ewma')
+
+    def test_update_metric_module_detail_with_invalid_tiers(self):
+        metric_id = '1'
+        data = {'status': 'Stopped', 'tiers': '1s, 5 minutes'}
+        request = self.factory.post('/metrics/' + metric_id, data, format='json')
+        response = metric_module_detail(request, metric_id)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(self.r.hexists('workload_metric:1', 'tiers'))
+
     def test_delete_metric_module_detail_ok(self):
         metric_id = '1'
         request = self.factory.delete('/metrics/' + metric_id)
@@ -171,3 +202,4 @@ class MetricsTestCase(TestCase):
     def setup_activated_metrics_data(self):
         self.r.hmset('metric:metric1', {'network_location': '?', 'type': 'integer'})
         self.r.hmset('metric:metric2', {'network_location': '?', 'type': 'integer'})
+        registry.add(self.r, 'metric:metric1', 'metric:metric2')
@@ -1,5 +1,8 @@
+import ast
 import json
 import os
+import socket
+import unittest
 
 import mock
 import redis
@@ -10,6 +13,10 @@ from rest_framework.test import APIRequestFactory
 
 from metrics.views import metric_module_list, metric_module_detail, MetricModuleData, list_activated_metrics
 from metrics.actors.swift_metric import SwiftMetric
+from metrics.aggregator import ColumnarAggregator, AggregationTier, Feed, parse_tiers
+from metrics.decoder import MetricDecoder, MetricRecord, msgpack
+from metrics.forwarder import LogstashForwarder
+from metrics.subscriptions import SubscriptionIndex
 
 
 # Tests use database=10 instead of 0.
@@ -33,9 +40,9 @@ class MetricsActorsTestCase(TestCase):
     # Actors
     #
 
-    @mock.patch('metrics.actors.swift_metric.SwiftMetric._send_data_to_logstash')
+    @mock.patch('metrics.actors.swift_metric.LogstashForwarder')
     @mock.patch('metrics.actors.swift_metric.Thread')
-    def test_swift_metric(self, mock_thread, mock_send_data_to_logstash):
+    def test_swift_metric(self, mock_thread, mock_forwarder):
         actor_id = '1'
         routing_key = 'metric.' + actor_id
         swift_metric = SwiftMetric(actor_id, routing_key)
@@ -46,11 +53,372 @@ class MetricsActorsTestCase(TestCase):
         body = '{"container": "crystal/data", "metric_name": "bandwidth", "@timestamp": "2017-09-09T18:00:18.331492+02:00", ' \
                '"value": 16.4375, "project": "crystal", "host": "controller", "method": "GET", "server_type": "proxy"}'
         swift_metric.notify(body)
+        self.assertFalse(swift_metric.messages.empty())
+        mock_forwarder.return_value.send.assert_not_called()
+
         expected_dict = {'project': 'crystal', 'host': 'controller', 'container': 'crystal/data', 'metric_name': 'bandwidth',
                          'server_type': 'proxy', '@timestamp': '2017-09-09T18:00:18.331492+02:00', 'method': 'GET', 'value': 16.4375}
-        mock_send_data_to_logstash.assert_called_with(expected_dict)
-        self.assertFalse(swift_metric.metrics.empty())
-        self.assertEqual(swift_metric.metrics.get(), expected_dict)
+        records = swift_metric._collect_metrics()
+        mock_forwarder.return_value.send.assert_called_with([expected_dict])
+        self.assertTrue(swift_metric.messages.empty())
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].project, 'crystal')
+        self.assertEqual(records[0].container, 'crystal/data')
+        self.assertEqual(records[0].value, 16.4375)
+        self.assertEqual(records[0].data, expected_dict)
+
+    @mock.patch('metrics.actors.swift_metric.LogstashForwarder')
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_only_aggregates_proxy_metrics(self, mock_thread, mock_forwarder):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        swift_metric.notify('{"container": "crystal/data", "value": 2, "project": "crystal", "server_type": "object"}')
+        swift_metric.notify('{"container": "crystal/data", "value": 3, "project": "crystal", "server_type": "proxy"}')
+        records = swift_metric._collect_metrics()
+        mock_forwarder.return_value.send.assert_called_once()
+        self.assertEqual(len(mock_forwarder.return_value.send.call_args[0][0]), 2)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].value, 3.0)
+
+    @mock.patch('metrics.actors.swift_metric.LogstashForwarder')
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_aggregate(self, mock_thread, mock_forwarder):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        records = [MetricRecord('crystal', 'crystal/data', 'GET', 'node1', 'proxy', 2.0, {}),
+                   MetricRecord('crystal', 'crystal/logs', 'GET', 'node1', 'proxy', 3.0, {}),
+                   MetricRecord('other', 'other/data', 'GET', 'node1', 'proxy', 4.0, {})]
+        # Nobody watches the metric
+        self.assertEqual(swift_metric._aggregate(records), {})
+
+        for observer_id, target in (('policy:1', 'crystal'), ('policy:2', 'crystal/*'),
+                                    ('policy:3', 'other'), ('policy:4', 'other/data')):
+            observer = mock.MagicMock()
+            observer.get_target.return_value = target
+            observer.get_id.return_value = observer_id
+            swift_metric.attach(observer)
+
+        aggregate = swift_metric._aggregate(records)
+        self.assertEqual(aggregate, {'crystal': 5.0, 'crystal/data': 2.0, 'crystal/logs': 3.0,
+                                     'other': 4.0, 'other/data': 4.0})
+        # Only the last interval is aggregated
+        aggregate = swift_metric._aggregate(records[:1])
+        self.assertEqual(aggregate, {'crystal': 2.0, 'crystal/data': 2.0})
+        self.assertEqual(swift_metric._aggregate([]), {})
+
+        # Targets nobody watches are skipped
+        swift_metric.detach('policy:2', 'crystal/*')
+        swift_metric.detach('policy:3', 'other')
+        aggregate = swift_metric._aggregate(records)
+        self.assertEqual(aggregate, {'crystal': 5.0, 'other/data': 4.0})
+
+    @mock.patch('metrics.actors.swift_metric.LogstashForwarder')
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_stop_actor(self, mock_thread, mock_forwarder):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        swift_metric.host = mock.MagicMock()
+        swift_metric.id = 'metric:1'
+        rule, engine = mock.MagicMock(), mock.MagicMock()
+        rule.get_target.return_value = 'crystal'
+        rule.get_id.return_value = 'policy:1'
+        engine.get_id.return_value = 'rule_engine:0'
+        swift_metric.attach(rule)
+        swift_metric.attach(engine, None, None, ['crystal', 'other'])
+        swift_metric.stop_actor()
+
+        rule.stop_actor.assert_called_once_with()
+        self.assertEqual(self.r.hget('policy:1', 'status'), 'Stopped')
+        # The engine keeps running the policies of other metrics
+        engine.remove_metric.assert_called_once_with('1')
+        engine.stop_actor.assert_not_called()
+        self.assertFalse(self.r.exists('rule_engine:0'))
+
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_sends_wildcard_targets(self, mock_thread):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'crystal/*'
+        observer.get_id.return_value = 'policy:1'
+        swift_metric.attach(observer)
+        swift_metric._send_info({'crystal': 5.0, 'crystal/data': 2.0, 'crystal/logs': 3.0, 'other/data': 1.0}, [])
+        observer.update_many.assert_called_once_with('1', {'crystal/data': 2.0, 'crystal/logs': 3.0})
+
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_sends_feeds_to_all_observers(self, mock_thread):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        observers = []
+        for observer_id, feed in (('controller:1', {'group_by': ['project_id', 'host'], 'reducer': 'sum'}),
+                                  ('controller:2', None)):
+            observer = mock.MagicMock()
+            observer.get_target.return_value = 'ALL'
+            observer.get_id.return_value = observer_id
+            swift_metric.attach(observer, None, feed)
+            observers.append(observer)
+
+        metrics = [{'project_id': 'p1', 'host': 'h1', 'storage_policy': '0', 'value': 1.0},
+                   {'project_id': 'p1', 'host': 'h1', 'storage_policy': '1', 'value': 2.0},
+                   {'project_id': 'p1', 'host': 'h2', 'storage_policy': '0', 'value': 4.0}]
+        swift_metric._send_info({}, metrics)
+        table = observers[0].update_many.call_args[0][1]['ALL']
+        self.assertEqual(sorted(table), [{'project_id': 'p1', 'host': 'h1', 'value': 3.0},
+                                         {'project_id': 'p1', 'host': 'h2', 'value': 4.0}])
+        observers[1].update_many.assert_called_once_with('1', {'ALL': metrics})
+
+    def test_feed_reducers(self):
+        metrics = [{'project_id': 'p1', 'value': 1.0}, {'project_id': 'p1', 'value': 3.0},
+                   {'project_id': 'p2', 'value': 5}, {'value': 7.0}]
+        feed = Feed.from_spec({'group_by': 'project_id', 'reducer': 'mean'})
+        self.assertEqual(sorted(feed.reduce(metrics)), [{'project_id': 'p1', 'value': 2.0},
+                                                        {'project_id': 'p2', 'value': 5.0}])
+        feed = Feed(['project_id'], 'count')
+        self.assertEqual(sorted(feed.reduce(metrics)), [{'project_id': 'p1', 'value': 2},
+                                                        {'project_id': 'p2', 'value': 1}])
+        with self.assertRaises(ValueError):
+            Feed(['project_id'], 'median')
+        with self.assertRaises(ValueError):
+            Feed([])
+
+    #
+    # Subscription index
+    #
+
+    def test_subscription_index(self):
+        index = SubscriptionIndex()
+        self.assertFalse(index)
+        index.add('crystal', 'policy:1', 'observer1')
+        index.add('crystal/*', 'policy:2', 'observer2')
+        index.add('ALL', 'controller:1', 'controller1')
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.match('crystal'), {'policy:1': 'observer1'})
+        self.assertEqual(index.match('crystal/data'), {'policy:2': 'observer2'})
+        self.assertEqual(index.match('other'), {})
+        self.assertTrue(index.watches_level('project'))
+        self.assertTrue(index.watches_level('container'))
+        self.assertEqual(sorted(index.observers()), ['controller1', 'observer1', 'observer2'])
+
+        self.assertTrue(index.remove('crystal/*', 'policy:2'))
+        self.assertFalse(index.remove('crystal/*', 'policy:2'))
+        self.assertFalse(index.watches('crystal/data'))
+        self.assertFalse(index.watches_level('container'))
+        self.assertTrue(index.remove('ALL', 'controller:1'))
+        self.assertEqual(len(index), 1)
+
+    def test_subscription_index_wildcard_levels(self):
+        index = SubscriptionIndex()
+        index.add('crystal*', 'policy:1', 'observer1')
+        # A wildcard without '/' matches projects, not their containers
+        self.assertEqual(index.match('crystal'), {'policy:1': 'observer1'})
+        self.assertEqual(index.match('crystal2'), {'policy:1': 'observer1'})
+        self.assertEqual(index.match('crystal/data'), {})
+        self.assertTrue(index.watches_level('project'))
+        self.assertFalse(index.watches_level('container'))
+
+        index.add('crystal/*', 'policy:2', 'observer2')
+        self.assertEqual(index.match('crystal'), {'policy:1': 'observer1'})
+        self.assertEqual(index.match('crystal/data'), {'policy:2': 'observer2'})
+        self.assertTrue(index.watches_level('container'))
+
+    #
+    # Aggregator
+    #
+
+    def test_aggregator_sums_selected_groups(self):
+        aggregator = ColumnarAggregator()
+        aggregator.store([MetricRecord('p1', 'p1/c1', 'GET', 'h1', 'proxy', 1.0, {}),
+                          MetricRecord('p2', 'p2/c1', 'GET', 'h1', 'proxy', 4.0, {})])
+        self.assertEqual(aggregator.sums('project', lambda name: name == 'p2'), {'p2': 4.0})
+        self.assertEqual(aggregator.sums('project', lambda name: False), {})
+
+    def test_aggregator_sums_per_group(self):
+        aggregator = ColumnarAggregator()
+        aggregator.store([MetricRecord('p1', 'p1/c1', 'GET', 'h1', 'proxy', 1.0, {}),
+                          MetricRecord('p1', 'p1/c2', 'PUT', 'h2', 'proxy', 2.0, {}),
+                          MetricRecord('p2', 'p2/c1', 'GET', 'h1', 'proxy', 4.0, {})])
+        self.assertEqual(aggregator.sums('project'), {'p1': 3.0, 'p2': 4.0})
+        self.assertEqual(aggregator.sums('container'), {'p1/c1': 1.0, 'p1/c2': 2.0, 'p2/c1': 4.0})
+
+    def test_aggregator_keeps_only_the_last_tick(self):
+        aggregator = ColumnarAggregator()
+        aggregator.store([MetricRecord('p1', 'p1/c1', 'GET', 'h1', 'proxy', 1.0, {})] * 3)
+        aggregator.store([MetricRecord('p2', 'p2/c1', 'GET', 'h1', 'proxy', 2.0, {})])
+        self.assertEqual(aggregator.sums('project'), {'p2': 2.0})
+        self.assertEqual(len(aggregator.values), 1)
+        aggregator.store([])
+        self.assertEqual(aggregator.sums('container'), {})
+
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_observers_per_tier(self, mock_thread):
+        swift_metric = SwiftMetric('1', 'metric.1', '1s, 2s:tumbling')
+        fast_observer = mock.MagicMock()
+        fast_observer.get_target.return_value = 'crystal'
+        fast_observer.get_id.return_value = 'policy:1'
+        slow_observer = mock.MagicMock()
+        slow_observer.get_target.return_value = 'crystal'
+        slow_observer.get_id.return_value = 'policy:2'
+        swift_metric.attach(fast_observer)
+        swift_metric.attach(slow_observer, '2s:tumbling')
+
+        swift_metric._send_info({'crystal': 1.0}, [])
+        fast_observer.update_many.assert_called_once_with('1', {'crystal': 1.0})
+        slow_observer.update_many.assert_not_called()
+
+        swift_metric._send_info({'crystal': 2.0}, [])
+        fast_observer.update_many.assert_called_with('1', {'crystal': 2.0})
+        slow_observer.update_many.assert_called_once_with('1', {'crystal': 3.0})
+
+        swift_metric.detach('policy:2', 'crystal')
+        swift_metric._send_info({'crystal': 2.0}, [])
+        swift_metric._send_info({'crystal': 2.0}, [])
+        self.assertEqual(slow_observer.update_many.call_count, 1)
+
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_sends_each_tier_separately(self, mock_thread):
+        swift_metric = SwiftMetric('1', 'metric.1', '1s, ewma:0.5')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'crystal'
+        observer.get_id.return_value = 'rule_engine:0'
+        swift_metric.attach(observer)
+        swift_metric.attach(observer, 'ewma:0.5')
+        swift_metric._send_info({'crystal': 4.0}, [])
+        self.assertEqual(sorted(call[0][1]['crystal'] for call in observer.update_many.call_args_list), [2.0, 4.0])
+
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_tier_created_on_attach(self, mock_thread):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        observer = mock.MagicMock()
+        observer.get_target.return_value = 'ALL'
+        observer.get_id.return_value = 'controller:1'
+        swift_metric.attach(observer, 'ewma:0.5')
+        self.assertIn('ewma:0.5', swift_metric._tiers)
+        swift_metric.set_tiers('1s')
+        # The tier is kept while it has observers
+        self.assertIn('ewma:0.5', swift_metric._tiers)
+        swift_metric._send_info({'crystal': 2.0}, [{'project': 'crystal', 'value': 2.0}])
+        observer.update_many.assert_called_once_with('1', {'ALL': [{'project': 'crystal', 'value': 2.0}]})
+
+    @mock.patch('metrics.actors.swift_metric.Thread')
+    def test_swift_metric_falls_back_to_update(self, mock_thread):
+        swift_metric = SwiftMetric('1', 'metric.1')
+        observer = mock.MagicMock(spec=['get_target', 'get_id', 'update'])
+        observer.get_target.return_value = 'crystal'
+        observer.get_id.return_value = 'controller:1'
+        swift_metric.attach(observer)
+        swift_metric._send_info({'crystal': 2.0, 'other': 1.0}, [])
+        observer.update.assert_called_once_with('1', 2.0)
+
+    #
+    # Aggregation tiers
+    #
+
+    def test_parse_tiers(self):
+        self.assertEqual(parse_tiers('1s, 10s:tumbling,60s, ewma:0.2'), ['1s', '10s:tumbling', '60s', 'ewma:0.2'])
+        self.assertEqual(parse_tiers(['1s', '1s', 'ewma']), ['1s', 'ewma'])
+        for invalid in ('', '0s', '10m', '10s:hopping', 'ewma:2', 'ewma:x'):
+            with self.assertRaises(ValueError):
+                parse_tiers(invalid)
+
+    def test_sliding_tier(self):
+        tier = AggregationTier('2s')
+        self.assertEqual(tier.update({'a': 1.0}, []), ({'a': 1.0}, []))
+        self.assertEqual(tier.update({'a': 2.0, 'b': 5.0}, []), ({'a': 3.0, 'b': 5.0}, []))
+        self.assertEqual(tier.update({'b': 1.0}, []), ({'a': 2.0, 'b': 6.0}, []))
+        self.assertEqual(tier.update({}, []), ({'b': 1.0}, []))
+        self.assertEqual(tier.update({}, []), ({}, []))
+
+    def test_tumbling_tier(self):
+        tier = AggregationTier('3s:tumbling')
+        self.assertIsNone(tier.update({'a': 1.0}, [{'m': 1}]))
+        self.assertIsNone(tier.update({'a': 2.0}, [{'m': 2}]))
+        self.assertEqual(tier.update({'b': 1.0}, [{'m': 3}]), ({'a': 3.0, 'b': 1.0}, [{'m': 1}, {'m': 2}, {'m': 3}]))
+        self.assertIsNone(tier.update({'a': 1.0}, []))
+
+    def test_ewma_tier(self):
+        tier = AggregationTier('ewma:0.5')
+        self.assertEqual(tier.update({'a': 4.0}, [])[0], {'a': 2.0})
+        self.assertEqual(tier.update({'a': 4.0}, [])[0], {'a': 3.0})
+        self.assertEqual(tier.update({}, [])[0], {'a': 1.5})
+
+    #
+    # Logstash forwarder
+    #
+
+    @mock.patch('metrics.forwarder.Thread')
+    def test_forwarder_packs_metrics_in_datagrams(self, mock_thread):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(2)
+        forwarder = LogstashForwarder(receiver.getsockname(), max_datagram=100)
+        metrics = [{'value': i, 'project': 'crystal'} for i in range(10)]
+        forwarder.flush(metrics)
+
+        lines = []
+        for _ in range(forwarder.datagrams):
+            datagram = receiver.recv(65535)
+            self.assertLessEqual(len(datagram), 100)
+            lines.extend(datagram.splitlines())
+        receiver.close()
+        self.assertEqual([json.loads(line) for line in lines], metrics)
+        self.assertEqual(forwarder.sent, 10)
+        self.assertLess(forwarder.datagrams, 10)
+
+    @mock.patch('metrics.forwarder.Thread')
+    def test_forwarder_drops_when_queue_is_full(self, mock_thread):
+        forwarder = LogstashForwarder(('127.0.0.1', 5400), queue_size=3)
+        forwarder.send([{'value': i} for i in range(5)])
+        self.assertEqual(forwarder.dropped, 2)
+        self.assertEqual(forwarder._drain(), [{'value': 0}, {'value': 1}, {'value': 2}])
+
+    #
+    # Decoder
+    #
+
+    def test_decode_json_body(self):
+        body = '{"container": "crystal/data", "value": 16.4375, "project": "crystal", "host": "controller", ' \
+               '"method": "GET", "server_type": "proxy"}'
+        record = MetricDecoder().decode(body)
+        self.assertEqual(record.project, 'crystal')
+        self.assertEqual(record.container, 'crystal/data')
+        self.assertEqual(record.method, 'GET')
+        self.assertEqual(record.host, 'controller')
+        self.assertEqual(record.server_type, 'proxy')
+        self.assertEqual(record.value, 16.4375)
+
+    def test_decode_python_literal_body(self):
+        body = "{'container': 'crystal/data', 'value': 5, 'project': 'crystal', 'server_type': 'proxy'}"
+        record = MetricDecoder().decode(body)
+        self.assertEqual(record.project, 'crystal')
+        self.assertEqual(record.value, 5.0)
+
+    @mock.patch('metrics.decoder.ast.literal_eval', wraps=ast.literal_eval)
+    def test_decode_python_literal_body_as_json(self, mock_literal_eval):
+        for data in ({'container': 'crystal/data', 'value': 2.5, 'project': 'crystal', 'method': 'GET'},
+                     {'container': 'it\'s', 'value': 1, 'project': 'say "hi"'},
+                     {'container': 'c\\d', 'value': -1e-05, 'project': 'p', 'server_type': None}):
+            self.assertEqual(MetricDecoder().decode(str(data)).data, data)
+        # Only the literals that are not JSON once quoted are evaluated
+        self.assertEqual(mock_literal_eval.call_count, 2)
+
+    def test_decode_does_not_evaluate_expressions(self):
+        body = "{'container': 'c', 'value': __import__('os').getpid(), 'project': 'p'}"
+        with self.assertRaises(ValueError):
+            MetricDecoder().decode(body)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_decode_msgpack_body(self):
+        body = msgpack.packb({'container': 'crystal/data', 'value': 1.5, 'project': 'crystal', 'server_type': 'proxy'})
+        record = MetricDecoder().decode(body)
+        self.assertEqual(record.container, 'crystal/data')
+        self.assertEqual(record.value, 1.5)
+
+    def test_decode_batch_discards_malformed_messages(self):
+        decoder = MetricDecoder()
+        bodies = ['{"container": "crystal/data", "value": 1, "project": "crystal"}',
+                  '{"container": "crystal/data", "project": "crystal"}',
+                  '{"container": "crystal/data", "value": "abc", "project": "crystal"}',
+                  '{not json',
+                  '{"container": "crystal/data", "value": 2, "project": "crystal"}']
+        records = decoder.decode_batch(bodies)
+        self.assertEqual([record.value for record in records], [1.0, 2.0])
+        self.assertEqual(decoder.decoded, 2)
+        self.assertEqual(decoder.errors, 3)
 
     #
     # Aux methods
@@ -14,10 +14,13 @@ import logging
 import mimetypes
 import os
 
-from api.common import to_json_bools, JSONResponse, get_redis_connection, \
-    rsync_dir_with_nodes, create_local_host, metric_actors, make_sure_path_exists, save_file
+from api import artifacts, registry
+from api.listing import ListQuery, InvalidListQuery, get_page, index_fetcher, list_response
+from api.common import to_json_bools, JSONResponse, get_redis_connection, get_hashes, \
+    rsync_dir_with_nodes, create_local_host, metric_actors
 
 from api.exceptions import FileSynchronizationException
+from metrics.aggregator import DEFAULT_TIER, parse_tiers
 
 
 logger = logging.getLogger(__name__)
@@ -40,13 +43,19 @@ def list_activated_metrics(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys("metric:*")
-        metrics = []
-        for key in keys:
-            metric = r.hgetall(key)
-            metric["name"] = key.split(":")[1]
-            metrics.append(metric)
-        return JSONResponse(metrics, status=status.HTTP_200_OK)
+        def load(keys):
+            metrics = get_hashes(r, keys)
+            for key, metric in zip(keys, metrics):
+                if metric:
+                    metric["name"] = key.split(":")[1]
+            return metrics
+
+        try:
+            query = ListQuery(request.GET)
+            metrics, last_key = get_page(query, index_fetcher(r, 'metric', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, metrics, last_key)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -65,26 +74,35 @@ def metric_module_list(request):
     except RedisError:
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     if request.method == 'GET':
-        keys = r.keys("workload_metric:*")
-        workload_metrics = []
-        for key in keys:
-            metric = r.hgetall(key)
-            to_json_bools(metric, 'put', 'get', 'replicate')
-            workload_metrics.append(metric)
-        sorted_workload_metrics = sorted(workload_metrics, key=lambda x: int(itemgetter('id')(x)))
-        return JSONResponse(sorted_workload_metrics, status=status.HTTP_200_OK)
+        def load(keys):
+            workload_metrics = get_hashes(r, keys)
+            for metric in workload_metrics:
+                to_json_bools(metric, 'put', 'get', 'replicate')
+            return workload_metrics
+
+        try:
+            query = ListQuery(request.GET)
+            workload_metrics, last_key = get_page(query, index_fetcher(r, 'workload_metric', load),
+                                                  sort_key=lambda x: int(itemgetter('id')(x)))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, workload_metrics, last_key)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
-def start_metric(actor_id):
+def start_metric(actor_id, tiers=DEFAULT_TIER):
     host = create_local_host()
     try:
         if actor_id not in metric_actors:
             logger.info("Metric, Starting workload metric actor: " + str(actor_id))
             metric_actors[actor_id] = host.spawn(actor_id, settings.METRIC_MODULE,
-                                                 actor_id, "metric." + actor_id)
+                                                 actor_id, "metric." + actor_id, tiers)
             metric_actors[actor_id].init_consum()
+        else:
+            metric_actors[actor_id].set_tiers(tiers)
+            # The running actor registered its previous tiers in its metric hash
+            get_redis_connection().hset("metric:" + actor_id, "tiers", ', '.join(parse_tiers(tiers)))
     except Exception as e:
         logger.error("Metric, Error starting workload metric actor: " + str(actor_id))
         raise e
@@ -133,6 +151,11 @@ def metric_module_detail(request, metric_module_id):
         data = redis_data
         to_json_bools(data, 'put', 'get', 'replicate')
 
+        try:
+            data['tiers'] = ', '.join(parse_tiers(data.get('tiers', DEFAULT_TIER)))
+        except ValueError as e:
+            return JSONResponse(str(e), status=status.HTTP_400_BAD_REQUEST)
+
         if 'metric_name' not in data:
             metric_name = r.hget('workload_metric:' + str(metric_id), 'metric_name').split('.')[0]
         else:
@@ -141,11 +164,11 @@ def metric_module_detail(request, metric_module_id):
         if data['status'] == 'Running':
             try:
                 if data['put'] == True:
-                    start_metric('put_'+metric_name)
+                    start_metric('put_'+metric_name, data['tiers'])
                 else:
                     stop_metric('put_'+metric_name)
                 if data['get'] == True:
-                    start_metric('get_'+metric_name)
+                    start_metric('get_'+metric_name, data['tiers'])
                 else:
                     stop_metric('get_'+metric_name)
             except Exception:
@@ -158,6 +181,7 @@ def metric_module_detail(request, metric_module_id):
 
         try:
             r.hmset('workload_metric:' + str(metric_id), data)
+            registry.add(r, 'workload_metric:' + str(metric_id))
             return JSONResponse("Data updated", status=status.HTTP_200_OK)
         except DataError:
             return JSONResponse("Error updating data", status=status.HTTP_408_REQUEST_TIMEOUT)
@@ -177,9 +201,9 @@ def metric_module_detail(request, metric_module_id):
                     stop_metric(actor_id)
 
             r.delete('workload_metric:' + str(metric_id))
+            registry.remove(r, 'workload_metric:' + str(metric_id))
 
-            wm_ids = r.keys('workload_metric:*')
-            if len(wm_ids) == 0:
+            if not registry.keys(r, 'workload_metric'):
                 r.set('workload_metrics:id', 0)
 
             return JSONResponse('Workload metric has been deleted', status=status.HTTP_204_NO_CONTENT)
@@ -206,18 +230,19 @@ class MetricModuleData(APIView):
         try:
             file_obj = request.FILES['file']
 
-            make_sure_path_exists(settings.WORKLOAD_METRICS_DIR)
-            path = save_file(file_obj, settings.WORKLOAD_METRICS_DIR)
+            path, data['sha256'] = artifacts.save_file(file_obj, settings.WORKLOAD_METRICS_DIR)
             data['metric_name'] = os.path.basename(path)
 
-            # synchronize metrics directory with all nodes
-            try:
-                rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR, settings.WORKLOAD_METRICS_DIR)
-            except FileSynchronizationException as e:
-                # print "FileSynchronizationException", e  # TODO remove
-                return JSONResponse(e.message, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            if r.hmget('workload_metric:' + str(metric_module_id), 'metric_name', 'sha256') != [data['metric_name'], data['sha256']]:
+                # synchronize metrics directory with all nodes
+                try:
+                    rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR, settings.WORKLOAD_METRICS_DIR)
+                except FileSynchronizationException as e:
+                    # print "FileSynchronizationException", e  # TODO remove
+                    return JSONResponse(e.message, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
             r.hmset('workload_metric:' + str(metric_module_id), data)
+            registry.add(r, 'workload_metric:' + str(metric_module_id))
 
             return JSONResponse("Data updated", status=status.HTTP_201_CREATED)
         except DataError:
@@ -241,8 +266,7 @@ class MetricModuleData(APIView):
 
             file_obj = request.FILES['file']
 
-            make_sure_path_exists(settings.WORKLOAD_METRICS_DIR)
-            path = save_file(file_obj, settings.WORKLOAD_METRICS_DIR)
+            path, data['sha256'] = artifacts.save_file(file_obj, settings.WORKLOAD_METRICS_DIR)
             data['metric_name'] = os.path.basename(path)
 
             # synchronize metrics directory with all nodes
@@ -253,6 +277,7 @@ class MetricModuleData(APIView):
                 return JSONResponse(e.message, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
             r.hmset('workload_metric:' + str(workload_metric_id), data)
+            registry.add(r, 'workload_metric:' + str(workload_metric_id))
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
 
@@ -1,21 +1,44 @@
 from swiftclient import client as c
 import json
-import operator
 import logging
 import redis
 import requests
 import os
 from policies.dsl_parser import parse_condition
+from policies.condition_evaluator import CompiledCondition
 
 from api.settings import MANAGEMENT_ACCOUNT, MANAGEMENT_ADMIN_USERNAME, \
     MANAGEMENT_ADMIN_PASSWORD, KEYSTONE_ADMIN_URL, REDIS_HOST, REDIS_PORT, REDIS_DATABASE
 
-mappings = {'>': operator.gt, '>=': operator.ge,
-            '==': operator.eq, '<=': operator.le, '<': operator.lt,
-            '!=': operator.ne, "OR": operator.or_, "AND": operator.and_}
 logger = logging.getLogger(__name__)
 
 
+def get_admin_token():
+    """
+    Obtains the admin credentials, which we need to deploy filters in
+    accounts.
+    """
+    _, token = c.get_auth(KEYSTONE_ADMIN_URL,
+                          MANAGEMENT_ACCOUNT + ":" + MANAGEMENT_ADMIN_USERNAME,
+                          MANAGEMENT_ADMIN_PASSWORD, auth_version="3")
+    return token
+
+
+def deploy_filter(controller_server, token, target_id, filter_name, data):
+    url = os.path.join('http://'+controller_server, 'filters', target_id, "deploy", str(filter_name))
+    return requests.put(url, json.dumps(data), headers={"X-Auth-Token": token})
+
+
+def undeploy_filter(controller_server, token, target_id, filter_name):
+    url = os.path.join('http://'+controller_server, 'filters', target_id, "undeploy", str(filter_name))
+    return requests.put(url, headers={"X-Auth-Token": token})
+
+
+def delete_static_policy(controller_server, token, target_id, static_policy_id):
+    url = os.path.join('http://'+controller_server, "policies/static", target_id+":"+str(static_policy_id))
+    return requests.delete(url, headers={"X-Auth-Token": token})
+
+
 class Rule(object):
     """
     Rule: Each policy of each tenant is compiled as Rule. Rule is an Actor and
@@ -25,7 +48,7 @@ class Rule(object):
     the rule executed the action, this actor is destroyed.
     """
     _ask = ['get_target', 'start_rule']
-    _tell = ['update', 'stop_actor']
+    _tell = ['update', 'update_many', 'stop_actor']
 
     def __init__(self, policy_data, controller_server):
         """
@@ -64,6 +87,7 @@ class Rule(object):
         self.object_type = policy_data['object_type']
         self.controller_server = controller_server
         self.condition = policy_data['condition']
+        self.metric_tier = policy_data.get('metric_tier')
         self.observers_values = dict()
         self.observers_proxies = dict()
         self.token = None
@@ -75,9 +99,7 @@ class Rule(object):
         filters in accounts.
         """
         try:
-            _, self.token = c.get_auth(self.admin_keystone_url,
-                                       self.admin_project+":"+self.admin_user,
-                                       self.admin_pass, auth_version="3")
+            self.token = get_admin_token()
         except:
             logger.error("Rule, There was an error gettting a token from keystone")
             raise Exception()
@@ -95,14 +117,15 @@ class Rule(object):
     def start_rule(self):
         """
         Method called after init to start the rule. Basically this method
-        allows to be called remotely and calls the internal method
-        **check_metrics()** which subscribes the rule to all the workload
-        metrics necessaries.
+        allows to be called remotely, compiles the condition of the policy
+        and calls the internal method **check_metrics()** which subscribes
+        the rule to all the workload metrics necessaries.
         """
         try:
             self.condition_list = parse_condition(self.condition)
         except:
             raise ValueError("Workload Metric not started")
+        self.compiled_condition = CompiledCondition(self.condition_list)
         logger.info("Rule, Start '" + str(self.id) + "'")
         logger.info('Rule, Conditions: ' + str(self.condition))
 
@@ -136,7 +159,7 @@ class Rule(object):
             logger.info("Rule, Workload metric: " + metric_name)
             observer = self.host.lookup(metric_name)
             logger.info('Rule, Observer: ' + str(observer.get_id()) + " " + str(observer))
-            observer.attach(self.proxy)
+            observer.attach(self.proxy, self.metric_tier)
             self.observers_proxies[metric_name] = observer
             self.observers_values[metric_name] = None
 
@@ -160,31 +183,30 @@ class Rule(object):
         # TODO Check the last time updated the value
         # Check the condition of the policy if all values are setted. If the
         # condition result is true, it calls the method do_action
-        if all(val is not None for val in self.observers_values.values()):
-            if self._check_conditions(self.condition_list):
-                self._do_action()
-        else:
-            logger.error("not all values setted" + str(self.observers_values.values()))
-
-    def _check_conditions(self, condition_list):
+        result = self.compiled_condition.update(metric_name, value)
+        if result:
+            self._do_action()
+        elif result is None:
+            # Not all the metrics of the condition have sent a value yet
+            logger.debug("Rule, Waiting for the metrics: " + str(self.observers_values))
+
+    def update_many(self, metric_name, values):
         """
-        The method **check_conditions()** runs the ternary tree of conditions
-        to check if the **self.observers_values** complies the conditions. If
-        the values comply the conditions return True, else return False.
+        Batched version of **update()**. The workload metrics send in a single
+        call all the values addressed to this rule. When the target of the
+        rule is a wildcard (e.g. 'crystal/*'), the rule is evaluated with the
+        sum of the values of all the matching targets.
 
-        :param condition_list: A list of all the conditions
-        :type condition_list: **any** List type
-
-        :return: If the values comply the conditions
-        :rtype: boolean type.
+        :param metric_name: The name that identifies the workload metric.
+        :type metric_name: **any** String type
+        :param values: The value of each target, e.g. {'crystal': 16.4}
+        :type values: **any** Dict type
         """
-        if not isinstance(condition_list[0], list):
-            result = mappings[condition_list[1]](float(self.observers_values[condition_list[0].lower()]), float(condition_list[2]))
-        else:
-            result = self.check_conditions(condition_list[0])
-            for i in range(1, len(condition_list) - 1, 2):
-                result = mappings[condition_list[i]](result, self.check_conditions(condition_list[i + 1]))
-        return result
+        target = self.get_target()
+        if target in values:
+            self.update(metric_name, values[target])
+        elif target.endswith('*') and values:
+            self.update(metric_name, sum(values.values()))
 
     def get_target(self):
         """
@@ -208,13 +230,9 @@ class Rule(object):
         if not self.token:
             self._get_admin_token()
 
-        headers = {"X-Auth-Token": self.token}
-
         if self.action == "SET":
             # TODO Review if this tenant has already deployed this filter. Not deploy the same filter more than one time.
 
-            url = os.path.join('http://'+self.controller_server, 'filters', self.target_id, "deploy", str(self.filter))
-
             data = dict()
 
             data['object_type'] = self.object_type
@@ -222,7 +240,7 @@ class Rule(object):
             data['object_tag'] = self.object_tag
             data['params'] = self.params
 
-            response = requests.put(url, json.dumps(data), headers=headers)
+            response = deploy_filter(self.controller_server, self.token, self.target_id, self.filter, data)
 
             if 200 <= response.status_code < 300:
                 logger.info('Policy ' + str(self.id) + ' applied')
@@ -237,8 +255,7 @@ class Rule(object):
 
         elif self.action == "DELETE":
 
-            url = os.path.join('http://'+self.controller_server, 'filters', self.target_id, "undeploy", str(self.filter))
-            response = requests.put(url, headers=headers)
+            response = undeploy_filter(self.controller_server, self.token, self.target_id, self.filter)
 
             if 200 <= response.status_code < 300:
                 logger.info(response.text + " " + str(response.status_code))
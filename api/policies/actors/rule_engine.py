@@ -0,0 +1,375 @@
+from django.conf import settings
+from redis.exceptions import RedisError
+from metrics.aggregator import Interner
+from metrics.subscriptions import WILDCARD, wildcard_matches
+from policies.dsl_parser import parse_condition
+from policies.condition_evaluator import CompiledCondition
+from policies.actors.rule import get_admin_token, deploy_filter, undeploy_filter, delete_static_policy
+import numpy as np
+import operator
+import logging
+import redis
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Vectorized version of each comparison of the DSL. The position in this
+# list is the operator code stored in the clause table.
+COMPARISONS = [(operator.gt, np.greater), (operator.ge, np.greater_equal),
+               (operator.eq, np.equal), (operator.le, np.less_equal),
+               (operator.lt, np.less), (operator.ne, np.not_equal)]
+OPERATOR_CODES = dict((comparison, code) for code, (comparison, _) in enumerate(COMPARISONS))
+
+RULE_ENGINE_PREFIX = 'rule_engine:'
+
+
+def rule_engine_id(policy_data, shards):
+    """
+    Returns the id of the rule engine actor that hosts a dynamic policy.
+    Policies are sharded by the first metric of their condition, so the
+    policies of a metric share an engine, and by aggregation tier.
+    """
+    metric = policy_data['condition'].split()[0].lower()
+    shard = (zlib.crc32(metric) & 0xffffffff) % shards
+    tier = policy_data.get('metric_tier')
+    if tier:
+        return RULE_ENGINE_PREFIX + tier + ':' + str(shard)
+    return RULE_ENGINE_PREFIX + str(shard)
+
+
+class EnginePolicy(object):
+    """
+    Handle of a policy hosted in a rule engine, with the same stop_actor()
+    interface as the Rule actors.
+    """
+
+    def __init__(self, engine, policy_id):
+        self.engine = engine
+        self.policy_id = policy_id
+
+    def stop_actor(self):
+        self.engine.remove_policy(self.policy_id)
+
+
+class PolicyRow(object):
+    __slots__ = ('data', 'target', 'condition', 'transient', 'clause_rows',
+                 'applied', 'execution_stat', 'static_policy_id')
+
+    def __init__(self, data, condition):
+        self.data = data
+        self.target = data['target_name']
+        self.condition = condition
+        self.transient = data.get('transient') in (True, 'True')
+        self.clause_rows = None
+        self.applied = False
+        self.execution_stat = False
+        self.static_policy_id = None
+
+
+class RuleEngine(object):
+    """
+    RuleEngine: Hosts many dynamic policies in a single actor, as an
+    alternative to one Rule actor per policy. The clauses of the conditions
+    of all the policies are stored column-wise (metric, target, operator and
+    threshold) and, every time a workload metric sends its values, all the
+    clauses that read that metric are compared at once with array
+    operations. Only the policies with a clause whose result changed are
+    evaluated again, with the same semantics as Rule (the action is executed
+    once) and TransientRule (the action is reversed when the condition
+    stops being satisfied). A wildcard target (e.g. 'crystal/*') is
+    evaluated with the sum of the values of all the matching targets, as
+    Rule does.
+    """
+    _ask = ['add_policy']
+    _tell = ['update_many', 'remove_policy', 'remove_metric', 'stop_actor']
+
+    def __init__(self, controller_server, metric_tier=None):
+        self.controller_server = controller_server
+        self.metric_tier = metric_tier
+        self.token = None
+
+        try:
+            self.redis = redis.Redis(connection_pool=settings.REDIS_CON_POOL)
+        except RedisError:
+            logger.error('"Error connecting with Redis DB"')
+
+        self.policies = dict()
+        self.metrics = Interner()
+        self.targets = Interner()
+        self.values = dict()
+        self.metric_observers = dict()
+        self.subscriptions = dict()
+        self.wildcards = set()
+        self._dirty = True
+
+    def add_policy(self, policy_data):
+        """
+        Adds a dynamic policy to the engine and subscribes the engine to the
+        metrics of its condition.
+
+        :param policy_data: The policy, as stored in redis.
+        :type policy_data: dict
+        :raises ValueError: If the condition of the policy is not valid.
+        """
+        try:
+            condition = CompiledCondition(parse_condition(policy_data['condition']))
+        except Exception:
+            raise ValueError("Workload Metric not started")
+
+        policy_id = 'policy:' + str(policy_data['id'])
+        row = PolicyRow(policy_data, condition)
+        self.targets.intern(row.target)
+        for metric in condition.metrics:
+            self.metrics.intern(metric)
+            self._subscribe(metric, row.target)
+        self.policies[policy_id] = row
+        if row.target.endswith(WILDCARD):
+            self.wildcards.add(row.target)
+        self._dirty = True
+        logger.info("Rule engine, Policy '" + policy_id + "' added to '" + str(self.id) + "'")
+
+    def remove_policy(self, policy_id):
+        row = self.policies.pop(policy_id, None)
+        if row is None:
+            return
+        for metric in row.condition.metrics:
+            self._unsubscribe(metric, row.target)
+        if row.target in self.wildcards and not any(other.target == row.target for other in self.policies.values()):
+            self.wildcards.discard(row.target)
+        self._dirty = True
+        logger.info("Rule engine, Policy '" + policy_id + "' removed from '" + str(self.id) + "'")
+
+    def remove_metric(self, metric_name):
+        """
+        Called by a workload metric that is being stopped. Removes the
+        policies whose condition reads it, and marks them as stopped. The
+        policies of other metrics keep running.
+
+        :param metric_name: The name that identifies the workload metric.
+        :type metric_name: String
+        """
+        metric = metric_name.lower()
+        # The metric detaches its observers itself
+        for key in [key for key in self.subscriptions if key[0] == metric]:
+            del self.subscriptions[key]
+        self.metric_observers.pop(metric, None)
+
+        for policy_id, row in self.policies.items():
+            if metric in row.condition.metrics:
+                self.remove_policy(policy_id)
+                self.redis.hset(policy_id, 'status', 'Stopped')
+
+    def _subscribe(self, metric, target):
+        key = (metric, target)
+        if key not in self.subscriptions:
+            if metric not in self.metric_observers:
+                self.metric_observers[metric] = self.host.lookup(metric)
+            self.metric_observers[metric].attach(self.proxy, self.metric_tier, None, [target])
+        self.subscriptions[key] = self.subscriptions.get(key, 0) + 1
+
+    def _unsubscribe(self, metric, target):
+        key = (metric, target)
+        if key not in self.subscriptions:
+            return
+        self.subscriptions[key] -= 1
+        if not self.subscriptions[key]:
+            del self.subscriptions[key]
+            self.metric_observers[metric].detach(self.id, target)
+
+    def stop_actor(self):
+        """
+        Unsubscribes the engine from all the workload metrics and kills the
+        actor.
+        """
+        for metric, target in self.subscriptions:
+            try:
+                self.metric_observers[metric].detach(self.id, target)
+            except Exception:
+                pass
+        self.host.stop_actor(self.id)
+
+    def _metric_values(self, metric_id):
+        values = self.values.get(metric_id)
+        if values is None or len(values) < len(self.targets):
+            grown = np.full(len(self.targets), np.nan)
+            if values is not None:
+                grown[:len(values)] = values
+            values = self.values[metric_id] = grown
+        return values
+
+    def _rebuild(self):
+        """
+        Rebuilds the clause table after policies were added or removed.
+        """
+        metric_ids = self.metrics.ids
+        target_ids = self.targets.ids
+        clause_metric, clause_target, clause_op, clause_limit = [], [], [], []
+        self.clause_policy = []
+        for policy_id, row in self.policies.items():
+            start = len(clause_metric)
+            for metric, comparison, limit in row.condition.clauses:
+                clause_metric.append(metric_ids[metric])
+                clause_target.append(target_ids[row.target])
+                clause_op.append(OPERATOR_CODES[comparison])
+                clause_limit.append(limit)
+                self.clause_policy.append(policy_id)
+            row.clause_rows = np.arange(start, len(clause_metric))
+
+        self.clause_metric = np.array(clause_metric, dtype=np.int32)
+        self.clause_target = np.array(clause_target, dtype=np.int32)
+        self.clause_op = np.array(clause_op, dtype=np.int8)
+        self.clause_limit = np.array(clause_limit, dtype=np.float64)
+        self.clause_results = np.zeros(len(clause_metric), dtype=bool)
+        self.clause_ready = np.zeros(len(clause_metric), dtype=bool)
+        self.rows_by_metric = dict((metric_id, np.flatnonzero(self.clause_metric == metric_id))
+                                   for metric_id in set(clause_metric))
+        self._dirty = False
+
+        for metric_id in self.rows_by_metric:
+            self._compare(metric_id)
+
+    def _compare(self, metric_id):
+        """
+        Compares all the clauses that read a metric with its current values.
+
+        :return: The clause rows whose result changed.
+        """
+        rows = self.rows_by_metric.get(metric_id)
+        if rows is None or not len(rows):
+            return []
+        values = self._metric_values(metric_id)[self.clause_target[rows]]
+        ready = ~np.isnan(values)
+        results = np.zeros(len(rows), dtype=bool)
+        ops = self.clause_op[rows]
+        limits = self.clause_limit[rows]
+        with np.errstate(invalid='ignore'):
+            for code, (_, comparison) in enumerate(COMPARISONS):
+                selected = ops == code
+                if selected.any():
+                    results[selected] = comparison(values[selected], limits[selected])
+        results &= ready
+
+        changed = rows[(results != self.clause_results[rows]) | (ready != self.clause_ready[rows])]
+        self.clause_results[rows] = results
+        self.clause_ready[rows] = ready
+        return changed
+
+    def update_many(self, metric_name, values):
+        """
+        Called by the workload metrics with the value of each target. All
+        the clauses that read the metric are evaluated at once.
+
+        :param metric_name: The name that identifies the workload metric.
+        :type metric_name: String
+        :param values: The value of each target, e.g. {'crystal': 16.4}
+        :type values: dict
+        """
+        metric_id = self.metrics.ids.get(metric_name.lower())
+        if metric_id is None:
+            return
+        metric_values = self._metric_values(metric_id)
+        target_ids = self.targets.ids
+        wildcard_sums = dict()
+        for target, value in values.items():
+            value = float(value)
+            target_id = target_ids.get(target)
+            if target_id is not None:
+                metric_values[target_id] = value
+            for wildcard in self.wildcards:
+                if wildcard_matches(wildcard[:-1], target):
+                    wildcard_sums[wildcard] = wildcard_sums.get(wildcard, 0.0) + value
+        # A wildcard without matching targets in this update has no value
+        for wildcard in self.wildcards:
+            metric_values[target_ids[wildcard]] = wildcard_sums.get(wildcard, np.nan)
+
+        if self._dirty:
+            self._rebuild()
+            policy_ids = self.policies.keys()
+        else:
+            policy_ids = set(self.clause_policy[row] for row in self._compare(metric_id))
+
+        for policy_id in policy_ids:
+            self._check_policy(policy_id)
+
+    def _check_policy(self, policy_id):
+        row = self.policies.get(policy_id)
+        if row is None or not self.clause_ready[row.clause_rows].all():
+            return
+        result = row.condition.evaluate_results(self.clause_results[row.clause_rows])
+        if row.transient:
+            if result != row.execution_stat:
+                self._do_transient_action(policy_id, row, result)
+                row.execution_stat = result
+        elif result:
+            self._do_action(policy_id, row)
+
+    def _get_token(self):
+        if not self.token:
+            try:
+                self.token = get_admin_token()
+            except Exception:
+                logger.error("Rule engine, There was an error gettting a token from keystone")
+                return False
+        return True
+
+    def _filter_data(self, row):
+        return {'object_type': row.data['object_type'],
+                'object_size': row.data['object_size'],
+                'object_tag': row.data['object_tag'],
+                'params': row.data['parameters']}
+
+    def _do_action(self, policy_id, row):
+        """
+        Executes the action of a policy once its condition is satisfied,
+        as Rule does.
+        """
+        if row.applied or not self._get_token():
+            return
+
+        target_id = row.data['target_id']
+        action = row.data['action']
+        if action == "SET":
+            response = deploy_filter(self.controller_server, self.token, target_id, row.data['filter'], self._filter_data(row))
+            if 200 <= response.status_code < 300:
+                logger.info('Policy ' + policy_id + ' applied')
+                row.applied = True
+                self.redis.hset(policy_id, 'status', 'Applied')
+                self.remove_policy(policy_id)
+            else:
+                logger.error('Error setting policy')
+        elif action == "DELETE":
+            response = undeploy_filter(self.controller_server, self.token, target_id, row.data['filter'])
+            if 200 <= response.status_code < 300:
+                logger.info(response.text + " " + str(response.status_code))
+                row.applied = True
+                self.remove_policy(policy_id)
+            else:
+                logger.error('ERROR RESPONSE')
+
+    def _do_transient_action(self, policy_id, row, condition_result):
+        """
+        Executes the action of a transient policy, or the reverse action
+        when its condition is no longer satisfied, as TransientRule does.
+        """
+        action = row.data['action']
+        if not condition_result:
+            action = "DELETE" if action == "SET" else "SET"
+        if not self._get_token():
+            return
+
+        target_id = row.data['target_id']
+        if action == "SET":
+            logger.info("Setting static policy")
+            response = deploy_filter(self.controller_server, self.token, target_id, row.data['filter'], self._filter_data(row))
+            if 200 <= response.status_code < 300:
+                logger.info("Static policy applied with ID: " + response.content)
+                row.static_policy_id = response.content
+            else:
+                logger.error('Error setting policy')
+        elif action == "DELETE":
+            logger.info("Deleting static policy " + str(row.static_policy_id))
+            response = delete_static_policy(self.controller_server, self.token, target_id, row.static_policy_id)
+            if 200 <= response.status_code < 300:
+                logger.info("Policy " + str(row.static_policy_id) + " successfully deleted")
+            else:
+                logger.error('Error Deleting policy')
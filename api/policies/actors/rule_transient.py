@@ -1,8 +1,5 @@
-from rule import Rule
-import requests
+from rule import Rule, deploy_filter, delete_static_policy
 import logging
-import json
-import os
 
 logger = logging.getLogger(__name__)
 
@@ -51,8 +48,8 @@ class TransientRule(Rule):
 
         self.observers_values[metric] = tenant_info
 
-        if all(val is not None for val in self.observers_values.values()):
-            condition_accomplished = self._check_conditions(self.condition_list)
+        condition_accomplished = self.compiled_condition.update(metric, tenant_info)
+        if condition_accomplished is not None:
             if condition_accomplished != self.execution_stat:
                 self.do_action(condition_accomplished)
                 self.execution_stat = condition_accomplished
@@ -72,13 +69,10 @@ class TransientRule(Rule):
         if not self.token:
             self._get_admin_token()
 
-        headers = {"X-Auth-Token": self.token}
-
         if action == "SET":
             # TODO Review if this tenant has already deployed this filter. Don't deploy the same filter more than one time.
             logger.info("Setting static policy")
             data = dict()
-            url = os.path.join('http://'+self.controller_server, 'filters', self.target_id, "deploy", str(self.filter))
 
             data['object_type'] = self.object_type
             data['object_size'] = self.object_size
@@ -86,7 +80,7 @@ class TransientRule(Rule):
 
             data['params'] = self.params
 
-            response = requests.put(url, json.dumps(data), headers=headers)
+            response = deploy_filter(self.controller_server, self.token, self.target_id, self.filter, data)
 
             if 200 <= response.status_code < 300:
                 logger.info("Static policy applied with ID: " + response.content)
@@ -96,8 +90,7 @@ class TransientRule(Rule):
 
         elif action == "DELETE":
             logger.info("Deleting static policy " + str(self.static_policy_id))
-            url = os.path.join('http://'+self.controller_server, "policies/static", self.target_id+":"+str(self.static_policy_id))
-            response = requests.delete(url, headers=headers)
+            response = delete_static_policy(self.controller_server, self.token, self.target_id, self.static_policy_id)
 
             if 200 <= response.status_code < 300:
                 logger.info("Policy " + str(self.static_policy_id) + " successfully deleted")
@@ -0,0 +1,94 @@
+"""
+Compiled evaluation of the conditions of the dynamic policies.
+
+The condition list produced by the DSL parser, e.g.
+[['metric1', '>', '5'], 'AND', [['metric2', '<', '3'], 'OR', ['metric1', '<', '2']]],
+is compiled once into a flat list of clauses (metric, comparison, limit)
+and a tree of closures over the clause results. When a metric value is
+updated only the clauses that read that metric are compared again, and the
+boolean tree is evaluated over the cached clause results.
+"""
+import operator
+
+mappings = {'>': operator.gt, '>=': operator.ge,
+            '==': operator.eq, '<=': operator.le, '<': operator.lt,
+            '!=': operator.ne, "OR": operator.or_, "AND": operator.and_}
+
+
+class CompiledCondition(object):
+    """
+    Evaluator of a parsed condition list.
+    """
+
+    def __init__(self, condition_list):
+        self.clauses = list()
+        self.clauses_by_metric = dict()
+        self.values = dict()
+        self.results = list()
+        self._evaluate = self._compile(condition_list)
+        self.metrics = set(self.clauses_by_metric)
+
+    def _compile(self, condition_list):
+        if not isinstance(condition_list[0], list):
+            metric, comparison, limit = condition_list[0].lower(), condition_list[1], float(condition_list[2])
+            index = len(self.clauses)
+            self.clauses.append((metric, mappings[comparison], limit))
+            self.clauses_by_metric.setdefault(metric, []).append(index)
+            self.results.append(None)
+            return lambda results: results[index]
+
+        operands = [self._compile(condition_list[i]) for i in range(0, len(condition_list), 2)]
+        operators = set(condition_list[1::2])
+        if operators == set(['AND']):
+            return lambda results: all(operand(results) for operand in operands)
+        if operators == set(['OR']):
+            return lambda results: any(operand(results) for operand in operands)
+
+        # Mixed operators at the same level are folded left to right
+        folded = [(mappings[condition_list[i]], operands[(i + 1) / 2]) for i in range(1, len(condition_list) - 1, 2)]
+        first = operands[0]
+
+        def evaluate(results):
+            result = first(results)
+            for op, operand in folded:
+                result = op(result, operand(results))
+            return result
+        return evaluate
+
+    @property
+    def ready(self):
+        """
+        True when all the metrics of the condition have a value.
+        """
+        return len(self.values) == len(self.metrics)
+
+    def update(self, metric, value):
+        """
+        Sets the value of a metric and re-evaluates the condition.
+
+        :param metric: The name of the workload metric.
+        :param value: The new value of the metric.
+        :return: The result of the condition, or None if some metric has no
+                 value yet.
+        """
+        metric = metric.lower()
+        if metric in self.clauses_by_metric:
+            value = float(value)
+            if self.values.get(metric) != value:
+                self.values[metric] = value
+                for index in self.clauses_by_metric[metric]:
+                    _, comparison, limit = self.clauses[index]
+                    self.results[index] = comparison(value, limit)
+        return self.evaluate()
+
+    def evaluate(self):
+        if not self.ready:
+            return None
+        return bool(self._evaluate(self.results))
+
+    def evaluate_results(self, results):
+        """
+        Evaluates the boolean tree over clause results computed elsewhere,
+        in the order of ``clauses``.
+        """
+        return bool(self._evaluate(results))
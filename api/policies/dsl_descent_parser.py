@@ -0,0 +1,287 @@
+"""
+Hand-written parser of the policy DSL.
+
+The rule is parsed by recursive descent. As pyparsing does, every terminal
+is matched at the current position of the rule, after skipping whitespace:
+keywords and the metric and filter names as literals (the longest name
+first, as oneOf), and words and numbers with the regular expressions of
+the pyparsing grammar. It accepts the grammar of the pyparsing backend
+(policies.dsl_parser) and builds the same ParseResults: the target,
+condition_list, action_list and object_list names, the same nesting of the
+condition (AND binds tighter than OR) and the same names inside each
+group, so the views and the rule actors work with either backend.
+
+Like pyparsing's parseString, an optional part of the rule (the WITH
+parameters, ON, TO, another target, action, object filter or AND/OR
+operand) that does not match is left out, and the text after the longest
+rule that matches is ignored.
+"""
+from pyparsing import ParseException, ParseResults
+import re
+
+WHITESPACE_RE = re.compile(r'[ \t\r\n]*')
+NUMBER_RE = re.compile(r'[+-]?\d+(:?\.\d*)?(:?[eE][+-]?\d+)?')
+PARAM_RE = re.compile(r'[A-Za-z0-9_]+')
+ALPHAS_RE = re.compile(r'[A-Za-z]+')
+GROUP_RE = re.compile(r'G:[0-9]+')
+
+TARGETS = {'TENANT': re.compile(r'[A-Za-z0-9]+'),
+           'CONTAINER': re.compile(r'[A-Za-z0-9]+/[A-Za-z0-9_\-]+'),
+           'OBJECT': re.compile(r'[A-Za-z0-9]+/[A-Za-z0-9_\-]+/[A-Za-z0-9_\-.]+')}
+# The longest option first, as oneOf matches them
+COMPARISONS = ('<=', '>=', '==', '!=', '<', '>')
+SERVERS = ('PROXY', 'OBJECT')
+
+
+def _group(tokens, **names):
+    result = ParseResults(tokens)
+    for name, value in names.items():
+        if value is not None:
+            result[name] = value
+    return result
+
+
+class DescentParser(object):
+    """
+    Parser of a single rule or condition.
+
+    :param services: The names of the registered workload metrics.
+    :param filters: The names of the registered filters.
+    :param group_tenants: Function that returns the projects of a group of
+                          projects, e.g. ['G:1'] -> [project ids].
+    """
+
+    def __init__(self, input_string, services, filters=(), group_tenants=None):
+        self.input_string = input_string
+        self.services = sorted(services, key=len, reverse=True)
+        self.filters = sorted(filters, key=len, reverse=True)
+        self.group_tenants = group_tenants
+        self.loc = 0
+
+    def error(self, expected):
+        raise ParseException(self.input_string, self.loc, 'Expected ' + expected)
+
+    def skip(self):
+        self.loc = WHITESPACE_RE.match(self.input_string, self.loc).end()
+
+    def accept(self, *options):
+        """
+        Matches the first option found at the current position, or returns
+        None without consuming the rule.
+        """
+        self.skip()
+        for option in options:
+            if self.input_string.startswith(option, self.loc):
+                self.loc += len(option)
+                return option
+        return None
+
+    def literal(self, *options):
+        option = self.accept(*options)
+        if option is None:
+            self.error(' or '.join('"' + expected + '"' for expected in options))
+        return option
+
+    def name(self, names, expected):
+        name = self.accept(*names)
+        if name is None:
+            self.error(expected)
+        return name
+
+    def regex(self, regex, expected):
+        self.skip()
+        match = regex.match(self.input_string, self.loc)
+        if match is None:
+            self.error(expected)
+        self.loc = match.end()
+        return match.group()
+
+    def optional(self, element, *args):
+        """
+        Parses element(*args), or returns None and goes back to the current
+        position if it does not match.
+        """
+        loc = self.loc
+        try:
+            return element(*args)
+        except ParseException:
+            self.loc = loc
+            return None
+
+    def preceded(self, keyword, element, *args):
+        self.literal(keyword)
+        return element(*args)
+
+    def delimited_list(self, element, *args):
+        items = [element(*args)]
+        while True:
+            item = self.optional(self.preceded, ',', element, *args)
+            if item is None:
+                return items
+            items.append(item)
+
+    #
+    # Condition
+    #
+    def condition(self):
+        metric = self.name(self.services, 'a workload metric')
+        operand = self.literal(*COMPARISONS)
+        limit_value = self.regex(NUMBER_RE, 'a number')
+        return _group([metric, operand, limit_value], operand=operand, limit_value=limit_value)
+
+    def condition_atom(self):
+        if self.accept('('):
+            expression = self.condition_list()
+            self.literal(')')
+            return expression
+        return self.condition()
+
+    def condition_level(self, operator, operand):
+        tokens = [operand()]
+        while True:
+            right = self.optional(self.preceded, operator, operand)
+            if right is None:
+                break
+            tokens += [operator, right]
+        if len(tokens) == 1:
+            return tokens[0]
+        return _group(tokens)
+
+    def condition_and(self):
+        return self.condition_level('AND', self.condition_atom)
+
+    def condition_list(self):
+        return self.condition_level('OR', self.condition_and)
+
+    #
+    # Target
+    #
+    def single_target(self, kind):
+        self.literal(kind)
+        self.literal(':')
+        return _group([kind, self.regex(TARGETS[kind], 'a target')], type=kind)
+
+    def tenant_group(self):
+        return self.group_tenants([self.regex(GROUP_RE, 'a group of projects')])
+
+    def target(self):
+        self.skip()
+        kinds = [kind for kind in TARGETS if self.input_string.startswith(kind, self.loc)]
+        if kinds:
+            targets = self.delimited_list(self.single_target, kinds[0])
+        elif GROUP_RE.match(self.input_string, self.loc):
+            targets = [project for group in self.delimited_list(self.tenant_group) for project in group]
+        else:
+            self.error('a target')
+        # Repeated targets are removed, as the pyparsing backend does
+        return list(set(targets))
+
+    #
+    # Action
+    #
+    def param(self):
+        name = self.regex(PARAM_RE, 'a parameter')
+        self.literal('=')
+        return [name, self.regex(PARAM_RE, 'a parameter value')]
+
+    def params(self):
+        return sum(self.delimited_list(self.param), [])
+
+    def action(self):
+        action = self.literal('SET', 'DELETE')
+        sfilter = self.name(self.filters, 'a filter')
+        tokens = [action, sfilter]
+
+        params = self.optional(self.preceded, 'WITH', self.params)
+        if params is not None:
+            tokens += params
+            params = _group(params)
+        server_execution = self.optional(self.preceded, 'ON', self.literal, *SERVERS)
+        if server_execution is not None:
+            tokens.append(server_execution)
+        transient = self.accept('TRANSIENT')
+        if transient:
+            tokens.append(transient)
+        is_callable = self.accept('CALLABLE')
+        if is_callable:
+            tokens.append(is_callable)
+
+        return _group(tokens, action=action, filter=sfilter, params=params,
+                      server_execution=server_execution, transient=transient,
+                      callable=is_callable)
+
+    def action_list(self):
+        return _group(self.delimited_list(self.action))
+
+    #
+    # Object list
+    #
+    def object_filter(self, objects):
+        """
+        Parses an object filter of a kind that is not in objects yet, and
+        adds it to objects.
+        """
+        self.skip()
+        start = self.loc
+        name = self.literal('OBJECT_TYPE', 'OBJECT_SIZE', 'OBJECT_TAG')
+        key = name.lower()
+        if key in objects:
+            self.loc = start
+            self.error('a different object filter')
+        if name == 'OBJECT_SIZE':
+            operand = self.literal(*COMPARISONS)
+            value = self.regex(NUMBER_RE, 'a number')
+            group = _group([name, operand, value], size=name, operand=operand, object_value=value)
+        else:
+            self.literal('=')
+            value = self.regex(ALPHAS_RE, 'a word')
+            if name == 'OBJECT_TYPE':
+                group = _group([name, '=', value], type=name, object_value=value)
+            else:
+                group = _group([name, '=', value], tag=name, object_value=value)
+        objects[key] = group
+        return group
+
+    def object_list(self):
+        objects = dict()
+        tokens = [self.object_filter(objects)]
+        while True:
+            group = self.optional(self.preceded, ',', self.object_filter, objects)
+            if group is None:
+                break
+            tokens += [',', group]
+        return _group(tokens, **objects)
+
+    #
+    # Rule
+    #
+    def parse_rule(self):
+        """
+        FOR target [WHEN condition_list] DO action_list [TO object_list]
+        """
+        self.literal('FOR')
+        target = self.target()
+        tokens = [target]
+        condition_list = self.optional(self.preceded, 'WHEN', self.condition_list)
+        if condition_list is not None:
+            tokens.append(condition_list)
+        self.literal('DO')
+        action_list = self.action_list()
+        tokens.append(action_list)
+        object_list = self.optional(self.preceded, 'TO', self.object_list)
+        if object_list is not None:
+            tokens.append(object_list)
+        return _group(tokens, target=target, condition_list=condition_list,
+                      action_list=action_list, object_list=object_list)
+
+    def parse_condition(self):
+        condition_list = self.condition_list()
+        return _group([condition_list], condition_list=condition_list)
+
+
+def parse_rule(input_string, services, filters, group_tenants):
+    return DescentParser(input_string, services, filters, group_tenants).parse_rule()
+
+
+def parse_condition(input_string, services):
+    return DescentParser(input_string, services).parse_condition()
@@ -1,8 +1,12 @@
 from pyparsing import Word, Suppress, alphas, Literal, Group, Combine, opAssoc, alphanums
-from pyparsing import Regex, operatorPrecedence, oneOf, nums, Optional, delimitedList
+from pyparsing import Regex, operatorPrecedence, oneOf, nums, Optional, delimitedList, ParserElement
 from django.conf import settings
+from api import registry
+from policies import dsl_descent_parser
+import threading
 import json
 import redis
+import uuid
 
 # By default, PyParsing treats \n as whitespace and ignores it
 # In our grammar, \n is significant, so tell PyParsing not to ignore it
@@ -22,10 +26,70 @@ import redis
 # TODO: Parse = TRUE or = False or condition number. Check to convert to float or convert to boolean.
 
 
+GRAMMAR_VERSION_KEY = 'dsl_parser:registry_version'
+GRAMMAR_CACHE_SIZE = 16
+
+# Packrat parsing memoizes the partial matches of the (backtracking)
+# object_list alternation and of the condition operator precedence.
+ParserElement.enablePackrat()
+
+_cache_lock = threading.Lock()
+_registries = dict()
+_condition_grammars = dict()
+_rule_grammars = dict()
+
+
 def get_redis_connection():
     return redis.Redis(connection_pool=settings.REDIS_CON_POOL)
 
 
+def invalidate_grammar_cache(r=None):
+    """
+    Must be called every time a workload metric or a filter is registered,
+    renamed or deleted, so that the grammar is built again with the new
+    metric and filter names.
+    """
+    if r is None:
+        r = get_redis_connection()
+    r.set(GRAMMAR_VERSION_KEY, uuid.uuid4().hex)
+
+
+def get_registries(r):
+    """
+    Returns the names of the registered workload metrics and filters.
+    They are only read from redis (from their index sets) when the registries changed
+    since the last call.
+
+    :rtype: tuple (metric names, filter names)
+    """
+    version = r.get(GRAMMAR_VERSION_KEY)
+    if version is not None and version in _registries:
+        return _registries[version]
+
+    services = tuple(sorted(key.split(":")[1] for key in registry.keys(r, "metric")))
+    sfilters = tuple(sorted(key.split(":")[1] for key in registry.keys(r, "filter")))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not r.setnx(GRAMMAR_VERSION_KEY, version):
+            # Registries changed meanwhile: do not cache this read
+            return services, sfilters
+    with _cache_lock:
+        _registries.clear()
+        _registries[version] = (services, sfilters)
+    return services, sfilters
+
+
+def _cached(cache, key, build):
+    grammar = cache.get(key)
+    if grammar is None:
+        grammar = build(*key)
+        with _cache_lock:
+            if len(cache) >= GRAMMAR_CACHE_SIZE:
+                cache.clear()
+            cache[key] = grammar
+    return grammar
+
+
 def parse_group_tenants(tokens):
     r = get_redis_connection()
     # data = r.lrange(tokens[0], 0, -1)
@@ -34,13 +98,8 @@ def parse_group_tenants(tokens):
     return json.loads(attached_projects)
 
 
-def parse_condition(input_string):
-
-    r = get_redis_connection()
-
-    metrics_workload = r.keys("metric:*")
-    services = map(lambda x: "".join(x.split(":")[1]), metrics_workload)
-    services_options = oneOf(services)
+def build_condition_grammar(services):
+    services_options = oneOf(list(services))
     operand = oneOf("< > == != <= >=")
     number = Regex(r"[+-]?\d+(:?\.\d*)?(:?[eE][+-]?\d+)?")
 
@@ -49,15 +108,22 @@ def parse_condition(input_string):
                                 ("AND", 2, opAssoc.LEFT, ),
                                 ("OR", 2, opAssoc.LEFT, ),
                                 ])
-    rule = condition_list('condition_list')
-    return rule.parseString(input_string).condition_list.asList()
+    return condition_list('condition_list')
 
 
-def parse(input_string):
-    # TODO Raise an exception if not metrics or not action registered
-    # TODO Raise an exception if group of tenants does not exist.
+def parse_condition(input_string):
+
     r = get_redis_connection()
 
+    services, _ = get_registries(r)
+    if settings.DSL_PARSER_BACKEND == 'descent':
+        return dsl_descent_parser.parse_condition(input_string, services).condition_list.asList()
+
+    rule = _cached(_condition_grammars, (services,), build_condition_grammar)
+    return rule.parseString(input_string).condition_list.asList()
+
+
+def build_rule_grammar(services, sfilter):
     # Support words to construct the grammar.
     word = Word(alphas)
     when = Suppress(Literal("WHEN"))
@@ -65,9 +131,7 @@ def parse(input_string):
     # boolean_condition = oneOf("AND OR")
     # Condition part
     param = Word(alphanums+"_") + Suppress(Literal("=")) + Word(alphanums+"_")
-    metrics_workload = r.keys("metric:*")
-    services = map(lambda x: "".join(x.split(":")[1]), metrics_workload)
-    services_options = oneOf(services)
+    services_options = oneOf(list(services))
     operand = oneOf("< > == != <= >=")
     number = Regex(r"[+-]?\d+(:?\.\d*)?(:?[eE][+-]?\d+)?")
     condition = Group(services_options + operand("operand") + number("limit_value"))
@@ -89,8 +153,6 @@ def parse(input_string):
     # Group(tenant_list ^ tenant_group_list ^ container_list ^ obj_list)
     # Action part
     action = oneOf("SET DELETE")
-    sfilters_list = r.keys("filter:*")
-    sfilter = map(lambda x: "".join(x.split(":")[1]), sfilters_list)
     with_params = Suppress(Literal("WITH"))
     do = Suppress(Literal("DO"))
     params_list = delimitedList(param)
@@ -99,7 +161,7 @@ def parse(input_string):
     transient = Literal("TRANSIENT")
     # CALLABLE
     is_callable = Literal("CALLABLE")
-    action = Group(action("action") + oneOf(sfilter)("filter") +
+    action = Group(action("action") + oneOf(list(sfilter))("filter") +
                    Optional(with_params + params_list("params")) +
                    Optional(Suppress("ON")+server_execution("server_execution")) +
                    Optional(transient("transient")) +
@@ -134,12 +196,23 @@ def parse(input_string):
     tenant_group.setParseAction(parse_group_tenants)
 
     # Final rule structure
-    rule_parse = literal_for + target("target") + \
-                 Optional(when + condition_list("condition_list")) + do + \
-                 action_list("action_list") + Optional(to + object_list("object_list"))
+    return literal_for + target("target") + \
+        Optional(when + condition_list("condition_list")) + do + \
+        action_list("action_list") + Optional(to + object_list("object_list"))
+
+
+def parse(input_string):
+    # TODO Raise an exception if not metrics or not action registered
+    # TODO Raise an exception if group of tenants does not exist.
+    r = get_redis_connection()
 
-    # Parse the rule
-    parsed_rule = rule_parse.parseString(input_string)
+    services, sfilters = get_registries(r)
+    if settings.DSL_PARSER_BACKEND == 'descent':
+        parsed_rule = dsl_descent_parser.parse_rule(input_string, services, sfilters, parse_group_tenants)
+    else:
+        # The grammar is built once for each set of metric and filter names
+        rule_parse = _cached(_rule_grammars, (services, sfilters), build_rule_grammar)
+        parsed_rule = rule_parse.parseString(input_string)
 
     # Post-parsed validation
     has_condition_list = True
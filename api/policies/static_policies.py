@@ -0,0 +1,158 @@
+"""
+Precomputed listing of the static policies.
+
+Listing the static policies used to read every pipeline, the filter and
+the object type of every policy, and sort them by execution order on each
+request. The listing is now kept in redis, ready to serve:
+
+- ``static_policies``: sorted set of the JSON documents of the policies,
+  scored by execution order.
+- ``static_policies:documents``: hash of the current document of each
+  policy, by ``<target>:<policy id>``, to replace it when it changes.
+
+set_filter, unset_filter and static_policy_detail update the document of
+the policy they change. Changes that affect many documents (a filter or an
+object type updated, a bulk import) invalidate the listing, and the next
+read builds it again from the pipelines, as it does the first time.
+
+The name of the target project is not stored, since projects can be
+renamed in Keystone; it is added to the documents when they are read.
+"""
+import json
+
+from api import registry
+from api.common import get_hashes, to_json_bools
+
+LISTING_KEY = 'static_policies'
+DOCUMENTS_KEY = 'static_policies:documents'
+BUILT_KEY = 'static_policies:built'
+FILTER_METHODS = ('get', 'put', 'post', 'head', 'delete')
+
+# The current document of a policy is read and replaced in the same script,
+# so concurrent updates of a policy cannot leave several of its documents
+# in the listing.
+# KEYS: listing, documents. ARGV: <target>:<policy id>, document, execution order
+UPDATE_SCRIPT = """
+local old_document = redis.call('hget', KEYS[2], ARGV[1])
+if old_document then
+    redis.call('zrem', KEYS[1], old_document)
+end
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[2])
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+"""
+
+# KEYS: listing, documents. ARGV: <target>:<policy id>
+REMOVE_SCRIPT = """
+local old_document = redis.call('hget', KEYS[2], ARGV[1])
+if old_document then
+    redis.call('zrem', KEYS[1], old_document)
+    redis.call('hdel', KEYS[2], ARGV[1])
+end
+"""
+
+
+def get_document(target, policy_id, policy, filter_data, object_names):
+    """
+    Returns the listing entry of a static policy.
+
+    :param target: The target of the pipeline, e.g. '<project id>:<container>'
+    :param policy: The data of the policy in the pipeline.
+    :param filter_data: The filter of the policy.
+    :param object_names: The extensions of the object type of the policy.
+    """
+    filter_data = dict(filter_data)
+    to_json_bools(filter_data, *FILTER_METHODS)
+    document = {'id': policy_id, 'target_id': target,
+                'filter_name': policy['filter_name'],
+                'object_type': policy['object_type'],
+                'object_size': policy['object_size'],
+                'object_tag': policy['object_tag'],
+                'object_name': ', '.join(object_names),
+                'execution_server': policy['execution_server'],
+                'reverse': policy['reverse'],
+                'execution_order': policy['execution_order'],
+                'params': policy['params'],
+                'put': filter_data['put'],
+                'get': filter_data['get']}
+    for method in ('post', 'head', 'delete'):
+        if method in filter_data:
+            document[method] = filter_data[method]
+    return document
+
+
+def _write(pipe, target, policy_id, document):
+    data = json.dumps(document, sort_keys=True)
+    pipe.zadd(LISTING_KEY, data, int(document['execution_order']))
+    pipe.hset(DOCUMENTS_KEY, target + ':' + str(policy_id), data)
+
+
+def update(r, target, policy_id, policy):
+    """
+    Adds or replaces a static policy in the listing.
+
+    :param policy: The data of the policy in the pipeline (JSON string or dict).
+    """
+    if isinstance(policy, basestring):
+        policy = json.loads(policy)
+    filter_data = r.hgetall('filter:' + str(policy['dsl_name']))
+    object_names = r.lrange('object_type:' + policy['object_type'], 0, -1)
+    document = get_document(target, policy_id, policy, filter_data, object_names)
+
+    r.eval(UPDATE_SCRIPT, 2, LISTING_KEY, DOCUMENTS_KEY, target + ':' + str(policy_id),
+           json.dumps(document, sort_keys=True), int(document['execution_order']))
+
+
+def remove(r, target, policy_id):
+    """
+    Removes a static policy from the listing.
+    """
+    r.eval(REMOVE_SCRIPT, 2, LISTING_KEY, DOCUMENTS_KEY, target + ':' + str(policy_id))
+
+
+def invalidate(r):
+    """
+    Makes the next read build the listing again from the pipelines.
+    """
+    r.delete(BUILT_KEY)
+
+
+def rebuild(r):
+    """
+    Builds the listing from the pipelines.
+    """
+    keys = registry.keys(r, 'pipeline')
+    entries = [(key.replace('pipeline:', ''), policy_id, json.loads(value))
+               for key, pipeline in zip(keys, get_hashes(r, keys))
+               for policy_id, value in pipeline.items()]
+
+    # Filters and object types of all the policies, read at once
+    dsl_names = list(set(str(policy['dsl_name']) for _, _, policy in entries))
+    filters = dict(zip(dsl_names, get_hashes(r, ['filter:' + dsl_name for dsl_name in dsl_names])))
+    object_types = list(set(policy['object_type'] for _, _, policy in entries))
+    pipe = r.pipeline(transaction=False)
+    for object_type in object_types:
+        pipe.lrange('object_type:' + object_type, 0, -1)
+    object_names = dict(zip(object_types, pipe.execute()))
+
+    pipe = r.pipeline()
+    pipe.delete(LISTING_KEY, DOCUMENTS_KEY)
+    for target, policy_id, policy in entries:
+        document = get_document(target, policy_id, policy, filters[str(policy['dsl_name'])],
+                                object_names[policy['object_type']])
+        _write(pipe, target, policy_id, document)
+    pipe.set(BUILT_KEY, 1)
+    pipe.execute()
+
+
+def listing(r, start=0, end=-1):
+    """
+    Returns the static policies sorted by execution order, without the
+    name of their target.
+
+    :param start: Position of the first policy to return.
+    :param end: Position of the last policy to return (inclusive).
+    :rtype: list of dict
+    """
+    if not r.exists(BUILT_KEY):
+        rebuild(r)
+    return [json.loads(document) for document in r.zrange(LISTING_KEY, start, end)]
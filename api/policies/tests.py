@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 
 import mock
 import redis
@@ -8,10 +9,13 @@ from django.test import TestCase, override_settings
 from pyparsing import ParseException
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
+from swiftclient.exceptions import ClientException
+from api import registry
+from policies import dsl_parser, static_policies
 from policies.dsl_parser import parse, parse_condition
-from filters.views import filter_list, filter_deploy, FilterData
+from filters.views import filter_list, filter_detail, filter_deploy, FilterData
 from policies.views import object_type_list, object_type_detail, static_policy_detail, dynamic_policy_detail, policy_list, \
-    access_control, access_control_detail
+    access_control, access_control_detail, policy_import
 from projects.views import add_projects_group
 
 
@@ -37,6 +41,8 @@ class PoliciesTestCase(TestCase):
         self.create_metric_modules()
         self.create_global_controllers()
         self.create_acls()
+        # The fixtures are written directly to redis
+        registry.build_indexes(self.r)
 
     def tearDown(self):
         self.r.flushdb()
@@ -138,6 +144,207 @@ class PoliciesTestCase(TestCase):
         self.assertEqual(policy_data['filter'], 'compression')
         self.assertEqual(policy_data['condition'], 'metric1 > 5')
 
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_create_with_metric_tier(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression"
+        request = self.factory.post('/policies/dynamic?metric_tier=10s: tumbling', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_list(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.r.hget('policy:2', 'metric_tier'), '10s:tumbling')
+
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_create_with_invalid_metric_tier(self, mock_create_local_host):
+        self.setup_dsl_parser_data()
+
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression"
+        for metric_tier in ('10x', '1s,10s'):
+            request = self.factory.post('/policies/dynamic?metric_tier=' + metric_tier, data,
+                                        content_type='text/plain')
+            request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+            request.META['HTTP_HOST'] = 'fake_host'
+            response = policy_list(request)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(self.r.exists('policy:2'))
+        self.assertFalse(mock_create_local_host.called)
+
+    @override_settings(DYNAMIC_POLICY_ENGINE='engine')
+    @mock.patch('policies.views.rule_engine_actors', {})
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_registry_dynamic_policy_create_in_rule_engine_ok(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+
+        for data in ("FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression",
+                     "FOR TENANT:0123456789abcdef WHEN metric1 > 8 DO SET compression"):
+            request = self.factory.post('/policies/dynamic', data, content_type='text/plain')
+            request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+            request.META['HTTP_HOST'] = 'fake_host'
+            response = policy_list(request)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # Both policies share the engine of their metric
+        mock_spawn = mock_create_local_host.return_value.spawn
+        mock_spawn.assert_called_once_with(mock.ANY, settings.RULE_ENGINE_MODULE, 'fake_host', None)
+        self.assertEqual(mock_spawn.return_value.add_policy.call_count, 2)
+        self.assertTrue(self.r.exists('policy:3'))
+
+    #
+    # policy_import()
+    #
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    @mock.patch('policies.views.deploy_storlet')
+    def test_policy_import_ok(self, mock_deploy_storlet, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+
+        data = "FOR TENANT:0123456789abcdef DO SET fake\n" \
+               "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression, SET encryption\n" \
+               "\n" \
+               "FOR TENANT:2 DO SET fake\n" \
+               "FOR TENANT:0123456789abcdef DO"
+        request = self.factory.post('/policies/import', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_import(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        results = json.loads(response.content)
+        self.assertEqual([result['line'] for result in results], [1, 2, 4, 5])
+        self.assertEqual(results[0]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(results[0]['policies'], [2])
+        self.assertEqual(results[1]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(results[1]['policies'], [3, 4])
+        self.assertEqual(results[2]['status'], status.HTTP_404_NOT_FOUND)
+        self.assertEqual(results[3]['status'], status.HTTP_400_BAD_REQUEST)
+
+        # Projects resolved and ids reserved once
+        self.assertEqual(mock_get_project_list.call_count, 1)
+        self.assertEqual(self.r.get('policies:id'), '4')
+        mock_deploy_storlet.assert_called_once_with(mock.ANY, '0123456789abcdef', mock.ANY, 'fake_token')
+        self.assertEqual(json.loads(self.r.hget('pipeline:0123456789abcdef', '2'))['dsl_name'], 'fake')
+        self.assertEqual(self.r.hget('policy:3', 'filter'), 'compression')
+        self.assertEqual(self.r.hget('policy:4', 'filter'), 'encryption')
+        self.assertEqual(mock_create_local_host.return_value.spawn.call_count, 2)
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_policy_import_with_metric_tier(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression"
+        request = self.factory.post('/policies/import?metric_tier=ewma', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_import(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.r.hget('policy:2', 'metric_tier'), 'ewma')
+
+        request = self.factory.post('/policies/import?metric_tier=10x', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_import(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(self.r.exists('policy:3'))
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.create_local_host')
+    def test_policy_import_atomic_with_invalid_rule(self, mock_create_local_host, mock_get_project_list):
+        self.setup_dsl_parser_data()
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+
+        data = "FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression\n" \
+               "FOR TENANT:2 WHEN metric1 > 5 DO SET compression"
+        request = self.factory.post('/policies/import?atomic=true', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_import(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        results = json.loads(response.content)
+        self.assertNotIn('status', results[0])
+        self.assertEqual(results[1]['status'], status.HTTP_404_NOT_FOUND)
+        self.assertFalse(self.r.exists('policy:2'))
+        self.assertFalse(mock_create_local_host.called)
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.get_pipeline_entry')
+    @mock.patch('policies.views.deploy_storlet')
+    def test_policy_import_atomic_does_not_deploy_storlets_of_invalid_imports(self, mock_deploy_storlet,
+                                                                              mock_get_pipeline_entry,
+                                                                              mock_get_project_list):
+        self.setup_dsl_parser_data()
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef', '2')
+        mock_get_pipeline_entry.side_effect = [('pipeline:0123456789abcdef', 2, '{}'), ValueError('error')]
+
+        data = "FOR TENANT:0123456789abcdef DO SET fake\n" \
+               "FOR TENANT:2 DO SET fake"
+        request = self.factory.post('/policies/import?atomic=true', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_import(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(mock_deploy_storlet.called)
+        self.assertFalse(self.r.hexists('pipeline:0123456789abcdef', '2'))
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.revert_deploy_storlet')
+    @mock.patch('policies.views.deploy_storlet')
+    def test_policy_import_atomic_with_storlet_error(self, mock_deploy_storlet, mock_revert_deploy_storlet,
+                                                     mock_get_project_list):
+        self.setup_dsl_parser_data()
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef', '2')
+        mock_deploy_storlet.side_effect = [None, ClientException('error')]
+
+        data = "FOR TENANT:0123456789abcdef DO SET fake\n" \
+               "FOR TENANT:2 DO SET fake"
+        request = self.factory.post('/policies/import?atomic=true', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_import(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(mock_deploy_storlet.call_count, 2)
+        self.assertFalse(self.r.hexists('pipeline:0123456789abcdef', '2'))
+        # The storlet deployed for the first rule is deleted again
+        mock_revert_deploy_storlet.assert_called_once_with(mock.ANY, '0123456789abcdef', mock.ANY, 'fake_token')
+
+    @mock.patch('policies.views.get_project_list')
+    @mock.patch('policies.views.undeploy_storlet')
+    @mock.patch('policies.views.deploy_storlet')
+    def test_policy_import_delete_after_set(self, mock_deploy_storlet, mock_undeploy_storlet, mock_get_project_list):
+        self.setup_dsl_parser_data()
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.r.lpush('projects_crystal_enabled', '0123456789abcdef')
+
+        data = "FOR TENANT:0123456789abcdef DO SET fake\n" \
+               "FOR TENANT:0123456789abcdef DO DELETE fake"
+        request = self.factory.post('/policies/import', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        request.META['HTTP_HOST'] = 'fake_host'
+        response = policy_import(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # The DELETE removes the filter set by the previous rule
+        self.assertFalse(self.r.hexists('pipeline:0123456789abcdef', '2'))
+        self.assertIn('path', mock_deploy_storlet.call_args[0][2])
+        mock_undeploy_storlet.assert_called_once()
+
     #
     # static_policy_detail()
     #
@@ -192,6 +399,63 @@ class PoliciesTestCase(TestCase):
         json_data = json.loads(response.content)
         self.assertEqual(len(json_data), 0)
 
+    @mock.patch('policies.views.get_project_list')
+    def test_static_policy_listing_is_maintained(self, mock_get_project_list):
+        mock_get_project_list.return_value = {'0123456789abcdef': 'tenantA', '2': 'tenantB'}
+        self.assertEqual([policy['id'] for policy in static_policies.listing(self.r)], ['1'])
+        self.assertTrue(self.r.exists(static_policies.BUILT_KEY))
+
+        # A second policy, listed before the first one
+        data = {"execution_server": "object", "reverse": "object", "execution_order": "0"}
+        self.r.hset('pipeline:0123456789abcdef', '2', self.r.hget('pipeline:0123456789abcdef', '1'))
+        request = self.factory.put('/policies/static/0123456789abcdef:2', data, format='json')
+        response = static_policy_detail(request, '0123456789abcdef:2')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        with mock.patch('policies.static_policies.rebuild') as mock_rebuild:
+            request = self.factory.get('/policies/static')
+            response = policy_list(request)
+            self.assertFalse(mock_rebuild.called)
+        json_data = json.loads(response.content)
+        self.assertEqual([policy['id'] for policy in json_data], ['2', '1'])
+        self.assertEqual(json_data[0]['execution_server'], 'object')
+        self.assertEqual(json_data[0]['target_name'], 'tenantA')
+        self.assertEqual(self.r.hlen(static_policies.DOCUMENTS_KEY), 2)
+
+        request = self.factory.delete('/policies/static/0123456789abcdef:2')
+        static_policy_detail(request, '0123456789abcdef:2')
+        self.assertEqual([policy['id'] for policy in static_policies.listing(self.r)], ['1'])
+        self.assertEqual(self.r.zcard(static_policies.LISTING_KEY), 1)
+
+    def test_static_policy_listing_concurrent_updates(self):
+        static_policies.listing(self.r)
+        policy = json.loads(self.r.hget('pipeline:0123456789abcdef', '1'))
+
+        def update(execution_order):
+            for _ in range(50):
+                static_policies.update(self.r, '0123456789abcdef', '1', dict(policy, execution_order=execution_order))
+        threads = [threading.Thread(target=update, args=(execution_order,)) for execution_order in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # A single document of the policy is listed
+        self.assertEqual(self.r.zcard(static_policies.LISTING_KEY), 1)
+        self.assertEqual(self.r.zrange(static_policies.LISTING_KEY, 0, -1),
+                         [self.r.hget(static_policies.DOCUMENTS_KEY, '0123456789abcdef:1')])
+
+        static_policies.remove(self.r, '0123456789abcdef', '1')
+        self.assertEqual(self.r.zcard(static_policies.LISTING_KEY), 0)
+        self.assertEqual(self.r.hlen(static_policies.DOCUMENTS_KEY), 0)
+
+    def test_static_policy_listing_rebuilt_after_filter_update(self):
+        self.assertFalse(static_policies.listing(self.r)[0]['get'])
+        request = self.factory.put('/filters/fake', {'get': 'True'}, format='json')
+        response = filter_detail(request, 'fake')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(self.r.exists(static_policies.BUILT_KEY))
+        self.assertTrue(static_policies.listing(self.r)[0]['get'])
+
     #
     # dynamic_policy_detail()
     #
@@ -372,6 +636,110 @@ class PoliciesTestCase(TestCase):
         self.assertIsNotNone(condition_list)
         self.assertEqual(condition_list, [['metric1', '>', '5.0'], 'OR', ['metric1', '<', '2.0']])
 
+    def test_parse_backends_return_the_same_results(self):
+        self.setup_dsl_parser_data()
+        rules = ['FOR TENANT:0123456789abcdef DO SET compression WITH cparam1=1, cparam2=2 ON PROXY TRANSIENT CALLABLE',
+                 'FOR TENANT:0123456789abcdef WHEN metric1 > 3 AND metric2 < 4 OR metric1 == 1 DO SET compression, DELETE encryption',
+                 'FOR CONTAINER:0123456789abcdef/c-1 WHEN (metric1 > 3 OR metric2 < -1.5e2) AND metric1 != 2 DO SET compression',
+                 'FOR OBJECT:0123456789abcdef/container1/object.txt DO DELETE compression ON OBJECT',
+                 'FOR TENANT:0123456789abcdef DO SET compression TO OBJECT_SIZE>10, OBJECT_TAG=tag, OBJECT_TYPE=DOCS',
+                 'FOR G:1 WHEN metric1 >= 5 DO SET encryption WITH eparam1=5']
+        for rule in rules:
+            with self.settings(DSL_PARSER_BACKEND='pyparsing'):
+                expected = parse(rule)
+            with self.settings(DSL_PARSER_BACKEND='descent'):
+                has_condition_list, rule_parsed = parse(rule)
+            self.assertEqual(has_condition_list, expected[0])
+            self.assertEqual(sorted(map(str, rule_parsed.target)), sorted(map(str, expected[1].target)))
+            self.assertEqual(rule_parsed.asList()[1:], expected[1].asList()[1:])
+            self.assertEqual(sorted(rule_parsed.keys()), sorted(expected[1].keys()))
+            for action, expected_action in zip(rule_parsed.action_list, expected[1].action_list):
+                self.assertEqual(action.asList(), expected_action.asList())
+                self.assertEqual(sorted(action.keys()), sorted(expected_action.keys()))
+                self.assertEqual(str(action.params), str(expected_action.params))
+            self.assertEqual(str(rule_parsed.object_list), str(expected[1].object_list))
+            self.assertEqual(str(rule_parsed.condition_list), str(expected[1].condition_list))
+
+    @staticmethod
+    def as_list(rule_parsed):
+        # The order of the targets is not kept by either backend
+        return [sorted(map(str, rule_parsed.target))] + rule_parsed.asList()[1:]
+
+    def test_parse_backends_accept_the_same_rules(self):
+        self.setup_dsl_parser_data()
+        rules = ['TENANT:0123456789abcdef DO SET compression',
+                 'FOR xxxxxxx DO SET compression',
+                 'FOR TENANT:0123456789abcdef, CONTAINER:0123456789abcdef/c1 DO SET compression',
+                 'FOR TENANT:0123456789abcdef WHEN metric3 > 5 DO SET compression',
+                 'FOR TENANT:0123456789abcdef WHEN (metric1 > 5 DO SET compression',
+                 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 AND DO SET compression',
+                 'FOR TENANT:0123456789abcdef DO SET fake WHEN',
+                 # Trailing text is ignored
+                 'FOR TENANT:0123456789abcdef DO SET compression10',
+                 'FOR TENANT:0123456789abcdef DO SET compression TRANSIENTX',
+                 'FOR TENANT:0123456789abcdef DO SET compression WITH',
+                 'FOR TENANT:0123456789abcdef DO SET compression WITH cparam1=1, xx',
+                 'FOR TENANT:0123456789abcdef DO SET compression WITH cparam1=1 cparam2=3',
+                 'FOR TENANT:0123456789abcdef DO SET compression WITH cparam1=1, SET encryption ON',
+                 'FOR TENANT:0123456789abcdef DO SET compression, !!! $$',
+                 'FOR TENANT : 0123456789abcdef, TENANT:2 WHEN metric1 > 5 OR metric2 DO SET compression TO',
+                 'FOR TENANT:0123456789abcdef DO SET compression TO OBJECT_TYPE=DOCS, OBJECT_TYPE=AUDIO',
+                 'FOR TENANT:0123456789abcdef DO SET compression TO OBJECT_SIZE>10 OBJECT_TYPE=DOCS1,']
+        for rule in rules:
+            with self.settings(DSL_PARSER_BACKEND='pyparsing'):
+                try:
+                    expected = self.as_list(parse(rule)[1])
+                except ParseException:
+                    expected = None
+            with self.settings(DSL_PARSER_BACKEND='descent'):
+                try:
+                    rule_parsed = self.as_list(parse(rule)[1])
+                except ParseException:
+                    rule_parsed = None
+            self.assertEqual(rule_parsed, expected, rule)
+        for condition in ['metric1 > 5 AND', 'metric1 > 5.0e OR metric2', '(metric1 > 5', 'metric1 > 5) xx']:
+            with self.settings(DSL_PARSER_BACKEND='pyparsing'):
+                try:
+                    expected = parse_condition(condition)
+                except ParseException:
+                    expected = None
+            with self.settings(DSL_PARSER_BACKEND='descent'):
+                try:
+                    condition_list = parse_condition(condition)
+                except ParseException:
+                    condition_list = None
+            self.assertEqual(condition_list, expected, condition)
+
+    @override_settings(DSL_PARSER_BACKEND='pyparsing')
+    def test_parse_reuses_grammar_while_registries_do_not_change(self):
+        self.setup_dsl_parser_data()
+        with mock.patch('policies.dsl_parser.build_rule_grammar', wraps=dsl_parser.build_rule_grammar) as mock_build:
+            dsl_parser._rule_grammars.clear()
+            parse('FOR TENANT:0123456789abcdef DO SET compression')
+            parse('FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET encryption')
+            self.assertEqual(mock_build.call_count, 1)
+
+    def test_parse_with_registries_changed(self):
+        self.setup_dsl_parser_data()
+        parse('FOR TENANT:0123456789abcdef DO SET compression')
+        with self.assertRaises(ParseException):
+            parse('FOR TENANT:0123456789abcdef WHEN metric3 > 5 DO SET noop')
+
+        self.r.hmset('filter:noop', {'valid_parameters': '{}'})
+        self.r.hmset('metric:metric3', {'network_location': '?', 'type': 'integer'})
+        registry.add(self.r, 'filter:noop', 'metric:metric3')
+        dsl_parser.invalidate_grammar_cache(self.r)
+        has_condition_list, rule_parsed = parse('FOR TENANT:0123456789abcdef WHEN metric3 > 5 DO SET noop')
+        self.assertTrue(has_condition_list)
+        self.assertEqual(rule_parsed.action_list[0].filter, 'noop')
+        self.assertEqual(parse_condition('metric3 > 5'), ['metric3', '>', '5'])
+
+        self.r.delete('filter:noop')
+        registry.remove(self.r, 'filter:noop')
+        dsl_parser.invalidate_grammar_cache(self.r)
+        with self.assertRaises(ParseException):
+            parse('FOR TENANT:0123456789abcdef DO SET noop')
+
     #
     # object_type tests
     #
@@ -689,6 +1057,7 @@ class PoliciesTestCase(TestCase):
         self.r.hmset('filter:encryption', {'valid_parameters': '{"eparam1": "integer", "eparam2": "bool", "eparam3": "string"}'})
         self.r.hmset('metric:metric1', {'network_location': '?', 'type': 'integer'})
         self.r.hmset('metric:metric2', {'network_location': '?', 'type': 'integer'})
+        registry.add(self.r, 'filter:compression', 'filter:encryption', 'metric:metric1', 'metric:metric2')
 
     def create_tenant_group_1(self):
         tenant_group_data = {'name': 'group1', 'attached_projects': json.dumps(['0123456789abcdef', 'abcdef0123456789'])}
@@ -1,3 +1,4 @@
+import itertools
 import json
 import os
 import mock
@@ -9,6 +10,8 @@ from httmock import urlmatch, HTTMock
 from actors.rule import Rule
 from actors.rule_transient import TransientRule
 from .dsl_parser import parse
+from .condition_evaluator import CompiledCondition, mappings
+from actors.rule_engine import RuleEngine, rule_engine_id
 
 
 @urlmatch(netloc=r'(.*\.)?example\.com')
@@ -37,6 +40,196 @@ class PoliciesActorsTestCase(TestCase):
     # rules/rule
     #
 
+    def test_compiled_condition(self):
+        condition_list = [['metric1', '>', '5'], 'AND', [['metric2', '<', '3'], 'OR', ['metric1', '<', '2']]]
+        condition = CompiledCondition(condition_list)
+        self.assertEqual(condition.metrics, set(['metric1', 'metric2']))
+        self.assertIsNone(condition.update('metric1', 6))
+        self.assertTrue(condition.update('metric2', 1))
+        self.assertFalse(condition.update('metric2', 4))
+        self.assertFalse(condition.update('metric1', 1))
+        self.assertFalse(condition.update('unknown_metric', 1))
+
+    def test_compiled_condition_matches_condition_walk(self):
+        def check_conditions(condition_list, values):
+            # Reference walk of the parsed condition list
+            if not isinstance(condition_list[0], list):
+                return mappings[condition_list[1]](float(values[condition_list[0]]), float(condition_list[2]))
+            result = check_conditions(condition_list[0], values)
+            for i in range(1, len(condition_list) - 1, 2):
+                result = mappings[condition_list[i]](result, check_conditions(condition_list[i + 1], values))
+            return result
+
+        condition_lists = [['metric1', '>=', '5'],
+                           [['metric1', '>', '5'], 'AND', ['metric2', '!=', '3'], 'AND', ['metric3', '<=', '1.5']],
+                           [['metric1', '==', '5'], 'OR', [['metric2', '<', '3'], 'AND', ['metric3', '>', '1']]],
+                           [['metric1', '<', '5'], 'AND', ['metric2', '>', '3'], 'OR', ['metric3', '==', '2']]]
+        for condition_list in condition_lists:
+            condition = CompiledCondition(condition_list)
+            for values in itertools.product([0, 1.5, 2, 3, 5, 7], repeat=3):
+                values = dict(zip(['metric1', 'metric2', 'metric3'], values))
+                for metric, value in values.items():
+                    result = condition.update(metric, value)
+                self.assertEqual(result, check_conditions(condition_list, values))
+
+    @mock.patch('policies.actors.rule.parse_condition')
+    @mock.patch('policies.actors.rule.Rule._do_action')
+    def test_rule_update_evaluates_compiled_condition(self, mock_do_action, mock_parse_condition):
+        mock_parse_condition.return_value = [['metric1', '>', '5'], 'AND', ['metric2', '<', '3']]
+        rule = Rule(self.policy_data('metric1 > 5 AND metric2 < 3'), 'example.com')
+        rule.id = 'policy:1'
+        with mock.patch.object(Rule, 'check_metrics'):
+            rule.start_rule()
+        rule.update('metric1', 6)
+        mock_do_action.assert_not_called()
+        rule.update('metric2', 4)
+        mock_do_action.assert_not_called()
+        rule.update('metric2', 2)
+        mock_do_action.assert_called_once()
+
+    #
+    # rules/rule_engine
+    #
+
+    def rule_engine(self, conditions):
+        engine = RuleEngine('example.com')
+        engine.id = 'rule_engine:0'
+        engine.host = mock.MagicMock()
+        engine.proxy = mock.MagicMock()
+        with mock.patch('policies.actors.rule_engine.parse_condition', side_effect=conditions):
+            for policy_id in range(1, len(conditions) + 1):
+                policy_data = self.policy_data('')
+                policy_data.update({'id': policy_id, 'target_name': 'tenant' + str(policy_id),
+                                    'target_id': 'id' + str(policy_id), 'transient': policy_id % 2 == 0})
+                engine.add_policy(policy_data)
+        return engine
+
+    @mock.patch('policies.actors.rule_engine.get_admin_token', return_value='token')
+    @mock.patch('policies.actors.rule_engine.deploy_filter')
+    def test_rule_engine_evaluates_all_policies(self, mock_deploy_filter, mock_get_admin_token):
+        mock_deploy_filter.return_value = mock.Mock(status_code=201, content='1')
+        engine = self.rule_engine([[['metric1', '>', '5']],
+                                   [['metric1', '>', '5'], 'AND', ['metric2', '<', '3']],
+                                   [['metric2', '==', '1']]])
+        metric1 = engine.host.lookup.return_value
+        self.assertEqual(metric1.attach.call_count, 4)
+        metric1.attach.assert_any_call(engine.proxy, None, None, ['tenant2'])
+
+        engine.update_many('metric1', {'tenant1': 3, 'tenant2': 6, 'other': 10})
+        mock_deploy_filter.assert_not_called()
+        engine.update_many('metric1', {'tenant1': 6})
+        mock_deploy_filter.assert_called_once_with('example.com', 'token', 'id1', 'compression', mock.ANY)
+        # Policy 1 is applied and removed from the engine
+        self.assertNotIn('policy:1', engine.policies)
+        self.assertEqual(self.r.hget('policy:1', 'status'), 'Applied')
+        metric1.detach.assert_called_with('rule_engine:0', 'tenant1')
+
+        engine.update_many('metric2', {'tenant2': 2, 'tenant3': 0})
+        self.assertEqual(mock_deploy_filter.call_count, 2)
+        self.assertEqual(mock_deploy_filter.call_args[0][2], 'id2')
+        engine.update_many('metric2', {'tenant2': 2, 'tenant3': 0})
+        self.assertEqual(mock_deploy_filter.call_count, 2)
+
+    @mock.patch('policies.actors.rule_engine.get_admin_token', return_value='token')
+    @mock.patch('policies.actors.rule_engine.delete_static_policy')
+    @mock.patch('policies.actors.rule_engine.deploy_filter')
+    def test_rule_engine_reverses_transient_policies(self, mock_deploy_filter, mock_delete_static_policy, mock_get_admin_token):
+        mock_deploy_filter.return_value = mock.Mock(status_code=201, content='7')
+        mock_delete_static_policy.return_value = mock.Mock(status_code=204)
+        engine = self.rule_engine([[['metric1', '>', '5']], [['metric1', '>', '5']]])
+        engine.update_many('metric1', {'tenant2': 6})
+        mock_deploy_filter.assert_called_once()
+        engine.update_many('metric1', {'tenant2': 7})
+        mock_deploy_filter.assert_called_once()
+        engine.update_many('metric1', {'tenant2': 1})
+        mock_delete_static_policy.assert_called_once_with('example.com', 'token', 'id2', '7')
+        self.assertIn('policy:2', engine.policies)
+
+    @mock.patch('policies.actors.rule_engine.get_admin_token', return_value='token')
+    @mock.patch('policies.actors.rule_engine.deploy_filter')
+    def test_rule_engine_retries_failed_actions(self, mock_deploy_filter, mock_get_admin_token):
+        mock_deploy_filter.side_effect = [mock.Mock(status_code=500), mock.Mock(status_code=201, content='1')]
+        engine = self.rule_engine([[['metric1', '>', '5']]])
+        engine.update_many('metric1', {'tenant1': 6})
+        self.assertFalse(engine.policies['policy:1'].applied)
+        engine.update_many('metric1', {'tenant1': 1})
+        engine.update_many('metric1', {'tenant1': 7})
+        self.assertEqual(mock_deploy_filter.call_count, 2)
+        self.assertNotIn('policy:1', engine.policies)
+
+    @mock.patch('policies.actors.rule_engine.get_admin_token', return_value='token')
+    @mock.patch('policies.actors.rule_engine.deploy_filter')
+    def test_rule_engine_wildcard_target(self, mock_deploy_filter, mock_get_admin_token):
+        mock_deploy_filter.return_value = mock.Mock(status_code=201, content='1')
+        engine = RuleEngine('example.com')
+        engine.id = 'rule_engine:0'
+        engine.host = mock.MagicMock()
+        engine.proxy = mock.MagicMock()
+        policy_data = self.policy_data('metric1 > 5')
+        policy_data.update({'id': 1, 'target_name': 'crystal/*'})
+        with mock.patch('policies.actors.rule_engine.parse_condition', return_value=[['metric1', '>', '5']]):
+            engine.add_policy(policy_data)
+        engine.host.lookup.return_value.attach.assert_called_once_with(engine.proxy, None, None, ['crystal/*'])
+
+        # Evaluated with the sum of the matching containers, without the
+        # aggregate of their project
+        engine.update_many('metric1', {'crystal': 5, 'crystal/a': 2, 'crystal/b': 3, 'other/c': 10})
+        mock_deploy_filter.assert_not_called()
+        engine.update_many('metric1', {'crystal/a': 4, 'crystal/b': 3})
+        mock_deploy_filter.assert_called_once_with('example.com', 'token', '0123456789abcdef', 'compression', mock.ANY)
+        self.assertEqual(engine.wildcards, set())
+
+    @mock.patch('policies.actors.rule_engine.get_admin_token', return_value='token')
+    @mock.patch('policies.actors.rule_engine.deploy_filter')
+    def test_rule_engine_wildcard_sum_is_reset(self, mock_deploy_filter, mock_get_admin_token):
+        mock_deploy_filter.return_value = mock.Mock(status_code=201, content='1')
+        engine = RuleEngine('example.com')
+        engine.id = 'rule_engine:0'
+        engine.host = mock.MagicMock()
+        engine.proxy = mock.MagicMock()
+        for policy_id, target, condition in ((1, 'crystal/*', [['metric1', '>', '5'], 'AND', ['metric2', '<', '3']]),
+                                             (2, 'tenant1', [['metric1', '>', '100']])):
+            policy_data = self.policy_data('')
+            policy_data.update({'id': policy_id, 'target_name': target})
+            with mock.patch('policies.actors.rule_engine.parse_condition', return_value=condition):
+                engine.add_policy(policy_data)
+
+        engine.update_many('metric1', {'crystal/a': 6})
+        # No matching target: the last sum of metric1 is not reused
+        engine.update_many('metric1', {'tenant1': 1})
+        engine.update_many('metric2', {'crystal/a': 1})
+        mock_deploy_filter.assert_not_called()
+        engine.update_many('metric1', {'crystal/a': 6})
+        mock_deploy_filter.assert_called_once()
+
+    def test_rule_engine_remove_metric(self):
+        engine = self.rule_engine([[['metric1', '>', '5']],
+                                   [['metric1', '>', '5'], 'AND', ['metric2', '<', '3']],
+                                   [['metric2', '==', '1']]])
+        metric1 = engine.host.lookup.return_value
+        metric1.detach.reset_mock()
+        engine.remove_metric('METRIC1')
+        self.assertEqual(sorted(engine.policies), ['policy:3'])
+        self.assertEqual(self.r.hget('policy:1', 'status'), 'Stopped')
+        self.assertEqual(self.r.hget('policy:2', 'status'), 'Stopped')
+        self.assertIsNone(self.r.hget('policy:3', 'status'))
+        # Only metric2 (still running) is told to detach the policy 2
+        metric1.detach.assert_called_once_with('rule_engine:0', 'tenant2')
+        self.assertFalse(any(metric == 'metric1' for metric, _ in engine.subscriptions))
+        engine.host.stop_actor.assert_not_called()
+
+    def test_rule_engine_id(self):
+        policy_data = self.policy_data('metric1 > 5 AND metric2 < 3')
+        self.assertEqual(rule_engine_id(policy_data, 4), rule_engine_id(self.policy_data('METRIC1 < 1'), 4))
+        self.assertTrue(rule_engine_id(policy_data, 4).startswith('rule_engine:'))
+        policy_data['metric_tier'] = '10s:tumbling'
+        self.assertTrue(rule_engine_id(policy_data, 4).startswith('rule_engine:10s:tumbling:'))
+
+    def policy_data(self, condition):
+        return {'action': 'SET', 'filter': 'compression', 'parameters': '', 'target_id': '0123456789abcdef',
+                'target_name': 'tenant1', 'object_size': '', 'object_tag': '', 'object_type': '',
+                'condition': condition}
+
     # def test_get_target_ok(self):
     #     self.setup_dsl_parser_data()
     #     _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
@@ -3,6 +3,9 @@ import views
 
 urlpatterns = [
 
+    # Bulk import of static and dynamic policies
+    url(r'^import/?$', views.policy_import),
+
     # Static policies
     url(r'^static/?$', views.policy_list),
     url(r'^static/(?P<policy_id>[^/]+)/?$', views.static_policy_detail),
@@ -3,17 +3,24 @@ from django.views.decorators.csrf import csrf_exempt
 from redis.exceptions import RedisError, DataError
 from rest_framework import status
 from rest_framework.parsers import JSONParser
-from operator import itemgetter
+from pyparsing import ParseException
+from swiftclient.exceptions import ClientException
 import logging
 import json
 import os
 import re
 import dsl_parser
-from api.common import JSONResponse, get_redis_connection, get_project_list, \
-    get_token_connection, create_local_host, rule_actors, to_json_bools
+import static_policies
+from api import registry
+from api.listing import ListQuery, InvalidListQuery, get_page, index_fetcher, list_response
+from api.common import JSONResponse, get_redis_connection, get_hashes, get_project_list, \
+    get_token_connection, create_local_host, rule_actors, rule_engine_actors, to_json_bools
 from api.exceptions import SwiftClientError, StorletNotFoundException, \
-    ProjectNotFound, ProjectNotCrystalEnabled
-from filters.views import set_filter, unset_filter
+    ProjectNotFound, ProjectNotCrystalEnabled, FilterNotFound
+from filters.views import set_filter, unset_filter, deploy_storlet, undeploy_storlet, revert_deploy_storlet, \
+    get_pipeline_entry, get_pipeline_entries
+from metrics.aggregator import parse_tiers
+from policies.actors.rule_engine import rule_engine_id, EnginePolicy
 logger = logging.getLogger(__name__)
 
 
@@ -31,51 +38,41 @@ def policy_list(request):
         if 'static' in str(request.path):
             project_list = get_project_list()
             project_list['global'] = 'Global'
-            keys = r.keys("pipeline:*")
-            policies = []
-            for it in keys:
-                for key, value in r.hgetall(it).items():
-                    policy = json.loads(value)
-                    filter_data = r.hgetall('filter:' + str(policy['dsl_name']))
-                    to_json_bools(filter_data, 'get', 'put', 'post', 'head', 'delete')
-                    target_id = it.replace('pipeline:', '')
-                    policy = {'id': key, 'target_id': target_id,
-                              'target_name': project_list[target_id.split(':')[0]],
-                              'filter_name': policy['filter_name'],
-                              'object_type': policy['object_type'],
-                              'object_size': policy['object_size'],
-                              'object_tag': policy['object_tag'],
-                              'object_name': ', '.join(r.lrange('object_type:' + policy['object_type'], 0, -1)),
-                              'execution_server': policy['execution_server'],
-                              'reverse': policy['reverse'],
-                              'execution_order': policy['execution_order'],
-                              'params': policy['params'],
-                              'put': filter_data['put'],
-                              'get': filter_data['get']}
-                    if 'post' in filter_data:
-                        policy['post'] = filter_data['post']
-                    if 'head' in filter_data:
-                        policy['head'] = filter_data['head']
-                    if 'delete' in filter_data:
-                        policy['delete'] = filter_data['delete']
-                    policies.append(policy)
-            sorted_policies = sorted(policies, key=lambda x: int(itemgetter('execution_order')(x)))
-
-            return JSONResponse(sorted_policies, status=status.HTTP_200_OK)
+
+            def fetch(after, count):
+                # The listing is sorted by execution order; the position of
+                # a policy in it is its cursor, so policies created or deleted
+                # before it shift the following pages.
+                try:
+                    start = int(after) + 1 if after is not None else 0
+                except ValueError:
+                    raise InvalidListQuery('Invalid cursor')
+                end = start + count - 1 if count is not None else -1
+                policies = static_policies.listing(r, start, end)
+                for policy in policies:
+                    policy['target_name'] = project_list[policy['target_id'].split(':')[0]]
+                return list(enumerate(policies, start))
+            fetcher = fetch
 
         elif 'dynamic' in str(request.path):
-            keys = r.keys("policy:*")
-            policies = []
-            for key in keys:
-                policy = r.hgetall(key)
-                policies.append(policy)
-            return JSONResponse(policies, status=status.HTTP_200_OK)
+            fetcher = index_fetcher(r, 'policy', lambda keys: get_hashes(r, keys))
 
         else:
             return JSONResponse("Invalid request", status=status.HTTP_400_BAD_REQUEST)
 
+        try:
+            query = ListQuery(request.GET)
+            policies, last_position = get_page(query, fetcher)
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, policies, last_position)
+
     if request.method == 'POST':
         # New Policy
+        try:
+            metric_tier = get_metric_tier(request.GET.get('metric_tier'))
+        except ValueError as e:
+            return JSONResponse(str(e), status=status.HTTP_400_BAD_REQUEST)
         rules_string = request.body.splitlines()
         for rule_string in rules_string:
             #
@@ -90,7 +87,7 @@ def policy_list(request):
                 if condition_list:
                     # Dynamic Rule
                     http_host = request.META['HTTP_HOST']
-                    deploy_dynamic_policy(r, rule_string, rule_parsed, http_host)
+                    deploy_dynamic_policy(r, rule_string, rule_parsed, http_host, metric_tier)
                 else:
                     # Static Rule
                     deploy_static_policy(request, r, rule_parsed)
@@ -117,6 +114,10 @@ def policy_list(request):
         # Dynamic Policy From form
         http_host = request.META['HTTP_HOST']
         data = JSONParser().parse(request)
+        try:
+            metric_tier = get_metric_tier(data.get('metric_tier'))
+        except ValueError as e:
+            return JSONResponse(str(e), status=status.HTTP_400_BAD_REQUEST)
 
         policy_id = r.incr("policies:id")
         rule_id = 'policy:' + str(policy_id)
@@ -158,11 +159,14 @@ def policy_list(request):
                        "transient": data['transient'],
                        "policy_location": policy_location,
                        "status": 'Alive'}
+        if metric_tier:
+            policy_data['metric_tier'] = metric_tier
 
         start_dynamic_policy_actor(policy_data, http_host)
 
         try:
             r.hmset(rule_id, policy_data)
+            registry.add(r, rule_id)
             return JSONResponse("Policy inserted correctly", status=status.HTTP_201_CREATED)
         except RedisError:
             return JSONResponse("Error inserting policy", status=status.HTTP_400_BAD_REQUEST)
@@ -217,16 +221,18 @@ def static_policy_detail(request, policy_id):
             json_data['object_name'] = ', '.join(r.lrange('object_type:' + json_data['object_type'], 0, -1))
             json_data['execution_order'] = int(json_data['execution_order'])
             r.hset("pipeline:" + str(target), policy, json.dumps(json_data))
+            registry.add(r, "pipeline:" + str(target))
+            static_policies.update(r, target, policy, json_data)
             return JSONResponse("Data updated", status=201)
         except DataError:
             return JSONResponse("Error updating data", status=400)
 
     elif request.method == 'DELETE':
         r.hdel('pipeline:' + target, policy)
+        registry.remove_if_empty(r, 'pipeline:' + target)
+        static_policies.remove(r, target, policy)
 
-        policies_ids = r.keys('policy:*')
-        pipelines_ids = r.keys('pipeline:*')
-        if len(policies_ids) == 0 and len(pipelines_ids) == 0:
+        if not registry.keys(r, 'policy') and not registry.keys(r, 'pipeline'):
             r.set('policies:id', 0)
         # token = get_token_connection(request)
         # unset_filter(r, target, filter_data, token)
@@ -237,38 +243,11 @@ def static_policy_detail(request, policy_id):
 
 def deploy_static_policy(request, r, parsed_rule):
     token = get_token_connection(request)
-    container = None
-    rules_to_parse = dict()
     projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
     project_list = get_project_list()
 
-    for target in parsed_rule.target:
-        if target[0] == 'TENANT':
-            project = target[1]
-        elif target[0] == 'CONTAINER':
-            project, container = target[1].split('/')
-
-        if project in project_list:
-            # Project ID
-            project_id = project
-        elif project in project_list.values():
-            # Project name
-            project_id = project_list.keys()[project_list.values().index(project)]
-        else:
-            raise ProjectNotFound()
-
-        if project_id not in projects_crystal_enabled:
-            raise ProjectNotCrystalEnabled()
-
-        if container:
-            target = os.path.join(project_id, container)
-        else:
-            target = project_id
-
-        rules_to_parse[target] = parsed_rule
-
-    for target in rules_to_parse.keys():
-        for action_info in rules_to_parse[target].action_list:
+    for target in get_static_policy_targets(parsed_rule, project_list, projects_crystal_enabled):
+        for action_info in parsed_rule.action_list:
             logger.info("Static policy, target rule: " + str(action_info))
 
             cfilter = r.hgetall("filter:"+str(action_info.filter))
@@ -280,33 +259,7 @@ def deploy_static_policy(request, r, parsed_rule):
 
                 # Get an identifier of this new policy
                 policy_id = r.incr("policies:id")
-
-                # Set the policy data
-                policy_data = {
-                    "policy_id": policy_id,
-                    "object_type": "",
-                    "object_size": "",
-                    "object_tag": "",
-                    "object_name": "",
-                    "execution_order": policy_id,
-                    "params": "",
-                    "callable": False
-                }
-
-                # Rewrite default values
-                if parsed_rule.object_list:
-                    if parsed_rule.object_list.object_type:
-                        policy_data["object_type"] = parsed_rule.object_list.object_type.object_value
-                        policy_data["object_name"] = ', '.join(r.lrange('object_type:' + policy_data['object_type'], 0, -1))
-                    if parsed_rule.object_list.object_size:
-                        policy_data["object_size"] = [parsed_rule.object_list.object_size.operand,
-                                                      parsed_rule.object_list.object_size.object_value]
-                if action_info.server_execution:
-                    policy_data["execution_server"] = action_info.server_execution
-                if action_info.params:
-                    policy_data["params"] = action_info.params
-                if action_info.callable:
-                    policy_data["callable"] = True
+                policy_data = get_static_policy_data(r, parsed_rule, action_info, policy_id)
 
                 # Deploy (an exception is raised if something goes wrong)
                 set_filter(r, target, cfilter, policy_data, token)
@@ -315,6 +268,84 @@ def deploy_static_policy(request, r, parsed_rule):
                 unset_filter(r, target, cfilter, token)
 
 
+def get_project_id(project, project_list, projects_crystal_enabled):
+    """
+    Returns the id of a project given its id or its name.
+
+    :raises ProjectNotFound: If the project does not exist.
+    :raises ProjectNotCrystalEnabled: If the project is not Crystal enabled.
+    """
+    if project in project_list:
+        # Project ID
+        project_id = project
+    elif project in project_list.values():
+        # Project name
+        project_id = project_list.keys()[project_list.values().index(project)]
+    else:
+        raise ProjectNotFound()
+
+    if project_id not in projects_crystal_enabled:
+        raise ProjectNotCrystalEnabled()
+
+    return project_id
+
+
+def get_static_policy_targets(parsed_rule, project_list, projects_crystal_enabled):
+    """
+    Returns the targets of a parsed static rule, e.g.
+    ['f1bf1d778939445dbd20734cbd98de16', 'f1bf1d778939445dbd20734cbd98de16/data']
+    """
+    container = None
+    targets = list()
+    for target in parsed_rule.target:
+        if target[0] == 'TENANT':
+            project = target[1]
+        elif target[0] == 'CONTAINER':
+            project, container = target[1].split('/')
+
+        project_id = get_project_id(project, project_list, projects_crystal_enabled)
+
+        if container:
+            target = os.path.join(project_id, container)
+        else:
+            target = project_id
+
+        if target not in targets:
+            targets.append(target)
+    return targets
+
+
+def get_static_policy_data(r, parsed_rule, action_info, policy_id):
+    # Set the policy data
+    policy_data = {
+        "policy_id": policy_id,
+        "object_type": "",
+        "object_size": "",
+        "object_tag": "",
+        "object_name": "",
+        "execution_order": policy_id,
+        "params": "",
+        "callable": False
+    }
+
+    # Rewrite default values
+    if parsed_rule.object_list:
+        if parsed_rule.object_list.object_type:
+            policy_data["object_type"] = parsed_rule.object_list.object_type.object_value
+            policy_data["object_name"] = ', '.join(r.lrange('object_type:' + policy_data['object_type'], 0, -1))
+        if parsed_rule.object_list.object_size:
+            policy_data["object_size"] = [parsed_rule.object_list.object_size.operand,
+                                          parsed_rule.object_list.object_size.object_value]
+    if action_info.server_execution:
+        policy_data["execution_server"] = action_info.server_execution
+    if action_info.params:
+        policy_data["params"] = action_info.params
+    if action_info.callable:
+        policy_data["callable"] = True
+
+    return policy_data
+
+
 #
 # Dynamic Policies
 #
@@ -333,6 +364,11 @@ def dynamic_policy_detail(request, policy_id):
 
     if request.method == 'PUT':
         data = JSONParser().parse(request)
+        if 'metric_tier' in data:
+            try:
+                data['metric_tier'] = get_metric_tier(data['metric_tier']) or ''
+            except ValueError as e:
+                return JSONResponse(str(e), status=400)
         try:
             if data['status'] == 'Stopped':
                 policy_id = int(policy_id)
@@ -347,6 +383,7 @@ def dynamic_policy_detail(request, policy_id):
                     return JSONResponse(str(e), status=400)
             data['object_name'] = ', '.join(r.lrange('object_type:' + data['object_type'], 0, -1))
             r.hmset(key, data)
+            registry.add(r, key)
             return JSONResponse("Data updated", status=201)
         except DataError:
             return JSONResponse("Error updating data", status=400)
@@ -361,42 +398,48 @@ def dynamic_policy_detail(request, policy_id):
             logger.info("Error stopping the rule actor: "+str(policy_id))
 
         r.delete(key)
-        policies_ids = r.keys('policy:*')
-        pipelines_ids = r.keys('pipeline:*')
-        if len(policies_ids) == 0 and len(pipelines_ids) == 0:
+        registry.remove(r, key)
+        if not registry.keys(r, 'policy') and not registry.keys(r, 'pipeline'):
             r.set('policies:id', 0)
         return JSONResponse('Policy has been deleted', status=204)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
 
-def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host):
-    rules_to_parse = dict()
-    project = None
-    container = None
+def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host, metric_tier=None):
     # TODO: get only the Crystal enabled projects
     projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
     project_list = get_project_list()
 
+    for target in get_dynamic_policy_targets(parsed_rule, project_list, projects_crystal_enabled):
+        for action_info in parsed_rule.action_list:
+            policy_id = r.incr("policies:id")
+            policy_data = get_dynamic_policy_data(r, rule_string, parsed_rule, action_info, target, policy_id,
+                                                  metric_tier)
+
+            start_dynamic_policy_actor(policy_data, http_host)
+
+            # Add policy into Redis
+            r.hmset('policy:' + str(policy_id), policy_data)
+            registry.add(r, 'policy:' + str(policy_id))
+
+
+def get_dynamic_policy_targets(parsed_rule, project_list, projects_crystal_enabled):
+    """
+    Returns the targets of a parsed dynamic rule, e.g.
+    ['crystal:f1bf1d778939445dbd20734cbd98de16', 'crystal:f1bf1d778939445dbd20734cbd98de16/data']
+    """
+    project = None
+    container = None
+    targets = list()
     for target in parsed_rule.target:
         if target[0] == 'TENANT':
             project = target[1]
         elif target[0] == 'CONTAINER':
             project, container = target[1].split('/')
 
-        if project in project_list:
-            # Project ID
-            project_id = project
-            project_name = project_list[project_id]
-        elif project in project_list.values():
-            # Project name
-            project_name = project
-            project_id = project_list.keys()[project_list.values().index(project)]
-        else:
-            raise ProjectNotFound()
-
-        if project_id not in projects_crystal_enabled:
-            raise ProjectNotCrystalEnabled()
+        project_id = get_project_id(project, project_list, projects_crystal_enabled)
+        project_name = project_list[project_id]
 
         if container:
             target = project_name+":"+os.path.join(project_id, container)
@@ -405,68 +448,83 @@ def deploy_dynamic_policy(r, rule_string, parsed_rule, http_host):
             target = project_name+":"+project_id
             # target = crystal:f1bf1d778939445dbd20734cbd98de16
 
-        rules_to_parse[target] = parsed_rule
-
-    for target in rules_to_parse.keys():
-        for action_info in rules_to_parse[target].action_list:
-            container = None
-            if '/' in target:
-                # target includes a container
-                project, container = target.split('/')
-                project_name, project_id = project.split(':')
-                target_id = os.path.join(project_id, container)
-                target_name = os.path.join(project_name, container)
-            else:
-                target_name, target_id = target.split(':')
+        if target not in targets:
+            targets.append(target)
+    return targets
 
-            policy_id = r.incr("policies:id")
-            rule_id = 'policy:' + str(policy_id)
 
-            if action_info.transient:
-                transient = True
-                location = settings.RULE_TRANSIENT_MODULE
-            else:
-                transient = False
-                location = settings.RULE_MODULE
-            policy_location = os.path.join(settings.PYACTOR_URL, location, str(rule_id))
-
-            # FIXME Should we recreate a static rule for each target and action??
-            condition_re = re.compile(r'.* (WHEN .*) DO .*', re.M | re.I)
-            condition_str = condition_re.match(rule_string).group(1)
-
-            object_type = ""
-            object_size = ""
-            object_tag = ""
-            object_name = ""
-            if parsed_rule.object_list:
-                if parsed_rule.object_list.object_type:
-                    object_type = parsed_rule.object_list.object_type.object_value
-                    object_name = ', '.join(r.lrange('object_type:' + object_type, 0, -1))
-                if parsed_rule.object_list.object_tag:
-                    object_tag = parsed_rule.object_list.object_tag.object_value
-                if parsed_rule.object_list.object_size:
-                    object_size = [parsed_rule.object_list.object_size.operand,
-                                   parsed_rule.object_list.object_size.object_value]
-
-            policy_data = {"id": policy_id,
-                           "target_id": target_id,
-                           "target_name": target_name,
-                           "filter": action_info.filter,
-                           "parameters": action_info.params,
-                           "action": action_info.action,
-                           "condition": condition_str.replace('WHEN ', ''),
-                           "object_name": object_name,
-                           "object_type": object_type,
-                           "object_size": object_size,
-                           "object_tag": object_tag,
-                           "transient": transient,
-                           "policy_location": policy_location,
-                           "status": 'Alive'}
+def get_dynamic_policy_data(r, rule_string, parsed_rule, action_info, target, policy_id, metric_tier=None):
+    container = None
+    if '/' in target:
+        # target includes a container
+        project, container = target.split('/')
+        project_name, project_id = project.split(':')
+        target_id = os.path.join(project_id, container)
+        target_name = os.path.join(project_name, container)
+    else:
+        target_name, target_id = target.split(':')
 
-            start_dynamic_policy_actor(policy_data, http_host)
+    rule_id = 'policy:' + str(policy_id)
 
-            # Add policy into Redis
-            r.hmset('policy:' + str(policy_id), policy_data)
+    if action_info.transient:
+        transient = True
+        location = settings.RULE_TRANSIENT_MODULE
+    else:
+        transient = False
+        location = settings.RULE_MODULE
+    policy_location = os.path.join(settings.PYACTOR_URL, location, str(rule_id))
+
+    # FIXME Should we recreate a static rule for each target and action??
+    condition_re = re.compile(r'.* (WHEN .*) DO .*', re.M | re.I)
+    condition_str = condition_re.match(rule_string).group(1)
+
+    object_type = ""
+    object_size = ""
+    object_tag = ""
+    object_name = ""
+    if parsed_rule.object_list:
+        if parsed_rule.object_list.object_type:
+            object_type = parsed_rule.object_list.object_type.object_value
+            object_name = ', '.join(r.lrange('object_type:' + object_type, 0, -1))
+        if parsed_rule.object_list.object_tag:
+            object_tag = parsed_rule.object_list.object_tag.object_value
+        if parsed_rule.object_list.object_size:
+            object_size = [parsed_rule.object_list.object_size.operand,
+                           parsed_rule.object_list.object_size.object_value]
+
+    policy_data = {"id": policy_id,
+                   "target_id": target_id,
+                   "target_name": target_name,
+                   "filter": action_info.filter,
+                   "parameters": action_info.params,
+                   "action": action_info.action,
+                   "condition": condition_str.replace('WHEN ', ''),
+                   "object_name": object_name,
+                   "object_type": object_type,
+                   "object_size": object_size,
+                   "object_tag": object_tag,
+                   "transient": transient,
+                   "policy_location": policy_location,
+                   "status": 'Alive'}
+    if metric_tier:
+        policy_data['metric_tier'] = metric_tier
+    return policy_data
+
+
+def get_metric_tier(spec):
+    """
+    Validates the aggregation tier (see metrics.aggregator) a dynamic policy
+    subscribes to, e.g. "10s:tumbling".
+
+    :return: The normalized tier spec, or None for the default tier.
+    :raises ValueError: If the spec is not a single valid tier.
+    """
+    if not spec:
+        return None
+    tiers = parse_tiers(spec)
+    if len(tiers) > 1:
+        raise ValueError('A policy subscribes to a single aggregation tier')
+    return tiers[0]
 
 
 def start_dynamic_policy_actor(policy_data, http_host):
@@ -475,6 +533,9 @@ def start_dynamic_policy_actor(policy_data, http_host):
     transient = policy_data["transient"]
     policy_id = int(policy_data["id"])
     rule_id = 'policy:' + str(policy_id)
+    if settings.DYNAMIC_POLICY_ENGINE == 'engine':
+        start_dynamic_policy_in_engine(host, policy_data, http_host)
+        return
     if transient:
         rule_actors[policy_id] = host.spawn(rule_id, settings.RULE_TRANSIENT_MODULE, policy_data, http_host)
     else:
@@ -487,6 +548,294 @@ def start_dynamic_policy_actor(policy_data, http_host):
         raise ValueError("An error occurred starting the policy actor: "+str(e))
 
 
+def start_dynamic_policy_in_engine(host, policy_data, http_host):
+    policy_id = int(policy_data["id"])
+    engine_id = rule_engine_id(policy_data, settings.RULE_ENGINE_SHARDS)
+    if engine_id not in rule_engine_actors:
+        rule_engine_actors[engine_id] = host.spawn(engine_id, settings.RULE_ENGINE_MODULE,
+                                                   http_host, policy_data.get('metric_tier'))
+    engine = rule_engine_actors[engine_id]
+    try:
+        engine.add_policy(policy_data)
+    except Exception as e:
+        raise ValueError("An error occurred starting the policy in the rule engine: "+str(e))
+    rule_actors[policy_id] = EnginePolicy(engine, 'policy:' + str(policy_id))
+
+
+#
+# Bulk import
+#
+@csrf_exempt
+def policy_import(request):
+    """
+    Deploy many policies via DSL, one rule per line. All the rules are
+    parsed, and their projects resolved, before deploying anything. The ids
+    of the new policies are reserved at once, and the pipelines and dynamic
+    policies of all the valid rules are written to redis in a single
+    MULTI/EXEC transaction.
+
+    The storlets of each rule are deployed or undeployed once every rule has
+    been prepared. If one of them fails, the ones already done for the rule
+    are reverted (a deployed storlet is deleted, an undeployed one uploaded
+    again) and the rule is not imported. With ?atomic=true nothing is
+    imported unless all the rules are valid and all their storlet operations
+    succeed; otherwise the storlet operations of all the rules are reverted.
+    Reverting is best effort: a revert that fails is logged and leaves that
+    storlet changed in Swift.
+
+    DELETE rules remove the filters deployed before the import, and the
+    ones set by the previous rules of the import.
+
+    :return: The result of each line: status 201 and the ids of the new
+             policies, or the status and the error of the rule.
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method != 'POST':
+        return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    atomic = request.GET.get('atomic', 'false').lower() == 'true'
+    try:
+        metric_tier = get_metric_tier(request.GET.get('metric_tier'))
+    except ValueError as e:
+        return JSONResponse(str(e), status=status.HTTP_400_BAD_REQUEST)
+    http_host = request.META['HTTP_HOST']
+    token = get_token_connection(request)
+    project_list = get_project_list()
+    projects_crystal_enabled = r.lrange('projects_crystal_enabled', 0, -1)
+    filters = dict()
+
+    # Parse all the rules
+    results = list()
+    rules = list()
+    for line, rule_string in enumerate(request.body.splitlines(), 1):
+        if not rule_string.strip():
+            continue
+        result = {'line': line, 'rule': rule_string}
+        results.append(result)
+        try:
+            rules.append((result, rule_string) + parse_import_rule(r, rule_string, project_list,
+                                                                   projects_crystal_enabled, filters))
+        except Exception as e:
+            set_import_error(result, e)
+
+    if not results:
+        return JSONResponse("Invalid format or empty request", status=status.HTTP_400_BAD_REQUEST)
+    if atomic and len(rules) < len(results):
+        return JSONResponse(results, status=status.HTTP_400_BAD_REQUEST)
+
+    # Reserve the ids of all the new policies
+    num_ids = 0
+    for _, _, dynamic, parsed_rule, targets in rules:
+        actions = [action_info for action_info in parsed_rule.action_list if dynamic or action_info.action == "SET"]
+        num_ids += len(targets) * len(actions)
+    last_id = r.incrby("policies:id", num_ids) if num_ids else 0
+    policy_ids = iter(xrange(last_id - num_ids + 1, last_id + 1))
+
+    # Prepare the writes and the storlet operations, with the operation that
+    # reverts each one, of each rule. The pipeline entries set and deleted by
+    # the prepared rules are tracked, so a DELETE sees the SETs before it.
+    prepared = list()
+    pending_entries = dict()
+    for result, rule_string, dynamic, parsed_rule, targets in rules:
+        rule_writes = list()
+        rule_storlets = list()
+        rule_policies = list()
+        rule_entries = dict()
+        try:
+            for target in targets:
+                for action_info in parsed_rule.action_list:
+                    cfilter = filters[str(action_info.filter)].copy()
+                    if dynamic:
+                        policy_id = next(policy_ids)
+                        policy_data = get_dynamic_policy_data(r, rule_string, parsed_rule, action_info, target,
+                                                              policy_id, metric_tier)
+                        rule_writes.append(('hmset', ('policy:' + str(policy_id), policy_data)))
+                        rule_policies.append(policy_data)
+                    elif action_info.action == "SET":
+                        policy_id = next(policy_ids)
+                        policy_data = get_static_policy_data(r, parsed_rule, action_info, policy_id)
+                        if cfilter['filter_type'] == 'storlet':
+                            # get_pipeline_entry() drops fields of the filter the deploy needs
+                            storlet = cfilter.copy()
+                            rule_storlets.append(((deploy_storlet, (r, target, storlet, token)),
+                                                  (revert_deploy_storlet, (r, target, storlet, token))))
+                        entry = get_pipeline_entry(target, cfilter, policy_data)
+                        rule_writes.append(('hset', entry))
+                        rule_entries[(entry[0], str(entry[1]))] = cfilter['filter_name']
+                        rule_policies.append(policy_id)
+                    elif action_info.action == "DELETE":
+                        if cfilter['filter_type'] == 'storlet':
+                            rule_storlets.append(((undeploy_storlet, (target, cfilter, token, dict())),
+                                                  (deploy_storlet, (r, target, cfilter, token))))
+                        entries = dict(pending_entries)
+                        entries.update(rule_entries)
+                        for entry in get_import_pipeline_entries(r, target, cfilter, entries):
+                            rule_writes.append(('hdel', entry))
+                            rule_entries[entry] = None
+        except Exception as e:
+            set_import_error(result, e)
+            continue
+        pending_entries.update(rule_entries)
+        prepared.append((result, dynamic, rule_writes, rule_storlets, rule_policies))
+
+    if atomic and len(prepared) < len(rules):
+        return JSONResponse(results, status=status.HTTP_400_BAD_REQUEST)
+
+    # Deploy and undeploy the storlets of the valid rules
+    done = list()
+    imported = list()
+    for result, dynamic, rule_writes, rule_storlets, rule_policies in prepared:
+        rule_done = list()
+        try:
+            for (function, args), revert in rule_storlets:
+                try:
+                    function(*args)
+                except ClientException:
+                    raise SwiftClientError("A problem occurred accessing Swift")
+                rule_done.append(revert)
+        except Exception as e:
+            set_import_error(result, e)
+            revert_storlet_operations(rule_done)
+            if atomic:
+                break
+            continue
+        done += rule_done
+        imported.append((result, dynamic, rule_writes, rule_policies))
+
+    if atomic and len(imported) < len(prepared):
+        revert_storlet_operations(done)
+        return JSONResponse(results, status=status.HTTP_400_BAD_REQUEST)
+
+    writes = list()
+    dynamic_policies = list()
+    for result, dynamic, rule_writes, rule_policies in imported:
+        writes += rule_writes
+        if dynamic:
+            dynamic_policies.append((result, rule_policies))
+            new_ids = [dynamic_policy['id'] for dynamic_policy in rule_policies]
+        else:
+            new_ids = rule_policies
+        result.update({'status': status.HTTP_201_CREATED, 'policies': new_ids})
+
+    try:
+        pipe = r.pipeline()
+        for command, args in writes:
+            getattr(pipe, command)(*args)
+            if command != 'hdel':
+                registry.add(pipe, args[0])
+        pipe.execute()
+        for key in set(args[0] for command, args in writes if command == 'hdel'):
+            registry.remove_if_empty(r, key)
+        if writes:
+            static_policies.invalidate(r)
+    except RedisError:
+        if atomic:
+            revert_storlet_operations(done)
+        return JSONResponse('Error saving the policies', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    # Start the dynamic policies once they are stored
+    for result, rule_policies in dynamic_policies:
+        for policy_data in rule_policies:
+            try:
+                start_dynamic_policy_actor(policy_data, http_host)
+            except Exception as e:
+                r.delete('policy:' + str(policy_data['id']))
+                registry.remove(r, 'policy:' + str(policy_data['id']))
+                result['policies'].remove(policy_data['id'])
+                set_import_error(result, e)
+
+    imported = [result for result in results if result['status'] == status.HTTP_201_CREATED]
+    if len(imported) == len(results):
+        return JSONResponse(results, status=status.HTTP_201_CREATED)
+    if not imported:
+        return JSONResponse(results, status=status.HTTP_400_BAD_REQUEST)
+    return JSONResponse(results, status=status.HTTP_200_OK)
+
+
+def parse_import_rule(r, rule_string, project_list, projects_crystal_enabled, filters):
+    """
+    Parses a rule of a bulk import and resolves its targets.
+
+    :param filters: Cache of the filters used by the rules, updated with the
+                    filters of this rule.
+    :return: Whether the rule is dynamic, the parsed rule and its targets.
+    """
+    condition_list, parsed_rule = dsl_parser.parse(rule_string)
+    for action_info in parsed_rule.action_list:
+        filter_name = str(action_info.filter)
+        if filter_name not in filters:
+            filters[filter_name] = r.hgetall("filter:" + filter_name)
+        if not filters[filter_name]:
+            raise FilterNotFound()
+
+    if condition_list:
+        targets = get_dynamic_policy_targets(parsed_rule, project_list, projects_crystal_enabled)
+    else:
+        targets = get_static_policy_targets(parsed_rule, project_list, projects_crystal_enabled)
+    return bool(condition_list), parsed_rule, targets
+
+
+def get_import_pipeline_entries(r, target, filter_data, pending_entries):
+    """
+    Like get_pipeline_entries(), with the entries set and deleted by the
+    rules of an import that are not written yet.
+
+    :param pending_entries: {(pipeline key, policy id): filter name, or
+                            None if the entry is deleted}
+    """
+    pipeline_key = "pipeline:" + str(target).replace('/', ':')
+    entries = [entry for entry in get_pipeline_entries(r, target, filter_data)
+               if pending_entries.get(entry, True) is not None]
+    for (key, policy_id), filter_name in pending_entries.items():
+        entry = (key, str(policy_id))
+        if key == pipeline_key and filter_name == filter_data['filter_name'] and entry not in entries:
+            entries.append(entry)
+    return entries
+
+
+def revert_storlet_operations(reverts):
+    """
+    Reverts the storlet operations of an import, the last one first. An
+    operation that cannot be reverted is logged.
+
+    :param reverts: The (function, args) that revert each operation.
+    """
+    for function, args in reversed(reverts):
+        try:
+            function(*args)
+        except Exception as e:
+            logger.error('Error reverting a storlet operation of an import: ' + str(e))
+
+
+def set_import_error(result, e):
+    """
+    Sets the status and the error of a rule of a bulk import, as policy_list
+    would respond to the rule.
+    """
+    if isinstance(e, SwiftClientError):
+        result.update({'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'error': 'Error accessing Swift.'})
+    elif isinstance(e, StorletNotFoundException):
+        result.update({'status': status.HTTP_404_NOT_FOUND, 'error': 'Storlet not found.'})
+    elif isinstance(e, FilterNotFound):
+        result.update({'status': status.HTTP_404_NOT_FOUND, 'error': 'Filter does not exist.'})
+    elif isinstance(e, ProjectNotFound):
+        result.update({'status': status.HTTP_404_NOT_FOUND,
+                       'error': 'Invalid Project Name/ID. The Project does not exist.'})
+    elif isinstance(e, ProjectNotCrystalEnabled):
+        result.update({'status': status.HTTP_404_NOT_FOUND,
+                       'error': 'The project is not Crystal Enabled. Verify it in the Projects panel.'})
+    elif isinstance(e, ParseException):
+        result.update({'status': status.HTTP_400_BAD_REQUEST, 'error': 'Invalid rule: ' + str(e)})
+    else:
+        logger.info('Unexpected exception: ' + str(e))
+        result.update({'status': status.HTTP_401_UNAUTHORIZED,
+                       'error': 'Please, review the rule, and start the related workload metric before creating a new policy'})
+
+
 #
 # Access Control
 #
@@ -502,9 +851,9 @@ def access_control(request):
         acl = []
         project_list = get_project_list()
         try:
-            keys = r.keys('acl:*')
-            for it in keys:
-                for key, value in r.hgetall(it).items():
+            keys = registry.keys(r, 'acl')
+            for it, acls in zip(keys, get_hashes(r, keys)):
+                for key, value in acls.items():
                     policy = json.loads(value)
                     to_json_bools(policy, 'list', 'write', 'read')
                     target_id = it.replace('acl:', '')
@@ -561,6 +910,7 @@ def access_control(request):
                 data['user_id'] = ''
 
             r.hset(key, acl_id, json.dumps(data))
+            registry.add(r, key)
 
             return JSONResponse("Access control policy created", status=201)
         except DataError:
@@ -610,6 +960,7 @@ def access_control_detail(request, policy_id):
     if request.method == 'DELETE':
         try:
             r.hdel("acl:" + str(target_id), acl_id)
+            registry.remove_if_empty(r, "acl:" + str(target_id))
         except DataError:
             return JSONResponse("Error retrieving policy", status=400)
 
@@ -663,19 +1014,29 @@ def slo_list(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        slos = []
-        keys = r.keys('SLO:*')
-        for key in keys:
-            _, dsl_filter, slo_name, target = key.split(':')
-            value = r.get(key)
-            slos.append({'dsl_filter': dsl_filter, 'slo_name': slo_name, 'target': target, 'value': value})
-        return JSONResponse(slos, status=status.HTTP_200_OK)
+        def load(keys):
+            slos = []
+            for key, value in zip(keys, r.mget(keys) if keys else []):
+                if value is not None:
+                    _, dsl_filter, slo_name, target = key.split(':')
+                    slos.append({'dsl_filter': dsl_filter, 'slo_name': slo_name, 'target': target, 'value': value})
+                else:
+                    slos.append(None)
+            return slos
+
+        try:
+            query = ListQuery(request.GET)
+            slos, last_key = get_page(query, index_fetcher(r, 'SLO', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, slos, last_key)
 
     elif request.method == 'POST':
         data = JSONParser().parse(request)
         try:
             slo_key = ':'.join(['SLO', data['dsl_filter'], data['slo_name'], data['target']])
             r.set(slo_key, data['value'])
+            registry.add(r, slo_key)
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
         except DataError:
@@ -709,12 +1070,14 @@ def slo_detail(request, dsl_filter, slo_name, target):
         data = JSONParser().parse(request)
         try:
             r.set(slo_key, data['value'])
+            registry.add(r, slo_key)
             return JSONResponse('Data updated', status=status.HTTP_201_CREATED)
         except DataError:
             return JSONResponse('Error updating data', status=status.HTTP_400_BAD_REQUEST)
 
     elif request.method == 'DELETE':
         r.delete(slo_key)
+        registry.remove(r, slo_key)
         return JSONResponse('SLA has been deleted', status=status.HTTP_204_NO_CONTENT)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -735,13 +1098,19 @@ def object_type_list(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys("object_type:*")
-        object_types = []
-        for key in keys:
-            name = key.split(":")[1]
-            types_list = r.lrange(key, 0, -1)
-            object_types.append({"name": name, "types_list": types_list})
-        return JSONResponse(object_types, status=status.HTTP_200_OK)
+        def load(keys):
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                pipe.lrange(key, 0, -1)
+            return [{"name": key.split(":")[1], "types_list": types_list} if types_list else None
+                    for key, types_list in zip(keys, pipe.execute())]
+
+        try:
+            query = ListQuery(request.GET)
+            object_types, last_key = get_page(query, index_fetcher(r, 'object_type', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, object_types, last_key)
 
     if request.method == "POST":
         data = JSONParser().parse(request)
@@ -755,6 +1124,7 @@ def object_type_list(request):
                                 status=status.HTTP_400_BAD_REQUEST)
 
         if r.rpush('object_type:' + str(name), *data["types_list"]):
+            registry.add(r, 'object_type:' + str(name))
             return JSONResponse('Object type has been added in the registy', status=status.HTTP_201_CREATED)
         return JSONResponse('Error storing the object type in the DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -793,6 +1163,7 @@ def object_type_detail(request, object_type_name):
         pipe = r.pipeline()
         # the following commands are buffered in a single atomic request (to replace current contents)
         if pipe.delete(key).rpush(key, *data).execute():
+            static_policies.invalidate(r)
             return JSONResponse('The object type ' + str(object_type_name) + ' has been updated',
                                 status=status.HTTP_201_CREATED)
         return JSONResponse('Error storing the object type in the DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -800,6 +1171,8 @@ def object_type_detail(request, object_type_name):
     if request.method == "DELETE":
         if r.exists(key):
             object_type = r.delete(key)
+            registry.remove(r, key)
+            static_policies.invalidate(r)
             return JSONResponse(object_type, status=status.HTTP_200_OK)
         return JSONResponse("Object type not found", status=status.HTTP_404_NOT_FOUND)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -817,6 +1190,8 @@ def object_type_items_detail(request, object_type_name, item_name):
         return JSONResponse('Error connecting with DB', status=500)
     if request.method == 'DELETE':
         r.lrem("object_type:" + str(object_type_name), str(item_name), 1)
+        registry.remove_if_empty(r, "object_type:" + str(object_type_name))
+        static_policies.invalidate(r)
         return JSONResponse('Extension ' + str(item_name) + ' has been deleted from object type ' + str(object_type_name),
                             status=204)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
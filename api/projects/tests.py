@@ -9,6 +9,7 @@ from django.conf import settings
 from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
+from api import jobs
 from projects.views import add_projects_group, projects_group_detail, projects_groups_detail, projects, \
     create_docker_image, delete_docker_image
 
@@ -17,7 +18,8 @@ from projects.views import add_projects_group, projects_group_detail, projects_g
 @override_settings(REDIS_CON_POOL=redis.ConnectionPool(host='localhost', port=6379, db=10),
                    STORLET_FILTERS_DIR=os.path.join("/tmp", "crystal", "storlet_filters"),
                    WORKLOAD_METRICS_DIR=os.path.join("/tmp", "crystal", "workload_metrics"),
-                   GLOBAL_CONTROLLERS_DIR=os.path.join("/tmp", "crystal", "global_controllers"))
+                   GLOBAL_CONTROLLERS_DIR=os.path.join("/tmp", "crystal", "global_controllers"),
+                   JOBS_WORKERS=0)
 class ProjectsTestCase(TestCase):
     def setUp(self):
         # Every test needs access to the request factory.
@@ -86,9 +88,12 @@ class ProjectsTestCase(TestCase):
         mock_get_swift_url_and_token.return_value = ('http://example.com/fakeurl', 'fakeToken',)
         mock_get_admin_role_user_ids.return_value = ('fakeId', 'fakeId', 'fakeName',)
         project_id = '0123456789abcdef'
+        self.r.hset('storlets:' + project_id, 'test-1.0.jar', 'abc')
         request = self.factory.delete('/projects' + project_id)
         response = projects(request, project_id)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # The record of the deployed storlets is dropped with the .storlet container
+        self.assertFalse(self.r.exists('storlets:' + project_id))
 
         self.assertEqual(mock_delete_container.call_count, 2)
         mock_post_account.assert_called_with('http://example.com/fakeurl', 'fakeToken', mock.ANY)
@@ -119,11 +124,19 @@ class ProjectsTestCase(TestCase):
         response = projects(request)
         self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
-    @mock.patch('projects.views.threading.Thread')
-    def test_create_docker_image_ok(self, mock_thread):
+    @mock.patch('projects.views.deploy_docker_image')
+    def test_create_docker_image_ok(self, mock_deploy_docker_image):
+        deployed = list()
+        mock_deploy_docker_image.side_effect = lambda node, node_data, project_id, r: deployed.append((node, project_id))
         project_id = '0123456789abcdef'
-        create_docker_image(self.r, project_id)
-        self.assertEqual(mock_thread.call_count, 3)
+        job = create_docker_image(self.r, project_id)
+        self.assertEqual((job['type'], job['status'], len(job['params']['nodes'])), ('create_docker_image', 'queued', 3))
+        self.assertFalse(mock_deploy_docker_image.called)
+
+        jobs.run_next(self.r)
+        job = jobs.get_job(self.r, job['id'])
+        self.assertEqual((job['status'], job['progress']), ('succeeded', 100))
+        self.assertEqual(sorted(deployed), sorted((node, project_id) for node in job['params']['nodes']))
 
     @mock.patch('projects.views.threading.Thread')
     def test_delete_docker_image_ok(self, mock_thread):
@@ -5,14 +5,17 @@ from rest_framework import status
 from rest_framework.parsers import JSONParser
 from paramiko.ssh_exception import SSHException, AuthenticationException
 from swiftclient import client as swift_client
+from multiprocessing.pool import ThreadPool
 import logging
 import threading
 import paramiko
 import json
 import os
 
-from api.common import JSONResponse, get_redis_connection, \
-    get_project_list, get_keystone_admin_auth, \
+from api import artifacts, jobs, registry
+from api.listing import ListQuery, InvalidListQuery, get_page, index_fetcher, list_response
+from api.common import JSONResponse, get_redis_connection, get_hashes, \
+    get_project_list, get_keystone_admin_auth, invalidate_project_list, \
     get_admin_role_user_ids, get_swift_url_and_token
 
 
@@ -41,6 +44,10 @@ def projects(request, project_id=None):
 
     if request.method == 'PUT':
         project_list = get_project_list()
+        if project_id not in project_list:
+            # The project may be created after the project list was cached
+            invalidate_project_list()
+            project_list = get_project_list()
         project_name = project_list[project_id]
         if project_name == settings.MANAGEMENT_ACCOUNT:
             return JSONResponse("Management project could not be set as Crystal project",
@@ -63,6 +70,7 @@ def projects(request, project_id=None):
             # Create project docker image
             create_docker_image(r, project_id)
             r.lpush('projects_crystal_enabled', project_id)
+            invalidate_project_list()
             return JSONResponse("Crystal Project correctly enabled", status=status.HTTP_201_CREATED)
         except:
             return JSONResponse("Error Enabling Crystal Project", status=status.HTTP_400_BAD_REQUEST)
@@ -94,7 +102,11 @@ def projects(request, project_id=None):
             # Delete project docker image
             delete_docker_image(r, project_id)
 
+            # The .storlet container was deleted
+            artifacts.unset_project(r, project_id)
+
             r.lrem('projects_crystal_enabled', project_id)
+            invalidate_project_list()
             return JSONResponse("Crystal project correctly disabled.", status=status.HTTP_201_CREATED)
         except RedisError:
             return JSONResponse("Error inserting data", status=status.HTTP_400_BAD_REQUEST)
@@ -110,18 +122,45 @@ def projects(request, project_id=None):
 
 
 def create_docker_image(r, project_id):
-    nodes = r.keys('*_node:*')
+    """
+    Creates the Docker image of a project in the nodes, in a job.
+
+    :return: The state of the job.
+    """
+    nodes = registry.scan(r, '*_node:*')
+    node_keys = list()
     already_created = list()
-    for node in nodes:
-        node_data = r.hgetall(node)
+    for node, node_data in zip(nodes, get_hashes(r, nodes)):
         node_ip = node_data['ip']
         if node_ip not in already_created:
             if node_data['ssh_access']:
                 already_created.append(node_ip)
-                threading.Thread(target=deploy_docker_image, args=(node, node_data, project_id, r,)).start()
+                node_keys.append(node)
             else:
                 logger.error('An error occurred connecting to: '+node)
                 raise AuthenticationException('An error occurred connecting to: '+node)
+    return jobs.submit(r, 'create_docker_image', project_id=project_id, nodes=node_keys)
+
+
+@jobs.job_handler('create_docker_image')
+def create_docker_image_job(job, project_id, nodes):
+    """
+    :return: The nodes where the image was created.
+    """
+    def deploy(node):
+        deploy_docker_image(node, job.r.hgetall(node), project_id, job.r)
+        return node
+
+    if not nodes:
+        return nodes
+    pool = ThreadPool(min(settings.NODE_SYNC_WORKERS, len(nodes)))
+    try:
+        for i, node in enumerate(pool.imap_unordered(deploy, nodes)):
+            job.progress(100 * (i + 1) / len(nodes), 'Docker image created in ' + node)
+    finally:
+        pool.close()
+        pool.join()
+    return nodes
 
 
 def deploy_docker_image(node, node_data, project_id, r):
@@ -150,10 +189,9 @@ def deploy_docker_image(node, node_data, project_id, r):
 
 
 def delete_docker_image(r, project_id):
-    nodes = r.keys('*_node:*')
+    nodes = registry.scan(r, '*_node:*')
     already_deleted = list()
-    for node in nodes:
-        node_data = r.hgetall(node)
+    for node, node_data in zip(nodes, get_hashes(r, nodes)):
         node_ip = node_data['ip']
         if node_ip not in already_deleted:
             if node_data['ssh_access']:
@@ -204,14 +242,20 @@ def add_projects_group(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys("project_group:*")
-        project_groups = []
-        for key in keys:
-            group = r.hgetall(key)
-            group['id'] = key.split(':')[1]
-            group['attached_projects'] = json.loads(group['attached_projects'])
-            project_groups.append(group)
-        return JSONResponse(project_groups, status=status.HTTP_200_OK)
+        def load(keys):
+            project_groups = get_hashes(r, keys)
+            for key, group in zip(keys, project_groups):
+                if group:
+                    group['id'] = key.split(':')[1]
+                    group['attached_projects'] = json.loads(group['attached_projects'])
+            return project_groups
+
+        try:
+            query = ListQuery(request.GET)
+            project_groups, last_key = get_page(query, index_fetcher(r, 'project_group', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, project_groups, last_key)
 
     if request.method == 'POST':
         data = JSONParser().parse(request)
@@ -220,6 +264,7 @@ def add_projects_group(request):
                                 status=status.HTTP_400_BAD_REQUEST)
         gtenant_id = r.incr("project_groups:id")
         r.hmset('project_group:' + str(gtenant_id), data)
+        registry.add(r, 'project_group:' + str(gtenant_id))
         return JSONResponse('Tenant group has been added to the registry', status=status.HTTP_201_CREATED)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -261,8 +306,8 @@ def projects_group_detail(request, group_id):
         key = 'project_group:' + str(group_id)
         if r.exists(key):
             r.delete("project_group:" + str(group_id))
-            gtenants_ids = r.keys('project_group:*')
-            if len(gtenants_ids) == 0:
+            registry.remove(r, "project_group:" + str(group_id))
+            if not registry.keys(r, 'project_group'):
                 r.set('project_groups:id', 0)
             return JSONResponse('Tenants group has been deleted', status=status.HTTP_204_NO_CONTENT)
         else:
@@ -0,0 +1,380 @@
+"""
+Migration of the objects of a container to another storage policy.
+
+The storage policy of a Swift container cannot be changed, so the
+container has to be created again. update_container used to download
+every object into SWIFT_CFG_TMP_DIR, holding each one in memory, and
+upload them again one by one, in a single request. A migration now runs
+in a job (see api.jobs) in these phases:
+
+1. copy: every object is streamed, in chunks of MIGRATION_CHUNK_SIZE
+   bytes, from a GET of the container to a PUT into a temporary
+   container (``.migration-<container>``) with the new policy. Large
+   object manifests (SLO and DLO) are copied as manifests
+   (``multipart-manifest=get``), not as the concatenation of their
+   segments.
+2. delete: the objects of the container are deleted, and the container is
+   created again with the new policy and its metadata and ACLs. An object
+   created or replaced after the copy phase listed it (it is not in the
+   temporary container, or with another hash) is copied before it is
+   deleted.
+3. restore: the objects are copied back from the temporary container,
+   with server-side copies.
+4. cleanup: the temporary container is deleted.
+
+Every phase lists the container page by page (MIGRATION_PAGE_SIZE objects,
+after the last object of the previous page), and processes each page
+with MIGRATION_WORKERS threads. The state of the migration is kept in
+Redis, in ``container_migration:<project id>:<container>``, and updated
+after every page, so a migration that failed (or whose process died)
+resumes from its last page when it is started again. It is also what the
+progress endpoint returns. A lock with a MIGRATION_LOCK_TTL seconds
+expiration prevents two migrations of the same container from running at
+once. It holds a token of the migration that took it, and only that
+migration refreshes it (from a timer, every third of the TTL) and releases
+it; a migration that finds its lock lost stops after the current page. The
+progress of the job is updated after every page too, and cancelling it
+stops the migration after the current page (it can be resumed later).
+
+A migration can last longer than its Swift token. Given an ``authenticate``
+function, it gets a new token when Swift rejects the current one (401) and
+retries the request.
+"""
+from django.conf import settings
+from multiprocessing.pool import ThreadPool
+from swiftclient import client as swift_client
+from swiftclient.exceptions import ClientException
+from urllib import quote
+import json
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+REDIS_PREFIX = 'container_migration:'
+TMP_CONTAINER_PREFIX = '.migration-'
+
+COPY = 'copy'
+DELETE = 'delete'
+RESTORE = 'restore'
+CLEANUP = 'cleanup'
+DONE = 'done'
+FAILED = 'failed'
+PHASES = (COPY, DELETE, RESTORE, CLEANUP, DONE)
+
+CONTAINER_HEADERS = ('x-container-read', 'x-container-write', 'x-versions-location', 'x-history-location')
+OBJECT_HEADERS = ('content-encoding', 'content-disposition', 'x-delete-at', 'x-object-manifest')
+
+# The lock is only released or extended by the migration that holds it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+REFRESH_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class MigrationInProgress(Exception):
+    pass
+
+
+class MigrationFailed(Exception):
+    pass
+
+
+def state_key(project_id, container):
+    return REDIS_PREFIX + project_id + ':' + container
+
+
+def job_id_key(project_id, container):
+    """
+    Key of the id of the last job submitted to migrate a container.
+    """
+    return state_key(project_id, container) + ':job'
+
+
+def get_progress(r, project_id, container):
+    """
+    :return: The state of the migration of a container, or None.
+    """
+    state = r.hgetall(state_key(project_id, container))
+    if not state:
+        return None
+    for field in ('total', 'copied', 'deleted', 'restored', 'cleaned'):
+        state[field] = int(state.get(field, 0))
+    state.pop('headers', None)
+    state['running'] = r.exists(state_key(project_id, container) + ':lock')
+    return state
+
+
+def container_headers(headers):
+    return dict((header, value) for header, value in headers.items()
+                if header.lower().startswith('x-container-meta-') or header.lower() in CONTAINER_HEADERS)
+
+
+def object_headers(headers):
+    return dict((header, value) for header, value in headers.items()
+                if header.lower().startswith('x-object-meta-') or header.lower() in OBJECT_HEADERS)
+
+
+def ignore_not_found(function, *args):
+    try:
+        function(*args)
+    except ClientException as e:
+        if e.http_status != 404:
+            raise
+
+
+class ContainerMigration(object):
+    """
+    Moves the objects of a container to a storage policy.
+
+    :param r: Redis connection.
+    :param url: The storage url of the project.
+    :param authenticate: Function that returns a new token, called when
+                         Swift rejects the current one.
+    """
+
+    def __init__(self, r, url, token, project_id, container, policy, authenticate=None):
+        self.r = r
+        self.url = url
+        self.token = token
+        self.authenticate = authenticate
+        self.project_id = project_id
+        self.container = container
+        self.tmp_container = TMP_CONTAINER_PREFIX + container
+        self.policy = policy
+        self.key = state_key(project_id, container)
+        self.lock_key = self.key + ':lock'
+        self.lock_token = uuid.uuid4().hex
+        self.job = None
+        self._token_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._lock_lost = False
+
+    def start(self):
+        """
+        Creates the state of a new migration, or resumes the one that did
+        not finish, and takes its lock.
+
+        :raises MigrationInProgress: If the container is being migrated, or
+                                     a migration to another policy did not
+                                     finish.
+        """
+        if not self.r.set(self.lock_key, self.lock_token, ex=settings.MIGRATION_LOCK_TTL, nx=True):
+            raise MigrationInProgress('The container is being migrated')
+        try:
+            self._prepare()
+        except Exception:
+            self.release()
+            raise
+
+    def _prepare(self):
+        state = self.r.hgetall(self.key)
+        if state and state['phase'] != DONE:
+            if state['policy'] != self.policy:
+                raise MigrationInProgress('The migration of the container to the policy ' + state['policy'] +
+                                          ' did not finish')
+            self.r.hmset(self.key, {'status': 'running', 'error': ''})
+            return
+
+        headers = self._authenticated(lambda: swift_client.head_container(self.url, self.token, self.container))
+        pipe = self.r.pipeline()
+        pipe.delete(self.key)
+        pipe.hmset(self.key, {'policy': self.policy, 'phase': COPY, 'status': 'running', 'marker': '',
+                              'total': headers.get('x-container-object-count', 0),
+                              'headers': json.dumps(container_headers(headers)),
+                              'started': time.time(), 'updated': time.time()})
+        pipe.execute()
+
+    def run(self, job=None):
+        """
+        Runs the migration from its current phase. Must be called after
+        start().
+
+        :param job: The job (api.jobs.Job) whose progress is updated.
+        :return: The status of the migration, done or failed.
+        """
+        self.job = job
+        self._stopped.clear()
+        refresher = threading.Thread(target=self._refresh_lock)
+        refresher.daemon = True
+        refresher.start()
+        try:
+            phase = self.r.hget(self.key, 'phase')
+            while phase != DONE:
+                getattr(self, '_' + phase)()
+                phase = PHASES[PHASES.index(phase) + 1]
+                self.r.hmset(self.key, {'phase': phase, 'marker': '', 'updated': time.time()})
+            self.r.hset(self.key, 'status', DONE)
+            logger.info("Container migration, " + self.container + " moved to the policy " + self.policy)
+            return DONE
+        except Exception as e:
+            logger.exception("Container migration, error migrating " + self.container)
+            self.r.hmset(self.key, {'status': FAILED, 'error': str(e), 'updated': time.time()})
+            return FAILED
+        finally:
+            self._stopped.set()
+            refresher.join()
+            self.release()
+
+    def release(self):
+        """
+        Releases the lock of the container, if this migration holds it.
+        """
+        self.r.eval(RELEASE_LOCK_SCRIPT, 1, self.lock_key, self.lock_token)
+
+    def _extend_lock(self):
+        if not self.r.eval(REFRESH_LOCK_SCRIPT, 1, self.lock_key, self.lock_token, settings.MIGRATION_LOCK_TTL):
+            self._lock_lost = True
+        return not self._lock_lost
+
+    def _refresh_lock(self):
+        while not self._stopped.wait(settings.MIGRATION_LOCK_TTL / 3.0):
+            try:
+                if not self._extend_lock():
+                    logger.error("Container migration, lost the lock of " + self.container)
+                    return
+            except Exception:
+                logger.exception("Container migration, error refreshing the lock of " + self.container)
+
+    def _authenticated(self, function, *args):
+        """
+        Calls a function that sends requests with self.token. If Swift
+        rejects the token, authenticates again and retries the call once.
+        """
+        token = self.token
+        try:
+            return function(*args)
+        except ClientException as e:
+            if e.http_status != 401 or self.authenticate is None:
+                raise
+        with self._token_lock:
+            # Other threads may have got a new token already
+            if self.token == token:
+                logger.info("Container migration, authenticating again to migrate " + self.container)
+                self.token = self.authenticate()
+        return function(*args)
+
+    def _report(self, phase, counter):
+        if self.job is None:
+            return
+        state = self.r.hmget(self.key, 'total', counter)
+        total = max(int(state[0] or 0), 1)
+        done = min(int(state[1] or 0), total)
+        # Every phase but done is a quarter of the migration
+        self.job.progress(25 * PHASES.index(phase) + 25 * done / total,
+                          phase.capitalize() + ': ' + str(done) + ' objects')
+
+    def _for_each_object(self, phase, container, counter, function, before_page=None):
+        """
+        Calls a function with every object of a container, page by page,
+        from the marker of the state.
+
+        :param before_page: Function called with the objects of each page
+                            and the pool, before the objects are processed.
+        """
+        pool = ThreadPool(settings.MIGRATION_WORKERS)
+        try:
+            marker = self.r.hget(self.key, 'marker') or ''
+            while True:
+                _, objects = self._authenticated(lambda: swift_client.get_container(
+                    self.url, self.token, container, marker=marker, limit=settings.MIGRATION_PAGE_SIZE))
+                if not objects:
+                    return
+                if before_page is not None:
+                    before_page(objects, marker, pool)
+                pool.map(lambda obj: self._authenticated(function, obj), objects)
+                if not self._extend_lock():
+                    raise MigrationFailed('The lock of the container was lost')
+                marker = objects[-1]['name']
+                pipe = self.r.pipeline()
+                pipe.hset(self.key, 'marker', marker)
+                pipe.hincrby(self.key, counter, len(objects))
+                pipe.hset(self.key, 'updated', time.time())
+                pipe.execute()
+                self._report(phase, counter)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _copy(self):
+        self._authenticated(lambda: ignore_not_found(swift_client.put_container, self.url, self.token,
+                                                     self.tmp_container, {'X-Storage-Policy': self.policy}))
+        self._for_each_object(COPY, self.container, 'copied', self._copy_object)
+
+    def _copy_object(self, obj):
+        headers, body = swift_client.get_object(self.url, self.token, self.container, obj['name'],
+                                                resp_chunk_size=settings.MIGRATION_CHUNK_SIZE,
+                                                query_string='multipart-manifest=get')
+        length = int(headers['content-length'])
+        etag = headers.get('etag')
+        query_string = None
+        if headers.get('x-static-large-object', '').lower() == 'true':
+            # The segments of the manifest, in the format of its PUT
+            segments = list()
+            for segment in json.loads(''.join(body)):
+                segments.append({'path': segment['name'], 'etag': segment['hash'], 'size_bytes': segment['bytes']})
+                if 'range' in segment:
+                    segments[-1]['range'] = segment['range']
+            body = json.dumps(segments)
+            length, etag, query_string = len(body), None, 'multipart-manifest=put'
+        swift_client.put_object(self.url, self.token, self.tmp_container, obj['name'],
+                                body, length, etag, None, headers.get('content-type'), object_headers(headers),
+                                query_string=query_string)
+
+    def _copy_leftovers(self, objects, marker, pool):
+        """
+        Copies the objects of a page of the container that are not in the
+        temporary container, or have another hash: they were created or
+        replaced after the copy phase listed the container.
+        """
+        _, copies = self._authenticated(lambda: swift_client.get_container(
+            self.url, self.token, self.tmp_container, marker=marker, end_marker=objects[-1]['name'] + u'\x00'))
+        hashes = dict((copy['name'], copy.get('hash')) for copy in copies)
+        leftovers = [obj for obj in objects if obj['name'] not in hashes or hashes[obj['name']] != obj.get('hash')]
+        if leftovers:
+            logger.info("Container migration, copying " + str(len(leftovers)) + " objects changed in " +
+                        self.container + " during the migration")
+            pool.map(lambda obj: self._authenticated(self._copy_object, obj), leftovers)
+            pipe = self.r.pipeline()
+            pipe.hincrby(self.key, 'copied', len(leftovers))
+            pipe.hincrby(self.key, 'total', len([obj for obj in leftovers if obj['name'] not in hashes]))
+            pipe.execute()
+
+    def _delete(self):
+        self._for_each_object(DELETE, self.container, 'deleted', self._delete_object, self._copy_leftovers)
+        self._authenticated(lambda: ignore_not_found(swift_client.delete_container, self.url, self.token,
+                                                     self.container))
+        headers = json.loads(self.r.hget(self.key, 'headers'))
+        headers['X-Storage-Policy'] = self.policy
+        self._authenticated(lambda: swift_client.put_container(self.url, self.token, self.container, headers))
+
+    def _delete_object(self, obj):
+        ignore_not_found(swift_client.delete_object, self.url, self.token, self.container, obj['name'])
+
+    def _restore(self):
+        self._for_each_object(RESTORE, self.tmp_container, 'restored', self._restore_object)
+
+    def _restore_object(self, obj):
+        copy_from = quote('/' + self.tmp_container + '/' + obj['name'].encode('utf-8'))
+        # Manifests are copied as manifests
+        swift_client.put_object(self.url, self.token, self.container, obj['name'],
+                                None, 0, headers={'X-Copy-From': copy_from}, query_string='multipart-manifest=get')
+
+    def _cleanup(self):
+        self._for_each_object(CLEANUP, self.tmp_container, 'cleaned', self._cleanup_object)
+        self._authenticated(lambda: ignore_not_found(swift_client.delete_container, self.url, self.token,
+                                                     self.tmp_container))
+
+    def _cleanup_object(self, obj):
+        ignore_not_found(swift_client.delete_object, self.url, self.token, self.tmp_container, obj['name'])
+
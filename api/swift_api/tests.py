@@ -8,15 +8,21 @@ from django.test.client import RequestFactory
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
+from api import jobs, registry
 from swift_api.views import storage_policies, storage_policy_detail, storage_policy_disks, deploy_storage_policy, deployed_storage_policies, \
     locality_list, node_list, node_detail, regions, region_detail, zones, zone_detail, delete_storage_policy_disks, create_container, update_container, \
-    load_swift_policies
+    load_swift_policies, node_restart
+from swift_api.container_migration import ContainerMigration, get_progress
+from swiftclient.exceptions import ClientException
+import hashlib
 import os
+import time
 
 
 # Tests use database=10 instead of 0.
 @override_settings(REDIS_CON_POOL=redis.ConnectionPool(host='localhost', port=6379, db=10),
-                   SWIFT_CFG_DEPLOY_DIR=os.path.join(os.getcwd(), 'test_data', 'deploy'))
+                   SWIFT_CFG_DEPLOY_DIR=os.path.join(os.getcwd(), 'test_data', 'deploy'),
+                   JOBS_WORKERS=0)
 class SwiftTestCase(TestCase):
     def setUp(self):
         # Every test needs access to the request factory.
@@ -28,6 +34,8 @@ class SwiftTestCase(TestCase):
         self.create_storage_policies()
         self.create_nodes()
         self.create_regions_and_zones()
+        # The fixtures are written directly to redis
+        registry.build_indexes(self.r)
 
     def tearDown(self):
         self.r.flushdb()
@@ -137,10 +145,20 @@ class SwiftTestCase(TestCase):
     @mock.patch('swift_api.views.copyfile')
     @mock.patch('swift_api.views.rsync_dir_with_nodes')
     def test_storage_policy_deploy(self, mock_rsync, mock_copyfile, mock_ring_builder_load):
+        mock_rsync.return_value = {'storagenode1': {'ip': '192.168.2.2', 'status': 'synced', 'files': 2}}
         sp_id = '1'
         request = self.api_factory.post('/swift/storage_policy/' + sp_id + '/deploy/')
         response = deploy_storage_policy(request, sp_id)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = json.loads(response.content)
+        self.assertEqual((job['type'], job['status']), ('deploy_storage_policy', 'queued'))
+        self.assertFalse(mock_ring_builder_load.called)
+
+        jobs.run_next(self.r)
+        job = jobs.get_job(self.r, job['id'])
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['result'], mock_rsync.return_value)
+        self.assertEqual(self.r.hget('storage-policy:1', 'deployed'), 'True')
         mock_ring_builder_load.assert_called_with('/opt/crystal/swift/tmp/object-1.builder')
         mock_ring_builder_load.return_value.save.assert_called_with('/opt/crystal/swift/tmp/object-1.builder')
         mock_ring_builder_load.return_value.get_ring.return_value.save.assert_called_with(os.path.join(os.getcwd(), 'test_data', 'deploy', 'object-1.ring.gz'))
@@ -177,6 +195,23 @@ class SwiftTestCase(TestCase):
         a_device = nodes[0]['devices'].keys()[0]
         self.assertIsNotNone(nodes[0]['devices'][a_device]['free'])
 
+    def test_list_nodes_paginated(self):
+        request = self.api_factory.get('/swift/nodes', {'limit': 2, 'fields': 'name,zone_name'})
+        response = node_list(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        nodes = json.loads(response.content)
+        self.assertEqual([node['name'] for node in nodes], ['storagenode1', 'storagenode2'])
+        self.assertEqual(sorted(nodes[0].keys()), ['name', 'zone_name'])
+
+        request = self.api_factory.get('/swift/nodes', {'limit': 2, 'cursor': response['X-Next-Cursor']})
+        response = node_list(request)
+        self.assertEqual([node['name'] for node in json.loads(response.content)], ['controller'])
+        self.assertFalse(response.has_header('X-Next-Cursor'))
+
+        request = self.api_factory.get('/swift/nodes', {'type': 'proxy'})
+        response = node_list(request)
+        self.assertEqual([node['name'] for node in json.loads(response.content)], ['controller'])
+
     def test_node_detail_with_method_not_allowed(self):
         server_type = 'object'
         node_id = 'storagenode1'
@@ -204,6 +239,7 @@ class SwiftTestCase(TestCase):
     def test_delete_node_detail_ok(self):
         server_type = 'object'
         node_id = 'storagenode1'
+        self.r.hset('node_sync:192.168.2.2:/opt/crystal/workload_metrics', 'a.py', '0123:644')
         request = self.api_factory.delete('/swift/nodes/' + server_type + '/' + node_id)
         response = node_detail(request, server_type, node_id)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
@@ -212,6 +248,8 @@ class SwiftTestCase(TestCase):
         request = self.api_factory.get('/swift/nodes/' + server_type + '/' + node_id)
         response = node_detail(request, server_type, node_id)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        # The files pushed to the node are forgotten
+        self.assertFalse(self.r.exists('node_sync:192.168.2.2:/opt/crystal/workload_metrics'))
 
     def test_delete_node_detail_not_found(self):
         server_type = 'object'
@@ -231,11 +269,13 @@ class SwiftTestCase(TestCase):
     def test_put_node_detail_ok(self, mock_ssh_client):
         server_type = 'object'
         node_id = 'storagenode1'
+        self.r.hset('node_sync:192.168.2.2:/opt/crystal/workload_metrics', 'a.py', '0123:644')
         data = {'ssh_username': 'admin', 'ssh_password': 's3cr3t'}
         request = self.api_factory.put('/swift/nodes/' + server_type + '/' + node_id, data, format='json')
         response = node_detail(request, server_type, node_id)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         mock_ssh_client.assert_called()
+        self.assertFalse(self.r.exists('node_sync:192.168.2.2:/opt/crystal/workload_metrics'))
 
         # Check ssh settings are stored:
         request = self.api_factory.get('/swift/nodes/' + server_type + '/' + node_id)
@@ -345,15 +385,184 @@ class SwiftTestCase(TestCase):
         response = create_container(request, 'projectid', 'container_name')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
-    @mock.patch('swift_api.views.swift_client')
-    @mock.patch('swift_api.views.os')
-    @mock.patch('swift_api.views.open')
-    def test_container_update(self, mock_open, mock_os, mock_swift_client):
-        request = self.api_factory.put('/swift/projectid/container_name/update', 'foo', format='json')
-        mock_swift_client.get_container.return_value = {'header': 'foo'}, [{'name': 'objname', 'content_type': 'text', 'headers': 'foo'}]
-        mock_swift_client.get_object.return_value = {'header': 'foo'}, 'body'
-        response = update_container(request, 'projectid', 'container_name')        
-        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+    @override_settings(MIGRATION_PAGE_SIZE=2, MIGRATION_WORKERS=2)
+    @mock.patch('swift_api.views.get_swift_url_and_token')
+    @mock.patch('swift_api.views.get_project_list')
+    def test_container_update(self, mock_get_project_list, mock_get_swift_url_and_token):
+        mock_get_project_list.return_value = {'projectid': 'project'}
+        mock_get_swift_url_and_token.return_value = ('url', 'admin-token')
+        swift = FakeSwift({'container_name': {'x-storage-policy': 'silver', 'x-container-meta-foo': 'bar'}},
+                          {'obj1': 'body1', 'obj2': 'body2', 'obj3': 'body3'})
+        with swift.patch():
+            request = self.api_factory.put('/swift/projectid/container_name/policy', 'gold', format='json')
+            response = update_container(request, 'projectid', 'container_name')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            job = json.loads(response.content)
+            self.assertEqual((job['type'], job['params']),
+                             ('update_container', {'project_id': 'projectid', 'container': 'container_name', 'policy': 'gold'}))
+            # The job takes the lock when it runs
+            self.assertFalse(self.r.exists('container_migration:projectid:container_name:lock'))
+
+            # Only one migration of a container at a time
+            request = self.api_factory.put('/swift/projectid/container_name/policy', 'gold', format='json')
+            response = update_container(request, 'projectid', 'container_name')
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+            jobs.run_next(self.r)
+
+        job = jobs.get_job(self.r, job['id'])
+        self.assertEqual((job['status'], job['progress'], job['result']['status']), ('succeeded', 100, 'done'))
+        self.assertEqual((job['result']['phase'], job['result']['total']), ('done', 3))
+        self.assertEqual(swift.containers['container_name'], {'X-Storage-Policy': 'gold', 'x-container-meta-foo': 'bar'})
+
+        request = self.api_factory.get('/swift/projectid/container_name/policy')
+        response = update_container(request, 'projectid', 'container_name')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(json.loads(response.content)['running'])
+
+        request = self.api_factory.get('/swift/projectid/other/policy')
+        response = update_container(request, 'projectid', 'other')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(MIGRATION_PAGE_SIZE=2, MIGRATION_WORKERS=2)
+    @mock.patch('swift_api.views.get_swift_url_and_token')
+    @mock.patch('swift_api.views.get_project_list')
+    def test_container_update_job_fails_before_the_migration(self, mock_get_project_list, mock_get_swift_url_and_token):
+        mock_get_project_list.return_value = {}
+        swift = FakeSwift({'container_name': {'x-storage-policy': 'silver'}}, {'obj1': 'body1'})
+        with swift.patch():
+            request = self.api_factory.put('/swift/projectid/container_name/policy', 'gold', format='json')
+            job = json.loads(update_container(request, 'projectid', 'container_name').content)
+            jobs.run_next(self.r)
+            self.assertEqual(jobs.get_job(self.r, job['id'])['status'], 'failed')
+            self.assertFalse(self.r.exists('container_migration:projectid:container_name:lock'))
+
+            # The container can be migrated again
+            mock_get_project_list.return_value = {'projectid': 'project'}
+            mock_get_swift_url_and_token.return_value = ('url', 'admin-token')
+            request = self.api_factory.put('/swift/projectid/container_name/policy', 'gold', format='json')
+            response = update_container(request, 'projectid', 'container_name')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            jobs.run_next(self.r)
+        self.assertEqual(get_progress(self.r, 'projectid', 'container_name')['status'], 'done')
+
+    def test_container_migration_releases_the_lock_if_it_cannot_start(self):
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver'}}, {'obj0': 'body0'})
+        swift.valid_token = 'other'
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            self.assertRaises(ClientException, migration.start)
+        self.assertFalse(self.r.exists('container_migration:projectid:data:lock'))
+        self.assertIsNone(get_progress(self.r, 'projectid', 'data'))
+
+    def test_container_migration(self):
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver', 'x-container-meta-owner': 'crystal'}},
+                          dict(('obj%d' % i, 'body%d' % i) for i in range(5)))
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            migration.start()
+            migration.run()
+
+        self.assertEqual(swift.containers['data'], {'X-Storage-Policy': 'gold', 'x-container-meta-owner': 'crystal'})
+        self.assertEqual(sorted(swift.objects['data'].items()), [('obj%d' % i, 'body%d' % i) for i in range(5)])
+        self.assertNotIn('.migration-data', swift.containers)
+        progress = get_progress(self.r, 'projectid', 'data')
+        self.assertEqual((progress['status'], progress['phase'], progress['copied'], progress['restored']), ('done', 'done', 5, 5))
+        self.assertFalse(progress['running'])
+
+    @override_settings(MIGRATION_PAGE_SIZE=2, MIGRATION_WORKERS=2)
+    def test_container_migration_resumes_after_a_failure(self):
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver'}}, dict(('obj%d' % i, 'body%d' % i) for i in range(5)))
+        swift.fail_on = 'obj3'
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            migration.start()
+            migration.run()
+        progress = get_progress(self.r, 'projectid', 'data')
+        self.assertEqual((progress['status'], progress['phase'], progress['copied']), ('failed', 'copy', 2))
+        self.assertEqual(len(swift.objects['data']), 5)
+
+        swift.fail_on = None
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            migration.start()
+            migration.run()
+        self.assertEqual(sorted(swift.objects['data'].items()), [('obj%d' % i, 'body%d' % i) for i in range(5)])
+        self.assertEqual(get_progress(self.r, 'projectid', 'data')['status'], 'done')
+
+    @override_settings(MIGRATION_PAGE_SIZE=2, MIGRATION_WORKERS=2)
+    def test_container_migration_copies_objects_changed_during_the_copy(self):
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver'}}, dict(('obj%d' % i, 'body%d' % i) for i in range(5)))
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            delete = migration._delete
+
+            def change_and_delete():
+                swift.objects['data']['new'] = 'new body'
+                swift.objects['data']['obj1'] = 'changed'
+                delete()
+            migration._delete = change_and_delete
+            migration.start()
+            migration.run()
+        expected = dict(('obj%d' % i, 'body%d' % i) for i in range(5))
+        expected.update({'new': 'new body', 'obj1': 'changed'})
+        self.assertEqual(swift.objects['data'], expected)
+        progress = get_progress(self.r, 'projectid', 'data')
+        self.assertEqual((progress['status'], progress['total'], progress['copied']), ('done', 6, 7))
+
+    def test_container_migration_copies_manifests(self):
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver'}}, {'small': 'body'})
+        swift.put_container('url', 'token', 'segments', {})
+        swift.objects['segments'].update({'big/1': 'part1', 'big/2': 'part2'})
+        manifest = json.dumps([{'name': '/segments/big/1', 'hash': 'etag1', 'bytes': 5},
+                               {'name': '/segments/big/2', 'hash': 'etag2', 'bytes': 5}])
+        swift.objects['data']['big'] = manifest
+        swift.manifests.add(('data', 'big'))
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            migration.start()
+            migration.run()
+        self.assertEqual(get_progress(self.r, 'projectid', 'data')['status'], 'done')
+        self.assertIn(('data', 'big'), swift.manifests)
+        self.assertEqual(json.loads(swift.objects['data']['big']), json.loads(manifest))
+        self.assertEqual(swift.objects['data']['small'], 'body')
+
+    @override_settings(MIGRATION_PAGE_SIZE=2, MIGRATION_WORKERS=1, MIGRATION_LOCK_TTL=1)
+    def test_container_migration_refreshes_its_lock(self):
+        # The first page takes longer than the TTL of the lock
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver'}}, {'obj0': 'body0', 'obj1': 'body1'})
+        swift.delay = 0.7
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            migration.start()
+            migration.run()
+        self.assertEqual(get_progress(self.r, 'projectid', 'data')['status'], 'done')
+        self.assertFalse(self.r.exists('container_migration:projectid:data:lock'))
+
+    def test_container_migration_keeps_the_lock_of_another_migration(self):
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver'}}, {'obj0': 'body0'})
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold')
+            migration.start()
+            # The lock expired and another migration took it
+            self.r.set('container_migration:projectid:data:lock', 'other')
+            migration.run()
+        progress = get_progress(self.r, 'projectid', 'data')
+        self.assertEqual((progress['status'], progress['phase']), ('failed', 'copy'))
+        self.assertEqual(self.r.get('container_migration:projectid:data:lock'), 'other')
+
+    def test_container_migration_authenticates_again(self):
+        swift = FakeSwift({'data': {'x-storage-policy': 'silver'}}, dict(('obj%d' % i, 'body%d' % i) for i in range(5)))
+        swift.valid_token = 'token'
+        tokens = ['new token']
+        with swift.patch():
+            migration = ContainerMigration(self.r, 'url', 'token', 'projectid', 'data', 'gold', tokens.pop)
+            migration.start()
+            swift.valid_token = 'new token'
+            migration.run()
+        self.assertEqual(tokens, [])
+        self.assertEqual(get_progress(self.r, 'projectid', 'data')['status'], 'done')
+        self.assertEqual(sorted(swift.objects['data'].items()), [('obj%d' % i, 'body%d' % i) for i in range(5)])
 
     @mock.patch('swift_api.views.ConfigParser')
     @mock.patch('swift_api.views.RingBuilder')
@@ -366,7 +575,26 @@ class SwiftTestCase(TestCase):
         mock_config_parser.has_section.return_value = True
         mock_config_parser.has_section.return_value = False
         response = load_swift_policies(request)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        jobs.run_next(self.r)
+        self.assertEqual(jobs.get_job(self.r, json.loads(response.content)['id'])['status'], 'succeeded')
+        self.assertTrue(mock_ring_builder.load.called)
+
+    @mock.patch('swift_api.views.paramiko.SSHClient')
+    def test_node_restart(self, mock_ssh_client):
+        request = self.api_factory.put('/swift/nodes/object/storagenode1/restart')
+        response = node_restart(request, 'object', 'storagenode1')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(mock_ssh_client.called)
+
+        jobs.run_next(self.r)
+        self.assertEqual(jobs.get_job(self.r, json.loads(response.content)['id'])['status'], 'succeeded')
+        mock_ssh_client.return_value.connect.assert_called_with('192.168.2.2', username='user', password='pass')
+        mock_ssh_client.return_value.exec_command.assert_called_with('sudo swift-init main restart')
+
+        request = self.api_factory.put('/swift/nodes/object/unknown/restart')
+        response = node_restart(request, 'object', 'unknown')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     
     #
@@ -406,3 +634,86 @@ class SwiftTestCase(TestCase):
         self.r.set('zones:id', 1)
         self.r.hmset('zone:1', {'name': 'Rack', 'description': 'Dummy Rack: GbE Switch, 2 Proxies and 7 Storage Nodes',
                                 'region': '1', 'zone_id': '1'})
+
+
+class FakeSwift(object):
+    """
+    In-memory containers and objects for the container migration tests. An
+    SLO manifest is stored in the format of its GET with
+    multipart-manifest=get, and returns its segments otherwise.
+    """
+
+    def __init__(self, containers, objects):
+        self.containers = containers
+        self.objects = dict((container, dict()) for container in containers)
+        self.objects[list(containers)[0]].update(objects)
+        self.manifests = set()
+        self.fail_on = None
+        self.valid_token = None
+        self.delay = 0
+
+    def patch(self):
+        return mock.patch.multiple('swift_api.container_migration.swift_client', head_container=self.head_container,
+                                   get_container=self.get_container, put_container=self.put_container,
+                                   delete_container=self.delete_container, get_object=self.get_object,
+                                   put_object=self.put_object, delete_object=self.delete_object)
+
+    def head_container(self, url, token, container):
+        self.check_token(token)
+        headers = dict(self.containers[container])
+        headers['x-container-object-count'] = str(len(self.objects[container]))
+        return headers
+
+    def put_container(self, url, token, container, headers):
+        self.containers[container] = headers
+        self.objects.setdefault(container, dict())
+
+    def delete_container(self, url, token, container):
+        assert not self.objects.pop(container)
+        del self.containers[container]
+
+    def check_token(self, token):
+        if self.valid_token is not None and token != self.valid_token:
+            raise ClientException('Unauthorized', http_status=401)
+
+    def get_container(self, url, token, container, marker='', limit=None, end_marker=None):
+        self.check_token(token)
+        names = sorted(name for name in self.objects[container]
+                       if name > marker and (end_marker is None or name < end_marker))[:limit]
+        return {}, [{'name': name, 'hash': hashlib.md5(self.objects[container][name]).hexdigest()} for name in names]
+
+    def get_object(self, url, token, container, name, resp_chunk_size=None, query_string=None):
+        self.check_token(token)
+        time.sleep(self.delay)
+        if name == self.fail_on:
+            raise ClientException('Service Unavailable', http_status=503)
+        body = self.objects[container][name]
+        headers = {'etag': hashlib.md5(body).hexdigest(), 'content-type': 'text/plain'}
+        if (container, name) in self.manifests:
+            if query_string == 'multipart-manifest=get':
+                headers['x-static-large-object'] = 'True'
+            else:
+                body = ''.join(self.objects[segment['name'].lstrip('/').split('/', 1)[0]][segment['name'].split('/', 2)[2]]
+                               for segment in json.loads(body))
+                headers['etag'] = '"slo-etag"'
+        headers['content-length'] = str(len(body))
+        return headers, iter([body])
+
+    def put_object(self, url, token, container, name, contents, content_length, etag=None, chunk_size=None,
+                   content_type=None, headers=None, query_string=None):
+        self.manifests.discard((container, name))
+        if 'X-Copy-From' in headers:
+            src_container, src_name = headers['X-Copy-From'].lstrip('/').split('/', 1)
+            self.objects[container][name] = self.objects[src_container][src_name]
+            if (src_container, src_name) in self.manifests and query_string == 'multipart-manifest=get':
+                self.manifests.add((container, name))
+        elif query_string == 'multipart-manifest=put':
+            segments = json.loads(contents)
+            self.objects[container][name] = json.dumps([{'name': segment['path'], 'hash': segment['etag'],
+                                                         'bytes': segment['size_bytes']} for segment in segments])
+            self.manifests.add((container, name))
+        else:
+            self.objects[container][name] = ''.join(contents)
+
+    def delete_object(self, url, token, container, name):
+        del self.objects[container][name]
@@ -7,8 +7,8 @@ from rest_framework import status
 from rest_framework.parsers import JSONParser
 from shutil import copyfile
 from swiftclient import client as swift_client
+from swiftclient.exceptions import ClientException
 from swift.common.ring import RingBuilder
-from swift.common import exceptions
 from operator import itemgetter
 import ConfigParser
 import os
@@ -19,9 +19,13 @@ import logging
 import requests
 import paramiko
 from socket import inet_aton
-from api.common import JSONResponse, get_redis_connection, to_json_bools, get_token_connection,\
-    rsync_dir_with_nodes
+from api import jobs, registry
+from api.listing import ListQuery, InvalidListQuery, get_page, index_fetcher, sorted_fetcher, list_response
+from api.common import JSONResponse, get_redis_connection, get_hashes, to_json_bools, get_token_connection,\
+    rsync_dir_with_nodes, get_project_list, get_swift_url_and_token
 from api.exceptions import FileSynchronizationException
+from api.node_sync import NodeSynchronizer
+from swift_api import container_migration
 
 
 logger = logging.getLogger(__name__)
@@ -70,15 +74,21 @@ def storage_policies(request):
         except RedisError:
             return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        keys = r.keys("storage-policy:*")
-        storage_policy_list = []
-        for key in keys:
-            storage_policy = r.hgetall(key)
-            to_json_bools(storage_policy, 'deprecated', 'default', 'deployed')
-            storage_policy['id'] = str(key).split(':')[-1]
-            storage_policy['devices'] = json.loads(storage_policy['devices'])
-            storage_policy_list.append(storage_policy)
-        return JSONResponse(storage_policy_list, status=status.HTTP_200_OK)
+        def load(keys):
+            storage_policy_list = get_hashes(r, keys)
+            for key, storage_policy in zip(keys, storage_policy_list):
+                if storage_policy:
+                    to_json_bools(storage_policy, 'deprecated', 'default', 'deployed')
+                    storage_policy['id'] = str(key).split(':')[-1]
+                    storage_policy['devices'] = json.loads(storage_policy['devices'])
+            return storage_policy_list
+
+        try:
+            query = ListQuery(request.GET)
+            storage_policy_list, last_key = get_page(query, index_fetcher(r, 'storage-policy', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, storage_policy_list, last_key)
 
     if request.method == "POST":
         try:
@@ -99,6 +109,7 @@ def storage_policies(request):
             ring.save(get_policy_file_path(settings.SWIFT_CFG_TMP_DIR, sp_id))
 
             r.hmset(key, data)
+            registry.add(r, key)
         except:
             return JSONResponse('Error creating the Storage Policy', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -116,7 +127,7 @@ def deployed_storage_policies(request):
         except RedisError:
             return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        keys = r.keys("storage-policy:*")
+        keys = registry.keys(r, "storage-policy")
         swift_file = os.path.join(settings.SWIFT_CFG_DEPLOY_DIR, 'swift.conf')
         config_parser = ConfigParser.RawConfigParser()
         config_parser.read(swift_file)
@@ -124,8 +135,7 @@ def deployed_storage_policies(request):
         deployed_storage_policy_list = [sp for sp in keys if config_parser.has_section(sp)]
         
         storage_policy_list = []
-        for key in deployed_storage_policy_list:
-            storage_policy = r.hgetall(key)
+        for key, storage_policy in zip(deployed_storage_policy_list, get_hashes(r, deployed_storage_policy_list)):
             to_json_bools(storage_policy, 'deprecated', 'default', 'deployed')
             storage_policy['id'] = str(key).split(':')[-1]
             storage_policy['devices'] = json.loads(storage_policy['devices'])
@@ -208,15 +218,18 @@ def storage_policy_detail(request, storage_policy_id):
                     config_parser.write(configfile)
 
                 r.delete(key)
+                registry.remove(r, key)
 
                 rsync_dir_with_nodes(settings.SWIFT_CFG_DEPLOY_DIR, '/etc/swift')
 
-                if not r.keys('storage-policy:*'):
+                if not registry.keys(r, 'storage-policy'):
                     r.delete('storage-policies:id')
 
                 return JSONResponse("Storage Policy deleted", status=status.HTTP_204_NO_CONTENT)
             except RedisError:
                 return JSONResponse("Error deleting storage policy", status=status.HTTP_400_BAD_REQUEST)
+            except FileSynchronizationException as e:
+                return JSONResponse(e.message, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         else:
             return JSONResponse('Storage policy not found.', status=status.HTTP_404_NOT_FOUND)
 
@@ -238,8 +251,8 @@ def storage_policy_disks(request, storage_policy_id):
             storage_policy = r.hgetall(key)
             storage_policy['devices'] = json.loads(storage_policy['devices'])
             all_devices = []
-            for node_key in r.keys('object_node:*'):
-                node = r.hgetall(node_key)
+            node_keys = registry.scan(r, 'object_node:*')
+            for node_key, node in zip(node_keys, get_hashes(r, node_keys, ['devices'])):
                 all_devices += [node_key.split(':')[1] + ':' + device for device in json.loads(node['devices']).keys()]
 
             current_devices = [dev[0] for dev in storage_policy['devices']]
@@ -333,7 +346,9 @@ def delete_storage_policy_disks(request, storage_policy_id, disk_id):
 
 @csrf_exempt
 def deploy_storage_policy(request, storage_policy_id):
-
+    """
+    POST: Rebalance the ring of the storage policy and deploy it to the nodes, in a job
+    """
     try:
         r = get_redis_connection()
     except RedisError:
@@ -343,146 +358,161 @@ def deploy_storage_policy(request, storage_policy_id):
 
     if request.method == "POST":
         if r.exists(key):
-            try:
-                tmp_policy_file = get_policy_file_path(settings.SWIFT_CFG_TMP_DIR, storage_policy_id)
-                deploy_policy_file = get_policy_file_path(settings.SWIFT_CFG_DEPLOY_DIR, storage_policy_id)
-                deploy_gzip_filename = deploy_policy_file.replace('builder', 'ring.gz')
+            job = jobs.submit(r, 'deploy_storage_policy', storage_policy_id=storage_policy_id)
+            return JSONResponse(job, status=status.HTTP_202_ACCEPTED)
+        else:
+            return JSONResponse('Storage policy not found.', status=status.HTTP_404_NOT_FOUND)
 
-                ring = RingBuilder.load(tmp_policy_file)
-                ring.rebalance()
-                ring.save(tmp_policy_file)
+    return JSONResponse('Only HTTP POST requests allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
-                ringdata = ring.get_ring()
-                ringdata.save(deploy_gzip_filename)
 
-                data = r.hgetall(key)
-                update_sp_files(settings.SWIFT_CFG_DEPLOY_DIR, storage_policy_id, {'name': data['name'],
-                                                                                   'deprecated': data['deprecated'],
-                                                                                   'default': data['default']})
+@jobs.job_handler('deploy_storage_policy')
+def deploy_storage_policy_job(job, storage_policy_id):
+    """
+    :return: The synchronization status of each node.
+    """
+    r = job.r
+    key = "storage-policy:" + storage_policy_id
+    tmp_policy_file = get_policy_file_path(settings.SWIFT_CFG_TMP_DIR, storage_policy_id)
+    deploy_policy_file = get_policy_file_path(settings.SWIFT_CFG_DEPLOY_DIR, storage_policy_id)
+    deploy_gzip_filename = deploy_policy_file.replace('builder', 'ring.gz')
 
-                copyfile(tmp_policy_file, deploy_policy_file)
-                rsync_dir_with_nodes(settings.SWIFT_CFG_DEPLOY_DIR, '/etc/swift')
+    job.progress(0, 'Rebalancing the ring')
+    ring = RingBuilder.load(tmp_policy_file)
+    ring.rebalance()
+    ring.save(tmp_policy_file)
 
-                r.hset(key, 'deployed', 'True')
+    ringdata = ring.get_ring()
+    ringdata.save(deploy_gzip_filename)
 
-                return JSONResponse('Storage policy deployed correctly', status=status.HTTP_200_OK)
-            except RedisError:
-                return JSONResponse('Storage policy could not be deployed', status=status.HTTP_400_BAD_REQUEST)
-            except exceptions.RingBuilderError, e:
-                return JSONResponse('Storage policy could not be deployed. Error message: %s' % e.message, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            return JSONResponse('Storage policy not found.', status=status.HTTP_404_NOT_FOUND)
+    data = r.hgetall(key)
+    update_sp_files(settings.SWIFT_CFG_DEPLOY_DIR, storage_policy_id, {'name': data['name'],
+                                                                       'deprecated': data['deprecated'],
+                                                                       'default': data['default']})
 
-    return JSONResponse('Only HTTP POST requests allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    copyfile(tmp_policy_file, deploy_policy_file)
+    job.progress(50, 'Synchronizing the nodes')
+    nodes = rsync_dir_with_nodes(settings.SWIFT_CFG_DEPLOY_DIR, '/etc/swift')
+
+    r.hset(key, 'deployed', 'True')
+    return nodes
 
 
 @csrf_exempt
 def load_swift_policies(request):
-
+    """
+    POST: Load the storage policies of the cluster from a proxy node, in a job
+    """
     try:
         r = get_redis_connection()
     except RedisError:
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == "POST":
+        job = jobs.submit(r, 'load_swift_policies')
+        return JSONResponse(job, status=status.HTTP_202_ACCEPTED)
 
-        # 1st step: Copy de swift.conf file from a Proxy Server to a local Crystal directory
-        proxy_nodes = r.keys("proxy_node:*")
-        if proxy_nodes:
-            node = r.hgetall(proxy_nodes[0])
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(node['ip'], username=node['ssh_username'], password=node['ssh_password'])
+    return JSONResponse('Only HTTP POST requests allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
-            try:
-                sftp_client = ssh_client.open_sftp()
-                swift_etc_path = '/etc/swift/'
-                remote_swift_file = swift_etc_path+'swift.conf'
-                local_swift_file_deploy = get_swift_cfg_path(settings.SWIFT_CFG_DEPLOY_DIR)
-                sftp_client.get(remote_swift_file, local_swift_file_deploy)
-
-                remote_file_list = sftp_client.listdir(swift_etc_path)
-                for r_file in remote_file_list:
-                    if r_file.startswith('object') and r_file.endswith('.builder'):
-                        remote_file = swift_etc_path+r_file
-                        local_file_tmp = os.path.join(settings.SWIFT_CFG_TMP_DIR, r_file)
-                        local_file_deploy = os.path.join(settings.SWIFT_CFG_DEPLOY_DIR, r_file)
-                        sftp_client.get(remote_file, local_file_tmp)
-                        sftp_client.get(remote_file, local_file_deploy)
-
-            except SSHException:
-                ssh_client.close()
-                logger.error('An error occurred restarting Swift nodes')
-                raise FileSynchronizationException("An error occurred restarting Swift nodes")
-
-            sftp_client.close()
-            ssh_client.close()
 
-        # 2nd step: load policies
-        pattern = os.path.join(settings.SWIFT_CFG_TMP_DIR, 'object*')
-        files = glob.glob(pattern)
+@jobs.job_handler('load_swift_policies')
+def load_swift_policies_job(job):
+    """
+    :return: The keys of the loaded storage policies.
+    """
+    r = job.r
+
+    # 1st step: Copy de swift.conf file from a Proxy Server to a local Crystal directory
+    proxy_nodes = registry.scan(r, "proxy_node:*")
+    if proxy_nodes:
+        job.progress(0, 'Copying the rings from ' + proxy_nodes[0])
+        node = r.hgetall(proxy_nodes[0])
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.connect(node['ip'], username=node['ssh_username'], password=node['ssh_password'])
 
         try:
-            for builder_file in files:
-                builder = RingBuilder.load(builder_file)
-                if '-' in builder_file:
-                    sp_id = builder_file.split('.')[0].split('-')[-1]
-                    key = 'storage-policy:' + sp_id
-                    if int(sp_id) > r.get('storage-policies:id'):
-                        r.set('storage-policies:id', sp_id)
-                else:
-                    key = 'storage-policy:0'
-
-                local_swift_file = get_swift_cfg_path(settings.SWIFT_CFG_DEPLOY_DIR)
-                config_parser = ConfigParser.RawConfigParser()
-                config_parser.read(local_swift_file)
-                if config_parser.has_section(key):
-
-                    name = config_parser.get(key, 'name') if config_parser.has_option(key, 'name') else 'Policy-' + sp_id
-                    policy_type = config_parser.get(key, 'policy_type') if config_parser.has_option(key, 'policy_type') else 'Replication'
-                    deprecated = config_parser.get(key, 'deprecated') if config_parser.has_option(key, 'deprecated') else 'False'
-
-                    if config_parser.has_option(key, 'default'):
-                        default = 'True' if config_parser.get(key, 'default') in ['yes', 'Yes'] else 'False'
-                    else:
-                        default = 'False'
-
-                    devices = []
-                    nodes_data = {}
-                    nodes = r.keys('*_node:*')
-                    for node in nodes:
-                        nodes_data[node] = r.hgetall(node)
-
-                    for device in builder.devs:
-                        try:
-                            inet_aton(device['ip'])
-                            device['ip'] = next((nodes_data[node]['name'] for node in nodes_data if nodes_data[node]['ip'] == device['ip']), device['ip'])
-                        except:
-                            pass
-                        devices.append((device['ip'] + ':' + device['device'], device['id']))
-
-                    data = {'name': name,
-                            'default': default,
-                            'deprecated': deprecated,
-                            'time': builder.min_part_hours,
-                            'devices': json.dumps(devices),
-                            'deployed': 'True',
-                            'policy_type': policy_type if policy_type else 'Replication',
-                            'partition_power': int(math.log(builder.parts, 2)),
-                            'replicas': int(builder.replicas)
-                            }
-
-                    r.hmset(key, data)
-
-                else:
-                    pass
+            sftp_client = ssh_client.open_sftp()
+            swift_etc_path = '/etc/swift/'
+            remote_swift_file = swift_etc_path+'swift.conf'
+            local_swift_file_deploy = get_swift_cfg_path(settings.SWIFT_CFG_DEPLOY_DIR)
+            sftp_client.get(remote_swift_file, local_swift_file_deploy)
+
+            remote_file_list = sftp_client.listdir(swift_etc_path)
+            for r_file in remote_file_list:
+                if r_file.startswith('object') and r_file.endswith('.builder'):
+                    remote_file = swift_etc_path+r_file
+                    local_file_tmp = os.path.join(settings.SWIFT_CFG_TMP_DIR, r_file)
+                    local_file_deploy = os.path.join(settings.SWIFT_CFG_DEPLOY_DIR, r_file)
+                    sftp_client.get(remote_file, local_file_tmp)
+                    sftp_client.get(remote_file, local_file_deploy)
 
-        except RedisError:
-                return JSONResponse('Policies could not be loaded', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except SSHException:
+            ssh_client.close()
+            logger.error('An error occurred restarting Swift nodes')
+            raise FileSynchronizationException("An error occurred restarting Swift nodes")
 
-        return JSONResponse('Policies loaded correctly', status=status.HTTP_200_OK)
+        sftp_client.close()
+        ssh_client.close()
 
-    return JSONResponse('Only HTTP POST requests allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    # 2nd step: load policies
+    pattern = os.path.join(settings.SWIFT_CFG_TMP_DIR, 'object*')
+    files = glob.glob(pattern)
+
+    loaded = list()
+    for i, builder_file in enumerate(files):
+        job.progress(50 + 50 * i / len(files), 'Loading ' + os.path.basename(builder_file))
+        builder = RingBuilder.load(builder_file)
+        if '-' in builder_file:
+            sp_id = builder_file.split('.')[0].split('-')[-1]
+            key = 'storage-policy:' + sp_id
+            if int(sp_id) > r.get('storage-policies:id'):
+                r.set('storage-policies:id', sp_id)
+        else:
+            key = 'storage-policy:0'
+
+        local_swift_file = get_swift_cfg_path(settings.SWIFT_CFG_DEPLOY_DIR)
+        config_parser = ConfigParser.RawConfigParser()
+        config_parser.read(local_swift_file)
+        if config_parser.has_section(key):
+
+            name = config_parser.get(key, 'name') if config_parser.has_option(key, 'name') else 'Policy-' + sp_id
+            policy_type = config_parser.get(key, 'policy_type') if config_parser.has_option(key, 'policy_type') else 'Replication'
+            deprecated = config_parser.get(key, 'deprecated') if config_parser.has_option(key, 'deprecated') else 'False'
+
+            if config_parser.has_option(key, 'default'):
+                default = 'True' if config_parser.get(key, 'default') in ['yes', 'Yes'] else 'False'
+            else:
+                default = 'False'
+
+            devices = []
+            nodes = registry.scan(r, '*_node:*')
+            nodes_data = dict(zip(nodes, get_hashes(r, nodes, ['name', 'ip'])))
+
+            for device in builder.devs:
+                try:
+                    inet_aton(device['ip'])
+                    device['ip'] = next((nodes_data[node]['name'] for node in nodes_data if nodes_data[node]['ip'] == device['ip']), device['ip'])
+                except:
+                    pass
+                devices.append((device['ip'] + ':' + device['device'], device['id']))
+
+            data = {'name': name,
+                    'default': default,
+                    'deprecated': deprecated,
+                    'time': builder.min_part_hours,
+                    'devices': json.dumps(devices),
+                    'deployed': 'True',
+                    'policy_type': policy_type if policy_type else 'Replication',
+                    'partition_power': int(math.log(builder.parts, 2)),
+                    'replicas': int(builder.replicas)
+                    }
+
+            r.hmset(key, data)
+            registry.add(r, key)
+            loaded.append(key)
+
+    return loaded
 
 
 @csrf_exempt
@@ -518,32 +548,40 @@ def node_list(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys("*_node:*")
-        nodes = []
-        for key in keys:
-            node = r.hgetall(key)
-            node.pop("ssh_username", None)  # username & password are not returned in the list
-            node.pop("ssh_password", None)
-            node['devices'] = json.loads(node['devices'])
-
-            r_id = node['region_id']
-            z_id = node['zone_id']
+        def load(keys):
+            node_list = get_hashes(r, keys)
+
+            # Names of the regions and zones of the nodes, read at once
+            region_ids = list(set(node['region_id'] for node in node_list if node))
+            zone_ids = list(set(node['zone_id'] for node in node_list if node))
+            region_keys = ['region:' + r_id for r_id in region_ids] + ['zone:' + z_id for z_id in zone_ids]
+            names = get_hashes(r, region_keys, ['name'])
+            region_names = dict(zip(region_ids, names[:len(region_ids)]))
+            zone_names = dict(zip(zone_ids, names[len(region_ids):]))
+
+            for node in node_list:
+                if not node:
+                    continue
+                node.pop("ssh_username", None)  # username & password are not returned in the list
+                node.pop("ssh_password", None)
+                node['devices'] = json.loads(node['devices'])
+
+                r_id = node['region_id']
+                z_id = node['zone_id']
+                node['region_name'] = region_names[r_id].get('name', r_id)
+                node['zone_name'] = zone_names[z_id].get('name', z_id)
+
+                if 'ssh_access' not in node:
+                    node['ssh_access'] = False
+            return node_list
 
-            if r.exists('region:' + r_id):
-                node['region_name'] = r.hgetall('region:' + r_id)['name']
-            else:
-                node['region_name'] = r_id
-
-            if r.exists('zone:' + z_id):
-                node['zone_name'] = r.hgetall('zone:' + z_id)['name']
-            else:
-                node['zone_name'] = z_id
-
-            if 'ssh_access' not in node:
-                node['ssh_access'] = False
-            nodes.append(node)
-        sorted_list = sorted(nodes, key=itemgetter('name'))
-        return JSONResponse(sorted_list, status=status.HTTP_200_OK)
+        try:
+            query = ListQuery(request.GET)
+            nodes, last_key = get_page(query, sorted_fetcher(registry.scan(r, "*_node:*"), load),
+                                       sort_key=itemgetter('name'))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, nodes, last_key)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -591,6 +629,8 @@ def node_detail(request, server_type, node_id):
                     data['ssh_access'] = False
 
                 r.hmset(key, data)
+                # The node may have been reinstalled: push every file again
+                NodeSynchronizer.invalidate(r, node['ip'])
                 return JSONResponse("Node Data updated", status=status.HTTP_201_CREATED)
             except RedisError:
                 return JSONResponse("Error updating node data", status=status.HTTP_400_BAD_REQUEST)
@@ -600,7 +640,10 @@ def node_detail(request, server_type, node_id):
     if request.method == 'DELETE':
         # Deletes the key. If the node is alive, the metric middleware will recreate this key again.
         if r.exists(key):
+            node_ip = r.hget(key, 'ip')
             r.delete(key)
+            if node_ip:
+                NodeSynchronizer.invalidate(r, node_ip)
             return JSONResponse('Node has been deleted', status=status.HTTP_204_NO_CONTENT)
         else:
             return JSONResponse('Node not found.', status=status.HTTP_404_NOT_FOUND)
@@ -619,25 +662,32 @@ def node_restart(request, server_type, node_id):
     logger.debug('Restarting node: ' + str(key))
 
     if request.method == 'PUT':
-        node = r.hgetall(key)
+        if not r.exists(key):
+            return JSONResponse('Node not found.', status=status.HTTP_404_NOT_FOUND)
+        job = jobs.submit(r, 'node_restart', node_key=key)
+        return JSONResponse(job, status=status.HTTP_202_ACCEPTED)
 
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(node['ip'], username=node['ssh_username'], password=node['ssh_password'])
+    logger.error('Method ' + str(request.method) + ' not allowed.')
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
-        try:
-            ssh_client.exec_command('sudo swift-init main restart')
-        except SSHException:
-            ssh_client.close()
-            logger.error('An error occurred restarting Swift nodes')
-            raise FileSynchronizationException("An error occurred restarting Swift nodes")
 
+@jobs.job_handler('node_restart')
+def node_restart_job(job, node_key):
+    node = job.r.hgetall(node_key)
+
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh_client.connect(node['ip'], username=node['ssh_username'], password=node['ssh_password'])
+
+    try:
+        ssh_client.exec_command('sudo swift-init main restart')
+    except SSHException:
         ssh_client.close()
-        logger.debug('Node ' + str(key) + ' was restarted!')
-        return JSONResponse('The node was restarted successfully.', status=status.HTTP_200_OK)
+        logger.error('An error occurred restarting Swift nodes')
+        raise FileSynchronizationException("An error occurred restarting Swift nodes")
 
-    logger.error('Method ' + str(request.method) + ' not allowed.')
-    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    ssh_client.close()
+    logger.debug('Node ' + str(node_key) + ' was restarted!')
 
 
 # Regions
@@ -652,21 +702,26 @@ def regions(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys("region:*")
-        region_items = []
+        def load(keys):
+            region_items = get_hashes(r, keys)
+            for key, region in zip(keys, region_items):
+                if region:
+                    region['id'] = key.split(':')[1]
+            return region_items
 
-        for key in keys:
-            region = r.hgetall(key)
-            region['id'] = key.split(':')[1]
-            region_items.append(region)
-
-        return JSONResponse(region_items, status=status.HTTP_200_OK)
+        try:
+            query = ListQuery(request.GET)
+            region_items, last_key = get_page(query, index_fetcher(r, 'region', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, region_items, last_key)
 
     if request.method == 'POST':
         key = "region:" + str(r.incr('regions:id'))
         data = JSONParser().parse(request)
         try:
             r.hmset(key, data)
+            registry.add(r, key)
             return JSONResponse("Data inserted correctly", status=status.HTTP_201_CREATED)
         except RedisError:
             return JSONResponse("Error inserting data", status=status.HTTP_400_BAD_REQUEST)
@@ -693,16 +748,14 @@ def region_detail(request, region_id):
     if request.method == 'DELETE':
         # Deletes the key. If the node is alive, the metric middleware will recreate this key again.
         if r.exists(region_key):
-            keys = r.keys("zone:*")
-            if 'zone:id' in keys:
-                keys.remove('zone:id')
-            for key in keys:
-                zone = r.hgetall(key)
-                if zone['region'] == region_id:
+            zone_keys = registry.keys(r, 'zone')
+            for zone in get_hashes(r, zone_keys, ['region']):
+                if zone.get('region') == region_id:
                     return JSONResponse("Region couldn't be deleted because the zone with id: " +
                                         region_id + ' has this region assigned.', status=status.HTTP_400_BAD_REQUEST)
 
             r.delete(region_key)
+            registry.remove(r, region_key)
             return JSONResponse('Region has been deleted', status=status.HTTP_204_NO_CONTENT)
         else:
             return JSONResponse('Region not found.', status=status.HTTP_404_NOT_FOUND)
@@ -712,6 +765,7 @@ def region_detail(request, region_id):
 
         try:
             r.hmset(region_key, data)
+            registry.add(r, region_key)
             return JSONResponse("Data updated correctly", status=status.HTTP_204_NO_CONTENT)
         except RedisError:
             return JSONResponse("Error updating data", status=status.HTTP_400_BAD_REQUEST)
@@ -731,22 +785,29 @@ def zones(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys("zone:*")
-        zone_items = []
-
-        for key in keys:
-            zone = r.hgetall(key)
-            zone['id'] = key.split(':')[1]
-            zone['region_name'] = r.hgetall('region:' + zone['region'])['name']
-            zone_items.append(zone)
+        def load(keys):
+            zone_items = get_hashes(r, keys)
+            region_ids = list(set(zone['region'] for zone in zone_items if zone))
+            region_names = dict(zip(region_ids, get_hashes(r, ['region:' + r_id for r_id in region_ids], ['name'])))
+            for key, zone in zip(keys, zone_items):
+                if zone:
+                    zone['id'] = key.split(':')[1]
+                    zone['region_name'] = region_names[zone['region']]['name']
+            return zone_items
 
-        return JSONResponse(zone_items, status=status.HTTP_200_OK)
+        try:
+            query = ListQuery(request.GET)
+            zone_items, last_key = get_page(query, index_fetcher(r, 'zone', load))
+        except InvalidListQuery as e:
+            return JSONResponse(e.message, status=status.HTTP_400_BAD_REQUEST)
+        return list_response(query, zone_items, last_key)
 
     if request.method == 'POST':
         key = "zone:" + str(r.incr('zones:id'))
         data = JSONParser().parse(request)
         try:
             r.hmset(key, data)
+            registry.add(r, key)
             return JSONResponse("Data inserted correctly", status=status.HTTP_201_CREATED)
         except RedisError:
             return JSONResponse("Error inserting data", status=status.HTTP_400_BAD_REQUEST)
@@ -774,6 +835,7 @@ def zone_detail(request, zone_id):
         # Deletes the key. If the node is alive, the metric middleware will recreate this key again.
         if r.exists(key):
             r.delete(key)
+            registry.remove(r, key)
             return JSONResponse('Zone has been deleted', status=status.HTTP_204_NO_CONTENT)
         else:
             return JSONResponse('Zone not found.', status=status.HTTP_404_NOT_FOUND)
@@ -783,6 +845,7 @@ def zone_detail(request, zone_id):
         key = "zone:" + str(data['zone_id'])
         try:
             r.hmset(key, data)
+            registry.add(r, key)
             return JSONResponse("Zone Data updated correctly", status=status.HTTP_204_NO_CONTENT)
         except RedisError:
             return JSONResponse("Error updating zone data", status=status.HTTP_400_BAD_REQUEST)
@@ -817,7 +880,8 @@ def containers_list(request, project_id):
 
         _, containers = swift_client.get_account(url, token)
         for c_id in reversed(range(len(containers))):
-            if containers[c_id]['name'] in ('.dependency', '.storlet'):
+            if containers[c_id]['name'] in ('.dependency', '.storlet') or \
+                    containers[c_id]['name'].startswith(container_migration.TMP_CONTAINER_PREFIX):
                 del containers[c_id]
 
         return JSONResponse(containers, status=status.HTTP_200_OK)
@@ -826,43 +890,62 @@ def containers_list(request, project_id):
 
 @csrf_exempt
 def update_container(request, project_id, container_name):
+    """
+    PUT: Moves the objects of a container to a storage policy, in the
+    background. GET: Progress of the migration.
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        progress = container_migration.get_progress(r, project_id, container_name)
+        if progress is None:
+            return JSONResponse('Migration not found.', status=status.HTTP_404_NOT_FOUND)
+        return JSONResponse(progress, status=status.HTTP_200_OK)
 
     if request.method == 'PUT':
         sp = JSONParser().parse(request)
-        token = get_token_connection(request)
-        url = settings.SWIFT_URL + "/AUTH_" + project_id
+        # The job takes the lock of the migration when it runs
+        pending = r.get(container_migration.job_id_key(project_id, container_name))
+        pending = pending and jobs.get_job(r, pending)
+        progress = container_migration.get_progress(r, project_id, container_name)
+        if (pending and pending['status'] not in jobs.FINISHED) or (progress and progress['running']):
+            return JSONResponse('The container is being migrated', status=status.HTTP_409_CONFLICT)
+        if progress and progress['phase'] != container_migration.DONE and progress['policy'] != sp:
+            return JSONResponse('The migration of the container to the policy ' + progress['policy'] +
+                                ' did not finish', status=status.HTTP_409_CONFLICT)
+
+        job = jobs.submit(r, 'update_container', project_id=project_id, container=container_name, policy=sp)
+        r.set(container_migration.job_id_key(project_id, container_name), job['id'], ex=settings.JOBS_RESULT_TTL)
+        return JSONResponse(job, status=status.HTTP_202_ACCEPTED)
 
-        headers, obj_list = swift_client.get_container(url, token, container_name)
-        headers['X-Storage-Policy'] = sp
-
-        path_container = settings.SWIFT_CFG_TMP_DIR + "/" + container_name
-        os.mkdir(path_container)
-
-        for obj in obj_list:
-            file = open(path_container + "/" + obj["name"], "w")
-            obj_headers, obj_body = swift_client.get_object(url, token, container_name, obj["name"])
-            file.write(obj_body)
-            file.close()
-            obj["headers"] = obj_headers
-            swift_client.delete_object(url, token, container_name, obj["name"])
-
-        swift_client.delete_container(url, token, container_name)
-        swift_client.put_container(url, token, container_name, headers)
-
-        for obj in obj_list:
-            obj_path = os.path.join(path_container, obj["name"])
-            obj_body = open(obj_path, "r")
-            content_length = os.stat(obj_path).st_size
-            swift_response = {}
-            swift_client.put_object(url, token, container_name, obj["name"],
-                                    obj_body, content_length,
-                                    None, None, obj['content_type'],
-                                    obj["headers"], None, None, None, swift_response)
-            obj_body.close()
-            os.remove(obj_path)
-
-        os.rmdir(path_container)
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
-        return JSONResponse("Container Policy updated correctly", status=status.HTTP_201_CREATED)
 
-    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
\ No newline at end of file
+@jobs.job_handler('update_container')
+def update_container_job(job, project_id, container, policy):
+    """
+    Runs a migration submitted by update_container. The job authenticates
+    as the Crystal manager of the project: the token of the request is not
+    stored with the job. The migration authenticates again when its token
+    expires. The lock of the container is taken by start() and released by
+    run(), or by start() itself if it fails, so a job that fails before the
+    migration runs leaves no lock and no running state behind.
+
+    :return: The progress of the migration.
+    """
+    project_name = get_project_list()[project_id]
+    _, token = get_swift_url_and_token(project_name)
+    url = settings.SWIFT_URL + "/AUTH_" + project_id
+    migration = container_migration.ContainerMigration(job.r, url, token, project_id, container, policy,
+                                                       lambda: get_swift_url_and_token(project_name)[1])
+    migration.start()
+    migration_status = migration.run(job)
+    progress = container_migration.get_progress(job.r, project_id, container)
+    if job.cancelled():
+        raise jobs.JobCancelled('The job was cancelled')
+    if migration_status == container_migration.FAILED:
+        raise container_migration.MigrationFailed(progress['error'])
+    return progress
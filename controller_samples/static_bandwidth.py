@@ -8,6 +8,7 @@ class StaticBandwidthPerProject(AbstractController):
         super(StaticBandwidthPerProject, self).__init__()
         self.method = method
         self.metrics = [self.method+'_bandwidth']
+        self.metric_feed = {'group_by': ['project_id', 'storage_policy', 'host'], 'reducer': 'sum'}
         self.prev_assignations = dict()
 
     def _get_redis_slos(self, slo_name):
@@ -59,6 +60,7 @@ class StaticBandwidthPerProject(AbstractController):
 
                 assignations[project_id][storage_policy][host] = bw_per_host
 
+        messages = list()
         for project_id in assignations:
             for storage_policy in assignations[project_id]:
                 for host in assignations[project_id][storage_policy]:
@@ -74,6 +76,7 @@ class StaticBandwidthPerProject(AbstractController):
 
                     if updated:
                         assignation = os.path.join(project_id, self.method, storage_policy, bw_assignation)
-                        self._send_message_rmq(host, assignation)
+                        messages.append((host, assignation))
 
+        self._send_messages_rmq(messages)
         self.prev_assignations = assignations